@@ -63,6 +63,8 @@ WORKER_API_TIMEOUT = int(os.getenv("FASTCHAT_WORKER_API_TIMEOUT", 100))
 WORKER_API_EMBEDDING_BATCH_SIZE = int(
     os.getenv("FASTCHAT_WORKER_API_EMBEDDING_BATCH_SIZE", 4)
 )
+# Requests allowed to wait for a busy worker before new ones are rejected (0: unbounded)
+WORKER_MAX_QUEUE_SIZE = int(os.getenv("FASTCHAT_WORKER_MAX_QUEUE_SIZE", 128))
 
 
 class ErrorCode(IntEnum):
@@ -76,21 +76,22 @@ class Conversation:
     def get_prompt(self) -> str:
         """Get the prompt for generation."""
         system_prompt = self.system_template.format(system_message=self.system_message)
-        if self.sep_style == SeparatorStyle.ADD_COLON_SINGLE:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
+        if self.sep_style == SeparatorStyle.YUAN2:
+            seps = [self.sep, self.sep2]
+            ret = ""
+            if self.system_message:
+                ret += system_prompt + seps[1]
+            for _, message in self.messages:
                 if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + ": " + message + self.sep
+                    ret += message + "<n>"
                 else:
-                    ret += role + ":"
+                    ret += ""
+            ret = ret.rstrip("<n>") + seps[0]
             return ret
-        elif self.sep_style == SeparatorStyle.ADD_COLON_TWO:
+        elif self.sep_style == SeparatorStyle.CLLM:
             seps = [self.sep, self.sep2]
             ret = system_prompt + seps[0]
-            for i, (role, message) in enumerate(self.messages):
+            for i, (role, message) in enumerate(self.messages[-2:]):
                 if message:
                     if type(message) is tuple:
                         message, images = message
@@ -99,234 +100,263 @@ class Conversation:
                 else:
                     ret += role + ":"
             return ret
+        return "".join(self.get_prompt_segments())
+
+    def get_prompt_segments(self) -> List[str]:
+        """
+        Get the prompt as a list of segments: the system prompt followed by one
+        segment per message. The segments are cached, so only the messages
+        added or changed since the last call are rendered again.
+        """
+        if self.sep_style in (SeparatorStyle.YUAN2, SeparatorStyle.CLLM):
+            # The prompt of these styles is not a concatenation of segments.
+            return [self.get_prompt()]
+
+        # The template fields every segment depends on
+        template_key = (
+            self.name,
+            self.system_template,
+            self.system_message,
+            tuple(self.roles),
+            self.sep_style,
+            self.sep,
+            self.sep2,
+        )
+        cache = self.__dict__.get("_prompt_cache")
+        if cache is None or cache["template_key"] != template_key:
+            system_prompt = self.system_template.format(
+                system_message=self.system_message
+            )
+            cache = {
+                "template_key": template_key,
+                "prefix": self.get_prompt_prefix(system_prompt),
+                "keys": [],
+                "segments": [],
+            }
+            self._prompt_cache = cache
+
+        keys, segments = cache["keys"], cache["segments"]
+        del keys[len(self.messages) :], segments[len(self.messages) :]
+        for i, (role, message) in enumerate(self.messages):
+            # A segment only depends on the role, the text and the number of images
+            if type(message) is tuple:
+                key = (role, message[0], len(message[1]))
+            else:
+                key = (role, message)
+            if i < len(keys) and keys[i] == key:
+                continue
+            # Render before touching the cache, so that an error leaves the
+            # keys and the segments in sync
+            segment = self.get_message_segment(i, role, message)
+            if i < len(keys):
+                keys[i], segments[i] = key, segment
+            else:
+                keys.append(key)
+                segments.append(segment)
+        return [cache["prefix"]] + segments
+
+    def get_prompt_prefix(self, system_prompt: str) -> str:
+        """Get the part of the prompt before the first message."""
+        if self.sep_style in (
+            SeparatorStyle.ADD_COLON_SINGLE,
+            SeparatorStyle.ADD_COLON_TWO,
+            SeparatorStyle.ADD_COLON_SPACE_SINGLE,
+            SeparatorStyle.ROBIN,
+        ):
+            return system_prompt + self.sep
+        elif self.sep_style in (
+            SeparatorStyle.ADD_NEW_LINE_SINGLE,
+            SeparatorStyle.METAMATH,
+        ):
+            return "" if system_prompt == "" else system_prompt + self.sep
+        elif self.sep_style in (
+            SeparatorStyle.NO_COLON_SINGLE,
+            SeparatorStyle.NO_COLON_TWO,
+            SeparatorStyle.RWKV,
+            SeparatorStyle.CHATINTERN,
+            SeparatorStyle.DOLLY,
+            SeparatorStyle.PHOENIX,
+            SeparatorStyle.DEEPSEEK_CHAT,
+        ):
+            return system_prompt
+        elif self.sep_style == SeparatorStyle.LLAMA2:
+            return system_prompt if self.system_message else "[INST] "
+        elif self.sep_style == SeparatorStyle.LLAMA3:
+            return "<|begin_of_text|>" + (system_prompt if self.system_message else "")
+        elif self.sep_style == SeparatorStyle.CHATGLM:
+            return system_prompt + self.sep if system_prompt else ""
+        elif self.sep_style == SeparatorStyle.CHATML:
+            return "" if system_prompt == "" else system_prompt + self.sep + "\n"
+        elif self.sep_style == SeparatorStyle.CHATGLM3:
+            return system_prompt if self.system_message else ""
+        elif self.sep_style == SeparatorStyle.FALCON_CHAT:
+            return system_prompt + self.sep if self.system_message else ""
+        elif self.sep_style == SeparatorStyle.GEMMA:
+            return "<bos>"
+        elif self.sep_style == SeparatorStyle.DEFAULT:
+            return system_prompt + "\n"
+        else:
+            raise ValueError(f"Invalid style: {self.sep_style}")
+
+    def get_message_segment(self, i: int, role: str, message) -> str:
+        """Get the part of the prompt of the i-th message."""
+        if self.sep_style == SeparatorStyle.ADD_COLON_SINGLE:
+            if message:
+                if type(message) is tuple:
+                    message, images = message
+                    message = IMAGE_PLACEHOLDER_STR * len(images) + message
+                return role + ": " + message + self.sep
+            return role + ":"
+        elif self.sep_style == SeparatorStyle.ADD_COLON_TWO:
+            if message:
+                if type(message) is tuple:
+                    message, images = message
+                    message = IMAGE_PLACEHOLDER_STR * len(images) + message
+                return role + ": " + message + [self.sep, self.sep2][i % 2]
+            return role + ":"
         elif self.sep_style == SeparatorStyle.ADD_COLON_SPACE_SINGLE:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ": "  # must be end with a space
-            return ret
+            if message:
+                return role + ": " + message + self.sep
+            return role + ": "  # must be end with a space
         elif self.sep_style == SeparatorStyle.ADD_NEW_LINE_SINGLE:
-            ret = "" if system_prompt == "" else system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + "\n" + message + self.sep
-                else:
-                    ret += role + "\n"
-            return ret
+            if message:
+                return role + "\n" + message + self.sep
+            return role + "\n"
         elif self.sep_style == SeparatorStyle.NO_COLON_SINGLE:
-            ret = system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + message + self.sep
-                else:
-                    ret += role
-            return ret
+            if message:
+                return role + message + self.sep
+            return role
         elif self.sep_style == SeparatorStyle.NO_COLON_TWO:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + message + seps[i % 2]
-                else:
-                    ret += role
-            return ret
+            if message:
+                return role + message + [self.sep, self.sep2][i % 2]
+            return role
         elif self.sep_style == SeparatorStyle.RWKV:
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += (
-                        role
-                        + ": "
-                        + message.replace("\r\n", "\n").replace("\n\n", "\n")
-                    )
-                    ret += "\n\n"
-                else:
-                    ret += role + ":"
-            return ret
+            if message:
+                return (
+                    role
+                    + ": "
+                    + message.replace("\r\n", "\n").replace("\n\n", "\n")
+                    + "\n\n"
+                )
+            return role + ":"
         elif self.sep_style == SeparatorStyle.LLAMA2:
-            seps = [self.sep, self.sep2]
-            if self.system_message:
-                ret = system_prompt
-            else:
-                ret = "[INST] "
-            for i, (role, message) in enumerate(self.messages):
-                tag = self.roles[i % 2]
-                if message:
-                    if i == 0:
-                        ret += message + " "
-                    else:
-                        ret += tag + " " + message + seps[i % 2]
-                else:
-                    ret += tag
-            return ret
+            tag = self.roles[i % 2]
+            if message:
+                if i == 0:
+                    return message + " "
+                return tag + " " + message + [self.sep, self.sep2][i % 2]
+            return tag
         elif self.sep_style == SeparatorStyle.LLAMA3:
-            ret = "<|begin_of_text|>"
-            if self.system_message:
-                ret += system_prompt
-            else:
-                ret += ""
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += f"<|start_header_id|>{role}<|end_header_id|>\n\n"
-                    ret += f"{message.strip()}<|eot_id|>"
-                else:
-                    ret += f"<|start_header_id|>{role}<|end_header_id|>\n\n"
+            ret = f"<|start_header_id|>{role}<|end_header_id|>\n\n"
+            if message:
+                ret += f"{message.strip()}<|eot_id|>"
             return ret
         elif self.sep_style == SeparatorStyle.CHATGLM:
             # source: https://huggingface.co/THUDM/chatglm-6b/blob/1d240ba371910e9282298d4592532d7f0f3e9f3e/modeling_chatglm.py#L1302-L1308
             # source2: https://huggingface.co/THUDM/chatglm2-6b/blob/e186c891cf64310ac66ef10a87e6635fa6c2a579/modeling_chatglm.py#L926
             round_add_n = 1 if self.name == "chatglm2" else 0
-            if system_prompt:
-                ret = system_prompt + self.sep
-            else:
-                ret = ""
-
-            for i, (role, message) in enumerate(self.messages):
-                if i % 2 == 0:
-                    ret += f"[Round {i//2 + round_add_n}]{self.sep}"
-
-                if message:
-                    ret += f"{role}：{message}{self.sep}"
-                else:
-                    ret += f"{role}："
-            return ret
+            ret = ""
+            if i % 2 == 0:
+                ret += f"[Round {i//2 + round_add_n}]{self.sep}"
+            if message:
+                return ret + f"{role}：{message}{self.sep}"
+            return ret + f"{role}："
         elif self.sep_style == SeparatorStyle.CHATML:
-            ret = "" if system_prompt == "" else system_prompt + self.sep + "\n"
-            for role, message in self.messages:
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + "\n" + message + self.sep + "\n"
-                else:
-                    ret += role + "\n"
-            return ret
+            if message:
+                if type(message) is tuple:
+                    message, images = message
+                    message = IMAGE_PLACEHOLDER_STR * len(images) + message
+                return role + "\n" + message + self.sep + "\n"
+            return role + "\n"
         elif self.sep_style == SeparatorStyle.CHATGLM3:
-            ret = ""
-            if self.system_message:
-                ret += system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + "\n" + message
-                else:
-                    ret += role
-            return ret
+            if message:
+                return role + "\n" + message
+            return role
         elif self.sep_style == SeparatorStyle.CHATINTERN:
             # source: https://huggingface.co/internlm/internlm-chat-7b-8k/blob/bd546fa984b4b0b86958f56bf37f94aa75ab8831/modeling_internlm.py#L771
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if i % 2 == 0:
-                    ret += "<s>"
-                if message:
-                    ret += role + ":" + message + seps[i % 2] + "\n"
-                else:
-                    ret += role + ":"
-            return ret
+            ret = "<s>" if i % 2 == 0 else ""
+            if message:
+                return ret + role + ":" + message + [self.sep, self.sep2][i % 2] + "\n"
+            return ret + role + ":"
         elif self.sep_style == SeparatorStyle.DOLLY:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + ":\n" + message + seps[i % 2]
-                    if i % 2 == 1:
-                        ret += "\n\n"
-                else:
-                    ret += role + ":\n"
-            return ret
+            if message:
+                ret = role + ":\n" + message + [self.sep, self.sep2][i % 2]
+                if i % 2 == 1:
+                    ret += "\n\n"
+                return ret
+            return role + ":\n"
         elif self.sep_style == SeparatorStyle.PHOENIX:
-            ret = system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + "<s>" + message + "</s>"
-                else:
-                    ret += role + ": " + "<s>"
-            return ret
+            if message:
+                return role + ": " + "<s>" + message + "</s>"
+            return role + ": " + "<s>"
         elif self.sep_style == SeparatorStyle.ROBIN:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ":\n" + message + self.sep
-                else:
-                    ret += role + ":\n"
-            return ret
+            if message:
+                return role + ":\n" + message + self.sep
+            return role + ":\n"
         elif self.sep_style == SeparatorStyle.FALCON_CHAT:
-            ret = ""
-            if self.system_message:
-                ret += system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ":"
-            return ret
+            if message:
+                return role + ": " + message + self.sep
+            return role + ":"
         elif self.sep_style == SeparatorStyle.METAMATH:
-            ret = "" if system_prompt == "" else system_prompt + self.sep
-            for i, (role, message) in enumerate(self.messages):
-                # For MetaMath, sep2 is used to prefix the message.
-                starting_sep = ":\n" if i % 2 == 0 else ": " + self.sep2
-                ending_sep = self.sep if i % 2 == 0 else ""
-                if message:
-                    ret += role + starting_sep + message + ending_sep
-                else:
-                    ret += role + starting_sep
-            return ret
+            # For MetaMath, sep2 is used to prefix the message.
+            starting_sep = ":\n" if i % 2 == 0 else ": " + self.sep2
+            ending_sep = self.sep if i % 2 == 0 else ""
+            if message:
+                return role + starting_sep + message + ending_sep
+            return role + starting_sep
         elif self.sep_style == SeparatorStyle.DEEPSEEK_CHAT:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.YUAN2:
-            seps = [self.sep, self.sep2]
-            ret = ""
-            if self.system_message:
-                ret += system_prompt + seps[1]
-            for _, message in self.messages:
-                if message:
-                    ret += message + "<n>"
-                else:
-                    ret += ""
-            ret = ret.rstrip("<n>") + seps[0]
-            return ret
+            if message:
+                return role + ": " + message + [self.sep, self.sep2][i % 2]
+            return role + ":"
         elif self.sep_style == SeparatorStyle.GEMMA:
-            ret = "<bos>"
-            for role, message in self.messages:
-                if message:
-                    ret += "<start_of_turn>" + role + "\n" + message + self.sep
-                else:
-                    ret += "<start_of_turn>" + role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CLLM:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt + seps[0]
-            for i, (role, message) in enumerate(self.messages[-2:]):
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
+            if message:
+                return "<start_of_turn>" + role + "\n" + message + self.sep
+            return "<start_of_turn>" + role + "\n"
         elif self.sep_style == SeparatorStyle.DEFAULT:
-            ret = system_prompt + "\n"
-            for role, message in self.messages:
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                    ret += role + ": " + message + "\n"
-                else:
-                    ret += role + ":"
-            return ret
+            if message:
+                if type(message) is tuple:
+                    message, images = message
+                return role + ": " + message + "\n"
+            return role + ":"
         else:
             raise ValueError(f"Invalid style: {self.sep_style}")
 
+    def get_prompt_token_ids(self, tokenizer) -> List[int]:
+        """
+        Get the token ids of the prompt for a Hugging Face tokenizer. The ids
+        of every segment are cached, so only the messages added or changed
+        since the last call are tokenized.
+
+        The segments are tokenized separately, so the ids can differ from
+        tokenizing the whole prompt where a token would span two segments,
+        e.g. when a separator is not a special token.
+        """
+        segments = self.get_prompt_segments()
+        tokenizer_key = (id(tokenizer), getattr(tokenizer, "name_or_path", None))
+        cache = self.__dict__.get("_token_cache")
+        if cache is None or cache["tokenizer_key"] != tokenizer_key:
+            cache = {"tokenizer_key": tokenizer_key, "token_ids": {}}
+            self._token_cache = cache
+
+        # Keep only the segments of the current prompt
+        token_ids = {}
+        input_ids = []
+        for segment in segments:
+            ids = cache["token_ids"].get(segment)
+            if ids is None:
+                ids = tokenizer.encode(segment, add_special_tokens=False)
+            token_ids[segment] = ids
+            input_ids.extend(ids)
+        cache["token_ids"] = token_ids
+
+        if hasattr(tokenizer, "build_inputs_with_special_tokens"):
+            input_ids = tokenizer.build_inputs_with_special_tokens(input_ids)
+        return input_ids
+
+    def count_prompt_tokens(self, tokenizer) -> int:
+        """Get the number of tokens of the prompt, see get_prompt_token_ids."""
+        return len(self.get_prompt_token_ids(tokenizer))
+
     def get_images(self):
         images = []
         for i, (role, msg) in enumerate(self.messages[self.offset :]):
@@ -437,6 +467,36 @@ class Conversation:
                     ret.append({"role": "assistant", "content": msg})
         return ret
 
+    def append_openai_api_messages(self, messages: List[Dict[str, Any]]):
+        """Append messages in OpenAI chat completion format to the conversation."""
+        for message in messages:
+            msg_role = message["role"]
+            if msg_role == "system":
+                self.set_system_message(message["content"])
+            elif msg_role == "user":
+                if type(message["content"]) == list:
+                    image_list = [
+                        item["image_url"]["url"]
+                        for item in message["content"]
+                        if item["type"] == "image_url"
+                    ]
+                    text_list = [
+                        item["text"]
+                        for item in message["content"]
+                        if item["type"] == "text"
+                    ]
+
+                    # TODO(chris): This only applies to LLaVA model. Implement an image_token string in the conv template.
+                    text = "<image>\n" * len(image_list)
+                    text += "\n".join(text_list)
+                    self.append_message(self.roles[0], (text, image_list))
+                else:
+                    self.append_message(self.roles[0], message["content"])
+            elif msg_role == "assistant":
+                self.append_message(self.roles[1], message["content"])
+            else:
+                raise ValueError(f"Unknown role: {msg_role}")
+
     def to_gemini_api_messages(self):
         from fastchat.utils import load_image
 
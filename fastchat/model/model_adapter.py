@@ -1,10 +1,17 @@
-"""Model adapter registration."""
+"""
+Model adapter registration.
+
+torch, transformers and the model backends are imported inside the functions
+that load or run a model, so that template lookup and adapter matching
+(get_conversation_template, get_model_adapter) work in the controller, API
+server and web server processes without them.
+"""
 
 import math
 import os
 import re
 import sys
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 import warnings
 
 if sys.version_info >= (3, 9):
@@ -12,40 +19,18 @@ if sys.version_info >= (3, 9):
 else:
     from functools import lru_cache as cache
 
-import psutil
-import torch
-from transformers import (
-    AutoConfig,
-    AutoModel,
-    AutoModelForCausalLM,
-    AutoModelForSeq2SeqLM,
-    AutoTokenizer,
-    LlamaTokenizer,
-    LlamaForCausalLM,
-    T5Tokenizer,
-)
-
 from fastchat.constants import CPU_ISA
 from fastchat.conversation import Conversation, get_conv_template
-from fastchat.model.compression import load_compress_model
-from fastchat.model.llama_condense_monkey_patch import replace_llama_with_condense
-from fastchat.model.model_chatglm import generate_stream_chatglm
-from fastchat.model.model_codet5p import generate_stream_codet5p
-from fastchat.model.model_falcon import generate_stream_falcon
-from fastchat.model.model_yuan2 import generate_stream_yuan2
-from fastchat.model.model_exllama import generate_stream_exllama
-from fastchat.model.model_xfastertransformer import generate_stream_xft
-from fastchat.model.model_cllm import generate_stream_cllm
-
-from fastchat.model.monkey_patch_non_inplace import (
-    replace_llama_attn_with_non_inplace_operations,
-)
-from fastchat.modules.awq import AWQConfig, load_awq_quantized
 from fastchat.modules.exllama import ExllamaConfig, load_exllama_model
 from fastchat.modules.xfastertransformer import load_xft_model, XftConfig
-from fastchat.modules.gptq import GptqConfig, load_gptq_quantized
 from fastchat.utils import get_gpu_memory
 
+if TYPE_CHECKING:
+    import torch
+
+    from fastchat.modules.awq import AWQConfig
+    from fastchat.modules.gptq import GptqConfig
+
 # Check an environment variable to check if we should be sharing Peft model
 # weights.  When false we treat all Peft models as separate.
 peft_share_base_weights = (
@@ -103,6 +88,8 @@ class BaseModelAdapter:
         return True
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         try:
             tokenizer = AutoTokenizer.from_pretrained(
@@ -132,6 +119,8 @@ class BaseModelAdapter:
         return model, tokenizer
 
     def load_compress_model(self, model_path, device, torch_dtype, revision="main"):
+        from fastchat.model.compression import load_compress_model
+
         return load_compress_model(
             model_path,
             device,
@@ -203,17 +192,24 @@ def load_model(
     device: str = "cuda",
     num_gpus: int = 1,
     max_gpu_memory: Optional[str] = None,
-    dtype: Optional[torch.dtype] = None,
+    dtype: Optional["torch.dtype"] = None,
     load_8bit: bool = False,
     cpu_offloading: bool = False,
-    gptq_config: Optional[GptqConfig] = None,
-    awq_config: Optional[AWQConfig] = None,
+    gptq_config: Optional["GptqConfig"] = None,
+    awq_config: Optional["AWQConfig"] = None,
     exllama_config: Optional[ExllamaConfig] = None,
     xft_config: Optional[XftConfig] = None,
     revision: str = "main",
     debug: bool = False,
 ):
     """Load a model from Hugging Face."""
+    import psutil
+    import torch
+    from fastchat.model.monkey_patch_non_inplace import (
+        replace_llama_attn_with_non_inplace_operations,
+    )
+    from fastchat.modules.awq import load_awq_quantized
+    from fastchat.modules.gptq import load_gptq_quantized
     import accelerate
 
     # get model adapter
@@ -401,8 +397,16 @@ def get_conversation_template(model_path: str) -> Conversation:
     return adapter.get_default_conv_template(model_path)
 
 
-def get_generate_stream_function(model: torch.nn.Module, model_path: str):
+def get_generate_stream_function(model: "torch.nn.Module", model_path: str):
     """Get the generate_stream function for inference."""
+    import torch
+    from fastchat.model.model_chatglm import generate_stream_chatglm
+    from fastchat.model.model_codet5p import generate_stream_codet5p
+    from fastchat.model.model_falcon import generate_stream_falcon
+    from fastchat.model.model_yuan2 import generate_stream_yuan2
+    from fastchat.model.model_exllama import generate_stream_exllama
+    from fastchat.model.model_xfastertransformer import generate_stream_xft
+    from fastchat.model.model_cllm import generate_stream_cllm
     from fastchat.serve.inference import generate_stream
 
     model_type = str(type(model)).lower()
@@ -708,6 +712,8 @@ class VicunaAdapter(BaseModelAdapter):
         return "vicuna" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -726,6 +732,8 @@ class VicunaAdapter(BaseModelAdapter):
         return get_conv_template("vicuna_v1.1")
 
     def raise_warning_for_old_weights(self, model):
+        from transformers import LlamaForCausalLM
+
         if isinstance(model, LlamaForCausalLM) and model.model.vocab_size > 32000:
             warnings.warn(
                 "\nYou are probably using the old Vicuna-v0 model, "
@@ -753,6 +761,8 @@ class AiroborosAdapter(BaseModelAdapter):
         return get_conv_template("airoboros_v1")
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         if "mpt" not in model_path.lower():
             return super().load_model(model_path, from_pretrained_kwargs)
         model = AutoModelForCausalLM.from_pretrained(
@@ -777,6 +787,11 @@ class LongChatAdapter(BaseModelAdapter):
         return "longchat" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+        from fastchat.model.llama_condense_monkey_patch import (
+            replace_llama_with_condense,
+        )
+
         revision = from_pretrained_kwargs.get("revision", "main")
 
         # Apply monkey patch, TODO(Dacheng): Add flash attention support
@@ -807,6 +822,8 @@ class GoogleT5Adapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForSeq2SeqLM, T5Tokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = T5Tokenizer.from_pretrained(model_path, revision=revision)
         model = AutoModelForSeq2SeqLM.from_pretrained(
@@ -849,6 +866,8 @@ class ChatGLMAdapter(BaseModelAdapter):
         return "chatglm" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         if "chatglm3" in model_path.lower():
             tokenizer = AutoTokenizer.from_pretrained(
@@ -882,6 +901,8 @@ class CodeGeexAdapter(BaseModelAdapter):
         return "codegeex" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True, revision=revision
@@ -902,6 +923,8 @@ class DollyV2Adapter(BaseModelAdapter):
         return "dolly-v2" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
         model = AutoModelForCausalLM.from_pretrained(
@@ -1006,6 +1029,8 @@ class MPTAdapter(BaseModelAdapter):
         return "mpt" in model_path and not "airoboros" in model_path
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1056,6 +1081,7 @@ class RwkvAdapter(BaseModelAdapter):
         return "rwkv-4" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoTokenizer
         from fastchat.model.rwkv_model import RwkvModel
 
         model = RwkvModel(model_path)
@@ -1098,6 +1124,8 @@ class ReaLMAdapter(BaseModelAdapter):
         return "ReaLM" in model_path
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
         model = AutoModelForCausalLM.from_pretrained(
             model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
@@ -1247,6 +1275,8 @@ class RedPajamaINCITEAdapter(BaseModelAdapter):
         return "redpajama-incite" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
         model = AutoModelForCausalLM.from_pretrained(
@@ -1336,6 +1366,8 @@ class GuanacoAdapter(BaseModelAdapter):
         return "guanaco" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -1393,6 +1425,8 @@ class FalconAdapter(BaseModelAdapter):
         return "falcon" in model_path.lower() and "chat" not in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         # Strongly suggest using bf16, which is recommended by the author of Falcon
         tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
@@ -1426,6 +1460,8 @@ class TigerBotAdapter(BaseModelAdapter):
         return "tigerbot" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1451,6 +1487,8 @@ class BaichuanAdapter(BaseModelAdapter):
         return "baichuan" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True, revision=revision
@@ -1479,6 +1517,8 @@ class XGenAdapter(BaseModelAdapter):
         return "xgen" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1515,6 +1555,8 @@ class InternLMChatAdapter(BaseModelAdapter):
         return "internlm" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1636,6 +1678,8 @@ class CuteGPTAdapter(BaseModelAdapter):
         return "cutegpt" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, LlamaTokenizer
+
         tokenizer = LlamaTokenizer.from_pretrained(model_path)
         model = AutoModelForCausalLM.from_pretrained(
             model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
@@ -1668,6 +1712,8 @@ class OpenOrcaAdapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -1707,6 +1753,8 @@ class Hermes2Adapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -1788,6 +1836,7 @@ class QwenChatAdapter(BaseModelAdapter):
             print("Invalid option. Please choose one from 'bf16', 'fp16' and 'fp32'.")
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
         from transformers.generation import GenerationConfig
 
         revision = from_pretrained_kwargs.get("revision", "main")
@@ -1845,6 +1894,8 @@ class BGEAdapter(BaseModelAdapter):
         return "bge" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModel.from_pretrained(
             model_path,
@@ -1876,6 +1927,8 @@ class E5Adapter(BaseModelAdapter):
         return "e5-" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModel.from_pretrained(
             model_path,
@@ -1909,6 +1962,8 @@ class AquilaChatAdapter(BaseModelAdapter):
         return "aquila" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1943,6 +1998,8 @@ class Lamma2ChineseAdapter(BaseModelAdapter):
         return "llama2-chinese" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1968,6 +2025,8 @@ class Lamma2ChineseAlpacaAdapter(BaseModelAdapter):
         return "chinese-alpaca" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1995,6 +2054,8 @@ class VigogneAdapter(BaseModelAdapter):
         return bool(re.search(r"vigogne|vigostral", model_path, re.I))
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -2029,6 +2090,8 @@ class OpenLLaMaOpenInstructAdapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -2254,6 +2317,8 @@ class Yuan2Adapter(BaseModelAdapter):
         return "yuan2" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, LlamaTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         # from_pretrained_kwargs["torch_dtype"] = torch.bfloat16
         tokenizer = LlamaTokenizer.from_pretrained(
@@ -2427,6 +2492,9 @@ class CllmAdapter(BaseModelAdapter):
         return "consistency-llm" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        import torch
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
         config = AutoConfig.from_pretrained(
             model_path,
         )
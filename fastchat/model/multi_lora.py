@@ -0,0 +1,250 @@
+"""
+Serve many LoRA adapters on one shared base model.
+
+The target linear layers of the base model are wrapped once with
+MultiLoraLinear, which holds a fixed number of adapter slots. Adapters are
+loaded into free slots on demand and the least recently used idle ones are
+evicted. Every row of a batch picks its own slot, so requests for different
+adapters (or for the base model) run in the same forward pass:
+
+    y = base(x) + (x @ A[slot].T) @ B[slot].T
+
+Only plain LoRA adapters saved by peft are supported (no DoRA, no adapted
+embeddings or modules_to_save).
+"""
+from collections import OrderedDict
+import json
+import os
+import re
+
+import torch
+from torch import nn
+
+
+def load_lora_config(lora_path):
+    with open(os.path.join(lora_path, "adapter_config.json")) as fin:
+        config = json.load(fin)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Not a LoRA adapter: {lora_path}")
+    if config.get("use_dora"):
+        raise ValueError(f"DoRA adapters are not supported: {lora_path}")
+    return config
+
+
+def get_lora_weights_file(lora_path):
+    for name in ["adapter_model.safetensors", "adapter_model.bin"]:
+        filename = os.path.join(lora_path, name)
+        if os.path.exists(filename):
+            return filename
+    raise FileNotFoundError(f"No adapter_model.safetensors or .bin in {lora_path}")
+
+
+def load_lora_state_dict(lora_path):
+    filename = get_lora_weights_file(lora_path)
+    if filename.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(filename)
+    return torch.load(filename, map_location="cpu")
+
+
+def is_target_module(name, target_modules):
+    # same matching rules as peft
+    if isinstance(target_modules, str):
+        return re.fullmatch(target_modules, name) is not None
+    return any(name == t or name.endswith("." + t) for t in target_modules)
+
+
+class LoraBatchContext:
+    """Adapter slot of every row of the current batch, shared by all layers."""
+
+    def __init__(self):
+        self.slot_ids = None
+        # set when all rows use the same slot, to skip the per-row gather
+        self.uniform_slot = None
+
+    def set_slots(self, slots, device):
+        if len(set(slots)) == 1:
+            self.uniform_slot = slots[0]
+            self.slot_ids = None
+        else:
+            self.uniform_slot = None
+            self.slot_ids = torch.as_tensor(slots, device=device)
+
+
+class MultiLoraLinear(nn.Module):
+    """A linear layer plus num_slots LoRA adapters of rank up to max_rank."""
+
+    def __init__(self, base_layer, context, num_slots, max_rank):
+        super().__init__()
+        self.base_layer = base_layer
+        self.context = context
+        weight = base_layer.weight
+        dtype = weight.dtype if weight.dtype.is_floating_point else torch.float16
+        # the extra last slot stays zero and serves rows without an adapter
+        self.lora_A = nn.Parameter(
+            torch.zeros(
+                num_slots + 1,
+                max_rank,
+                base_layer.in_features,
+                dtype=dtype,
+                device=weight.device,
+            ),
+            requires_grad=False,
+        )
+        # scaled by lora_alpha / r when loaded
+        self.lora_B = nn.Parameter(
+            torch.zeros(
+                num_slots + 1,
+                base_layer.out_features,
+                max_rank,
+                dtype=dtype,
+                device=weight.device,
+            ),
+            requires_grad=False,
+        )
+        self.no_adapter_slot = num_slots
+
+    def forward(self, x):
+        out = self.base_layer(x)
+        ctx = self.context
+        if ctx.uniform_slot is not None:
+            if ctx.uniform_slot == self.no_adapter_slot:
+                return out
+            lora_A = self.lora_A[ctx.uniform_slot]
+            lora_B = self.lora_B[ctx.uniform_slot]
+            h = (x.to(lora_A.dtype) @ lora_A.T) @ lora_B.T
+        else:
+            # (batch, rank, in) and (batch, out, rank)
+            lora_A = self.lora_A[ctx.slot_ids]
+            lora_B = self.lora_B[ctx.slot_ids]
+            h = torch.bmm(x.to(lora_A.dtype), lora_A.transpose(1, 2))
+            h = torch.bmm(h, lora_B.transpose(1, 2))
+        return out + h.to(out.dtype)
+
+    @torch.no_grad()
+    def set_slot(self, slot, lora_A=None, lora_B=None, scaling=1.0):
+        self.lora_A[slot].zero_()
+        self.lora_B[slot].zero_()
+        if lora_A is not None:
+            rank = lora_A.shape[0]
+            self.lora_A[slot, :rank].copy_(lora_A)
+            self.lora_B[slot, :, :rank].copy_(lora_B * scaling)
+
+
+def inject_multi_lora(model, target_modules, num_slots, max_rank):
+    """Wrap the target linear layers of model. Return the context and the wrapped layers."""
+    context = LoraBatchContext()
+    context.uniform_slot = num_slots
+    layers = {}
+    for name, module in list(model.named_modules()):
+        if name and is_target_module(name, target_modules):
+            if not hasattr(module, "in_features"):
+                raise ValueError(f"Only linear layers can be adapted: {name}")
+            parent_name, _, attr = name.rpartition(".")
+            parent = model.get_submodule(parent_name)
+            layer = MultiLoraLinear(module, context, num_slots, max_rank)
+            setattr(parent, attr, layer)
+            layers[name] = layer
+    if not layers:
+        raise ValueError(f"No layer matches the LoRA target modules {target_modules}")
+    return context, layers
+
+
+class LoraAdapterSlots:
+    """
+    Load adapters into a fixed number of device slots, evicting the least
+    recently used ones that no running request holds.
+    """
+
+    def __init__(self, model, lora_paths, num_slots):
+        """
+        lora_paths: adapter name -> local adapter directory
+        """
+        self.lora_paths = lora_paths
+        self.configs = {
+            name: load_lora_config(path) for name, path in lora_paths.items()
+        }
+        # fail at startup rather than on the first request of the adapter
+        for path in lora_paths.values():
+            get_lora_weights_file(path)
+        target_modules = set()
+        for config in self.configs.values():
+            modules = config["target_modules"]
+            if isinstance(modules, str):
+                raise ValueError("Regex target_modules are not supported")
+            target_modules.update(modules)
+        max_rank = max(config["r"] for config in self.configs.values())
+
+        self.num_slots = num_slots
+        self.no_adapter_slot = num_slots
+        self.context, self.layers = inject_multi_lora(
+            model, sorted(target_modules), num_slots, max_rank
+        )
+        self.device = next(iter(self.layers.values())).lora_A.device
+        # adapter name -> slot, least recently used first
+        self.slot_of = OrderedDict()
+        self.pins = [0] * num_slots
+        self.num_loads = 0
+
+    def acquire(self, name):
+        """
+        Return the slot of adapter name, loading it if needed, and pin it until
+        release. Return None if all slots are held by running requests.
+        """
+        if name is None:
+            return self.no_adapter_slot
+        if name in self.slot_of:
+            slot = self.slot_of[name]
+            self.slot_of.move_to_end(name)
+        else:
+            used = set(self.slot_of.values())
+            free = [i for i in range(self.num_slots) if i not in used]
+            if free:
+                slot = free[0]
+            else:
+                victim = next(
+                    (n for n, s in self.slot_of.items() if self.pins[s] == 0), None
+                )
+                if victim is None:
+                    return None
+                slot = self.slot_of.pop(victim)
+            self.load(name, slot)
+            self.slot_of[name] = slot
+        self.pins[slot] += 1
+        return slot
+
+    def release(self, slot):
+        if slot != self.no_adapter_slot:
+            self.pins[slot] -= 1
+
+    def load(self, name, slot):
+        config = self.configs[name]
+        scaling = config["lora_alpha"] / (
+            config["r"] ** 0.5 if config.get("use_rslora") else config["r"]
+        )
+        weights = {}
+        for key, value in load_lora_state_dict(self.lora_paths[name]).items():
+            # e.g. base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight
+            match = re.fullmatch(r"base_model\.model\.(.+)\.(lora_[AB])\.weight", key)
+            if match is None:
+                raise ValueError(f"Unsupported weight in adapter {name}: {key}")
+            layer_name, kind = match.groups()
+            if layer_name not in self.layers:
+                raise ValueError(f"Adapter {name} targets an unknown layer: {key}")
+            weights.setdefault(layer_name, {})[kind] = value.to(self.device)
+
+        for layer_name, layer in self.layers.items():
+            if layer_name in weights:
+                layer.set_slot(
+                    slot,
+                    weights[layer_name]["lora_A"],
+                    weights[layer_name]["lora_B"],
+                    scaling,
+                )
+            else:
+                layer.set_slot(slot)
+        self.num_loads += 1
+
+    def set_batch(self, slots):
+        self.context.set_slots(slots, self.device)
@@ -0,0 +1,85 @@
+"""
+Reusable HTTP clients of the API providers.
+
+Building a provider SDK client, or calling requests.post without a session,
+for every turn pays the client construction and a new TCP + TLS handshake
+each time. Clients are kept here keyed by (provider, api_base, api_key), so
+their keep-alive connections are reused across turns and threads. The httpx
+clients given to the SDKs speak HTTP/2 when the h2 package is installed.
+"""
+import importlib.util
+import inspect
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+# connections kept open per client
+POOL_MAXSIZE = 64
+KEEPALIVE_EXPIRY = 60
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(provider, api_base, api_key, create_client):
+    """Return the client of (provider, api_base, api_key), creating it on first use."""
+    key = (provider, api_base, api_key)
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            client = clients.get(key)
+            if client is None:
+                client = create_client()
+                clients[key] = client
+    return client
+
+
+def create_http_client(timeout=180):
+    return httpx.Client(
+        http2=HTTP2_AVAILABLE,
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=POOL_MAXSIZE,
+            max_keepalive_connections=POOL_MAXSIZE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def create_async_http_client(timeout=180):
+    """Only use it from the event loop that first used it."""
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=POOL_MAXSIZE,
+            max_keepalive_connections=POOL_MAXSIZE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(provider, api_base):
+    """A requests session for the plain HTTP providers."""
+    return get_client(provider, api_base, None, create_session)
+
+
+def close_clients():
+    with clients_lock:
+        for client in clients.values():
+            # async clients are dropped with their event loop
+            close = getattr(client, "close", None)
+            if close is not None and not inspect.iscoroutinefunction(close):
+                close()
+        clients.clear()
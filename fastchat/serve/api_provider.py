@@ -7,8 +7,12 @@ import re
 from typing import Optional
 import time
 
-import requests
-
+from fastchat.serve.api_client_pool import (
+    create_async_http_client,
+    create_http_client,
+    get_client,
+    get_session,
+)
 from fastchat.utils import build_logger
 
 
@@ -26,10 +30,7 @@ def get_api_provider_stream_iter(
     extra_body=None,
 ):
     if model_api_dict["api_type"] == "openai":
-        if model_api_dict.get("vision-arena", False):
-            prompt = conv.to_openai_vision_api_messages()
-        else:
-            prompt = conv.to_openai_api_messages()
+        prompt = get_chat_api_messages(conv, model_api_dict)
         stream_iter = openai_api_stream_iter(
             model_api_dict["model_name"],
             prompt,
@@ -40,7 +41,7 @@ def get_api_provider_stream_iter(
             api_key=model_api_dict["api_key"],
         )
     elif model_api_dict["api_type"] == "openai_no_stream":
-        prompt = conv.to_openai_api_messages()
+        prompt = get_chat_api_messages(conv, model_api_dict)
         stream_iter = openai_api_stream_iter(
             model_api_dict["model_name"],
             prompt,
@@ -52,7 +53,7 @@ def get_api_provider_stream_iter(
             stream=False,
         )
     elif model_api_dict["api_type"] == "openai_o1":
-        prompt = conv.to_openai_api_messages()
+        prompt = get_chat_api_messages(conv, model_api_dict)
         stream_iter = openai_api_stream_iter(
             model_api_dict["model_name"],
             prompt,
@@ -80,18 +81,12 @@ def get_api_provider_stream_iter(
             model_name, prompt, temperature, top_p, max_new_tokens
         )
     elif model_api_dict["api_type"] == "anthropic_message":
-        if model_api_dict.get("vision-arena", False):
-            prompt = conv.to_anthropic_vision_api_messages()
-        else:
-            prompt = conv.to_openai_api_messages()
+        prompt = get_chat_api_messages(conv, model_api_dict)
         stream_iter = anthropic_message_api_stream_iter(
             model_api_dict["model_name"], prompt, temperature, top_p, max_new_tokens
         )
     elif model_api_dict["api_type"] == "anthropic_message_vertex":
-        if model_api_dict.get("vision-arena", False):
-            prompt = conv.to_anthropic_vision_api_messages()
-        else:
-            prompt = conv.to_openai_api_messages()
+        prompt = get_chat_api_messages(conv, model_api_dict)
         stream_iter = anthropic_message_api_stream_iter(
             model_api_dict["model_name"],
             prompt,
@@ -146,7 +141,7 @@ def get_api_provider_stream_iter(
             api_key=model_api_dict.get("api_key"),
         )
     elif model_api_dict["api_type"] == "nvidia":
-        prompt = conv.to_openai_api_messages()
+        prompt = get_chat_api_messages(conv, model_api_dict)
         stream_iter = nvidia_api_stream_iter(
             model_name,
             prompt,
@@ -265,35 +260,22 @@ def get_api_provider_stream_iter(
     return stream_iter
 
 
-def openai_api_stream_iter(
-    model_name,
-    messages,
-    temperature,
-    top_p,
-    max_new_tokens,
-    api_base=None,
-    api_key=None,
-    stream=True,
-    is_o1=False,
-):
-    import openai
-
-    api_key = api_key or os.environ["OPENAI_API_KEY"]
+def get_chat_api_messages(conv, model_api_dict):
+    """
+    The messages of the OpenAI-compatible, Anthropic messages and NVIDIA
+    providers, shared with api_provider_async.
+    """
+    api_type = model_api_dict["api_type"]
+    if model_api_dict.get("vision-arena", False):
+        if api_type == "openai":
+            return conv.to_openai_vision_api_messages()
+        if api_type in ["anthropic_message", "anthropic_message_vertex"]:
+            return conv.to_anthropic_vision_api_messages()
+    return conv.to_openai_api_messages()
 
-    if "azure" in model_name:
-        client = openai.AzureOpenAI(
-            api_version="2023-07-01-preview",
-            azure_endpoint=api_base or "https://api.openai.com/v1",
-            api_key=api_key,
-        )
-    else:
-        client = openai.OpenAI(
-            base_url=api_base or "https://api.openai.com/v1",
-            api_key=api_key,
-            timeout=180,
-        )
 
-    # Make requests for logging
+def get_text_messages(messages):
+    """Messages without images, for logging."""
     text_messages = []
     for message in messages:
         if type(message["content"]) == str:  # text-only model
@@ -305,60 +287,115 @@ def openai_api_stream_iter(
             text_messages.append(
                 {"role": message["role"], "content": filtered_content_list}
             )
+    return text_messages
 
+
+def log_request(model_name, messages, temperature, top_p, max_new_tokens):
     gen_params = {
         "model": model_name,
-        "prompt": text_messages,
+        "prompt": get_text_messages(messages),
         "temperature": temperature,
         "top_p": top_p,
         "max_new_tokens": max_new_tokens,
     }
     logger.info(f"==== request ====\n{gen_params}")
 
-    if stream and not is_o1:
-        res = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_new_tokens,
-            stream=True,
+
+def get_simulated_stream(text):
+    """Growing prefixes of a complete reply, to simulate token streaming."""
+    pos = 0
+    while pos < len(text):
+        pos += 2
+        yield text[:pos]
+
+
+def get_openai_client(model_name, api_base=None, api_key=None, is_async=False):
+    """The pooled OpenAI (or Azure) client of the sync or async API."""
+    import openai
+
+    api_key = api_key or os.environ["OPENAI_API_KEY"]
+    api_base = api_base or "https://api.openai.com/v1"
+    create = create_async_http_client if is_async else create_http_client
+    suffix = "_async" if is_async else ""
+
+    if "azure" in model_name:
+        azure_class = openai.AsyncAzureOpenAI if is_async else openai.AzureOpenAI
+        return get_client(
+            "azure" + suffix,
+            api_base,
+            api_key,
+            lambda: azure_class(
+                api_version="2023-07-01-preview",
+                azure_endpoint=api_base,
+                api_key=api_key,
+                http_client=create(),
+            ),
         )
+    openai_class = openai.AsyncOpenAI if is_async else openai.OpenAI
+    return get_client(
+        "openai" + suffix,
+        api_base,
+        api_key,
+        lambda: openai_class(
+            base_url=api_base,
+            api_key=api_key,
+            timeout=180,
+            http_client=create(),
+        ),
+    )
+
+
+def get_openai_request(
+    model_name, messages, temperature, max_new_tokens, stream=True, is_o1=False
+):
+    """The arguments of chat.completions.create."""
+    if is_o1:
+        return dict(model=model_name, messages=messages, temperature=1.0, stream=False)
+    return dict(
+        model=model_name,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        stream=stream,
+    )
+
+
+def get_openai_chunk_text(chunk):
+    """The text of a streamed chat completion chunk, None if it has no choice."""
+    if len(chunk.choices) > 0:
+        return chunk.choices[0].delta.content or ""
+    return None
+
+
+def openai_api_stream_iter(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stream=True,
+    is_o1=False,
+):
+    client = get_openai_client(model_name, api_base, api_key)
+    log_request(model_name, messages, temperature, top_p, max_new_tokens)
+
+    request = get_openai_request(
+        model_name, messages, temperature, max_new_tokens, stream, is_o1
+    )
+    res = client.chat.completions.create(**request)
+    if request["stream"]:
         text = ""
         for chunk in res:
-            if len(chunk.choices) > 0:
-                text += chunk.choices[0].delta.content or ""
-                data = {
-                    "text": text,
-                    "error_code": 0,
-                }
-                yield data
+            delta = get_openai_chunk_text(chunk)
+            if delta is not None:
+                text += delta
+                yield {"text": text, "error_code": 0}
     else:
-        if is_o1:
-            res = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=1.0,
-                stream=False,
-            )
-        else:
-            res = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_new_tokens,
-                stream=False,
-            )
-        text = res.choices[0].message.content
-        pos = 0
-        while pos < len(text):
-            # simulate token streaming
-            pos += 2
+        for text in get_simulated_stream(res.choices[0].message.content):
             time.sleep(0.001)
-            data = {
-                "text": text[:pos],
-                "error_code": 0,
-            }
-            yield data
+            yield {"text": text, "error_code": 0}
 
 
 def column_api_stream_iter(
@@ -395,7 +432,7 @@ def column_api_stream_iter(
         # try 3 times
         for i in range(3):
             try:
-                response = requests.post(
+                response = get_session("column", api_base).post(
                     api_base, json=gen_params, stream=True, timeout=30
                 )
                 break
@@ -437,24 +474,21 @@ def p2l_api_stream_iter(
 ):
     import openai
 
-    client = openai.OpenAI(
-        base_url=api_base,
-        api_key=api_key or "-",
-        timeout=180,
+    api_key = api_key or "-"
+    client = get_client(
+        "p2l",
+        api_base,
+        api_key,
+        lambda: openai.OpenAI(
+            base_url=api_base,
+            api_key=api_key,
+            timeout=180,
+            http_client=create_http_client(),
+        ),
     )
 
     # Make requests for logging
-    text_messages = []
-    for message in messages:
-        if type(message["content"]) == str:  # text-only model
-            text_messages.append(message)
-        else:  # vision model
-            filtered_content_list = [
-                content for content in message["content"] if content["type"] == "text"
-            ]
-            text_messages.append(
-                {"role": message["role"], "content": filtered_content_list}
-            )
+    text_messages = get_text_messages(messages)
 
     gen_params = {
         "model": model_name,
@@ -518,7 +552,15 @@ def openai_assistant_api_stream_iter(
     import base64
 
     api_key = api_key or os.environ["OPENAI_API_KEY"]
-    client = openai.OpenAI(base_url="https://api.openai.com/v1", api_key=api_key)
+    api_base = "https://api.openai.com/v1"
+    client = get_client(
+        "openai_assistant",
+        api_base,
+        api_key,
+        lambda: openai.OpenAI(
+            base_url=api_base, api_key=api_key, http_client=create_http_client()
+        ),
+    )
 
     if state.oai_thread_id is None:
         logger.info("==== create thread ====")
@@ -541,8 +583,8 @@ def openai_assistant_api_stream_iter(
     }
     logger.info(f"==== request ====\n{gen_params}")
 
-    res = requests.post(
-        f"https://api.openai.com/v1/threads/{state.oai_thread_id}/runs",
+    res = get_session("openai_assistant", api_base).post(
+        f"{api_base}/threads/{state.oai_thread_id}/runs",
         headers={
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
@@ -651,7 +693,13 @@ def openai_assistant_api_stream_iter(
 def anthropic_api_stream_iter(model_name, prompt, temperature, top_p, max_new_tokens):
     import anthropic
 
-    c = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
+    api_key = os.environ["ANTHROPIC_API_KEY"]
+    c = get_client(
+        "anthropic",
+        None,
+        api_key,
+        lambda: anthropic.Anthropic(api_key=api_key, http_client=create_http_client()),
+    )
 
     # Make requests
     gen_params = {
@@ -682,6 +730,58 @@ def anthropic_api_stream_iter(model_name, prompt, temperature, top_p, max_new_to
         yield data
 
 
+def get_anthropic_message_client(vertex_ai=False, is_async=False):
+    """The pooled Anthropic messages client (or Vertex AI one) of the sync or async API."""
+    import anthropic
+
+    create = create_async_http_client if is_async else create_http_client
+    suffix = "_async" if is_async else ""
+    if vertex_ai:
+        region = os.environ["GCP_LOCATION"]
+        project_id = os.environ["GCP_PROJECT_ID"]
+        vertex_class = (
+            anthropic.AsyncAnthropicVertex if is_async else anthropic.AnthropicVertex
+        )
+        return get_client(
+            "anthropic_vertex" + suffix,
+            region,
+            project_id,
+            lambda: vertex_class(
+                region=region,
+                project_id=project_id,
+                max_retries=5,
+                http_client=create(),
+            ),
+        )
+    api_key = os.environ["ANTHROPIC_API_KEY"]
+    anthropic_class = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+    return get_client(
+        "anthropic_messages" + suffix,
+        None,
+        api_key,
+        lambda: anthropic_class(
+            api_key=api_key,
+            max_retries=5,
+            http_client=create(),
+        ),
+    )
+
+
+def get_anthropic_message_request(
+    model_name, messages, temperature, top_p, max_new_tokens
+):
+    """The arguments of messages.stream."""
+    system_prompt, messages = split_anthropic_system_prompt(messages)
+    return dict(
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_new_tokens,
+        messages=messages,
+        model=model_name,
+        system=system_prompt,
+    )
+
+
 def anthropic_message_api_stream_iter(
     model_name,
     messages,
@@ -690,42 +790,22 @@ def anthropic_message_api_stream_iter(
     max_new_tokens,
     vertex_ai=False,
 ):
-    import anthropic
+    client = get_anthropic_message_client(vertex_ai)
+    log_request(model_name, messages, temperature, top_p, max_new_tokens)
 
-    if vertex_ai:
-        client = anthropic.AnthropicVertex(
-            region=os.environ["GCP_LOCATION"],
-            project_id=os.environ["GCP_PROJECT_ID"],
-            max_retries=5,
-        )
-    else:
-        client = anthropic.Anthropic(
-            api_key=os.environ["ANTHROPIC_API_KEY"],
-            max_retries=5,
+    text = ""
+    with client.messages.stream(
+        **get_anthropic_message_request(
+            model_name, messages, temperature, top_p, max_new_tokens
         )
+    ) as stream:
+        for chunk in stream.text_stream:
+            text += chunk
+            yield {"text": text, "error_code": 0}
 
-    text_messages = []
-    for message in messages:
-        if type(message["content"]) == str:  # text-only model
-            text_messages.append(message)
-        else:  # vision model
-            filtered_content_list = [
-                content for content in message["content"] if content["type"] == "text"
-            ]
-            text_messages.append(
-                {"role": message["role"], "content": filtered_content_list}
-            )
-
-    # Make requests for logging
-    gen_params = {
-        "model": model_name,
-        "prompt": text_messages,
-        "temperature": temperature,
-        "top_p": top_p,
-        "max_new_tokens": max_new_tokens,
-    }
-    logger.info(f"==== request ====\n{gen_params}")
 
+def split_anthropic_system_prompt(messages):
+    """Anthropic takes the system prompt apart from the messages."""
     system_prompt = ""
     if messages[0]["role"] == "system":
         if type(messages[0]["content"]) == dict:
@@ -734,23 +814,7 @@ def anthropic_message_api_stream_iter(
             system_prompt = messages[0]["content"]
         # remove system prompt
         messages = messages[1:]
-
-    text = ""
-    with client.messages.stream(
-        temperature=temperature,
-        top_p=top_p,
-        max_tokens=max_new_tokens,
-        messages=messages,
-        model=model_name,
-        system=system_prompt,
-    ) as stream:
-        for chunk in stream.text_stream:
-            text += chunk
-            data = {
-                "text": text,
-                "error_code": 0,
-            }
-            yield data
+    return system_prompt, messages
 
 
 def gemini_api_stream_iter(
@@ -872,7 +936,7 @@ def ai2_api_stream_iter(
     if temperature == 0.0 and top_p < 1.0:
         raise ValueError("top_p must be 1 when temperature is 0.0")
 
-    res = requests.post(
+    res = get_session("ai2", api_base).post(
         api_base,
         stream=True,
         headers={"Authorization": f"Bearer {ai2_key}"},
@@ -926,20 +990,15 @@ def mistral_api_stream_iter(
     if api_key is None:
         api_key = os.environ["MISTRAL_API_KEY"]
 
-    client = Mistral(api_key=api_key)
+    client = get_client(
+        "mistral",
+        None,
+        api_key,
+        lambda: Mistral(api_key=api_key, client=create_http_client()),
+    )
 
     # Make requests for logging
-    text_messages = []
-    for message in messages:
-        if type(message["content"]) == str:  # text-only model
-            text_messages.append(message)
-        else:  # vision model
-            filtered_content_list = [
-                content for content in message["content"] if content["type"] == "text"
-            ]
-            text_messages.append(
-                {"role": message["role"], "content": filtered_content_list}
-            )
+    text_messages = get_text_messages(messages)
 
     # Make requests
     gen_params = {
@@ -975,14 +1034,13 @@ def mistral_api_stream_iter(
             yield data
 
 
-def nvidia_api_stream_iter(
+def get_nvidia_request(
     model_name, messages, temp, top_p, max_tokens, api_base, api_key=None
 ):
+    """Return the url, headers and payload of a streaming request."""
     model_2_api = {
         "nemotron-4-340b": "/b0fcd392-e905-4ab4-8eb9-aeae95c30b37",
     }
-    api_base += model_2_api[model_name]
-
     api_key = api_key or os.environ["NVIDIA_API_KEY"]
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -1002,15 +1060,29 @@ def nvidia_api_stream_iter(
         "seed": 42,
         "stream": True,
     }
-    logger.info(f"==== request ====\n{payload}")
+    return api_base + model_2_api[model_name], headers, payload
 
-    # payload.pop("model")
+
+def parse_nvidia_line(line):
+    """The text of a server-sent event line, None at the end of the stream."""
+    if line.endswith("[DONE]"):
+        return None
+    return json.loads(line[6:])["choices"][0]["delta"]["content"]
+
+
+def nvidia_api_stream_iter(
+    model_name, messages, temp, top_p, max_tokens, api_base, api_key=None
+):
+    url, headers, payload = get_nvidia_request(
+        model_name, messages, temp, top_p, max_tokens, api_base, api_key
+    )
+    logger.info(f"==== request ====\n{payload}")
 
     # try 3 times
     for i in range(3):
         try:
-            response = requests.post(
-                api_base, headers=headers, json=payload, stream=True, timeout=3
+            response = get_session("nvidia", url).post(
+                url, headers=headers, json=payload, stream=True, timeout=3
             )
             break
         except Exception as e:
@@ -1025,11 +1097,10 @@ def nvidia_api_stream_iter(
     text = ""
     for line in response.iter_lines():
         if line:
-            data = line.decode("utf-8")
-            if data.endswith("[DONE]"):
+            delta = parse_nvidia_line(line.decode("utf-8"))
+            if delta is None:
                 break
-            data = json.loads(data[6:])["choices"][0]["delta"]["content"]
-            text += data
+            text += delta
             yield {"text": text, "error_code": 0}
 
 
@@ -1054,7 +1125,7 @@ def yandexgpt_api_stream_iter(
     logger.info(f"==== request ====\n{payload}")
 
     # https://llm.api.cloud.yandex.net/foundationModels/v1/completion
-    response = requests.post(
+    response = get_session("yandexgpt", api_base).post(
         api_base, headers=headers, json=payload, stream=True, timeout=60
     )
     text = ""
@@ -1094,10 +1165,16 @@ def cohere_api_stream_iter(
         "system": "System",
     }
 
-    client = cohere.Client(
-        api_key=api_key,
-        base_url=api_base,
-        client_name=client_name,
+    client = get_client(
+        f"cohere/{client_name}",
+        api_base,
+        api_key,
+        lambda: cohere.Client(
+            api_key=api_key,
+            base_url=api_base,
+            client_name=client_name,
+            httpx_client=create_http_client(),
+        ),
     )
 
     # prepare and log requests
@@ -1225,7 +1302,12 @@ def reka_api_stream_iter(
 
     api_key = api_key or os.environ["REKA_API_KEY"]
 
-    client = Reka(api_key=api_key)
+    client = get_client(
+        "reka",
+        None,
+        api_key,
+        lambda: Reka(api_key=api_key, httpx_client=create_http_client()),
+    )
 
     use_search_engine = False
     if "-online" in model_name:
@@ -1280,19 +1362,7 @@ def metagen_api_stream_iter(
     conversation_id,
 ):
     try:
-        text_messages = []
-        for message in messages:
-            if type(message["content"]) == str:  # text-only model
-                text_messages.append(message)
-            else:  # vision model
-                filtered_content_list = [
-                    content
-                    for content in message["content"]
-                    if content["type"] == "text"
-                ]
-                text_messages.append(
-                    {"role": message["role"], "content": filtered_content_list}
-                )
+        text_messages = get_text_messages(messages)
         gen_params = {
             "model": model_name,
             "prompt": text_messages,
@@ -1302,7 +1372,7 @@ def metagen_api_stream_iter(
         }
         logger.info(f"==== request ====\n{gen_params}")
 
-        res = requests.post(
+        res = get_session("metagen", api_base).post(
             f"{api_base}/chat_stream_completions?access_token={api_key}",
             stream=True,
             headers={"Content-Type": "application/json"},
@@ -0,0 +1,243 @@
+"""
+Async streaming from API providers, used by the async bot_response path of
+the web server.
+
+The sync iterators of api_provider hold a Gradio worker thread for the whole
+generation. Here the OpenAI-compatible, Anthropic messages and NVIDIA
+providers stream on the event loop with pooled async clients, so one process
+can wait on hundreds of remote generations. The other providers run their
+sync iterator in a worker thread one chunk at a time.
+
+Every stream holds a slot of a per-provider semaphore while it runs.
+"""
+import asyncio
+
+from fastchat.serve.api_client_pool import create_async_http_client, get_client
+from fastchat.serve.api_provider import (
+    get_anthropic_message_client,
+    get_anthropic_message_request,
+    get_api_provider_stream_iter,
+    get_chat_api_messages,
+    get_nvidia_request,
+    get_openai_chunk_text,
+    get_openai_client,
+    get_openai_request,
+    get_simulated_stream,
+    log_request,
+    logger,
+    parse_nvidia_line,
+)
+
+DEFAULT_PROVIDER_CONCURRENCY = 64
+
+
+class ProviderLimiter:
+    """Bound the number of concurrent streams of every provider endpoint."""
+
+    def __init__(self, default_limit=DEFAULT_PROVIDER_CONCURRENCY):
+        self.default_limit = default_limit
+        self.semaphores = {}
+
+    def get_semaphore(self, key, limit=None):
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.Semaphore(limit or self.default_limit)
+        return self.semaphores[key]
+
+    async def limit(self, key, stream_iter, limit=None):
+        semaphore = self.get_semaphore(key, limit)
+        if semaphore.locked():
+            logger.info(f"provider {key} is at its concurrency limit, waiting")
+        try:
+            async with semaphore:
+                async for data in stream_iter:
+                    yield data
+        finally:
+            await stream_iter.aclose()
+
+
+provider_limiter = ProviderLimiter()
+
+
+def set_provider_concurrency_limit(limit):
+    """Default limit of the endpoints without a max_concurrency of their own."""
+    provider_limiter.default_limit = limit
+
+
+async def iterate_in_thread(stream_iter):
+    """Run a sync stream iterator in a worker thread, one chunk at a time."""
+    done = object()
+    try:
+        while True:
+            data = await asyncio.to_thread(next, stream_iter, done)
+            if data is done:
+                break
+            yield data
+    finally:
+        try:
+            stream_iter.close()
+        except ValueError:
+            # still running in its thread after a cancellation
+            pass
+
+
+def get_api_provider_stream_iter_async(
+    conv,
+    model_name,
+    model_api_dict,
+    temperature,
+    top_p,
+    max_new_tokens,
+    state,
+    extra_body=None,
+):
+    """Same as get_api_provider_stream_iter, but returns an async iterator."""
+    api_type = model_api_dict["api_type"]
+    if api_type in ["openai", "openai_no_stream", "openai_o1"]:
+        prompt = get_chat_api_messages(conv, model_api_dict)
+        stream_iter = openai_api_stream_iter_async(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            api_base=model_api_dict["api_base"],
+            api_key=model_api_dict["api_key"],
+            stream=api_type != "openai_no_stream",
+            is_o1=api_type == "openai_o1",
+        )
+    elif api_type in ["anthropic_message", "anthropic_message_vertex"]:
+        prompt = get_chat_api_messages(conv, model_api_dict)
+        stream_iter = anthropic_message_api_stream_iter_async(
+            model_api_dict["model_name"],
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            vertex_ai=api_type == "anthropic_message_vertex",
+        )
+    elif api_type == "nvidia":
+        prompt = get_chat_api_messages(conv, model_api_dict)
+        stream_iter = nvidia_api_stream_iter_async(
+            model_name,
+            prompt,
+            temperature,
+            top_p,
+            max_new_tokens,
+            model_api_dict["api_base"],
+            model_api_dict["api_key"],
+        )
+    else:
+        stream_iter = iterate_in_thread(
+            get_api_provider_stream_iter(
+                conv,
+                model_name,
+                model_api_dict,
+                temperature,
+                top_p,
+                max_new_tokens,
+                state,
+                extra_body=extra_body,
+            )
+        )
+
+    key = (api_type, model_api_dict.get("api_base"))
+    return provider_limiter.limit(
+        key, stream_iter, model_api_dict.get("max_concurrency")
+    )
+
+
+async def openai_api_stream_iter_async(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    api_base=None,
+    api_key=None,
+    stream=True,
+    is_o1=False,
+):
+    client = get_openai_client(model_name, api_base, api_key, is_async=True)
+    log_request(model_name, messages, temperature, top_p, max_new_tokens)
+
+    request = get_openai_request(
+        model_name, messages, temperature, max_new_tokens, stream, is_o1
+    )
+    res = await client.chat.completions.create(**request)
+    if request["stream"]:
+        try:
+            text = ""
+            async for chunk in res:
+                delta = get_openai_chunk_text(chunk)
+                if delta is not None:
+                    text += delta
+                    yield {"text": text, "error_code": 0}
+        finally:
+            await res.close()
+    else:
+        for text in get_simulated_stream(res.choices[0].message.content):
+            await asyncio.sleep(0.001)
+            yield {"text": text, "error_code": 0}
+
+
+async def anthropic_message_api_stream_iter_async(
+    model_name,
+    messages,
+    temperature,
+    top_p,
+    max_new_tokens,
+    vertex_ai=False,
+):
+    client = get_anthropic_message_client(vertex_ai, is_async=True)
+    log_request(model_name, messages, temperature, top_p, max_new_tokens)
+
+    text = ""
+    async with client.messages.stream(
+        **get_anthropic_message_request(
+            model_name, messages, temperature, top_p, max_new_tokens
+        )
+    ) as stream:
+        async for chunk in stream.text_stream:
+            text += chunk
+            yield {"text": text, "error_code": 0}
+
+
+async def nvidia_api_stream_iter_async(
+    model_name, messages, temp, top_p, max_tokens, api_base, api_key=None
+):
+    url, headers, payload = get_nvidia_request(
+        model_name, messages, temp, top_p, max_tokens, api_base, api_key
+    )
+    logger.info(f"==== request ====\n{payload}")
+
+    client = get_client("nvidia_async", url, None, create_async_http_client)
+    # try 3 times
+    for i in range(3):
+        try:
+            response = await client.send(
+                client.build_request(
+                    "POST", url, headers=headers, json=payload, timeout=3
+                ),
+                stream=True,
+            )
+            break
+        except Exception as e:
+            logger.error(f"==== error ====\n{e}")
+            if i == 2:
+                yield {
+                    "text": f"**API REQUEST ERROR** Reason: API timeout. please try again later.",
+                    "error_code": 1,
+                }
+                return
+
+    try:
+        text = ""
+        async for line in response.aiter_lines():
+            if line:
+                delta = parse_nvidia_line(line)
+                if delta is None:
+                    break
+                text += delta
+                yield {"text": text, "error_code": 0}
+    finally:
+        await response.aclose()
@@ -1,14 +1,24 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+import inspect
+import json
 import threading
 import time
 from typing import List
+import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 import requests
 
-from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
-from fastchat.conversation import Conversation
+from fastchat.constants import (
+    WORKER_HEART_BEAT_INTERVAL,
+    WORKER_MAX_QUEUE_SIZE,
+    ErrorCode,
+    SERVER_ERROR_MSG,
+)
+from fastchat.conversation import Conversation, SeparatorStyle
 from fastchat.utils import pretty_print_semaphore, build_logger
 
 
@@ -24,6 +34,192 @@ def heart_beat_worker(obj):
         obj.send_heart_beat()
 
 
+class InferenceExecutor:
+    """
+    Run blocking model calls on dedicated threads so that the event loop stays
+    free for heart beats, status queries, token counting and new admissions.
+    """
+
+    def __init__(self, num_threads: int):
+        self.pool = ThreadPoolExecutor(num_threads, thread_name_prefix="inference")
+        self.lock = threading.Lock()
+        # endpoint -> number of calls submitted and not finished yet
+        self.queue_depth = {}
+
+    def update_queue_depth(self, endpoint: str, delta: int):
+        with self.lock:
+            self.queue_depth[endpoint] = self.queue_depth.get(endpoint, 0) + delta
+
+    def get_queue_depth(self):
+        with self.lock:
+            return dict(self.queue_depth)
+
+    async def run(self, endpoint: str, fn, *args):
+        """Run fn(*args) on the executor. A call cancelled while queued never runs."""
+        self.update_queue_depth(endpoint, 1)
+        try:
+            return await asyncio.wrap_future(self.pool.submit(fn, *args))
+        finally:
+            self.update_queue_depth(endpoint, -1)
+
+    async def iterate(self, endpoint: str, generator):
+        """
+        Drive a blocking generator on the executor one chunk at a time.
+        When the consumer goes away (e.g. the client disconnects), no further
+        chunks are generated and the generator is closed on the executor.
+        """
+        self.update_queue_depth(endpoint, 1)
+        future = None
+        try:
+            while True:
+                future = self.pool.submit(next, generator, None)
+                chunk = await asyncio.wrap_future(future)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if future is not None:
+                future.cancel()
+            # the pool is FIFO, so this runs after any pending step of the generator
+            self.pool.submit(close_generator, generator, future)
+            self.update_queue_depth(endpoint, -1)
+
+
+def close_generator(generator, future=None):
+    if future is not None:
+        wait([future])
+    generator.close()
+
+
+def estimate_num_tokens(text: str):
+    # rough estimate, only used to size embedding batches
+    return len(text) // 4 + 1
+
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent /worker_get_embeddings calls into shared forward passes.
+
+    Calls are collected for up to max_wait seconds, or until max_tokens of input
+    is pending. The collected inputs are sorted by length and split into batches
+    of at most max_tokens padded tokens, so that similar lengths are padded
+    together, and the results are scattered back to each call. Every batch
+    holds the worker semaphore while it runs, like a single call.
+    The worker's get_embeddings must report per-input counts in "token_nums".
+    """
+
+    def __init__(self, max_tokens: int, max_wait: float):
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait
+        # (model, encoding_format) -> [(worker, inputs, future)]
+        self.pending = {}
+        self.pending_tokens = {}
+        self.timers = {}
+        self.tasks = set()
+
+    async def get_embeddings(self, worker, executor, params, acquire, release):
+        key = (params.get("model"), params.get("encoding_format"))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(key, []).append((worker, params["input"], future))
+        self.pending_tokens[key] = self.pending_tokens.get(key, 0) + sum(
+            estimate_num_tokens(x) for x in params["input"]
+        )
+        if self.pending_tokens[key] >= self.max_tokens:
+            self.flush(key, executor, acquire, release)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(
+                self.max_wait, self.flush, key, executor, acquire, release
+            )
+        return await future
+
+    def get_num_pending(self, worker):
+        """The calls of a worker that are collected but not flushed yet."""
+        return sum(
+            1 for calls in self.pending.values() for w, _, _ in calls if w is worker
+        )
+
+    def flush(self, key, executor, acquire, release):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        calls = self.pending.pop(key, [])
+        self.pending_tokens.pop(key, None)
+        if calls:
+            task = asyncio.create_task(
+                self.run_batches(key, calls, executor, acquire, release)
+            )
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def split_batches(self, texts):
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches, batch = [], []
+        for i in order:
+            # sorted by length, so the new input sets the padded length
+            if (
+                batch
+                and (len(batch) + 1) * estimate_num_tokens(texts[i]) > self.max_tokens
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def run_batches(self, key, calls, executor, acquire, release):
+        worker = calls[0][0]
+        texts = [text for _, inputs, _ in calls for text in inputs]
+        batches = self.split_batches(texts)
+
+        async def run_batch(batch):
+            await acquire()
+            try:
+                return await executor.run(
+                    "embeddings",
+                    worker.get_embeddings,
+                    {
+                        "model": key[0],
+                        "input": [texts[i] for i in batch],
+                        "encoding_format": key[1],
+                    },
+                )
+            finally:
+                release()
+
+        try:
+            rets = await asyncio.gather(*[run_batch(batch) for batch in batches])
+        except Exception as e:
+            for _, _, future in calls:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        error = next((ret for ret in rets if ret.get("error_code", 0) != 0), None)
+        embeddings = [None] * len(texts)
+        token_nums = [0] * len(texts)
+        if error is None:
+            for batch, ret in zip(batches, rets):
+                for j, i in enumerate(batch):
+                    embeddings[i] = ret["embedding"][j]
+                    token_nums[i] = ret["token_nums"][j]
+
+        start = 0
+        for _, inputs, future in calls:
+            end = start + len(inputs)
+            if not future.done():
+                future.set_result(
+                    error
+                    or {
+                        "embedding": embeddings[start:end],
+                        "token_num": sum(token_nums[start:end]),
+                        "token_nums": token_nums[start:end],
+                    }
+                )
+            start = end
+
+
 class BaseModelWorker:
     def __init__(
         self,
@@ -52,6 +248,13 @@ class BaseModelWorker:
         self.context_len = None
         self.call_ct = 0
         self.semaphore = None
+        self.executor = None
+        self.embedding_batcher = None
+        # request_id -> cancel event of the generations in progress
+        self.generations = {}
+        self.num_cancelled_requests = 0
+        # max_new_tokens budget that was not decoded thanks to cancellations
+        self.num_cancelled_tokens = 0
 
         self.heart_beat_thread = None
 
@@ -116,6 +319,8 @@ class BaseModelWorker:
                     json={
                         "worker_name": self.worker_addr,
                         "queue_length": self.get_queue_length(),
+                        "queue_depth": self.get_queue_depth(),
+                        "model_states": self.get_model_states(),
                     },
                     timeout=5,
                 )
@@ -128,9 +333,14 @@ class BaseModelWorker:
         if not exist:
             self.register_to_controller()
 
+    def get_num_pending_embeddings(self):
+        if self.embedding_batcher is None:
+            return 0
+        return self.embedding_batcher.get_num_pending(self)
+
     def get_queue_length(self):
         if self.semaphore is None:
-            return 0
+            return self.get_num_pending_embeddings()
         else:
             sempahore_value = (
                 self.semaphore._value
@@ -140,15 +350,74 @@ class BaseModelWorker:
             waiter_count = (
                 0 if self.semaphore._waiters is None else len(self.semaphore._waiters)
             )
-            return self.limit_worker_concurrency - sempahore_value + waiter_count
+            return (
+                self.limit_worker_concurrency
+                - sempahore_value
+                + waiter_count
+                + self.get_num_pending_embeddings()
+            )
+
+    def get_model_states(self):
+        """model name -> "resident", "evicted" or "unloaded" """
+        return {name: "resident" for name in self.model_names}
+
+    def get_queue_depth(self):
+        if self.executor is None:
+            return {}
+        return self.executor.get_queue_depth()
+
+    def is_queue_full(self):
+        if self.semaphore is None or WORKER_MAX_QUEUE_SIZE <= 0:
+            return False
+        waiter_count = (
+            0 if self.semaphore._waiters is None else len(self.semaphore._waiters)
+        )
+        waiter_count += self.get_num_pending_embeddings()
+        return waiter_count >= WORKER_MAX_QUEUE_SIZE
 
     def get_status(self):
         return {
             "model_names": self.model_names,
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "queue_depth": self.get_queue_depth(),
+            "model_states": self.get_model_states(),
+            "cancelled_requests": self.num_cancelled_requests,
+            "cancelled_tokens": self.num_cancelled_tokens,
         }
 
+    def start_generation(self, params):
+        """
+        Register a generation so that /worker_cancel can stop it. A request_id
+        is assigned if the client did not send one. Return the cancel event.
+        """
+        if not params.get("request_id"):
+            params["request_id"] = uuid.uuid4().hex
+        cancel_event = threading.Event()
+        self.generations[params["request_id"]] = cancel_event
+        return cancel_event
+
+    def finish_generation(self, params):
+        self.generations.pop(params.get("request_id"), None)
+
+    def get_cancel_event(self, params):
+        return self.generations.get(params.get("request_id"))
+
+    def cancel_generation(self, request_id):
+        cancel_event = self.generations.get(request_id)
+        if cancel_event is None:
+            return False
+        cancel_event.set()
+        return True
+
+    def record_cancellation(self, params, completion_tokens):
+        self.num_cancelled_requests += 1
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.num_cancelled_tokens += max(max_new_tokens - completion_tokens, 0)
+        logger.info(
+            f"Cancelled {params.get('request_id')} after {completion_tokens} tokens"
+        )
+
     def count_token(self, params):
         prompt = params["prompt"]
 
@@ -167,6 +436,49 @@ class BaseModelWorker:
     def get_conv_template(self):
         return {"conv": self.conv}
 
+    def render_prompt(self, params):
+        """
+        Render OpenAI-style messages (or a plain prompt string) with the
+        worker's conversation template and count the prompt tokens, so that
+        the API server needs a single call instead of fetching the template,
+        rendering and calling /count_token.
+        """
+        messages = params["messages"]
+        conv = self.conv.copy()
+        conv.sep_style = SeparatorStyle(conv.sep_style)
+        if isinstance(messages, str):
+            prompt = messages
+            images = []
+        else:
+            try:
+                conv.append_openai_api_messages(messages)
+            except ValueError as e:
+                return {
+                    "text": str(e),
+                    "error_code": ErrorCode.VALIDATION_TYPE_ERROR,
+                }
+            # Add a blank message for the assistant.
+            conv.append_message(conv.roles[1], None)
+            prompt = conv.get_prompt()
+            images = conv.get_images()
+
+        return {
+            "prompt": prompt,
+            "images": images,
+            "stop_str": conv.stop_str,
+            "stop_token_ids": conv.stop_token_ids,
+            "count": self.count_token({"prompt": prompt})["count"],
+            "context_length": self.context_len,
+            "error_code": 0,
+        }
+
+    def supports_parallel_n(self):
+        """
+        Whether generate_stream_gate samples params["n"] choices of one prefill,
+        None if it is not known yet (the model is not loaded).
+        """
+        return False
+
     def generate_stream_gate(self, params):
         raise NotImplementedError
 
@@ -187,39 +499,152 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
-def create_background_tasks():
+def get_inference_executor():
+    if worker.executor is None:
+        worker.executor = InferenceExecutor(worker.limit_worker_concurrency)
+    return worker.executor
+
+
+def call_once(*fns):
+    """Return a callback that calls fns on its first call only."""
+    called = False
+
+    def callback():
+        nonlocal called
+        if not called:
+            called = True
+            for fn in fns:
+                fn()
+
+    return callback
+
+
+async def release_on_exit(generator, release):
+    """
+    Call release as soon as the stream ends, including when the client goes
+    away. Background tasks would be skipped when the disconnect raises.
+    """
+    try:
+        async for chunk in generator:
+            yield chunk
+    finally:
+        release()
+
+
+async def run_until_disconnected(request: Request, future, cancel):
+    """Await future, calling cancel if the client goes away meanwhile."""
+    future = asyncio.ensure_future(future)
+    while True:
+        done, _ = await asyncio.wait([future], timeout=1)
+        if done:
+            return future.result()
+        if await request.is_disconnected():
+            cancel()
+            return await future
+
+
+def create_background_tasks(release=release_worker_semaphore):
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(release_worker_semaphore)
+    background_tasks.add_task(release)
     return background_tasks
 
 
+def create_cancelled_output():
+    return {
+        "text": "",
+        "error_code": 0,
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        "finish_reason": "abort",
+    }
+
+
+def create_queue_full_response(stream=False):
+    ret = {
+        "text": SERVER_ERROR_MSG,
+        "error_code": ErrorCode.ENGINE_OVERLOADED,
+    }
+    if stream:
+        return StreamingResponse(iter([json.dumps(ret).encode() + b"\0"]))
+    return JSONResponse(ret)
+
+
+def iterate_in_executor(executor, endpoint, generator):
+    # async generators (e.g. of vLLM-style engines) do not block the event loop
+    if inspect.isasyncgen(generator):
+        return generator
+    return executor.iterate(endpoint, generator)
+
+
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
+    if worker.is_queue_full():
+        return create_queue_full_response(stream=True)
     await acquire_worker_semaphore()
-    generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
-    return StreamingResponse(generator, background=background_tasks)
+    worker.start_generation(params)
+    release = call_once(
+        release_worker_semaphore, partial(worker.finish_generation, params)
+    )
+    generator = iterate_in_executor(
+        get_inference_executor(),
+        "generate_stream",
+        worker.generate_stream_gate(params),
+    )
+    background_tasks = create_background_tasks(release)
+    return StreamingResponse(
+        release_on_exit(generator, release), background=background_tasks
+    )
 
 
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
+    if worker.is_queue_full():
+        return create_queue_full_response()
     await acquire_worker_semaphore()
-    output = await asyncio.to_thread(worker.generate_gate, params)
-    release_worker_semaphore()
+    worker.start_generation(params)
+    try:
+        output = await run_until_disconnected(
+            request,
+            get_inference_executor().run("generate", worker.generate_gate, params),
+            partial(worker.cancel_generation, params["request_id"]),
+        )
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     return JSONResponse(output)
 
 
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
+    if worker.is_queue_full():
+        return create_queue_full_response()
+    if worker.embedding_batcher is not None:
+        embedding = await worker.embedding_batcher.get_embeddings(
+            worker,
+            get_inference_executor(),
+            params,
+            acquire_worker_semaphore,
+            release_worker_semaphore,
+        )
+        return JSONResponse(content=embedding)
     await acquire_worker_semaphore()
-    embedding = worker.get_embeddings(params)
-    release_worker_semaphore()
+    try:
+        embedding = await get_inference_executor().run(
+            "embeddings", worker.get_embeddings, params
+        )
+    finally:
+        release_worker_semaphore()
     return JSONResponse(content=embedding)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    return {"cancelled": worker.cancel_generation(params["request_id"])}
+
+
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return worker.get_status()
@@ -236,6 +661,17 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {
+        "context_length": worker.context_len,
+        "embed_in_truncate": getattr(worker, "embed_in_truncate", None),
+        "parallel_n": worker.supports_parallel_n(),
+        "render_prompt": True,
+    }
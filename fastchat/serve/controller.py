@@ -13,6 +13,7 @@ import time
 from typing import List, Union
 import threading
 
+import aiohttp
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 import numpy as np
@@ -53,6 +54,14 @@ class WorkerInfo:
     check_heart_beat: bool
     last_heart_beat: str
     multimodal: bool
+    # endpoint -> number of inference calls queued or running on the worker
+    queue_depth: dict = dataclasses.field(default_factory=dict)
+    # model name -> "resident", "evicted" or "unloaded"
+    model_states: dict = dataclasses.field(default_factory=dict)
+
+    def is_warm(self, model_name: str):
+        # workers that do not report states keep all their models resident
+        return self.model_states.get(model_name, "resident") == "resident"
 
 
 def heart_beat_controller(controller):
@@ -96,6 +105,8 @@ class Controller:
             check_heart_beat,
             time.time(),
             multimodal,
+            worker_status.get("queue_depth", {}),
+            worker_status.get("model_states", {}),
         )
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
@@ -153,11 +164,25 @@ class Controller:
 
         return list(model_names)
 
+    def get_candidate_workers(self, model_name: str):
+        """Workers serving model_name, only those with it warm if there are any."""
+        candidates = [
+            (w_name, w_info)
+            for w_name, w_info in self.worker_info.items()
+            if model_name in w_info.model_names
+        ]
+        warm = [
+            (w_name, w_info)
+            for w_name, w_info in candidates
+            if w_info.is_warm(model_name)
+        ]
+        return warm or candidates
+
     def get_worker_address(self, model_name: str):
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
+            for w_name, w_info in self.get_candidate_workers(model_name):
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
                     worker_speeds.append(w_info.speed)
@@ -190,7 +215,7 @@ class Controller:
         elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
             worker_names = []
             worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
+            for w_name, w_info in self.get_candidate_workers(model_name):
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
                     worker_qlen.append(w_info.queue_length / w_info.speed)
@@ -206,12 +231,30 @@ class Controller:
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def get_worker_addresses(self, model_name: str):
+        """All workers serving model_name, for requests that fan out across them."""
+        return sorted(
+            w_name
+            for w_name, w_info in self.worker_info.items()
+            if model_name in w_info.model_names and w_info.speed > 0
+        )
+
+    def receive_heart_beat(
+        self,
+        worker_name: str,
+        queue_length: int,
+        queue_depth: dict = None,
+        model_states: dict = None,
+    ):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
         self.worker_info[worker_name].queue_length = queue_length
+        if queue_depth is not None:
+            self.worker_info[worker_name].queue_depth = queue_depth
+        if model_states is not None:
+            self.worker_info[worker_name].model_states = model_states
         self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
@@ -248,6 +291,7 @@ class Controller:
         model_names = set()
         speed = 0
         queue_length = 0
+        queue_depth = {}
 
         for w_name in self.worker_info:
             worker_status = self.get_worker_status(w_name)
@@ -255,12 +299,15 @@ class Controller:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
                 queue_length += worker_status["queue_length"]
+                for endpoint, depth in worker_status.get("queue_depth", {}).items():
+                    queue_depth[endpoint] = queue_depth.get(endpoint, 0) + depth
 
         model_names = sorted(list(model_names))
         return {
             "model_names": model_names,
             "speed": speed,
             "queue_length": queue_length,
+            "queue_depth": queue_depth,
         }
 
     def worker_api_generate_stream(self, params):
@@ -268,6 +315,7 @@ class Controller:
         if not worker_addr:
             yield self.handle_no_worker(params)
 
+        response = None
         try:
             response = requests.post(
                 worker_addr + "/worker_generate_stream",
@@ -280,6 +328,41 @@ class Controller:
                     yield chunk + b"\0"
         except requests.exceptions.RequestException as e:
             yield self.handle_worker_timeout(worker_addr)
+        finally:
+            # a closed connection lets the worker notice a client that left
+            if response is not None:
+                response.close()
+
+    async def worker_api_cancel(self, params):
+        """
+        Forward a cancellation to every worker that may run the request, all
+        at once and without blocking the event loop.
+        """
+        model_name = params.get("model")
+        worker_names = [
+            w_name
+            for w_name, w_info in self.worker_info.items()
+            if model_name is None or model_name in w_info.model_names
+        ]
+
+        async def cancel(session, w_name):
+            try:
+                async with session.post(
+                    w_name + "/worker_cancel",
+                    json={"request_id": params["request_id"]},
+                ) as r:
+                    return (await r.json()).get("cancelled", False)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.info(f"cancel failed: {w_name}, {e!r}")
+                return False
+
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=5)
+        ) as session:
+            results = await asyncio.gather(
+                *[cancel(session, w_name) for w_name in worker_names]
+            )
+        return {"cancelled": any(results)}
 
 
 app = FastAPI()
@@ -326,10 +409,22 @@ async def get_worker_address(request: Request):
     return {"address": addr}
 
 
+@app.post("/get_worker_addresses")
+async def get_worker_addresses(request: Request):
+    data = await request.json()
+    addrs = controller.get_worker_addresses(data["model"])
+    return {"addresses": addrs}
+
+
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
-    exist = controller.receive_heart_beat(data["worker_name"], data["queue_length"])
+    exist = controller.receive_heart_beat(
+        data["worker_name"],
+        data["queue_length"],
+        data.get("queue_depth"),
+        data.get("model_states"),
+    )
     return {"exist": exist}
 
 
@@ -340,6 +435,12 @@ async def worker_api_generate_stream(request: Request):
     return StreamingResponse(generator)
 
 
+@app.post("/worker_cancel")
+async def worker_api_cancel(request: Request):
+    params = await request.json()
+    return await controller.worker_api_cancel(params)
+
+
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
     return controller.worker_api_get_status()
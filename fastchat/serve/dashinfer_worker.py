@@ -18,7 +18,8 @@ import uvicorn
 from dashinfer.helper import EngineHelper, ConfigManager
 
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
-from fastchat.serve.base_model_worker import BaseModelWorker
+from fastchat.serve.base_model_worker import BaseModelWorker, create_cancelled_output
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
@@ -95,6 +96,7 @@ class DashInferWorker(BaseModelWorker):
 
     async def generate_stream(self, params):
         self.call_ct += 1
+        encoder = StreamEncoder(params)
 
         context = params.pop("prompt")
         temperature = params.get("temperature")
@@ -180,8 +182,18 @@ class DashInferWorker(BaseModelWorker):
                 engine_req
             )
 
+            cancel_event = self.get_cancel_event(params)
+            ret = None
             try:
                 for generate_text in results_generator:
+                    if cancel_event is not None and cancel_event.is_set():
+                        completion_tokens = 0
+                        if ret is not None:
+                            completion_tokens = ret["usage"]["completion_tokens"]
+                            ret = {**ret, "finish_reason": "abort"}
+                            yield (json.dumps(encoder.encode(ret)) + "\0").encode()
+                        self.record_cancellation(params, completion_tokens)
+                        break
                     if echo:
                         output_text = context + generate_text
                     else:
@@ -197,7 +209,7 @@ class DashInferWorker(BaseModelWorker):
                             "total_tokens": prompt_tokens + completion_tokens,
                         },
                     }
-                    yield (json.dumps(ret) + "\0").encode()
+                    yield (json.dumps(encoder.encode(ret)) + "\0").encode()
             except Exception as e:
                 ret = {
                     "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -206,8 +218,14 @@ class DashInferWorker(BaseModelWorker):
                 yield json.dumps(ret).encode() + b"\0"
 
     async def generate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
+        x = None
         async for x in self.generate_stream(params):
             pass
+        if x is None:
+            # cancelled before the first chunk
+            return create_cancelled_output()
         return json.loads(x[:-1].decode())
 
 
@@ -221,9 +239,10 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
-def create_background_tasks():
+def create_background_tasks(params):
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_worker_semaphore)
+    background_tasks.add_task(worker.finish_generation, params)
     return background_tasks
 
 
@@ -231,8 +250,9 @@ def create_background_tasks():
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
+    worker.start_generation(params)
     generator = worker.generate_stream(params)
-    background_tasks = create_background_tasks()
+    background_tasks = create_background_tasks(params)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -240,11 +260,21 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    output = await worker.generate(params)
-    release_worker_semaphore()
+    worker.start_generation(params)
+    try:
+        output = await worker.generate(params)
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     return JSONResponse(output)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    return {"cancelled": worker.cancel_generation(params["request_id"])}
+
+
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return worker.get_status()
@@ -261,9 +291,15 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "render_prompt": True}
 
 
 if __name__ == "__main__":
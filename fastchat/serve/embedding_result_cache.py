@@ -0,0 +1,187 @@
+"""
+Embedding result cache of the OpenAI-compatible API server.
+
+Results are keyed by a hash of (model, text, encoding_format, truncation mode),
+so hits are served without contacting any worker. There are two tiers:
+an in-memory LRU and an optional append-only disk store that is read through
+a memory map, so the cache survives restarts without loading it into memory.
+
+Disk layout:
+    <cache_dir>/index.bin  fixed-size records (key, offset, length, token_num, kind)
+    <cache_dir>/data.bin   embedding payloads: float32 vectors or base64 strings
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import mmap
+import os
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("key", "S20"),
+        ("offset", "<u8"),
+        ("length", "<u4"),
+        ("token_num", "<u4"),
+        ("kind", "u1"),
+    ]
+)
+# payload kinds
+FLOAT_KIND = 0
+BASE64_KIND = 1
+
+
+def get_cache_key(model, text, encoding_format, truncation):
+    return hashlib.sha1(
+        json.dumps(
+            [model, text, encoding_format, truncation], ensure_ascii=False
+        ).encode("utf-8")
+    ).digest()
+
+
+def encode_payload(embedding):
+    if isinstance(embedding, str):
+        return BASE64_KIND, embedding.encode("ascii")
+    return FLOAT_KIND, np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def decode_payload(kind, data):
+    if kind == BASE64_KIND:
+        return data.decode("ascii")
+    return np.frombuffer(data, dtype=np.float32).tolist()
+
+
+class DiskEmbeddingStore:
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, "index.bin")
+        self.data_file = os.path.join(cache_dir, "data.bin")
+        for filename in [self.index_file, self.data_file]:
+            if not os.path.exists(filename):
+                open(filename, "wb").close()
+
+        data_size = os.path.getsize(self.data_file)
+        num_records = os.path.getsize(self.index_file) // INDEX_DTYPE.itemsize
+        records = np.fromfile(self.index_file, dtype=INDEX_DTYPE, count=num_records)
+        # drop records of a torn append
+        records = records[
+            records["offset"] + records["length"].astype(np.uint64) <= data_size
+        ]
+        # numpy strips trailing null bytes from "S" fields, so pad them back
+        self.index = {
+            bytes(r["key"]).ljust(INDEX_DTYPE["key"].itemsize, b"\0"): (
+                int(r["offset"]),
+                int(r["length"]),
+                int(r["token_num"]),
+                int(r["kind"]),
+            )
+            for r in records
+        }
+        self.data_size = (
+            int((records["offset"] + records["length"]).max()) if len(records) else 0
+        )
+        with open(self.data_file, "r+b") as fout:
+            fout.truncate(self.data_size)
+        with open(self.index_file, "r+b") as fout:
+            fout.truncate(0)
+            fout.write(records.tobytes())
+
+        self.data_out = open(self.data_file, "ab")
+        self.index_out = open(self.index_file, "ab")
+        self.mmap = None
+        self.mmap_size = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        offset, length, token_num, kind = entry
+        if offset + length > self.mmap_size:
+            self.data_out.flush()
+            if self.mmap is not None:
+                self.mmap.close()
+            with open(self.data_file, "rb") as fin:
+                self.mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmap_size = len(self.mmap)
+        return decode_payload(kind, self.mmap[offset : offset + length]), token_num
+
+    def put(self, key, embedding, token_num):
+        if key in self.index:
+            return
+        kind, data = encode_payload(embedding)
+        record = np.array(
+            [(key, self.data_size, len(data), token_num, kind)], dtype=INDEX_DTYPE
+        )
+        self.data_out.write(data)
+        self.index_out.write(record.tobytes())
+        self.index[key] = (self.data_size, len(data), token_num, kind)
+        self.data_size += len(data)
+
+    def flush(self):
+        # data before index, so a crash never leaves records without payload
+        self.data_out.flush()
+        self.index_out.flush()
+
+
+class EmbeddingResultCache:
+    def __init__(self, max_memory_items=100000, cache_dir=None):
+        self.max_memory_items = max_memory_items
+        # key -> (embedding, token_num), most recently used last
+        self.memory = OrderedDict()
+        self.disk = DiskEmbeddingStore(cache_dir) if cache_dir else None
+        self.stats = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bytes_saved": 0,
+        }
+
+    def get(self, key):
+        """Return (embedding, token_num) or None."""
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+        elif self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.put_memory(key, value)
+                self.stats["disk_hits"] += 1
+
+        if value is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.stats["bytes_saved"] += len(encode_payload(value[0])[1])
+        return value
+
+    def put_memory(self, key, value):
+        if self.max_memory_items <= 0:
+            return
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def put(self, key, embedding, token_num):
+        self.put_memory(key, (embedding, token_num))
+        if self.disk is not None:
+            self.disk.put(key, embedding, token_num)
+
+    def flush(self):
+        if self.disk is not None:
+            self.disk.flush()
+
+    def get_stats(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / total if total else 0.0,
+            "memory_items": len(self.memory),
+            "disk_items": len(self.disk) if self.disk is not None else 0,
+        }
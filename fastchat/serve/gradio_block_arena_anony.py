@@ -26,7 +26,7 @@ from fastchat.model.model_adapter import get_conversation_template
 from fastchat.serve.gradio_block_arena_named import flash_buttons
 from fastchat.serve.gradio_web_server import (
     State,
-    bot_response,
+    bot_response_async,
     get_conv_log_filename,
     no_change_btn,
     enable_btn,
@@ -395,7 +395,7 @@ def add_text(
     )
 
 
-def bot_response_multi(
+async def bot_response_multi(
     state0,
     state1,
     temperature,
@@ -421,7 +421,7 @@ def bot_response_multi(
     gen = []
     for i in range(num_sides):
         gen.append(
-            bot_response(
+            bot_response_async(
                 states[i],
                 temperature,
                 top_p,
@@ -470,10 +470,10 @@ def bot_response_multi(
             try:
                 # yield fewer times if chunk size is larger
                 if model_tpy[i] == 1 or (iters % model_tpy[i] == 1 or iters < 3):
-                    ret = next(gen[i])
+                    ret = await gen[i].__anext__()
                     states[i], chatbots[i] = ret[0], ret[1]
                 stop = False
-            except StopIteration:
+            except StopAsyncIteration:
                 pass
         yield states + chatbots + [disable_btn] * 6
         if stop:
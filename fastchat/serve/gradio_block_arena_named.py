@@ -19,7 +19,7 @@ from fastchat.constants import (
 from fastchat.model.model_adapter import get_conversation_template
 from fastchat.serve.gradio_web_server import (
     State,
-    bot_response,
+    bot_response_async,
     get_conv_log_filename,
     no_change_btn,
     enable_btn,
@@ -28,6 +28,8 @@ from fastchat.serve.gradio_web_server import (
     acknowledgment_md,
     get_ip,
     get_model_description_md,
+    get_moderation_texts,
+    start_moderation,
 )
 from fastchat.serve.remote_logger import get_remote_logger
 from fastchat.utils import (
@@ -39,11 +41,13 @@ logger = build_logger("gradio_web_server_multi", "logs/gradio_web_server_multi.l
 
 num_sides = 2
 enable_moderation = False
+moderation_mode = "sync"
 
 
-def set_global_vars_named(enable_moderation_):
-    global enable_moderation
+def set_global_vars_named(enable_moderation_, moderation_mode_="sync"):
+    global enable_moderation, moderation_mode
     enable_moderation = enable_moderation_
+    moderation_mode = moderation_mode_
 
 
 def load_demo_side_by_side_named(models, url_params):
@@ -178,12 +182,14 @@ def add_text(
         )
 
     model_list = [states[i].model_name for i in range(num_sides)]
-    all_conv_text_left = states[0].conv.get_prompt()
-    all_conv_text_right = states[1].conv.get_prompt()
-    all_conv_text = (
-        all_conv_text_left[-1000:] + all_conv_text_right[-1000:] + "\nuser: " + text
-    )
-    flagged = moderation_filter(all_conv_text, model_list)
+    moderation_texts = get_moderation_texts([x.conv for x in states], text, 1000)
+    if moderation_mode == "parallel":
+        verdict = start_moderation(moderation_texts, model_list)
+        for i in range(num_sides):
+            states[i].moderation_verdict = verdict
+        flagged = False
+    else:
+        flagged = moderation_filter(moderation_texts, model_list)
     if flagged:
         logger.info(f"violate moderation (named). ip: {ip}. text: {text}")
         # overwrite the original text
@@ -221,7 +227,7 @@ def add_text(
     )
 
 
-def bot_response_multi(
+async def bot_response_multi(
     state0,
     state1,
     temperature,
@@ -245,7 +251,7 @@ def bot_response_multi(
     gen = []
     for i in range(num_sides):
         gen.append(
-            bot_response(
+            bot_response_async(
                 states[i],
                 temperature,
                 top_p,
@@ -291,10 +297,10 @@ def bot_response_multi(
             try:
                 # yield fewer times if chunk size is larger
                 if model_tpy[i] == 1 or (iters % model_tpy[i] == 1 or iters < 3):
-                    ret = next(gen[i])
+                    ret = await gen[i].__anext__()
                     states[i], chatbots[i] = ret[0], ret[1]
                 stop = False
-            except StopIteration:
+            except StopAsyncIteration:
                 pass
         yield states + chatbots + [disable_btn] * 6
         if stop:
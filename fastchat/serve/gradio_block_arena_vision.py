@@ -32,7 +32,7 @@ from fastchat.serve.gradio_global_state import Context
 from fastchat.serve.gradio_web_server import (
     get_model_description_md,
     acknowledgment_md,
-    bot_response,
+    bot_response_async,
     get_ip,
     disable_btn,
     State,
@@ -630,7 +630,7 @@ def build_single_vision_language_model_ui(
     # Register listeners
     btn_list = [regenerate_btn, clear_btn]
     regenerate_btn.click(regenerate, state, [state, chatbot, textbox] + btn_list).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
@@ -659,7 +659,7 @@ def build_single_vision_language_model_ui(
         [state, model_selector, multimodal_textbox, context_state],
         [state, chatbot, multimodal_textbox, textbox, send_btn] + btn_list,
     ).then(set_invisible_image, [], [image_column]).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
@@ -669,7 +669,7 @@ def build_single_vision_language_model_ui(
         [state, model_selector, textbox, context_state],
         [state, chatbot, multimodal_textbox, textbox, send_btn] + btn_list,
     ).then(set_invisible_image, [], [image_column]).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
@@ -679,7 +679,7 @@ def build_single_vision_language_model_ui(
         [state, model_selector, textbox, context_state],
         [state, chatbot, multimodal_textbox, textbox, send_btn] + btn_list,
     ).then(set_invisible_image, [], [image_column]).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
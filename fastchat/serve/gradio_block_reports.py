@@ -5,6 +5,8 @@ Displays complete HTML reports with proper chart support.
 
 import subprocess
 import os
+import json
+import threading
 import gradio as gr
 from pathlib import Path
 import re
@@ -121,9 +123,13 @@ def generate_html_report(force_refresh=False):
             with open(report_path, 'r', encoding='utf-8') as f:
                 html_content = f.read()
             
-            # 从HTML中提取动态数据
-            vote_data = extract_vote_data_from_html(html_content)
-            model_data = extract_model_data_from_html(html_content)
+            # 读取报告数据，旧报告没有数据文件时从HTML中提取
+            report_data = load_report_data(Path(report_path).parent / "report_data.json")
+            if report_data is not None:
+                vote_data, model_data = get_chart_data(report_data)
+            else:
+                vote_data = extract_vote_data_from_html(html_content)
+                model_data = extract_model_data_from_html(html_content)
             
             # 修复Chart.js CDN链接，使用更可靠的CDN
             html_content = html_content.replace(
@@ -632,171 +638,165 @@ def extract_model_data_from_html(html_content):
         'borderColors': '["rgba(40, 167, 69, 1)", "rgba(102, 126, 234, 1)"]'
     }
 
-def refresh_latest_report():
-    """刷新最新报告（不重新生成）"""
-    vote_data = {'leftvote': 0, 'rightvote': 0, 'tievote': 0}
-    model_data = {
-        'labels': '["Model A", "Model B"]',
-        'winRates': '[50, 50]',
-        'barColors': '["rgba(40, 167, 69, 0.8)", "rgba(102, 126, 234, 0.8)"]',
-        'borderColors': '["rgba(40, 167, 69, 1)", "rgba(102, 126, 234, 1)"]'
+# 支持的报告数据格式版本，与 scripts_py/generate_report.py 中的 REPORT_DATA_VERSION 对应
+REPORT_DATA_VERSION = 1
+
+# 报告数据和渲染结果的缓存，数据和HTML文件都没有变化时直接返回渲染好的报告
+report_cache = {
+    'data_key': None,  # report_data.json 的 (路径, 修改时间, 大小)
+    'data': None,
+    'html_key': None,  # (数据版本, report.html 的 (路径, 修改时间, 大小))
+    'html': None,
+}
+report_cache_lock = threading.Lock()
+
+# 注入报告的深色主题样式 - 解决ELO排名表白色背景问题
+REPORT_THEME_CSS = '''
+    <style>
+    /* 优化配色方案：柔和深色背景+高亮色，提升可读性和现代感 */
+    .report-html-container body {
+        background-color: #181c24 !important;
+        color: #f3f6fa !important;
+        font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif !important;
+    }
+    .report-html-container .content, .report-html-container .table-container, .report-html-container .chart-container {
+        background-color: #181c24 !important;
+        color: #f3f6fa !important;
+    }
+    .report-html-container table, .report-html-container #eloTable, .report-html-container #detailTable {
+        background: #23293a !important;
+        color: #f3f6fa !important;
+        border-collapse: collapse !important;
+        border: 2px solid #3b4252 !important;
+        border-radius: 10px !important;
+        overflow: hidden !important;
+    }
+    .report-html-container table th, .report-html-container #eloTable th, .report-html-container #detailTable th {
+        background: linear-gradient(135deg, #2563eb 0%, #60a5fa 100%) !important;
+        color: #fff !important;
+        border-bottom: 2px solid #2563eb !important;
+        padding: 16px 12px !important;
+        font-weight: 700 !important;
+        text-shadow: 0 1px 2px rgba(0,0,0,0.3) !important;
+        font-size: 15px !important;
+    }
+    .report-html-container table td, .report-html-container #eloTable td, .report-html-container #detailTable td {
+        background: #23293a !important;
+        color: #f3f6fa !important;
+        border-bottom: 1px solid #3b4252 !important;
+        padding: 14px 10px !important;
+        font-size: 14px !important;
+        font-weight: 500 !important;
     }
+    .report-html-container table tbody tr:nth-child(even), .report-html-container #eloTable tbody tr:nth-child(even), .report-html-container #detailTable tbody tr:nth-child(even) {
+        background: #20232b !important;
+    }
+    .report-html-container table tbody tr:hover, .report-html-container #eloTable tbody tr:hover, .report-html-container #detailTable tbody tr:hover {
+        background: #2563eb !important;
+        color: #fff !important;
+        box-shadow: 0 4px 12px rgba(37,99,235,0.15) !important;
+    }
+    .report-html-container .winner { color: #22c55e !important; font-weight: 700 !important; }
+    .report-html-container .loser { color: #ef4444 !important; font-weight: 700 !important; }
+    .report-html-container .tie { color: #f59e0b !important; font-weight: 700 !important; }
+    .report-html-container .model-name { color: #60a5fa !important; font-weight: 700 !important; }
+    .report-html-container .table-container, .report-html-container .chart-container {
+        background: #181c24 !important;
+        color: #f3f6fa !important;
+        border: 2px solid #3b4252 !important;
+        border-radius: 12px !important;
+        padding: 18px !important;
+        margin: 18px 0 !important;
+    }
+    .report-html-container .chart-title, .report-html-container .table-title {
+        color: #fff !important;
+        font-weight: 700 !important;
+        font-size: 18px !important;
+        margin-bottom: 14px !important;
+    }
+    .report-html-container .stat-card {
+        background: linear-gradient(135deg, #23293a 0%, #181c24 100%) !important;
+        color: #f3f6fa !important;
+        border: 2px solid #2563eb !important;
+        border-radius: 12px !important;
+        box-shadow: 0 8px 24px rgba(0,0,0,0.25) !important;
+        padding: 18px !important;
+        margin: 14px 0 !important;
+    }
+    .report-html-container .stat-value { color: #60a5fa !important; font-weight: 900 !important; font-size: 22px !important; }
+    .report-html-container .stat-label { color: #e2e8f0 !important; font-weight: 600 !important; font-size: 13px !important; }
+    .report-html-container .footer {
+        background: #181c24 !important;
+        color: #f3f6fa !important;
+        border-top: 2px solid #3b4252 !important;
+        padding: 18px !important;
+        margin-top: 32px !important;
+    }
+    .report-html-container * { background-color: transparent !important; }
+    .report-html-container .chart-container canvas { background: #23293a !important; border-radius: 8px !important; }
+    .report-html-container .stats-grid { display: grid !important; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)) !important; gap: 18px !important; margin: 18px 0 !important; }
+    .report-html-container h1, .report-html-container h2, .report-html-container h3, .report-html-container h4, .report-html-container h5, .report-html-container h6 { color: #fff !important; font-weight: 700 !important; }
+    .report-html-container p { color: #e2e8f0 !important; line-height: 1.6 !important; font-size: 14px !important; }
+    .report-html-container *::-webkit-scrollbar { width: 10px; height: 10px; }
+    .report-html-container *::-webkit-scrollbar-track { background: #23293a; border-radius: 5px; }
+    .report-html-container *::-webkit-scrollbar-thumb { background: linear-gradient(135deg, #2563eb 0%, #60a5fa 100%); border-radius: 5px; border: 2px solid #23293a; }
+    .report-html-container *::-webkit-scrollbar-thumb:hover { background: linear-gradient(135deg, #3b82f6 0%, #2563eb 100%); }
+    @media (max-width: 768px) {
+        .report-html-container table th, .report-html-container table td { padding: 10px 6px !important; font-size: 12px !important; }
+        .report-html-container .stat-value { font-size: 18px !important; }
+        .report-html-container .chart-title, .report-html-container .table-title { font-size: 15px !important; }
+    }
+    </style>
+'''
+
+def get_file_key(path):
+    """文件的 (路径, 修改时间, 大小)，文件不存在时返回None"""
     try:
-        # 获取项目根目录路径
-        current_dir = Path(__file__).parent
-        project_root = current_dir.parent.parent  # 从 fastchat/serve/ 回到项目根目录
-        
-        print(f"刷新报告 - 项目根目录: {project_root}")
-        
-        # 查找最新生成的报告文件
-        reports_dir = project_root / "reports"
-        print(f"检查报告目录: {reports_dir}")
-        
-        if reports_dir.exists():
-            # 找到最新的报告目录
-            report_dirs = [d for d in reports_dir.iterdir() if d.is_dir()]
-            print(f"找到 {len(report_dirs)} 个报告目录")
-            
-            if report_dirs:
-                latest_dir = max(report_dirs, key=lambda x: x.stat().st_mtime)
-                print(f"最新报告目录: {latest_dir}")
-                
-                report_file = latest_dir / "report.html"
-                print(f"报告文件路径: {report_file}")
-                
-                if report_file.exists():
-                    print(f"✅ 找到报告文件: {report_file}")
-                    
-                    # 读取HTML内容
-                    with open(report_file, 'r', encoding='utf-8') as f:
-                        html_content = f.read()
-                    
-                    # 从HTML中提取动态数据
-                    vote_data = extract_vote_data_from_html(html_content)
-                    model_data = extract_model_data_from_html(html_content)
-                    
-                    print(f"提取的投票数据: {vote_data}")
-                    print(f"提取的模型数据: {model_data}")
-                    
-                    # 修复Chart.js CDN链接
-                    html_content = html_content.replace(
-                        'https://cdnjs.cloudflare.com/ajax/libs/Chart.js/3.9.1/chart.min.js',
-                        'https://cdn.jsdelivr.net/npm/chart.js'
-                    )
-                    
-                    # 修复黑色覆盖问题 - 移除过度的通用CSS规则
-                    html_content = html_content.replace(
-                        '.content * {\n                color: #ffffff !important;\n            }',
-                        '/* 修复过度的通用样式 - 移除 .content * 规则 */'
-                    )
-                    
-                    # 注入强制黑色主题样式 - 解决ELO排名表白色背景问题
-                    theme_fix_css = '''
-                    <style>
-                    /* 优化配色方案：柔和深色背景+高亮色，提升可读性和现代感 */
-                    .report-html-container body {
-                        background-color: #181c24 !important;
-                        color: #f3f6fa !important;
-                        font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif !important;
-                    }
-                    .report-html-container .content, .report-html-container .table-container, .report-html-container .chart-container {
-                        background-color: #181c24 !important;
-                        color: #f3f6fa !important;
-                    }
-                    .report-html-container table, .report-html-container #eloTable, .report-html-container #detailTable {
-                        background: #23293a !important;
-                        color: #f3f6fa !important;
-                        border-collapse: collapse !important;
-                        border: 2px solid #3b4252 !important;
-                        border-radius: 10px !important;
-                        overflow: hidden !important;
-                    }
-                    .report-html-container table th, .report-html-container #eloTable th, .report-html-container #detailTable th {
-                        background: linear-gradient(135deg, #2563eb 0%, #60a5fa 100%) !important;
-                        color: #fff !important;
-                        border-bottom: 2px solid #2563eb !important;
-                        padding: 16px 12px !important;
-                        font-weight: 700 !important;
-                        text-shadow: 0 1px 2px rgba(0,0,0,0.3) !important;
-                        font-size: 15px !important;
-                    }
-                    .report-html-container table td, .report-html-container #eloTable td, .report-html-container #detailTable td {
-                        background: #23293a !important;
-                        color: #f3f6fa !important;
-                        border-bottom: 1px solid #3b4252 !important;
-                        padding: 14px 10px !important;
-                        font-size: 14px !important;
-                        font-weight: 500 !important;
-                    }
-                    .report-html-container table tbody tr:nth-child(even), .report-html-container #eloTable tbody tr:nth-child(even), .report-html-container #detailTable tbody tr:nth-child(even) {
-                        background: #20232b !important;
-                    }
-                    .report-html-container table tbody tr:hover, .report-html-container #eloTable tbody tr:hover, .report-html-container #detailTable tbody tr:hover {
-                        background: #2563eb !important;
-                        color: #fff !important;
-                        box-shadow: 0 4px 12px rgba(37,99,235,0.15) !important;
-                    }
-                    .report-html-container .winner { color: #22c55e !important; font-weight: 700 !important; }
-                    .report-html-container .loser { color: #ef4444 !important; font-weight: 700 !important; }
-                    .report-html-container .tie { color: #f59e0b !important; font-weight: 700 !important; }
-                    .report-html-container .model-name { color: #60a5fa !important; font-weight: 700 !important; }
-                    .report-html-container .table-container, .report-html-container .chart-container {
-                        background: #181c24 !important;
-                        color: #f3f6fa !important;
-                        border: 2px solid #3b4252 !important;
-                        border-radius: 12px !important;
-                        padding: 18px !important;
-                        margin: 18px 0 !important;
-                    }
-                    .report-html-container .chart-title, .report-html-container .table-title {
-                        color: #fff !important;
-                        font-weight: 700 !important;
-                        font-size: 18px !important;
-                        margin-bottom: 14px !important;
-                    }
-                    .report-html-container .stat-card {
-                        background: linear-gradient(135deg, #23293a 0%, #181c24 100%) !important;
-                        color: #f3f6fa !important;
-                        border: 2px solid #2563eb !important;
-                        border-radius: 12px !important;
-                        box-shadow: 0 8px 24px rgba(0,0,0,0.25) !important;
-                        padding: 18px !important;
-                        margin: 14px 0 !important;
-                    }
-                    .report-html-container .stat-value { color: #60a5fa !important; font-weight: 900 !important; font-size: 22px !important; }
-                    .report-html-container .stat-label { color: #e2e8f0 !important; font-weight: 600 !important; font-size: 13px !important; }
-                    .report-html-container .footer {
-                        background: #181c24 !important;
-                        color: #f3f6fa !important;
-                        border-top: 2px solid #3b4252 !important;
-                        padding: 18px !important;
-                        margin-top: 32px !important;
-                    }
-                    .report-html-container * { background-color: transparent !important; }
-                    .report-html-container .chart-container canvas { background: #23293a !important; border-radius: 8px !important; }
-                    .report-html-container .stats-grid { display: grid !important; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)) !important; gap: 18px !important; margin: 18px 0 !important; }
-                    .report-html-container h1, .report-html-container h2, .report-html-container h3, .report-html-container h4, .report-html-container h5, .report-html-container h6 { color: #fff !important; font-weight: 700 !important; }
-                    .report-html-container p { color: #e2e8f0 !important; line-height: 1.6 !important; font-size: 14px !important; }
-                    .report-html-container *::-webkit-scrollbar { width: 10px; height: 10px; }
-                    .report-html-container *::-webkit-scrollbar-track { background: #23293a; border-radius: 5px; }
-                    .report-html-container *::-webkit-scrollbar-thumb { background: linear-gradient(135deg, #2563eb 0%, #60a5fa 100%); border-radius: 5px; border: 2px solid #23293a; }
-                    .report-html-container *::-webkit-scrollbar-thumb:hover { background: linear-gradient(135deg, #3b82f6 0%, #2563eb 100%); }
-                    @media (max-width: 768px) {
-                        .report-html-container table th, .report-html-container table td { padding: 10px 6px !important; font-size: 12px !important; }
-                        .report-html-container .stat-value { font-size: 18px !important; }
-                        .report-html-container .chart-title, .report-html-container .table-title { font-size: 15px !important; }
-                    }
-                    </style>
-                    '''
-                    # 在head标签中注入样式
-                    if '<head>' in html_content:
-                        html_content = html_content.replace('<head>', f'<head>{theme_fix_css}')
-                    else:
-                        html_content = theme_fix_css + html_content
-                    # 移除原始的图表初始化脚本，避免冲突
-                    html_content = re.sub(r'<script>.*?function initCharts\(\).*?</script>', '', html_content, flags=re.DOTALL)
-                    # 在</body>标签前添加唯一的强制图表初始化代码
-                    force_init_script = f'''
+        stat = path.stat()
+    except OSError:
+        return None
+    return (str(path), stat.st_mtime_ns, stat.st_size)
+
+def load_report_data(data_file):
+    """读取报告数据 report_data.json，文件没有变化时使用缓存，文件不存在或版本不支持时返回None"""
+    data_key = get_file_key(data_file)
+    if data_key is None:
+        return None
+    with report_cache_lock:
+        if report_cache['data_key'] == data_key:
+            return report_cache['data']
+    
+    try:
+        with open(data_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取报告数据失败: {e}")
+        return None
+    if data.get('version') != REPORT_DATA_VERSION:
+        print(f"不支持的报告数据版本: {data.get('version')}")
+        return None
+    
+    with report_cache_lock:
+        report_cache['data_key'] = data_key
+        report_cache['data'] = data
+    return data
+
+def get_chart_data(report_data):
+    """从报告数据得到图表使用的投票分布和模型胜率"""
+    distribution = report_data.get('vote_distribution', {})
+    vote_data = {vote_type: distribution.get(vote_type, 0) for vote_type in ('leftvote', 'rightvote', 'tievote')}
+    models = report_data.get('models', [])
+    model_data = {
+        'labels': json.dumps([str(row['model']) for row in models], ensure_ascii=False),
+        'winRates': json.dumps([round(float(row['win_rate']), 2) for row in models]),
+        'barColors': json.dumps(['rgba(40, 167, 69, 0.8)' if i == 0 else 'rgba(102, 126, 234, 0.8)' for i in range(len(models))]),
+        'borderColors': json.dumps(['rgba(40, 167, 69, 1)' if i == 0 else 'rgba(102, 126, 234, 1)' for i in range(len(models))])
+    }
+    return vote_data, model_data
+
+def get_chart_script(vote_data, model_data):
+    """唯一的图表初始化脚本，替换报告中原有的脚本"""
+    return f'''
     <script>
         // 唯一的图表初始化脚本 - 避免冲突
         let chartsInitialized = false;
@@ -828,12 +828,99 @@ def refresh_latest_report():
         }}
         startInitialization();
     </script>
-    </body>'''
-                    html_content = html_content.replace('</body>', force_init_script)
-                    return f"✅ 最新报告已刷新！累积数据已更新，包含最新投票信息。", html_content
-                else:
-                    print(f"❌ 报告文件不存在: {report_file}")
+    </body>
+    '''
+
+def render_report_html(html_content, vote_data, model_data):
+    """修正报告HTML的样式，并注入图表初始化脚本"""
+    # 修复Chart.js CDN链接
+    html_content = html_content.replace(
+        'https://cdnjs.cloudflare.com/ajax/libs/Chart.js/3.9.1/chart.min.js',
+        'https://cdn.jsdelivr.net/npm/chart.js'
+    )
+    
+    # 修复黑色覆盖问题 - 移除过度的通用CSS规则
+    html_content = html_content.replace(
+        '.content * {\n                color: #ffffff !important;\n            }',
+        '/* 修复过度的通用样式 - 移除 .content * 规则 */'
+    )
+    
+    # 在head标签中注入样式
+    if '<head>' in html_content:
+        html_content = html_content.replace('<head>', f'<head>{REPORT_THEME_CSS}')
+    else:
+        html_content = REPORT_THEME_CSS + html_content
+    # 移除原始的图表初始化脚本，避免冲突
+    html_content = re.sub(r'<script>.*?function initCharts\(\).*?</script>', '', html_content, flags=re.DOTALL)
+    # 在</body>标签前添加唯一的强制图表初始化代码
+    return html_content.replace('</body>', get_chart_script(vote_data, model_data))
+
+def refresh_latest_report():
+    """
+    刷新最新报告（不重新生成）
+    报告数据和HTML都没有变化时直接返回缓存的渲染结果，不读取任何文件
+    """
+    try:
+        # 获取项目根目录路径
+        current_dir = Path(__file__).parent
+        project_root = current_dir.parent.parent  # 从 fastchat/serve/ 回到项目根目录
+        static_reports_dir = project_root / "static" / "reports"
         
+        report_data = load_report_data(static_reports_dir / "report_data.json")
+        if report_data is None:
+            # 没有报告数据文件的旧报告，从HTML中解析数据
+            return refresh_legacy_report(project_root)
+        
+        report_file = static_reports_dir / report_data.get('report_html', 'report.html')
+        report_key = get_file_key(report_file)
+        if report_key is None:
+            print(f"❌ 报告文件不存在: {report_file}")
+            return "❌ 未找到任何报告文件", "<p>请先生成报告</p>"
+        
+        status_msg = f"✅ 最新报告已刷新！累积数据已更新，包含最新投票信息。(生成于 {report_data.get('generated_at', '未知')})"
+        html_key = (report_data['data_version'], report_key)
+        with report_cache_lock:
+            if report_cache['html_key'] == html_key:
+                return status_msg, report_cache['html']
+        
+        print(f"✅ 加载报告: {report_file} (数据版本 {report_data['data_version']})")
+        with open(report_file, 'r', encoding='utf-8') as f:
+            html_content = f.read()
+        vote_data, model_data = get_chart_data(report_data)
+        html_content = render_report_html(html_content, vote_data, model_data)
+        
+        with report_cache_lock:
+            report_cache['html_key'] = html_key
+            report_cache['html'] = html_content
+        return status_msg, html_content
+    except Exception as e:
+        print(f"刷新报告异常: {str(e)}")
+        return f"❌ 刷新报告失败: {str(e)}", "<p>刷新失败</p>"
+
+def refresh_legacy_report(project_root):
+    """显示没有报告数据文件的旧报告，图表数据从HTML中解析"""
+    print(f"刷新报告 - 项目根目录: {project_root}")
+    
+    # 查找最新生成的报告文件
+    reports_dir = project_root / "reports"
+    print(f"检查报告目录: {reports_dir}")
+    
+    report_file = None
+    if reports_dir.exists():
+        # 找到最新的报告目录
+        report_dirs = [d for d in reports_dir.iterdir() if d.is_dir()]
+        print(f"找到 {len(report_dirs)} 个报告目录")
+        
+        if report_dirs:
+            latest_dir = max(report_dirs, key=lambda x: x.stat().st_mtime)
+            print(f"最新报告目录: {latest_dir}")
+            
+            if (latest_dir / "report.html").exists():
+                report_file = latest_dir / "report.html"
+            else:
+                print(f"❌ 报告文件不存在: {latest_dir / 'report.html'}")
+    
+    if report_file is None:
         # 备用：从static/reports目录查找
         static_reports_dir = project_root / "static" / "reports"
         print(f"检查静态报告目录: {static_reports_dir}")
@@ -843,159 +930,26 @@ def refresh_latest_report():
             print(f"找到 {len(html_files)} 个HTML文件")
             
             if html_files:
-                latest_report = max(html_files, key=os.path.getmtime)
-                print(f"最新静态报告: {latest_report}")
-                
-                # 读取HTML内容
-                with open(latest_report, 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                
-                # 注入强制黑色主题样式 - 解决ELO排名表白色背景问题
-                theme_fix_css = '''
-                <style>
-                /* 优化配色方案：柔和深色背景+高亮色，提升可读性和现代感 */
-                .report-html-container body {
-                    background-color: #181c24 !important;
-                    color: #f3f6fa !important;
-                    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif !important;
-                }
-                .report-html-container .content, .report-html-container .table-container, .report-html-container .chart-container {
-                    background-color: #181c24 !important;
-                    color: #f3f6fa !important;
-                }
-                .report-html-container table, .report-html-container #eloTable, .report-html-container #detailTable {
-                    background: #23293a !important;
-                    color: #f3f6fa !important;
-                    border-collapse: collapse !important;
-                    border: 2px solid #3b4252 !important;
-                    border-radius: 10px !important;
-                    overflow: hidden !important;
-                }
-                .report-html-container table th, .report-html-container #eloTable th, .report-html-container #detailTable th {
-                    background: linear-gradient(135deg, #2563eb 0%, #60a5fa 100%) !important;
-                    color: #fff !important;
-                    border-bottom: 2px solid #2563eb !important;
-                    padding: 16px 12px !important;
-                    font-weight: 700 !important;
-                    text-shadow: 0 1px 2px rgba(0,0,0,0.3) !important;
-                    font-size: 15px !important;
-                }
-                .report-html-container table td, .report-html-container #eloTable td, .report-html-container #detailTable td {
-                    background: #23293a !important;
-                    color: #f3f6fa !important;
-                    border-bottom: 1px solid #3b4252 !important;
-                    padding: 14px 10px !important;
-                    font-size: 14px !important;
-                    font-weight: 500 !important;
-                }
-                .report-html-container table tbody tr:nth-child(even), .report-html-container #eloTable tbody tr:nth-child(even), .report-html-container #detailTable tbody tr:nth-child(even) {
-                    background: #20232b !important;
-                }
-                .report-html-container table tbody tr:hover, .report-html-container #eloTable tbody tr:hover, .report-html-container #detailTable tbody tr:hover {
-                    background: #2563eb !important;
-                    color: #fff !important;
-                    box-shadow: 0 4px 12px rgba(37,99,235,0.15) !important;
-                }
-                .report-html-container .winner { color: #22c55e !important; font-weight: 700 !important; }
-                .report-html-container .loser { color: #ef4444 !important; font-weight: 700 !important; }
-                .report-html-container .tie { color: #f59e0b !important; font-weight: 700 !important; }
-                .report-html-container .model-name { color: #60a5fa !important; font-weight: 700 !important; }
-                .report-html-container .table-container, .report-html-container .chart-container {
-                    background: #181c24 !important;
-                    color: #f3f6fa !important;
-                    border: 2px solid #3b4252 !important;
-                    border-radius: 12px !important;
-                    padding: 18px !important;
-                    margin: 18px 0 !important;
-                }
-                .report-html-container .chart-title, .report-html-container .table-title {
-                    color: #fff !important;
-                    font-weight: 700 !important;
-                    font-size: 18px !important;
-                    margin-bottom: 14px !important;
-                }
-                .report-html-container .stat-card {
-                    background: linear-gradient(135deg, #23293a 0%, #181c24 100%) !important;
-                    color: #f3f6fa !important;
-                    border: 2px solid #2563eb !important;
-                    border-radius: 12px !important;
-                    box-shadow: 0 8px 24px rgba(0,0,0,0.25) !important;
-                    padding: 18px !important;
-                    margin: 14px 0 !important;
-                }
-                .report-html-container .stat-value { color: #60a5fa !important; font-weight: 900 !important; font-size: 22px !important; }
-                .report-html-container .stat-label { color: #e2e8f0 !important; font-weight: 600 !important; font-size: 13px !important; }
-                .report-html-container .footer {
-                    background: #181c24 !important;
-                    color: #f3f6fa !important;
-                    border-top: 2px solid #3b4252 !important;
-                    padding: 18px !important;
-                    margin-top: 32px !important;
-                }
-                .report-html-container * { background-color: transparent !important; }
-                .report-html-container .chart-container canvas { background: #23293a !important; border-radius: 8px !important; }
-                .report-html-container .stats-grid { display: grid !important; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)) !important; gap: 18px !important; margin: 18px 0 !important; }
-                .report-html-container h1, .report-html-container h2, .report-html-container h3, .report-html-container h4, .report-html-container h5, .report-html-container h6 { color: #fff !important; font-weight: 700 !important; }
-                .report-html-container p { color: #e2e8f0 !important; line-height: 1.6 !important; font-size: 14px !important; }
-                .report-html-container *::-webkit-scrollbar { width: 10px; height: 10px; }
-                .report-html-container *::-webkit-scrollbar-track { background: #23293a; border-radius: 5px; }
-                .report-html-container *::-webkit-scrollbar-thumb { background: linear-gradient(135deg, #2563eb 0%, #60a5fa 100%); border-radius: 5px; border: 2px solid #23293a; }
-                .report-html-container *::-webkit-scrollbar-thumb:hover { background: linear-gradient(135deg, #3b82f6 0%, #2563eb 100%); }
-                @media (max-width: 768px) {
-                    .report-html-container table th, .report-html-container table td { padding: 10px 6px !important; font-size: 12px !important; }
-                    .report-html-container .stat-value { font-size: 18px !important; }
-                    .report-html-container .chart-title, .report-html-container .table-title { font-size: 15px !important; }
-                }
-                </style>
-                '''
-                # 在head标签中注入样式
-                if '<head>' in html_content:
-                    html_content = html_content.replace('<head>', f'<head>{theme_fix_css}')
-                else:
-                    html_content = theme_fix_css + html_content
-                # 移除原始的图表初始化脚本，避免冲突
-                html_content = re.sub(r'<script>.*?function initCharts\(\).*?</script>', '', html_content, flags=re.DOTALL)
-                # 在</body>标签前添加唯一的强制图表初始化代码
-                force_init_script = f'''
-    <script>
-        // 唯一的图表初始化脚本 - 避免冲突
-        let chartsInitialized = false;
-        let initAttempts = 0;
-        function initializeCharts() {{
-            initAttempts++;
-            if (chartsInitialized) return;
-            if (typeof Chart === 'undefined') {{
-                if (initAttempts < 20) setTimeout(initializeCharts, 500);
-                return;
-            }}
-            try {{
-                const voteCanvas = document.getElementById('voteTypeChart');
-                if (voteCanvas) {{ Chart.getChart(voteCanvas)?.destroy();
-                    const voteCtx = voteCanvas.getContext('2d');
-                    new Chart(voteCtx, {{ type: 'doughnut', data: {{ labels: ['左方获胜', '右方获胜', '平局'], datasets: [{{ data: [{vote_data['leftvote']}, {vote_data['rightvote']}, {vote_data['tievote']}], backgroundColor: ['#22c55e', '#2563eb', '#f59e0b'], borderWidth: 2, borderColor: '#fff' }}] }}, options: {{ responsive: true, maintainAspectRatio: false, plugins: {{ legend: {{ position: 'bottom', labels: {{ padding: 10, usePointStyle: true }} }} }} }} }});
-                const winRateCanvas = document.getElementById('winRateChart');
-                if (winRateCanvas) {{ Chart.getChart(winRateCanvas)?.destroy();
-                    const winRateCtx = winRateCanvas.getContext('2d');
-                    new Chart(winRateCtx, {{ type: 'bar', data: {{ labels: {model_data['labels']}, datasets: [{{ label: '胜率 (%)', data: {model_data['winRates']}, backgroundColor: {model_data['barColors']}, borderColor: {model_data['borderColors']}, borderWidth: 2 }}] }}, options: {{ responsive: true, maintainAspectRatio: false, scales: {{ y: {{ beginAtZero: true, max: 100, ticks: {{ callback: function(value) {{ return value + '%' }} }} }} }}, plugins: {{ legend: {{ display: false }} }} }} }});
-                chartsInitialized = true;
-            }} catch (error) {{}}
-        }}
-        function startInitialization() {{
-            initializeCharts();
-            if (document.readyState === 'loading') {{ document.addEventListener('DOMContentLoaded', function() {{ setTimeout(initializeCharts, 100); }}); }}
-            if (document.readyState !== 'complete') {{ window.addEventListener('load', function() {{ setTimeout(initializeCharts, 200); }}); }}
-            let retryCount = 0; const maxRetries = 10; const retryInterval = setInterval(function() {{ retryCount++; if (!chartsInitialized && retryCount < maxRetries) {{ initializeCharts(); }} else {{ clearInterval(retryInterval); }} }}, 1000);
-        }}
-        startInitialization();
-    </script>
-    </body>'''
-                html_content = html_content.replace('</body>', force_init_script)
-                return f"✅ 最新报告已刷新！累积数据已更新，包含最新投票信息。", html_content
-        
+                report_file = max(html_files, key=os.path.getmtime)
+    
+    if report_file is None:
         return "❌ 未找到任何报告文件", "<p>请先生成报告</p>"
-    except Exception as e:
-        print(f"刷新报告异常: {str(e)}")
-        return f"❌ 刷新报告失败: {str(e)}", "<p>刷新失败</p>"
+    
+    print(f"✅ 找到报告文件: {report_file}")
+    
+    # 读取HTML内容
+    with open(report_file, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+    
+    # 从HTML中提取动态数据
+    vote_data = extract_vote_data_from_html(html_content)
+    model_data = extract_model_data_from_html(html_content)
+    
+    print(f"提取的投票数据: {vote_data}")
+    print(f"提取的模型数据: {model_data}")
+    
+    html_content = render_report_html(html_content, vote_data, model_data)
+    return f"✅ 最新报告已刷新！累积数据已更新，包含最新投票信息。", html_content
 
 def build_reports_tab():
     """构建FastChat投票分析报告标签页"""
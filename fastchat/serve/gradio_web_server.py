@@ -3,6 +3,7 @@ The gradio demo server for chatting with a single model.
 """
 
 import argparse
+import asyncio
 from collections import defaultdict
 import datetime
 import hashlib
@@ -14,6 +15,7 @@ import uuid
 from typing import List, Dict
 
 import gradio as gr
+import httpx
 import requests
 
 from fastchat.constants import (
@@ -33,13 +35,21 @@ from fastchat.model.model_adapter import (
     get_conversation_template,
 )
 from fastchat.model.model_registry import get_model_info, model_info
+from fastchat.serve.api_client_pool import create_async_http_client, get_client
 from fastchat.serve.api_provider import get_api_provider_stream_iter
+from fastchat.serve.api_provider_async import (
+    get_api_provider_stream_iter_async,
+    set_provider_concurrency_limit,
+)
 from fastchat.serve.gradio_global_state import Context
+from fastchat.serve.moderation import get_moderation_service
 from fastchat.serve.remote_logger import get_remote_logger
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_DELTA, StreamDecoder
 from fastchat.utils import (
     build_logger,
     get_window_url_params_js,
     get_window_url_params_with_tos_js,
+    get_moderation_thresholds,
     moderation_filter,
     parse_gradio_auth_creds,
     load_image,
@@ -65,6 +75,10 @@ disable_text = gr.Textbox(
 controller_url = None
 enable_moderation = False
 use_remote_storage = False
+# "sync": moderate each turn before generating.
+# "parallel": start generating right away and withhold the output until the
+# moderation verdict arrives.
+moderation_mode = "sync"
 
 acknowledgment_md = """
 ### Terms of Service
@@ -121,6 +135,8 @@ class State:
         self.is_vision = is_vision
         self.ans_models = []
         self.router_outputs = []
+        # future of the moderation verdict of the last turn in parallel mode
+        self.moderation_verdict = None
 
         # NOTE(chris): This could be sort of a hack since it assumes the user only uploads one image. If they can upload multiple, we should store a list of image hashes.
         self.has_csam_image = False
@@ -185,11 +201,13 @@ def set_global_vars(
     controller_url_,
     enable_moderation_,
     use_remote_storage_,
+    moderation_mode_="sync",
 ):
-    global controller_url, enable_moderation, use_remote_storage
+    global controller_url, enable_moderation, use_remote_storage, moderation_mode
     controller_url = controller_url_
     enable_moderation = enable_moderation_
     use_remote_storage = use_remote_storage_
+    moderation_mode = moderation_mode_
 
 
 def get_conv_log_filename(is_vision=False, has_csam_image=False):
@@ -354,6 +372,43 @@ def get_ip(request: gr.Request):
     return ip
 
 
+def get_moderation_texts(convs, text, max_chars):
+    """
+    The new text and the messages in the last max_chars characters of each
+    conversation. They are moderated one by one, so the messages checked on
+    earlier turns hit the moderation cache.
+    """
+    texts = [text]
+    for conv in convs:
+        num_chars = 0
+        for _, message in reversed(conv.messages[conv.offset :]):
+            if num_chars >= max_chars:
+                break
+            if isinstance(message, (tuple, list)):
+                # text and images
+                message = message[0]
+            if not message:
+                continue
+            texts.append(message[-max_chars:])
+            num_chars += len(message)
+    return texts
+
+
+def start_moderation(texts, model_list):
+    """Return a future of the moderation verdict, None if model_list is not moderated."""
+    custom_thresholds = get_moderation_thresholds(model_list)
+    if custom_thresholds is None:
+        return None
+    return get_moderation_service().check_later(texts, custom_thresholds)
+
+
+def apply_moderation_verdict(state, flagged):
+    """Overwrite the last user message if the moderation flagged it."""
+    if flagged:
+        logger.info(f"violate moderation. text: {state.conv.messages[-2][1]}")
+        state.conv.messages[-2][1] = MODERATION_MSG
+
+
 def add_text(state, model_selector, text, request: gr.Request):
     ip = get_ip(request)
     logger.info(f"add_text. ip: {ip}. len: {len(text)}")
@@ -365,10 +420,14 @@ def add_text(state, model_selector, text, request: gr.Request):
         state.skip_next = True
         return (state, state.to_gradio_chatbot(), "", None) + (no_change_btn,) * 5
 
-    all_conv_text = state.conv.get_prompt()
-    all_conv_text = all_conv_text[-2000:] + "\nuser: " + text
-    flagged = moderation_filter(all_conv_text, [state.model_name])
-    # flagged = moderation_filter(text, [state.model_name])
+    moderation_texts = get_moderation_texts([state.conv], text, 2000)
+    if moderation_mode == "parallel":
+        state.moderation_verdict = start_moderation(
+            moderation_texts, [state.model_name]
+        )
+        flagged = False
+    else:
+        flagged = moderation_filter(moderation_texts, [state.model_name])
     if flagged:
         logger.info(f"violate moderation. ip: {ip}. text: {text}")
         # overwrite the original text
@@ -387,10 +446,9 @@ def add_text(state, model_selector, text, request: gr.Request):
     return (state, state.to_gradio_chatbot(), "") + (disable_btn,) * 5
 
 
-def model_worker_stream_iter(
+def get_worker_gen_params(
     conv,
     model_name,
-    worker_addr,
     prompt,
     temperature,
     repetition_penalty,
@@ -398,7 +456,6 @@ def model_worker_stream_iter(
     max_new_tokens,
     images,
 ):
-    # Make requests
     gen_params = {
         "model": model_name,
         "prompt": prompt,
@@ -409,12 +466,39 @@ def model_worker_stream_iter(
         "stop": conv.stop_str,
         "stop_token_ids": conv.stop_token_ids,
         "echo": False,
+        "stream_protocol": STREAM_PROTOCOL_DELTA,
+        "request_id": uuid.uuid4().hex,
     }
 
     logger.info(f"==== request ====\n{gen_params}")
 
     if len(images) > 0:
         gen_params["images"] = images
+    return gen_params
+
+
+def model_worker_stream_iter(
+    conv,
+    model_name,
+    worker_addr,
+    prompt,
+    temperature,
+    repetition_penalty,
+    top_p,
+    max_new_tokens,
+    images,
+):
+    # Make requests
+    gen_params = get_worker_gen_params(
+        conv,
+        model_name,
+        prompt,
+        temperature,
+        repetition_penalty,
+        top_p,
+        max_new_tokens,
+        images,
+    )
 
     # Stream output
     response = requests.post(
@@ -424,10 +508,83 @@ def model_worker_stream_iter(
         stream=True,
         timeout=WORKER_API_TIMEOUT,
     )
-    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-        if chunk:
-            data = json.loads(chunk.decode())
-            yield data
+    decoder = StreamDecoder()
+    finished = False
+    try:
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                data, _ = decoder.decode(json.loads(chunk.decode()))
+                yield data
+        finished = True
+    finally:
+        response.close()
+        if not finished:
+            # the user left or stopped the generation, free the worker
+            try:
+                requests.post(
+                    worker_addr + "/worker_cancel",
+                    headers=headers,
+                    json={"request_id": gen_params["request_id"]},
+                    timeout=5,
+                )
+            except requests.exceptions.RequestException:
+                pass
+
+
+async def model_worker_stream_iter_async(
+    conv,
+    model_name,
+    worker_addr,
+    prompt,
+    temperature,
+    repetition_penalty,
+    top_p,
+    max_new_tokens,
+    images,
+):
+    gen_params = get_worker_gen_params(
+        conv,
+        model_name,
+        prompt,
+        temperature,
+        repetition_penalty,
+        top_p,
+        max_new_tokens,
+        images,
+    )
+
+    client = get_client("model_worker", worker_addr, None, create_async_http_client)
+    decoder = StreamDecoder()
+    finished = False
+    try:
+        async with client.stream(
+            "POST",
+            worker_addr + "/worker_generate_stream",
+            headers=headers,
+            json=gen_params,
+            timeout=WORKER_API_TIMEOUT,
+        ) as response:
+            buffer = b""
+            async for raw_chunk in response.aiter_raw():
+                buffer += raw_chunk
+                while (chunk_end := buffer.find(b"\0")) >= 0:
+                    chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+                    if chunk:
+                        data, _ = decoder.decode(json.loads(chunk.decode()))
+                        yield data
+        finished = True
+    finally:
+        if not finished:
+            # the user left or stopped the generation, free the worker
+            try:
+                await client.post(
+                    worker_addr + "/worker_cancel",
+                    headers=headers,
+                    json={"request_id": gen_params["request_id"]},
+                    timeout=5,
+                )
+            except httpx.HTTPError:
+                pass
 
 
 def is_limit_reached(model_name, ip):
@@ -443,27 +600,12 @@ def is_limit_reached(model_name, ip):
         return None
 
 
-def bot_response(
-    state: State,
-    temperature,
-    top_p,
-    max_new_tokens,
-    request: gr.Request,
-    apply_rate_limit=True,
-    use_recommended_config=False,
-):
-    ip = get_ip(request)
-    logger.info(f"bot_response. ip: {ip}")
-    start_tstamp = time.time()
-    temperature = float(temperature)
-    top_p = float(top_p)
-    max_new_tokens = int(max_new_tokens)
-
+def check_bot_response(state, ip, apply_rate_limit):
+    """Return the outputs that end bot_response right away, or None."""
     if state.skip_next:
         # This generate call is skipped due to invalid inputs
         state.skip_next = False
-        yield (state, state.to_gradio_chatbot()) + (no_change_btn,) * 5
-        return
+        return (state, state.to_gradio_chatbot()) + (no_change_btn,) * 5
 
     if apply_rate_limit:
         ret = is_limit_reached(state.model_name, ip)
@@ -471,9 +613,22 @@ def bot_response(
             error_msg = RATE_LIMIT_MSG + "\n\n" + ret["reason"]
             logger.info(f"rate limit reached. ip: {ip}. error_msg: {ret['reason']}")
             state.conv.update_last_message(error_msg)
-            yield (state, state.to_gradio_chatbot()) + (no_change_btn,) * 5
-            return
+            return (state, state.to_gradio_chatbot()) + (no_change_btn,) * 5
+    return None
+
 
+def prepare_bot_response(
+    state,
+    temperature,
+    top_p,
+    max_new_tokens,
+    use_recommended_config=False,
+    use_async=False,
+):
+    """
+    Start the stream of the reply of the model of state to the last turn.
+    Return (stream_iter, gen_params), or (None, None) if no worker serves the model.
+    """
     conv, model_name = state.conv, state.model_name
     model_api_dict = (
         api_endpoint_info[model_name] if model_name in api_endpoint_info else None
@@ -490,17 +645,7 @@ def bot_response(
 
         # No available worker
         if worker_addr == "":
-            conv.update_last_message(SERVER_ERROR_MSG)
-            yield (
-                state,
-                state.to_gradio_chatbot(),
-                disable_btn,
-                disable_btn,
-                disable_btn,
-                enable_btn,
-                enable_btn,
-            )
-            return
+            return None, None
 
         # Construct prompt.
         # We need to call it here, so it will not be affected by "▌".
@@ -511,7 +656,11 @@ def bot_response(
         else:
             repetition_penalty = 1.0
 
-        stream_iter = model_worker_stream_iter(
+        if use_async:
+            stream_iter_func = model_worker_stream_iter_async
+        else:
+            stream_iter_func = model_worker_stream_iter
+        stream_iter = stream_iter_func(
             conv,
             model_name,
             worker_addr,
@@ -540,7 +689,11 @@ def bot_response(
                 )
                 extra_body = recommended_config.get("extra_body", None)
 
-        stream_iter = get_api_provider_stream_iter(
+        if use_async:
+            stream_iter_func = get_api_provider_stream_iter_async
+        else:
+            stream_iter_func = get_api_provider_stream_iter
+        stream_iter = stream_iter_func(
             conv,
             model_name,
             model_api_dict,
@@ -551,77 +704,81 @@ def bot_response(
             extra_body=extra_body,
         )
 
-    html_code = ' <span class="cursor"></span> '
+    gen_params = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+    }
+    return stream_iter, gen_params
+
+
+def get_no_worker_outputs(state):
+    state.conv.update_last_message(SERVER_ERROR_MSG)
+    return (
+        state,
+        state.to_gradio_chatbot(),
+        disable_btn,
+        disable_btn,
+        disable_btn,
+        enable_btn,
+        enable_btn,
+    )
 
-    # conv.update_last_message("▌")
-    conv.update_last_message(html_code)
-    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
-    try:
-        data = {"text": ""}
-        for i, data in enumerate(stream_iter):
-            # Change for P2L:
-            if i == 0:
-                if "ans_model" in data:
-                    ans_model = data.get("ans_model")
-
-                    state.update_ans_models(ans_model)
-
-                if "router_outputs" in data:
-                    router_outputs = data.get("router_outputs")
-
-                    state.update_router_outputs(router_outputs)
-
-            if data["error_code"] == 0:
-                output = data["text"].strip()
-                conv.update_last_message(output + "▌")
-                # conv.update_last_message(output + html_code)
-                yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
-            else:
-                output = data["text"] + f"\n\n(error_code: {data['error_code']})"
-                conv.update_last_message(output)
-                yield (state, state.to_gradio_chatbot()) + (
-                    disable_btn,
-                    disable_btn,
-                    disable_btn,
-                    enable_btn,
-                    enable_btn,
-                )
-                return
+def render_bot_chunk(state, i, data):
+    """Return the outputs for chunk i of the stream, and whether it is an error."""
+    # Change for P2L:
+    if i == 0:
+        if "ans_model" in data:
+            ans_model = data.get("ans_model")
+
+            state.update_ans_models(ans_model)
+
+        if "router_outputs" in data:
+            router_outputs = data.get("router_outputs")
+
+            state.update_router_outputs(router_outputs)
+
+    if data["error_code"] == 0:
         output = data["text"].strip()
-        conv.update_last_message(output)
-        yield (state, state.to_gradio_chatbot()) + (enable_btn,) * 5
-    except requests.exceptions.RequestException as e:
-        conv.update_last_message(
-            f"{SERVER_ERROR_MSG}\n\n"
-            f"(error_code: {ErrorCode.GRADIO_REQUEST_ERROR}, {e})"
-        )
-        yield (state, state.to_gradio_chatbot()) + (
-            disable_btn,
-            disable_btn,
-            disable_btn,
-            enable_btn,
-            enable_btn,
-        )
-        return
-    except Exception as e:
-        conv.update_last_message(
-            f"{SERVER_ERROR_MSG}\n\n"
-            f"(error_code: {ErrorCode.GRADIO_STREAM_UNKNOWN_ERROR}, {e})"
-        )
-        yield (state, state.to_gradio_chatbot()) + (
-            disable_btn,
-            disable_btn,
-            disable_btn,
-            enable_btn,
-            enable_btn,
-        )
-        return
+        state.conv.update_last_message(output + "▌")
+        # conv.update_last_message(output + html_code)
+        return (state, state.to_gradio_chatbot()) + (disable_btn,) * 5, False
+
+    output = data["text"] + f"\n\n(error_code: {data['error_code']})"
+    state.conv.update_last_message(output)
+    outputs = (state, state.to_gradio_chatbot()) + (
+        disable_btn,
+        disable_btn,
+        disable_btn,
+        enable_btn,
+        enable_btn,
+    )
+    return outputs, True
+
+
+def render_bot_error(state, e):
+    if isinstance(e, (requests.exceptions.RequestException, httpx.HTTPError)):
+        error_code = ErrorCode.GRADIO_REQUEST_ERROR
+    else:
+        error_code = ErrorCode.GRADIO_STREAM_UNKNOWN_ERROR
+    state.conv.update_last_message(
+        f"{SERVER_ERROR_MSG}\n\n(error_code: {error_code}, {e})"
+    )
+    return (state, state.to_gradio_chatbot()) + (
+        disable_btn,
+        disable_btn,
+        disable_btn,
+        enable_btn,
+        enable_btn,
+    )
+
 
+def log_bot_response(state, gen_params, start_tstamp, request):
     finish_tstamp = time.time()
-    logger.info(f"{output}")
+    logger.info(f"{state.conv.messages[-1][1]}")
 
-    conv.save_new_images(
+    state.conv.save_new_images(
         has_csam_images=state.has_csam_image, use_remote_storage=use_remote_storage
     )
 
@@ -633,12 +790,8 @@ def bot_response(
         data = {
             "tstamp": round(finish_tstamp, 4),
             "type": "chat",
-            "model": model_name,
-            "gen_params": {
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_new_tokens": max_new_tokens,
-            },
+            "model": state.model_name,
+            "gen_params": gen_params,
             "start": round(start_tstamp, 4),
             "finish": round(finish_tstamp, 4),
             "state": state.dict(),
@@ -648,6 +801,183 @@ def bot_response(
     get_remote_logger().log(data)
 
 
+def bot_response(
+    state: State,
+    temperature,
+    top_p,
+    max_new_tokens,
+    request: gr.Request,
+    apply_rate_limit=True,
+    use_recommended_config=False,
+):
+    ip = get_ip(request)
+    logger.info(f"bot_response. ip: {ip}")
+    start_tstamp = time.time()
+    temperature = float(temperature)
+    top_p = float(top_p)
+    max_new_tokens = int(max_new_tokens)
+
+    verdict, state.moderation_verdict = state.moderation_verdict, None
+    outputs = check_bot_response(state, ip, apply_rate_limit)
+    if outputs is not None:
+        yield outputs
+        return
+
+    if verdict is not None:
+        apply_moderation_verdict(state, verdict.result())
+    stream_iter, gen_params = prepare_bot_response(
+        state, temperature, top_p, max_new_tokens, use_recommended_config
+    )
+    if stream_iter is None:
+        yield get_no_worker_outputs(state)
+        return
+
+    html_code = ' <span class="cursor"></span> '
+
+    # conv.update_last_message("▌")
+    state.conv.update_last_message(html_code)
+    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+
+    try:
+        data = {"text": ""}
+        for i, data in enumerate(stream_iter):
+            outputs, is_error = render_bot_chunk(state, i, data)
+            yield outputs
+            if is_error:
+                return
+        state.conv.update_last_message(data["text"].strip())
+        yield (state, state.to_gradio_chatbot()) + (enable_btn,) * 5
+    except Exception as e:
+        yield render_bot_error(state, e)
+        return
+    finally:
+        # stops the worker too when the user leaves half way
+        stream_iter.close()
+
+    log_bot_response(state, gen_params, start_tstamp, request)
+
+
+async def prepend_chunk(first_chunk, stream_iter):
+    try:
+        try:
+            data = await first_chunk
+        except StopAsyncIteration:
+            return
+        yield data
+        async for data in stream_iter:
+            yield data
+    finally:
+        await stream_iter.aclose()
+
+
+async def withhold_until_moderated(verdict, stream_iter):
+    """
+    Let stream_iter produce its first chunk while the moderation verdict is
+    pending. Return (flagged, stream): the same output as stream_iter if the
+    turn passes, or None after closing stream_iter if it is flagged.
+    """
+    first_chunk = asyncio.ensure_future(stream_iter.__anext__())
+    try:
+        flagged = await asyncio.wrap_future(verdict)
+    except BaseException:
+        first_chunk.cancel()
+        await asyncio.gather(first_chunk, return_exceptions=True)
+        raise
+    if not flagged:
+        return False, prepend_chunk(first_chunk, stream_iter)
+    first_chunk.cancel()
+    await asyncio.gather(first_chunk, return_exceptions=True)
+    await stream_iter.aclose()
+    return True, None
+
+
+async def bot_response_async(
+    state: State,
+    temperature,
+    top_p,
+    max_new_tokens,
+    request: gr.Request,
+    apply_rate_limit=True,
+    use_recommended_config=False,
+):
+    """
+    Same as bot_response, but the model output is awaited on the event loop,
+    so a stream does not hold a Gradio worker thread while it waits.
+    """
+    ip = get_ip(request)
+    logger.info(f"bot_response. ip: {ip}")
+    start_tstamp = time.time()
+    temperature = float(temperature)
+    top_p = float(top_p)
+    max_new_tokens = int(max_new_tokens)
+
+    verdict, state.moderation_verdict = state.moderation_verdict, None
+    # the rate limit and worker lookups are blocking HTTP calls
+    outputs = await asyncio.to_thread(check_bot_response, state, ip, apply_rate_limit)
+    if outputs is not None:
+        yield outputs
+        return
+
+    stream_iter, gen_params = await asyncio.to_thread(
+        prepare_bot_response,
+        state,
+        temperature,
+        top_p,
+        max_new_tokens,
+        use_recommended_config,
+        use_async=True,
+    )
+    if stream_iter is None:
+        yield get_no_worker_outputs(state)
+        return
+
+    html_code = ' <span class="cursor"></span> '
+
+    state.conv.update_last_message(html_code)
+    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+
+    try:
+        if verdict is not None:
+            flagged, stream_iter = await withhold_until_moderated(verdict, stream_iter)
+            if flagged:
+                # generate again for the overwritten message
+                apply_moderation_verdict(state, True)
+                state.conv.update_last_message(None)
+                stream_iter, gen_params = await asyncio.to_thread(
+                    prepare_bot_response,
+                    state,
+                    temperature,
+                    top_p,
+                    max_new_tokens,
+                    use_recommended_config,
+                    use_async=True,
+                )
+                if stream_iter is None:
+                    yield get_no_worker_outputs(state)
+                    return
+                state.conv.update_last_message(html_code)
+
+        data = {"text": ""}
+        i = 0
+        async for data in stream_iter:
+            outputs, is_error = render_bot_chunk(state, i, data)
+            i += 1
+            yield outputs
+            if is_error:
+                return
+        state.conv.update_last_message(data["text"].strip())
+        yield (state, state.to_gradio_chatbot()) + (enable_btn,) * 5
+    except Exception as e:
+        yield render_bot_error(state, e)
+        return
+    finally:
+        # stops the worker too when the user leaves half way
+        if stream_iter is not None:
+            await stream_iter.aclose()
+
+    await asyncio.to_thread(log_bot_response, state, gen_params, start_tstamp, request)
+
+
 block_css = """
 .prose {
     font-size: 105% !important;
@@ -1631,7 +1961,7 @@ def build_single_model_ui(models, add_promotion_links=False):
         [textbox, upvote_btn, downvote_btn, flag_btn],
     )
     regenerate_btn.click(regenerate, state, [state, chatbot, textbox] + btn_list).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
@@ -1644,7 +1974,7 @@ def build_single_model_ui(models, add_promotion_links=False):
         [state, model_selector, textbox],
         [state, chatbot, textbox] + btn_list,
     ).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
@@ -1653,7 +1983,7 @@ def build_single_model_ui(models, add_promotion_links=False):
         [state, model_selector, textbox],
         [state, chatbot, textbox] + btn_list,
     ).then(
-        bot_response,
+        bot_response_async,
         [state, temperature, top_p, max_output_tokens],
         [state, chatbot] + btn_list,
     )
@@ -1733,7 +2063,13 @@ if __name__ == "__main__":
         "--concurrency-count",
         type=int,
         default=10,
-        help="The concurrency count of the gradio queue",
+        help="The concurrency count of the gradio queue. Streaming replies do not hold a worker thread, so it can be well above max_threads",
+    )
+    parser.add_argument(
+        "--provider-concurrency-limit",
+        type=int,
+        default=64,
+        help="The max number of concurrent streams of an API provider endpoint, unless its max_concurrency is set",
     )
     parser.add_argument(
         "--model-list-mode",
@@ -1747,6 +2083,13 @@ if __name__ == "__main__":
         action="store_true",
         help="Enable content moderation to block unsafe inputs",
     )
+    parser.add_argument(
+        "--moderation-mode",
+        type=str,
+        default="sync",
+        choices=["sync", "parallel"],
+        help="Whether to moderate a turn before generating, or while generating with the output withheld until the verdict",
+    )
     parser.add_argument(
         "--show-terms-of-use",
         action="store_true",
@@ -1777,7 +2120,13 @@ if __name__ == "__main__":
     logger.info(f"args: {args}")
 
     # Set global variables
-    set_global_vars(args.controller_url, args.moderate, args.use_remote_storage)
+    set_global_vars(
+        args.controller_url,
+        args.moderate,
+        args.use_remote_storage,
+        args.moderation_mode,
+    )
+    set_provider_concurrency_limit(args.provider_concurrency_limit)
     models, all_models = get_model_list(
         args.controller_url, args.register_api_endpoint_file, vision_arena=False
     )
@@ -6,6 +6,7 @@ It supports chatting with a single model or chatting with two models side-by-sid
 import argparse
 import gradio as gr
 
+from fastchat.serve.api_provider_async import set_provider_concurrency_limit
 from fastchat.serve.gradio_block_arena_anony import (
     build_side_by_side_ui_anony,
     load_demo_side_by_side_anony,
@@ -336,7 +337,13 @@ if __name__ == "__main__":
         "--concurrency-count",
         type=int,
         default=10,
-        help="The concurrency count of the gradio queue",
+        help="The concurrency count of the gradio queue. Streaming replies do not hold a worker thread, so it can be well above max_threads",
+    )
+    parser.add_argument(
+        "--provider-concurrency-limit",
+        type=int,
+        default=64,
+        help="The max number of concurrent streams of an API provider endpoint, unless its max_concurrency is set",
     )
     parser.add_argument(
         "--model-list-mode",
@@ -350,6 +357,13 @@ if __name__ == "__main__":
         action="store_true",
         help="Enable content moderation to block unsafe inputs",
     )
+    parser.add_argument(
+        "--moderation-mode",
+        type=str,
+        default="sync",
+        choices=["sync", "parallel"],
+        help="Whether to moderate a turn before generating, or while generating with the output withheld until the verdict",
+    )
     parser.add_argument(
         "--show-terms-of-use",
         action="store_true",
@@ -415,8 +429,14 @@ if __name__ == "__main__":
     logger.info(f"args: {args}")
 
     # Set global variables
-    set_global_vars(args.controller_url, args.moderate, args.use_remote_storage)
-    set_global_vars_named(args.moderate)
+    set_global_vars(
+        args.controller_url,
+        args.moderate,
+        args.use_remote_storage,
+        args.moderation_mode,
+    )
+    set_provider_concurrency_limit(args.provider_concurrency_limit)
+    set_global_vars_named(args.moderate, args.moderation_mode)
     set_global_vars_anony(args.moderate)
     text_models, all_text_models = get_model_list(
         args.controller_url,
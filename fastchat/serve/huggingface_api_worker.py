@@ -35,7 +35,8 @@ from fastapi.responses import JSONResponse, StreamingResponse
 from huggingface_hub import InferenceClient
 
 from fastchat.constants import SERVER_ERROR_MSG, ErrorCode
-from fastchat.serve.base_model_worker import BaseModelWorker
+from fastchat.serve.base_model_worker import BaseModelWorker, create_cancelled_output
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.utils import build_logger
 
 worker_id = str(uuid.uuid4())[:8]
@@ -161,7 +162,18 @@ class HuggingfaceApiWorker(BaseModelWorker):
 
             reason = None
             text = ""
+            encoder = StreamEncoder(params)
+            cancel_event = self.get_cancel_event(params)
+            num_tokens = 0
             for chunk in res:
+                if cancel_event is not None and cancel_event.is_set():
+                    # closing the response stops the upstream generation
+                    res.close()
+                    self.record_cancellation(params, num_tokens)
+                    ret = {"text": text, "error_code": 0, "finish_reason": "abort"}
+                    yield json.dumps(encoder.encode(ret)).encode() + b"\0"
+                    break
+                num_tokens += 1
                 if chunk.token.special:
                     continue
                 text += chunk.token.text
@@ -185,7 +197,7 @@ class HuggingfaceApiWorker(BaseModelWorker):
                     "error_code": 0,
                     "finish_reason": reason,
                 }
-                yield json.dumps(ret).encode() + b"\0"
+                yield json.dumps(encoder.encode(ret)).encode() + b"\0"
         except Exception as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -194,8 +206,13 @@ class HuggingfaceApiWorker(BaseModelWorker):
             yield json.dumps(ret).encode() + b"\0"
 
     def generate_gate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
+        x = None
         for x in self.generate_stream_gate(params):
             pass
+        if x is None:
+            return create_cancelled_output()
         return json.loads(x[:-1].decode())
 
     def get_embeddings(self, params):
@@ -212,9 +229,10 @@ def acquire_worker_semaphore(worker):
     return worker.semaphore.acquire()
 
 
-def create_background_tasks(worker):
+def create_background_tasks(worker, params):
     background_tasks = BackgroundTasks()
     background_tasks.add_task(lambda: release_worker_semaphore(worker))
+    background_tasks.add_task(worker.finish_generation, params)
     return background_tasks
 
 
@@ -223,8 +241,9 @@ async def api_generate_stream(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
     await acquire_worker_semaphore(worker)
+    worker.start_generation(params)
     generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks(worker)
+    background_tasks = create_background_tasks(worker, params)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -233,11 +252,22 @@ async def api_generate(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
     await acquire_worker_semaphore(worker)
-    output = worker.generate_gate(params)
-    release_worker_semaphore(worker)
+    worker.start_generation(params)
+    try:
+        output = worker.generate_gate(params)
+    finally:
+        release_worker_semaphore(worker)
+        worker.finish_generation(params)
     return JSONResponse(output)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    cancelled = [w.cancel_generation(params["request_id"]) for w in workers]
+    return {"cancelled": any(cancelled)}
+
+
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
@@ -271,11 +301,18 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    worker = worker_map[params["model"]]
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "render_prompt": True}
 
 
 def create_huggingface_api_worker():
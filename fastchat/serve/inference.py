@@ -5,6 +5,7 @@ import json
 import math
 import os
 import sys
+import threading
 import time
 from typing import Iterable, Optional, Dict
 import warnings
@@ -58,6 +59,262 @@ def prepare_logits_processor(
     return processor_list
 
 
+class Sampler:
+    """
+    Sampling for generate_stream, on the device of the logits.
+
+    The output ids are kept in a preallocated tensor. The processors of
+    prepare_logits_processor are applied in place, and stop tokens are found
+    with a mask over the vocabulary, so a decoding step does not wait for the
+    device. Sampled tokens are copied to the host by sync, once per streamed
+    chunk; a stop token found there ends the output, and the tokens sampled
+    after it are dropped.
+    """
+
+    def __init__(
+        self,
+        input_ids,
+        max_new_tokens: int,
+        device,
+        temperature: float,
+        repetition_penalty: float,
+        top_p: float,
+        top_k: int,
+        stop_token_ids,
+        num_candidates: int = 1,
+        logprobs: bool = False,
+    ):
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.top_p = top_p
+        self.top_k = top_k
+        self.greedy = temperature < 1e-5 or top_p < 1e-8
+        self.stop_token_ids = [t for t in stop_token_ids if t is not None]
+        # the second candidate replaces a stop token with judge_sent_end
+        self.num_candidates = num_candidates
+        self.device = device
+
+        self.ids = torch.empty(
+            len(input_ids) + max_new_tokens, dtype=torch.int64, device=device
+        )
+        self.ids[: len(input_ids)] = torch.as_tensor(input_ids)
+        self.length = self.prompt_len = len(input_ids)
+        self.max_prompt_id = max(input_ids, default=0)
+        # the output ids up to the last sync
+        self.output_ids = list(input_ids)
+        self.num_synced = self.length
+        self.stopped = False
+        # built at the first step, when the vocabulary size is known
+        self.stop_mask = None
+        self.candidates = None
+
+        self.token_logprobs = None
+        if logprobs:
+            self.token_logprobs = torch.empty(max_new_tokens, device=device)
+        # the logprobs of the output tokens up to the last sync
+        self.logprobs = []
+
+    def process(self, logits):
+        """Apply temperature, repetition penalty, top-p and top-k in place."""
+        if self.greedy and self.num_candidates == 1:
+            # only the repetition penalty can change the argmax
+            if self.repetition_penalty > 1.0:
+                self.apply_repetition_penalty(logits)
+            return logits
+
+        if self.temperature >= 1e-5 and self.temperature != 1.0:
+            logits.div_(self.temperature)
+        if self.repetition_penalty > 1.0:
+            self.apply_repetition_penalty(logits)
+        if 1e-8 <= self.top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= 1 - self.top_p
+            sorted_to_remove[-1] = False
+            logits.masked_fill_(
+                sorted_to_remove.scatter(0, sorted_indices, sorted_to_remove),
+                -float("inf"),
+            )
+        if self.top_k > 0:
+            top_k = min(self.top_k, logits.shape[-1])
+            logits.masked_fill_(
+                logits < torch.topk(logits, top_k)[0][-1], -float("inf")
+            )
+        return logits
+
+    def apply_repetition_penalty(self, logits):
+        ids = self.ids[: self.length]
+        if self.max_prompt_id >= logits.shape[-1]:
+            # prompt tokens outside the output vocabulary cannot be sampled
+            ids = ids[ids < logits.shape[-1]]
+        score = logits.gather(0, ids)
+        score = torch.where(
+            score < 0,
+            score * self.repetition_penalty,
+            score / self.repetition_penalty,
+        )
+        logits.scatter_(0, ids, score)
+
+    def sample(self, logits):
+        """
+        Pick the next token from the logits of the last position and append
+        it. Return the token as a tensor of shape [1] on the device.
+        """
+        if self.stop_mask is None:
+            self.stop_mask = torch.zeros(
+                logits.shape[-1], dtype=torch.int64, device=logits.device
+            )
+            stop_token_ids = [t for t in self.stop_token_ids if t < logits.shape[-1]]
+            self.stop_mask[stop_token_ids] = 1
+        if self.token_logprobs is not None:
+            # Cannot use the processed logits because logprobs is based on raw logits.
+            raw_logprobs = torch.log_softmax(logits, dim=-1)
+
+        logits = self.process(logits)
+        if self.greedy:
+            candidates = torch.topk(logits, self.num_candidates).indices
+        else:
+            probs = torch.softmax(logits, dim=-1)
+            candidates = torch.multinomial(probs, num_samples=self.num_candidates)
+        self.candidates = candidates
+        token = candidates[:1]
+
+        # slices instead of indices, so that the device is not synchronized
+        self.ids[self.length : self.length + 1] = token
+        if self.token_logprobs is not None:
+            step = self.length - self.prompt_len
+            self.token_logprobs[step : step + 1] = raw_logprobs.index_select(0, token)
+        self.length += 1
+        return token
+
+    def sync(self):
+        """
+        Copy the tokens sampled since the last sync to output_ids (and their
+        logprobs to logprobs). Return whether a stop token was sampled.
+        """
+        if self.num_synced < self.length:
+            new_ids = self.ids[self.num_synced : self.length]
+            new_ids, is_stop = torch.stack((new_ids, self.stop_mask[new_ids])).tolist()
+            if any(is_stop):
+                new_ids = new_ids[: is_stop.index(1) + 1]
+                self.length = self.num_synced + len(new_ids)
+                self.stopped = True
+            self.output_ids.extend(new_ids)
+            if self.token_logprobs is not None:
+                self.logprobs.extend(
+                    self.token_logprobs[
+                        self.num_synced
+                        - self.prompt_len : self.length
+                        - self.prompt_len
+                    ].tolist()
+                )
+            self.num_synced = self.length
+        return self.stopped
+
+    def replace_last(self):
+        """Replace the last token, a stop token, by the second candidate."""
+        token = self.candidates[1:2]
+        self.ids[self.length - 1 : self.length] = token
+        self.output_ids[-1] = int(token)
+        self.stopped = False
+        return token
+
+
+STEP_PHASES = ("prefill", "forward", "sample", "output")
+
+
+class StepTimer:
+    """
+    Time of the decoding steps of generate_stream, shared by the generations
+    of a worker. A step is split into the model forward, sampling, and the
+    output: detokenization, stop strings and the consumer of the stream.
+
+    The device is synchronized after the forward and after sampling, so that
+    the time of queued kernels is counted in their own phase. This costs some
+    speed, so the timer is only used when asked for.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        # decoding steps, without the prefill
+        self.num_steps = 0
+        self.times = dict.fromkeys(STEP_PHASES, 0.0)
+
+    def update(self, num_steps: int, times: Dict[str, float]):
+        with self.lock:
+            self.num_requests += 1
+            self.num_steps += num_steps
+            for phase, elapsed in times.items():
+                self.times[phase] += elapsed
+
+    def get_stats(self):
+        """Mean milliseconds per request (prefill) and per step (other phases)."""
+        with self.lock:
+            num_steps = max(self.num_steps, 1)
+            step_time = sum(self.times[p] for p in ("forward", "sample", "output"))
+            return {
+                "requests": self.num_requests,
+                "steps": self.num_steps,
+                "prefill_ms": 1000 * self.times["prefill"] / max(self.num_requests, 1),
+                "forward_ms": 1000 * self.times["forward"] / num_steps,
+                "sample_ms": 1000 * self.times["sample"] / num_steps,
+                "output_ms": 1000 * self.times["output"] / num_steps,
+                "outside_forward_ratio": 1 - self.times["forward"] / step_time
+                if step_time > 0
+                else 0.0,
+            }
+
+
+def synchronize_device(device):
+    device_type = torch.device(device).type
+    if device_type == "cuda":
+        torch.cuda.synchronize()
+    elif device_type == "xpu":
+        torch.xpu.synchronize()
+    elif device_type == "npu":
+        torch.npu.synchronize()
+    elif device_type == "mps":
+        torch.mps.synchronize()
+
+
+def apply_stop_str(output: str, stop_str, rfind_start: int):
+    """Cut output at the first stop string found. Return (output, stopped, partially_stopped)."""
+    stopped = partially_stopped = False
+    if stop_str:
+        if isinstance(stop_str, str):
+            pos = output.rfind(stop_str, rfind_start)
+            if pos != -1:
+                output = output[:pos]
+                stopped = True
+            else:
+                partially_stopped = is_partial_stop(output, stop_str)
+        elif isinstance(stop_str, Iterable):
+            for each_stop in stop_str:
+                pos = output.rfind(each_stop, rfind_start)
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
+                    break
+                else:
+                    partially_stopped = is_partial_stop(output, each_stop)
+                    if partially_stopped:
+                        break
+        else:
+            raise ValueError("Invalid stop field type.")
+    return output, stopped, partially_stopped
+
+
+def expand_past_key_values(past_key_values, n: int):
+    """Repeat every sequence of a KV cache n times along the batch dimension."""
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(n)
+        return past_key_values
+    return tuple(
+        tuple(t.repeat_interleave(n, dim=0) for t in layer) for layer in past_key_values
+    )
+
+
 @torch.inference_mode()
 def generate_stream(
     model,
@@ -67,10 +324,37 @@ def generate_stream(
     context_len: int,
     stream_interval: int = 2,
     judge_sent_end: bool = False,
+    step_timer: Optional[StepTimer] = None,
 ):
     if hasattr(model, "device"):
         device = model.device
 
+    n = int(params.get("n", 1))
+    if n > 1:
+        if (
+            not model.config.is_encoder_decoder
+            and params.get("logprobs", None) is None
+            and not judge_sent_end
+        ):
+            yield from generate_stream_n(
+                model, tokenizer, params, device, context_len, stream_interval
+            )
+        else:
+            # one choice after another, tagged with its index
+            for i in range(n):
+                for output in generate_stream(
+                    model,
+                    tokenizer,
+                    {**params, "n": 1},
+                    device,
+                    context_len,
+                    stream_interval,
+                    judge_sent_end,
+                    step_timer,
+                ):
+                    yield {**output, "index": i}
+        return
+
     # Read parameters
     prompt = params["prompt"]
     len_prompt = len(prompt)
@@ -86,9 +370,6 @@ def generate_stream(
     if tokenizer.eos_token_id not in stop_token_ids:
         stop_token_ids.append(tokenizer.eos_token_id)
 
-    logits_processor = prepare_logits_processor(
-        temperature, repetition_penalty, top_p, top_k
-    )
     input_ids = tokenizer(prompt).input_ids
 
     if model.config.is_encoder_decoder:
@@ -97,7 +378,6 @@ def generate_stream(
         max_src_len = context_len - max_new_tokens - 1
 
     input_ids = input_ids[-max_src_len:]
-    output_ids = list(input_ids)
     input_echo_len = len(input_ids)
 
     if model.config.is_encoder_decoder:
@@ -114,12 +394,40 @@ def generate_stream(
     else:
         start_ids = torch.as_tensor([input_ids], device=device)
 
+    sampler = Sampler(
+        input_ids,
+        max_new_tokens,
+        # Switch to CPU by avoiding some bugs in mps backend.
+        "cpu" if device == "mps" else device,
+        temperature,
+        repetition_penalty,
+        top_p,
+        top_k,
+        stop_token_ids,
+        num_candidates=2 if judge_sent_end else 1,
+        logprobs=logprobs is not None,
+    )
+
+    if step_timer is not None:
+        times = dict.fromkeys(STEP_PHASES, 0.0)
+        lap = time.perf_counter()
+
+        def record(phase, sync=True):
+            nonlocal lap
+            if sync:
+                synchronize_device(device)
+            now = time.perf_counter()
+            times[phase] += now - lap
+            lap = now
+
     past_key_values = out = None
     token_logprobs = [None]  # The first token has no logprobs.
     sent_interrupt = False
     finish_reason = None
     stopped = False
     for i in range(max_new_tokens):
+        if step_timer is not None:
+            record("output", sync=False)
         if i == 0:  # prefill
             if model.config.is_encoder_decoder:
                 out = model.decoder(
@@ -135,20 +443,21 @@ def generate_stream(
 
             if logprobs is not None:
                 # Prefull logprobs for the prompt.
-                shift_input_ids = start_ids[..., 1:].contiguous()
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_logits = torch.log_softmax(shift_logits, dim=-1).tolist()
-                for label_id, logit in zip(
-                    shift_input_ids[0].tolist(), shift_logits[0]
-                ):
-                    token_logprobs.append(logit[label_id])
+                shift_input_ids = start_ids[0, 1:]
+                shift_logits = torch.log_softmax(logits[0, :-1, :], dim=-1)
+                token_logprobs.extend(
+                    shift_logits.gather(1, shift_input_ids[:, None])[:, 0].tolist()
+                )
         else:  # decoding
+            # with sent_interrupt, the whole output is decoded again without the cache
+            decoder_input_ids = (
+                token[None, :]
+                if not sent_interrupt
+                else sampler.ids[None, : sampler.length]
+            ).to(device)
             if model.config.is_encoder_decoder:
                 out = model.decoder(
-                    input_ids=torch.as_tensor(
-                        [[token] if not sent_interrupt else output_ids],
-                        device=device,
-                    ),
+                    input_ids=decoder_input_ids,
                     encoder_hidden_states=encoder_output,
                     use_cache=True,
                     past_key_values=past_key_values if not sent_interrupt else None,
@@ -158,52 +467,32 @@ def generate_stream(
                 logits = model.lm_head(out[0])
             else:
                 out = model(
-                    input_ids=torch.as_tensor(
-                        [[token] if not sent_interrupt else output_ids],
-                        device=device,
-                    ),
+                    input_ids=decoder_input_ids,
                     use_cache=True,
                     past_key_values=past_key_values if not sent_interrupt else None,
                 )
                 sent_interrupt = False
                 logits = out.logits
             past_key_values = out.past_key_values
+        if step_timer is not None:
+            record("prefill" if i == 0 else "forward")
 
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
-            else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
-
+        last_token_logits = logits[0, -1, :]
         if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
             last_token_logits = last_token_logits.float().to("cpu")
-
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            _, indices = torch.topk(last_token_logits, 2)
-            tokens = [int(index) for index in indices.tolist()]
-        else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            indices = torch.multinomial(probs, num_samples=2)
-            tokens = [int(token) for token in indices.tolist()]
-        token = tokens[0]
-        output_ids.append(token)
-        if logprobs is not None:
-            # Cannot use last_token_logits because logprobs is based on raw logits.
-            token_logprobs.append(
-                torch.log_softmax(logits[0, -1, :], dim=-1)[token].tolist()
-            )
-
-        if token in stop_token_ids:
-            stopped = True
-        else:
-            stopped = False
+        token = sampler.sample(last_token_logits)
+        if step_timer is not None:
+            record("sample")
 
         # Yield the output tokens
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+        # judge_sent_end needs to see a stop token at the step it is sampled
+        if judge_sent_end or i % stream_interval == 0 or i == max_new_tokens - 1:
+            stopped = sampler.sync()
+            output_ids = sampler.output_ids
+            if stopped:
+                # the stop token can be from a step before this one
+                i = len(output_ids) - input_echo_len - 1
+        if stopped or i % stream_interval == 0 or i == max_new_tokens - 1:
             if echo:
                 tmp_output_ids = output_ids
                 rfind_start = len_prompt
@@ -219,6 +508,7 @@ def generate_stream(
             )
             ret_logprobs = None
             if logprobs is not None:
+                all_logprobs = token_logprobs + sampler.logprobs
                 ret_logprobs = {
                     "text_offset": [],
                     "tokens": [
@@ -227,11 +517,11 @@ def generate_stream(
                             output_ids if echo else output_ids[input_echo_len:]
                         )
                     ],
-                    "token_logprobs": token_logprobs
+                    "token_logprobs": all_logprobs
                     if echo
-                    else token_logprobs[input_echo_len:],
+                    else all_logprobs[input_echo_len:],
                     "top_logprobs": [{}]
-                    * len(token_logprobs if echo else token_logprobs[input_echo_len:]),
+                    * len(all_logprobs if echo else all_logprobs[input_echo_len:]),
                 }
                 # Compute text_offset
                 curr_pos = 0
@@ -241,36 +531,14 @@ def generate_stream(
 
             # TODO: For the issue of incomplete sentences interrupting output, apply a patch and others can also modify it to a more elegant way
             if judge_sent_end and stopped and not is_sentence_complete(output):
-                if len(tokens) > 1:
-                    token = tokens[1]
-                    output_ids[-1] = token
-                else:
-                    output_ids.pop()
+                sampler.replace_last()
                 stopped = False
                 sent_interrupt = True
 
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
+            output, found_stop, partially_stopped = apply_stop_str(
+                output, stop_str, rfind_start
+            )
+            stopped = stopped or found_stop
 
             # Prevent yielding partial stop sequence
             if not partially_stopped:
@@ -295,6 +563,10 @@ def generate_stream(
     if stopped:
         finish_reason = "stop"
 
+    if step_timer is not None:
+        record("output", sync=False)
+        step_timer.update(sampler.length - input_echo_len - 1, times)
+
     yield {
         "text": output,
         "logprobs": ret_logprobs,
@@ -306,6 +578,139 @@ def generate_stream(
         "finish_reason": finish_reason,
     }
 
+    # Clean
+    del past_key_values, out, sampler
+    gc.collect()
+    torch.cuda.empty_cache()
+    if device == "xpu":
+        torch.xpu.empty_cache()
+    if device == "npu":
+        torch.npu.empty_cache()
+
+
+@torch.inference_mode()
+def generate_stream_n(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int = 2,
+):
+    """
+    Sample params["n"] continuations of one prompt, prefilled once.
+
+    The KV cache of the prompt is shared by all choices: it is computed once and
+    then repeated along the batch dimension, and the choices are decoded as one
+    batch. Outputs are the same as those of generate_stream, with the index of
+    the choice in "index".
+    """
+    # Read parameters
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    n = int(params["n"])
+    temperature = float(params.get("temperature", 1.0))
+    repetition_penalty = float(params.get("repetition_penalty", 1.0))
+    top_p = float(params.get("top_p", 1.0))
+    top_k = int(params.get("top_k", -1))  # -1 means disable
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    echo = bool(params.get("echo", True))
+    stop_str = params.get("stop", None)
+    stop_token_ids = params.get("stop_token_ids", None) or []
+    if tokenizer.eos_token_id not in stop_token_ids:
+        stop_token_ids.append(tokenizer.eos_token_id)
+
+    logits_processor = prepare_logits_processor(
+        temperature, repetition_penalty, top_p, top_k
+    )
+    input_ids = tokenizer(prompt).input_ids
+    max_src_len = context_len - max_new_tokens - 1
+    input_ids = input_ids[-max_src_len:]
+    input_echo_len = len(input_ids)
+    # all choices have the same length, so they stack into one tensor
+    output_ids = [list(input_ids) for _ in range(n)]
+    finish_reasons = [None] * n
+
+    out = model(input_ids=torch.as_tensor([input_ids], device=device), use_cache=True)
+    past_key_values = expand_past_key_values(out.past_key_values, n)
+    logits = out.logits[:, -1, :].repeat(n, 1)
+    for i in range(max_new_tokens):
+        if i > 0:  # decoding
+            out = model(
+                input_ids=torch.as_tensor(
+                    [[ids[-1]] for ids in output_ids], device=device
+                ),
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+            past_key_values = out.past_key_values
+            logits = out.logits[:, -1, :]
+
+        if logits_processor:
+            if repetition_penalty > 1.0:
+                tmp_output_ids = torch.as_tensor(output_ids, device=logits.device)
+            else:
+                tmp_output_ids = None
+            last_token_logits = logits_processor(tmp_output_ids, logits)
+        else:
+            last_token_logits = logits
+
+        if device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            last_token_logits = last_token_logits.float().to("cpu")
+
+        if temperature < 1e-5 or top_p < 1e-8:  # greedy
+            tokens = torch.argmax(last_token_logits, dim=-1).tolist()
+        else:
+            probs = torch.softmax(last_token_logits, dim=-1)
+            tokens = torch.multinomial(probs, num_samples=1)[:, 0].tolist()
+
+        for j, token in enumerate(tokens):
+            # finished choices keep decoding in the batch, their tokens are ignored
+            output_ids[j].append(token)
+            if finish_reasons[j] is not None:
+                continue
+
+            stopped = token in stop_token_ids
+            if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                if echo:
+                    tmp_output_ids = output_ids[j]
+                    rfind_start = len_prompt
+                else:
+                    tmp_output_ids = output_ids[j][input_echo_len:]
+                    rfind_start = 0
+                output = tokenizer.decode(
+                    tmp_output_ids,
+                    skip_special_tokens=True,
+                    spaces_between_special_tokens=False,
+                    clean_up_tokenization_spaces=True,
+                )
+                output, found_stop, partially_stopped = apply_stop_str(
+                    output, stop_str, rfind_start
+                )
+                stopped = stopped or found_stop
+                if stopped:
+                    finish_reasons[j] = "stop"
+                elif i == max_new_tokens - 1:
+                    finish_reasons[j] = "length"
+
+                # Prevent yielding partial stop sequence
+                if not partially_stopped or finish_reasons[j] is not None:
+                    yield {
+                        "index": j,
+                        "text": output,
+                        "logprobs": None,
+                        "usage": {
+                            "prompt_tokens": input_echo_len,
+                            "completion_tokens": i,
+                            "total_tokens": input_echo_len + i,
+                        },
+                        "finish_reason": finish_reasons[j],
+                    }
+
+        if all(reason is not None for reason in finish_reasons):
+            break
+
     # Clean
     del past_key_values, out
     gc.collect()
@@ -19,6 +19,7 @@ from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 
 from fastchat.serve.base_model_worker import BaseModelWorker
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
@@ -76,9 +77,11 @@ class LightLLMWorker(BaseModelWorker):
 
     async def generate_stream(self, params):
         self.call_ct += 1
+        encoder = StreamEncoder(params)
+        cancel_event = self.get_cancel_event(params)
 
         prompt = params.pop("prompt")
-        request_id = params.pop("request_id")
+        request_id = params.pop("engine_request_id")
         temperature = float(params.get("temperature", 1.0))
         top_p = float(params.get("top_p", 1.0))
         top_k = params.get("top_k", -1.0)
@@ -152,9 +155,12 @@ class LightLLMWorker(BaseModelWorker):
             else:
                 finish_reason = finish_status.get_finish_reason()
 
-            if request and await request.is_disconnected():
+            if (request and await request.is_disconnected()) or (
+                cancel_event is not None and cancel_event.is_set()
+            ):
                 await httpserver_manager.abort(request_id)
                 finish_reason = "abort"
+                self.record_cancellation(params, completion_tokens)
 
             logprob = metadata.get("logprob", None)
             if logprob is not None:
@@ -174,11 +180,17 @@ class LightLLMWorker(BaseModelWorker):
 
             if finish_reason is not None:
                 yield (
-                    json.dumps({**ret, "finish_reason": None}, ensure_ascii=False)
+                    json.dumps(
+                        encoder.encode({**ret, "finish_reason": None}),
+                        ensure_ascii=False,
+                    )
                     + "\0"
                 ).encode("utf-8")
             yield (
-                json.dumps({**ret, "finish_reason": finish_reason}, ensure_ascii=False)
+                json.dumps(
+                    encoder.encode({**ret, "finish_reason": finish_reason}),
+                    ensure_ascii=False,
+                )
                 + "\0"
             ).encode("utf-8")
 
@@ -186,6 +198,8 @@ class LightLLMWorker(BaseModelWorker):
                 break
 
     async def generate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
         async for x in self.generate_stream(params):
             pass
         return json.loads(x[:-1].decode())
@@ -201,13 +215,14 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
-def create_background_tasks(request_id):
+def create_background_tasks(request_id, params):
     async def abort_request() -> None:
         await httpserver_manager.abort(request_id)
 
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_worker_semaphore)
     background_tasks.add_task(abort_request)
+    background_tasks.add_task(worker.finish_generation, params)
     return background_tasks
 
 
@@ -215,11 +230,13 @@ def create_background_tasks(request_id):
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
+    # the client's request_id, used by /worker_cancel
+    worker.start_generation(params)
     request_id = g_id_gen.generate_id()
-    params["request_id"] = request_id
+    params["engine_request_id"] = request_id
     params["request"] = request
     generator = worker.generate_stream(params)
-    background_tasks = create_background_tasks(request_id)
+    background_tasks = create_background_tasks(request_id, params)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -227,15 +244,25 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
+    worker.start_generation(params)
     request_id = g_id_gen.generate_id()
-    params["request_id"] = request_id
+    params["engine_request_id"] = request_id
     params["request"] = request
-    output = await worker.generate(params)
-    release_worker_semaphore()
+    try:
+        output = await worker.generate(params)
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     await httpserver_manager.abort(request_id)
     return JSONResponse(output)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    return {"cancelled": worker.cancel_generation(params["request_id"])}
+
+
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return worker.get_status()
@@ -252,9 +279,15 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "render_prompt": True}
 
 
 if __name__ == "__main__":
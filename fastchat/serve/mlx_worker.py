@@ -23,6 +23,7 @@ from fastapi.responses import StreamingResponse, JSONResponse
 import uvicorn
 
 from fastchat.serve.base_model_worker import BaseModelWorker
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
@@ -76,9 +77,11 @@ class MLXWorker(BaseModelWorker):
 
     async def generate_stream(self, params):
         self.call_ct += 1
+        encoder = StreamEncoder(params)
+        cancel_event = self.get_cancel_event(params)
 
         context = params.pop("prompt")
-        request_id = params.pop("request_id")
+        request_id = params["request_id"]
         temperature = float(params.get("temperature", 1.0))
         top_p = float(params.get("top_p", 1.0))
         top_k = params.get("top_k", -1.0)
@@ -124,6 +127,10 @@ class MLXWorker(BaseModelWorker):
         )
 
         for i in range(max_new_tokens):
+            if cancel_event is not None and cancel_event.is_set():
+                finish_reason = "abort"
+                self.record_cancellation(params, len(tokens))
+                break
             (token, _) = await run_in_threadpool(next, iterator)
             if token == self.mlx_tokenizer.eos_token_id:
                 finish_reason = "stop"
@@ -151,7 +158,7 @@ class MLXWorker(BaseModelWorker):
                 "finish_reason": None,  # hard code for now
             }
             # print(ret)
-            yield (json.dumps(ret) + "\0").encode()
+            yield (json.dumps(encoder.encode(ret)) + "\0").encode()
         ret = {
             "text": self.mlx_tokenizer.decode(tokens),
             "error_code": 0,
@@ -159,10 +166,14 @@ class MLXWorker(BaseModelWorker):
             "cumulative_logprob": [],
             "finish_reason": finish_reason,
         }
-        yield (json.dumps(obj={**ret, **{"finish_reason": None}}) + "\0").encode()
-        yield (json.dumps(ret) + "\0").encode()
+        yield (
+            json.dumps(obj=encoder.encode({**ret, **{"finish_reason": None}})) + "\0"
+        ).encode()
+        yield (json.dumps(encoder.encode(ret)) + "\0").encode()
 
     async def generate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
         async for x in self.generate_stream(params):
             pass
         return json.loads(x[:-1].decode())
@@ -178,13 +189,11 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
-def create_background_tasks(request_id):
-    async def abort_request() -> None:
-        print("trying to abort but not implemented")
-
+def create_background_tasks(params):
+    # generation steps are awaited one by one, so a disconnect stops them
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_worker_semaphore)
-    background_tasks.add_task(abort_request)
+    background_tasks.add_task(worker.finish_generation, params)
     return background_tasks
 
 
@@ -192,10 +201,10 @@ def create_background_tasks(request_id):
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    request_id = uuid.uuid4()
-    params["request_id"] = str(request_id)
+    params["request_id"] = params.get("request_id") or str(uuid.uuid4())
+    worker.start_generation(params)
     generator = worker.generate_stream(params)
-    background_tasks = create_background_tasks(request_id)
+    background_tasks = create_background_tasks(params)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -203,15 +212,22 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    request_id = uuid.uuid4()
-    params["request_id"] = str(request_id)
-    output = await worker.generate(params)
-    release_worker_semaphore()
-    # await engine.abort(request_id)
-    print("Trying to abort but not implemented")
+    params["request_id"] = params.get("request_id") or str(uuid.uuid4())
+    worker.start_generation(params)
+    try:
+        output = await worker.generate(params)
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     return JSONResponse(output)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    return {"cancelled": worker.cancel_generation(params["request_id"])}
+
+
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return worker.get_status()
@@ -228,9 +244,15 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "render_prompt": True}
 
 
 worker = None
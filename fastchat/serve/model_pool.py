@@ -0,0 +1,182 @@
+"""
+On-demand model loading for the multi-model worker.
+
+The pool keeps the models of its sub-workers resident on their device within
+a memory budget. A model is loaded on its first request, and the least
+recently used idle models are evicted when another one needs the room:
+either moved to CPU RAM, or written once to a safetensors file and reloaded
+from it memory-mapped.
+
+Only single-device torch models can be evicted; quantized backends such as
+exllama or xFasterTransformer and multi-GPU device maps are not supported.
+"""
+import asyncio
+from collections import OrderedDict
+import gc
+import glob
+import itertools
+import os
+
+import torch
+
+RESIDENT = "resident"
+EVICTED = "evicted"
+UNLOADED = "unloaded"
+
+
+def get_model_nbytes(model):
+    return sum(
+        t.numel() * t.element_size()
+        for t in itertools.chain(model.parameters(), model.buffers())
+    )
+
+
+def get_checkpoint_nbytes(model_path):
+    """Size of the weights of a local checkpoint, 0 if unknown."""
+    for pattern in ["*.safetensors", "*.bin"]:
+        files = glob.glob(os.path.join(model_path, pattern))
+        if files:
+            return sum(os.path.getsize(x) for x in files)
+    return 0
+
+
+def empty_device_cache():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelPool:
+    def __init__(self, memory_budget, evict_to="cpu", evict_dir=None):
+        """
+        memory_budget: bytes of weights kept resident
+        evict_to: "cpu" or "disk"
+        evict_dir: where evicted weights are written with evict_to="disk"
+        """
+        assert evict_to in ["cpu", "disk"], f"Invalid evict_to: {evict_to}"
+        self.memory_budget = memory_budget
+        self.evict_to = evict_to
+        self.evict_dir = evict_dir
+        if evict_to == "disk":
+            os.makedirs(evict_dir, exist_ok=True)
+
+        self.workers = []
+        self.states = {}
+        self.nbytes = {}
+        self.in_use = {}
+        # resident workers, least recently used first
+        self.lru = OrderedDict()
+        # buffers of disk-evicted models, which are not all in the state dict
+        self.cpu_buffers = {}
+        self.lock = None
+
+    def add_worker(self, worker):
+        worker.model_pool = self
+        self.workers.append(worker)
+        self.in_use[worker] = 0
+        if self.evict_to == "disk" and os.path.exists(self.get_evict_file(worker)):
+            # left by a previous run, possibly of other weights
+            os.remove(self.get_evict_file(worker))
+        if worker.model is None:
+            self.states[worker] = UNLOADED
+            self.nbytes[worker] = get_checkpoint_nbytes(worker.model_path)
+        else:
+            self.states[worker] = RESIDENT
+            self.nbytes[worker] = get_model_nbytes(worker.model)
+            self.lru[worker] = None
+
+    def get_model_states(self):
+        return {name: self.states[w] for w in self.workers for name in w.model_names}
+
+    def get_resident_nbytes(self):
+        return sum(self.nbytes[w] for w in self.lru)
+
+    def pick_victims(self, worker, nbytes):
+        """Idle resident workers to evict, LRU first, so that nbytes more fit."""
+        victims = []
+        resident_nbytes = self.get_resident_nbytes()
+        for w in self.lru:
+            if resident_nbytes + nbytes <= self.memory_budget:
+                break
+            if w is worker or self.in_use[w] > 0:
+                continue
+            victims.append(w)
+            resident_nbytes -= self.nbytes[w]
+        # taken out of service right away, before any await
+        for w in victims:
+            self.states[w] = EVICTED
+            del self.lru[w]
+        return victims
+
+    async def acquire(self, worker, executor):
+        """Make the model of worker resident and pin it until release."""
+        self.in_use[worker] += 1
+        if self.states[worker] == RESIDENT:
+            self.lru.move_to_end(worker)
+            return
+
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        try:
+            async with self.lock:
+                if self.states[worker] != RESIDENT:
+                    victims = self.pick_victims(worker, self.nbytes[worker])
+                    await executor.run("load_model", self.swap, victims, worker)
+                    self.states[worker] = RESIDENT
+                    self.lru[worker] = None
+                    # the checkpoint size is only an estimate
+                    victims = self.pick_victims(worker, 0)
+                    if victims:
+                        await executor.run("load_model", self.swap, victims, None)
+        except BaseException:
+            self.in_use[worker] -= 1
+            raise
+        self.lru.move_to_end(worker)
+
+    def release(self, worker):
+        self.in_use[worker] -= 1
+
+    def swap(self, victims, worker):
+        for w in victims:
+            self.evict(w)
+        if victims:
+            empty_device_cache()
+        if worker is not None:
+            self.load(worker)
+            self.nbytes[worker] = get_model_nbytes(worker.model)
+
+    def get_evict_file(self, worker):
+        return os.path.join(
+            self.evict_dir, worker.model_names[0].replace("/", "--") + ".safetensors"
+        )
+
+    def evict(self, worker):
+        if self.evict_to == "cpu":
+            worker.model.to("cpu")
+            return
+
+        from safetensors.torch import save_model
+
+        filename = self.get_evict_file(worker)
+        if not os.path.exists(filename):
+            save_model(worker.model, filename + ".tmp")
+            os.replace(filename + ".tmp", filename)
+        self.cpu_buffers[worker] = {
+            name: buf.to("cpu") for name, buf in worker.model.named_buffers()
+        }
+        worker.model.to("meta")
+
+    def load(self, worker):
+        if self.states[worker] == UNLOADED:
+            worker.load_weights()
+        elif self.evict_to == "cpu":
+            worker.model.to(worker.device)
+        else:
+            from safetensors.torch import load_model
+
+            worker.model.to_empty(device=worker.device)
+            # memory-mapped read straight into the allocated weights
+            load_model(worker.model, self.get_evict_file(worker), device=worker.device)
+            buffers = self.cpu_buffers.pop(worker)
+            for name, buf in worker.model.named_buffers():
+                buf.copy_(buffers[name])
@@ -3,6 +3,7 @@ A model worker that executes the model.
 """
 import argparse
 import base64
+from functools import partial
 import gc
 import json
 import os
@@ -11,7 +12,7 @@ import uuid
 
 import torch
 import torch.nn.functional as F
-from transformers import set_seed
+from transformers import AutoConfig, AutoTokenizer, set_seed
 import uvicorn
 
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
@@ -24,7 +25,20 @@ from fastchat.modules.awq import AWQConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
 from fastchat.modules.gptq import GptqConfig
-from fastchat.serve.base_model_worker import BaseModelWorker, app
+from fastchat.serve.base_model_worker import (
+    BaseModelWorker,
+    EmbeddingBatcher,
+    app,
+    create_cancelled_output,
+)
+from fastchat.serve.inference import StepTimer, generate_stream
+from fastchat.serve.speculative_decoding import (
+    SPECULATIVE_METHODS,
+    SpeculativeConfig,
+    SpeculativeStats,
+    generate_stream_speculative,
+)
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.utils import (
     build_logger,
     get_context_length,
@@ -61,6 +75,9 @@ class ModelWorker(BaseModelWorker):
         embed_in_truncate: bool = False,
         seed: Optional[int] = None,
         debug: bool = False,
+        lazy_load: bool = False,
+        speculative_config: Optional[SpeculativeConfig] = None,
+        step_timing: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -73,9 +90,8 @@ class ModelWorker(BaseModelWorker):
             conv_template=conv_template,
         )
 
-        logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
-        self.model, self.tokenizer = load_model(
-            model_path,
+        self.model_path = model_path
+        self.load_kwargs = dict(
             revision=revision,
             device=device,
             num_gpus=num_gpus,
@@ -90,10 +106,28 @@ class ModelWorker(BaseModelWorker):
             debug=debug,
         )
         self.device = device
-        if self.tokenizer.pad_token == None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.context_len = get_context_length(self.model.config)
-        self.generate_stream_func = get_generate_stream_function(self.model, model_path)
+        self.speculative_config = speculative_config
+        self.speculative_stats = (
+            SpeculativeStats() if speculative_config is not None else None
+        )
+        self.step_timer = StepTimer() if step_timing else None
+        # set by multi_model_worker when models are loaded on demand
+        self.model_pool = None
+        if lazy_load:
+            # only what the control-plane endpoints need, the weights come on first use
+            self.model = None
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                model_path, revision=revision, trust_remote_code=True
+            )
+            self.context_len = get_context_length(
+                AutoConfig.from_pretrained(
+                    model_path, revision=revision, trust_remote_code=True
+                )
+            )
+            if self.tokenizer.pad_token == None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+        else:
+            self.load_weights()
         self.stream_interval = stream_interval
         self.embed_in_truncate = embed_in_truncate
         self.seed = seed
@@ -101,6 +135,78 @@ class ModelWorker(BaseModelWorker):
         if not no_register:
             self.init_heart_beat()
 
+    def load_weights(self):
+        logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
+        self.model, self.tokenizer = load_model(self.model_path, **self.load_kwargs)
+        if self.tokenizer.pad_token == None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.context_len = get_context_length(self.model.config)
+        self.generate_stream_func = get_generate_stream_function(
+            self.model, self.model_path
+        )
+        if self.speculative_config is not None:
+            self.enable_speculative_decoding()
+        elif self.step_timer is not None:
+            if self.generate_stream_func is generate_stream:
+                self.generate_stream_func = partial(
+                    generate_stream, step_timer=self.step_timer
+                )
+            else:
+                logger.warning(
+                    f"Step timing is not supported by the generate function "
+                    f"of {self.model_path}, it is disabled."
+                )
+
+    def enable_speculative_decoding(self):
+        config = self.speculative_config
+        if self.generate_stream_func is not generate_stream:
+            logger.warning(
+                f"Speculative decoding is not supported by the generate function "
+                f"of {self.model_path}, it is disabled."
+            )
+            return
+
+        draft_model = None
+        if config.method == "draft-model":
+            logger.info(f"Loading the draft model {config.draft_model_path} ...")
+            draft_model, draft_tokenizer = load_model(
+                config.draft_model_path,
+                device=self.device,
+                num_gpus=self.load_kwargs["num_gpus"],
+                max_gpu_memory=self.load_kwargs["max_gpu_memory"],
+                dtype=self.load_kwargs["dtype"],
+                load_8bit=self.load_kwargs["load_8bit"],
+                cpu_offloading=self.load_kwargs["cpu_offloading"],
+            )
+            # the target model verifies the token ids of the draft
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                raise ValueError(
+                    f"The draft model {config.draft_model_path} does not use "
+                    f"the tokenizer of {self.model_path}."
+                )
+        self.generate_stream_func = partial(
+            generate_stream_speculative,
+            config=config,
+            draft_model=draft_model,
+            stats=self.speculative_stats,
+        )
+
+    def get_status(self):
+        ret = super().get_status()
+        if self.speculative_stats is not None:
+            ret["speculative"] = {
+                "method": self.speculative_config.method,
+                **self.speculative_stats.get_stats(),
+            }
+        if self.step_timer is not None:
+            ret["step_timing"] = self.step_timer.get_stats()
+        return ret
+
+    def get_model_states(self):
+        if self.model_pool is None:
+            return super().get_model_states()
+        return self.model_pool.get_model_states()
+
     def generate_stream_gate(self, params):
         if self.device == "npu":
             import torch_npu
@@ -108,9 +214,16 @@ class ModelWorker(BaseModelWorker):
             torch_npu.npu.set_device("npu:0")
         self.call_ct += 1
 
+        cancel_event = self.get_cancel_event(params)
+        # the generation is cancelled unless it runs to its end or fails
+        finished = False
+        completion_tokens = 0
         try:
             if self.seed is not None:
                 set_seed(self.seed)
+            # one encoder and last chunk per choice when n > 1
+            encoders = {}
+            last_rets = {}
             for output in self.generate_stream_func(
                 self.model,
                 self.tokenizer,
@@ -119,6 +232,12 @@ class ModelWorker(BaseModelWorker):
                 self.context_len,
                 self.stream_interval,
             ):
+                # checked at every chunk, leaving the loop stops the decoding
+                if cancel_event is not None and cancel_event.is_set():
+                    for index, ret in last_rets.items():
+                        ret = {**ret, "finish_reason": "abort"}
+                        yield json.dumps(encoders[index].encode(ret)).encode() + b"\0"
+                    break
                 ret = {
                     "text": output["text"],
                     "error_code": 0,
@@ -129,34 +248,77 @@ class ModelWorker(BaseModelWorker):
                     ret["finish_reason"] = output["finish_reason"]
                 if "logprobs" in output:
                     ret["logprobs"] = output["logprobs"]
-                yield json.dumps(ret).encode() + b"\0"
+                index = output.get("index")
+                if index is not None:
+                    ret["index"] = index
+                if index not in encoders:
+                    encoders[index] = StreamEncoder(params)
+                last_rets[index] = ret
+                completion_tokens = max(
+                    completion_tokens, ret.get("usage", {}).get("completion_tokens", 0)
+                )
+                yield json.dumps(encoders[index].encode(ret)).encode() + b"\0"
+            else:
+                finished = True
         except torch.cuda.OutOfMemoryError as e:
+            finished = True
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
             yield json.dumps(ret).encode() + b"\0"
         except (ValueError, RuntimeError) as e:
+            finished = True
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
             yield json.dumps(ret).encode() + b"\0"
+        finally:
+            # also reached when the client goes away and the stream is closed
+            if not finished:
+                self.record_cancellation(params, completion_tokens)
 
     def generate_gate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
+        if int(params.get("n", 1)) > 1:
+            choices = {}
+            for x in self.generate_stream_gate(params):
+                ret = json.loads(x[:-1].decode())
+                if ret["error_code"] != 0:
+                    return ret
+                choices[ret.get("index", 0)] = ret
+            return {"error_code": 0, "choices": [choices[i] for i in sorted(choices)]}
+        x = None
         for x in self.generate_stream_gate(params):
             pass
+        if x is None:
+            # cancelled before the first chunk
+            return create_cancelled_output()
         return json.loads(x[:-1].decode())
 
+    def supports_parallel_n(self):
+        func = getattr(self, "generate_stream_func", None)
+        if func is None:
+            # not known before the weights of a lazily loaded model are loaded
+            return None
+        # speculative decoding leaves n > 1 to generate_stream
+        if isinstance(func, partial):
+            func = func.func
+        return func in (generate_stream, generate_stream_speculative)
+
     def __process_embed_chunk(self, input_ids, attention_mask, **model_type_dict):
         if model_type_dict.get("is_bert"):
-            model_output = self.model(input_ids)
+            model_output = self.model(input_ids, attention_mask=attention_mask)
             if model_type_dict.get("is_robert"):
                 data = model_output.last_hidden_state
             else:
                 data = model_output[0]
         elif model_type_dict.get("is_t5"):
-            model_output = self.model(input_ids, decoder_input_ids=input_ids)
+            model_output = self.model(
+                input_ids, attention_mask=attention_mask, decoder_input_ids=input_ids
+            )
             data = model_output.encoder_last_hidden_state
         else:
             model_output = self.model(input_ids, output_hidden_states=True)
@@ -211,6 +373,8 @@ class ModelWorker(BaseModelWorker):
                 )
             input_ids = encoding["input_ids"].to(self.device)
             attention_mask = input_ids != tokenizer.pad_token_id
+            # per input, so that micro-batched requests can be split again
+            ret["token_nums"] = attention_mask.sum(dim=1).tolist()
 
             base64_encode = params.get("encoding_format", None)
 
@@ -231,6 +395,8 @@ class ModelWorker(BaseModelWorker):
                 for i in range(0, input_ids.size(1), self.context_len):
                     chunk_input_ids = input_ids[:, i : i + self.context_len]
                     chunk_attention_mask = attention_mask[:, i : i + self.context_len]
+                    # inputs shorter than the batch have only padding here
+                    has_tokens = chunk_attention_mask.any(dim=1, keepdim=True)
 
                     # add cls token and mask to get cls embedding
                     if (
@@ -264,7 +430,11 @@ class ModelWorker(BaseModelWorker):
                         hasattr(self.model, "use_cls_pooling")
                         and self.model.use_cls_pooling
                     ):
-                        all_embeddings.append(chunk_embeddings * token_num)
+                        # weight by the tokens of each input, not of the batch
+                        row_token_nums = chunk_attention_mask.sum(dim=1, keepdim=True)
+                        all_embeddings.append(
+                            chunk_embeddings * row_token_nums * has_tokens
+                        )
                     else:
                         all_embeddings.append(chunk_embeddings)
                     all_token_num += token_num
@@ -300,6 +470,22 @@ class ModelWorker(BaseModelWorker):
         return ret
 
 
+def add_embed_batch_args(parser):
+    parser.add_argument(
+        "--embed-batch-max-tokens",
+        type=int,
+        default=0,
+        help="Coalesce concurrent embedding requests into batches of up to this "
+        "many padded tokens. 0 disables micro-batching.",
+    )
+    parser.add_argument(
+        "--embed-batch-max-wait-ms",
+        type=float,
+        default=5,
+        help="Maximum time an embedding request waits for others to batch with.",
+    )
+
+
 def create_model_worker():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
@@ -318,6 +504,7 @@ def create_model_worker():
         "--conv-template", type=str, default=None, help="Conversation prompt template."
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    add_embed_batch_args(parser)
     parser.add_argument(
         "--limit-worker-concurrency",
         type=int,
@@ -325,6 +512,39 @@ def create_model_worker():
         help="Limit the model concurrency to prevent OOM.",
     )
     parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument(
+        "--speculative-method",
+        type=str,
+        choices=SPECULATIVE_METHODS,
+        default=None,
+        help="Enable speculative decoding. prompt-lookup drafts from n-grams of "
+        "the sequence, draft-model drafts with --draft-model-path.",
+    )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        default=None,
+        help="A small model with the same tokenizer, for --speculative-method draft-model.",
+    )
+    parser.add_argument(
+        "--num-speculative-tokens",
+        type=int,
+        default=5,
+        help="The number of tokens drafted per step of speculative decoding.",
+    )
+    parser.add_argument(
+        "--prompt-lookup-max-ngram",
+        type=int,
+        default=3,
+        help="The longest n-gram matched by prompt-lookup drafting.",
+    )
+    parser.add_argument(
+        "--step-timing",
+        action="store_true",
+        help="Report the mean time of the model forward, sampling and output "
+        "of a decoding step in the worker status. The device is synchronized "
+        "after each phase, which slows down decoding.",
+    )
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument(
         "--seed",
@@ -381,6 +601,19 @@ def create_model_worker():
             args.device = "cpu"
     else:
         xft_config = None
+    if args.speculative_method is not None:
+        if args.speculative_method == "draft-model" and not args.draft_model_path:
+            raise ValueError(
+                "--speculative-method draft-model needs --draft-model-path"
+            )
+        speculative_config = SpeculativeConfig(
+            method=args.speculative_method,
+            num_draft_tokens=args.num_speculative_tokens,
+            max_ngram=args.prompt_lookup_max_ngram,
+            draft_model_path=args.draft_model_path,
+        )
+    else:
+        speculative_config = None
 
     worker = ModelWorker(
         args.controller_address,
@@ -406,7 +639,13 @@ def create_model_worker():
         embed_in_truncate=args.embed_in_truncate,
         seed=args.seed,
         debug=args.debug,
+        speculative_config=speculative_config,
+        step_timing=args.step_timing,
     )
+    if args.embed_batch_max_tokens > 0:
+        worker.embedding_batcher = EmbeddingBatcher(
+            args.embed_batch_max_tokens, args.embed_batch_max_wait_ms / 1000
+        )
     return args, worker
 
 
@@ -0,0 +1,168 @@
+"""
+Text moderation with the OpenAI moderation API, shared by the web servers.
+
+Results are cached by text hash, so the messages of a conversation checked on
+earlier turns are not sent again. Texts submitted by concurrent requests
+within a short window go out together in one API call, made with a pooled
+client.
+"""
+from collections import OrderedDict
+import concurrent.futures
+import hashlib
+import os
+import queue
+import threading
+import time
+
+from fastchat.serve.api_client_pool import create_http_client, get_client
+
+MAX_RETRY = 3
+
+
+def is_flagged(result, custom_thresholds=None):
+    flagged, category_scores = result
+    if custom_thresholds is not None:
+        for category, threshold in custom_thresholds.items():
+            if category_scores.get(category, 0) > threshold:
+                flagged = True
+    return flagged
+
+
+class ModerationService:
+    def __init__(self, max_cache_items=100000, batch_window=0.01, max_batch_size=32):
+        """
+        batch_window: seconds to wait for more texts before sending a batch
+        """
+        self.max_cache_items = max_cache_items
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        # text hash -> (flagged, category_scores), most recently used last
+        self.cache = OrderedDict()
+        # text hash -> future of texts waiting for the API
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.stats = {"hits": 0, "misses": 0, "api_calls": 0}
+
+    def submit(self, texts):
+        """Return a future of the (flagged, category_scores) of every text."""
+        futures = []
+        with self.lock:
+            for text in texts:
+                key = hashlib.sha1(text.encode("utf-8")).digest()
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.stats["hits"] += 1
+                    future = concurrent.futures.Future()
+                    future.set_result(self.cache[key])
+                elif key in self.pending:
+                    future = self.pending[key]
+                else:
+                    self.stats["misses"] += 1
+                    future = concurrent.futures.Future()
+                    self.pending[key] = future
+                    self.queue.put((key, text, future))
+                futures.append(future)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return futures
+
+    def check_later(self, texts, custom_thresholds=None):
+        """Return a future of whether any of texts is flagged."""
+        futures = self.submit(texts)
+        verdict = concurrent.futures.Future()
+        if not futures:
+            verdict.set_result(False)
+            return verdict
+
+        remaining = [len(futures)]
+        remaining_lock = threading.Lock()
+
+        def on_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            verdict.set_result(
+                any(is_flagged(f.result(), custom_thresholds) for f in futures)
+            )
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return verdict
+
+    def check(self, texts, custom_thresholds=None):
+        return self.check_later(texts, custom_thresholds).result()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.moderate([text for _, text, _ in batch])
+            except Exception as e:
+                print(f"MODERATION ERROR: {e}")
+                results = None
+            self.resolve(batch, results)
+
+    def moderate(self, texts):
+        """Return the (flagged, category_scores) of texts, None if the API fails."""
+        import openai
+
+        results = None
+        for _ in range(MAX_RETRY):
+            try:
+                api_key = os.environ["OPENAI_API_KEY"]
+                client = get_client(
+                    "openai_moderation",
+                    None,
+                    api_key,
+                    lambda: openai.OpenAI(
+                        api_key=api_key, http_client=create_http_client()
+                    ),
+                )
+                self.stats["api_calls"] += 1
+                res = client.moderations.create(input=texts)
+                results = [
+                    (r.flagged, r.category_scores.model_dump()) for r in res.results
+                ]
+                break
+            except (openai.OpenAIError, KeyError, IndexError) as e:
+                print(f"MODERATION ERROR: {e}\nInput: {texts}")
+        return results
+
+    def resolve(self, batch, results):
+        with self.lock:
+            for i, (key, _, future) in enumerate(batch):
+                del self.pending[key]
+                if results is None:
+                    # flagged to be conservative, and not cached
+                    future.set_result((True, {}))
+                    continue
+                self.cache[key] = results[i]
+                while len(self.cache) > self.max_cache_items:
+                    self.cache.popitem(last=False)
+                future.set_result(results[i])
+
+
+moderation_service = None
+moderation_service_lock = threading.Lock()
+
+
+def get_moderation_service():
+    global moderation_service
+    if moderation_service is None:
+        with moderation_service_lock:
+            if moderation_service is None:
+                moderation_service = ModerationService()
+    return moderation_service
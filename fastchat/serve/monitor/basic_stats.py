@@ -1,7 +1,6 @@
 import argparse
 import code
 import datetime
-import json
 import os
 from pytz import timezone
 import time
@@ -11,6 +10,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 from tqdm import tqdm
 
+from fastchat.serve.monitor.log_scanner import scan_log
+
 
 NUM_SERVERS = 14
 LOG_ROOT_DIR = "~/fastchat_logs"
@@ -34,26 +35,22 @@ def get_log_files(max_num_files=None):
     return filenames
 
 
+def project_basic_stats(row):
+    return dict(
+        type=row["type"],
+        tstamp=row["tstamp"],
+        model=row.get("model", ""),
+        models=row.get("models", ["", ""]),
+    )
+
+
 def load_log_files(filename):
-    data = []
     for retry in range(5):
         try:
-            lines = open(filename).readlines()
-            break
+            return list(scan_log(filename, project=project_basic_stats))
         except FileNotFoundError:
             time.sleep(2)
-
-    for l in lines:
-        row = json.loads(l)
-        data.append(
-            dict(
-                type=row["type"],
-                tstamp=row["tstamp"],
-                model=row.get("model", ""),
-                models=row.get("models", ["", ""]),
-            )
-        )
-    return data
+    return []
 
 
 def load_log_files_parallel(log_files, num_threads=16):
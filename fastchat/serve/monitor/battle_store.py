@@ -0,0 +1,233 @@
+"""
+Columnar (Parquet) store for cleaned battles.
+
+Layout (hive partitioned by US/Pacific date):
+    <root>/battles/date=2024-05-01/part-<name>.parquet        rating columns
+    <root>/conversations/date=2024-05-01/part-<name>.parquet  conversation bodies
+
+Both column groups are written row-aligned from the same sorted rows, so the
+rating jobs read only the small `battles` group and never touch conversation
+text. Reads are memory-mapped and pruned by column and date.
+
+Dependency:
+pip install pyarrow
+
+Usage:
+python3 -m fastchat.serve.monitor.battle_store --in clean_battle_20240501.json --out clean_battle_store
+"""
+import argparse
+import datetime
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pytz import timezone
+
+BATTLES_DIR = "battles"
+CONVERSATIONS_DIR = "conversations"
+
+CONVERSATION_COLUMNS = ["conversation_a", "conversation_b"]
+# columns repeated in the conversation group so it can be used on its own
+CONVERSATION_KEY_COLUMNS = ["question_id", "tstamp"]
+# schema metadata key listing columns stored as JSON strings
+JSON_COLUMNS_KEY = b"fastchat_json_columns"
+
+
+def get_battle_date(tstamp):
+    return datetime.datetime.fromtimestamp(tstamp, tz=timezone("US/Pacific")).strftime(
+        "%Y-%m-%d"
+    )
+
+
+def is_battle_store(path):
+    return os.path.isdir(os.path.join(path, BATTLES_DIR))
+
+
+def to_arrow_table(df):
+    """Nested columns with free-form keys (conv_metadata, category_tag, ...) are
+    stored as JSON strings, conversations keep their native list<struct> type."""
+    json_columns = []
+    df = df.copy()
+    for col in df.columns:
+        if col in CONVERSATION_COLUMNS or df[col].dtype != object:
+            continue
+        if df[col].map(lambda x: isinstance(x, (dict, list))).any():
+            df[col] = df[col].map(lambda x: json.dumps(x, ensure_ascii=False))
+            json_columns.append(col)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            JSON_COLUMNS_KEY: json.dumps(json_columns).encode(),
+        }
+    )
+
+
+def from_arrow_table(table):
+    metadata = table.schema.metadata or {}
+    json_columns = json.loads(metadata.get(JSON_COLUMNS_KEY, b"[]"))
+    df = table.drop(
+        [c for c in CONVERSATION_COLUMNS if c in table.column_names]
+    ).to_pandas()
+    # plain python lists of dicts, exactly as json.load would return them
+    for col in CONVERSATION_COLUMNS:
+        if col in table.column_names:
+            df[col] = table.column(col).to_pylist()
+    for col in json_columns:
+        if col in df.columns:
+            df[col] = df[col].map(json.loads)
+    return df
+
+
+def write_battle_partition(df, root, date, part_name="0"):
+    """Write the rows of one date as a row-aligned pair of parquet files."""
+    df = df.sort_values(by=["tstamp"]).reset_index(drop=True)
+    battle_columns = [c for c in df.columns if c not in CONVERSATION_COLUMNS]
+    conv_columns = [c for c in CONVERSATION_KEY_COLUMNS if c in df.columns] + [
+        c for c in CONVERSATION_COLUMNS if c in df.columns
+    ]
+
+    groups = [(BATTLES_DIR, battle_columns)]
+    if any(c in df.columns for c in CONVERSATION_COLUMNS):
+        groups.append((CONVERSATIONS_DIR, conv_columns))
+
+    for group, columns in groups:
+        part_dir = os.path.join(root, group, f"date={date}")
+        os.makedirs(part_dir, exist_ok=True)
+        filename = os.path.join(part_dir, get_part_filename(part_name))
+        tmp_filename = filename + ".tmp"
+        pq.write_table(to_arrow_table(df[columns]), tmp_filename)
+        os.replace(tmp_filename, filename)
+
+
+def write_battle_store(battles, root, part_name="0"):
+    """
+    Write cleaned battles (list of dicts or DataFrame) into the store.
+    Existing parts with the same name are replaced date by date.
+    """
+    df = battles if isinstance(battles, pd.DataFrame) else pd.DataFrame(battles)
+    if len(df) == 0:
+        return []
+    dates = df["tstamp"].map(get_battle_date)
+    for date, df_date in df.groupby(dates):
+        write_battle_partition(df_date, root, date, part_name)
+    return sorted(dates.unique())
+
+
+def get_date_filter(start_date, end_date):
+    expr = None
+    if start_date is not None:
+        expr = ds.field("date") >= start_date
+    if end_date is not None:
+        end_expr = ds.field("date") <= end_date
+        expr = end_expr if expr is None else expr & end_expr
+    return expr
+
+
+def get_part_filename(part_name):
+    return f"part-{part_name}.parquet"
+
+
+def delete_battle_parts(root, part_name, dates):
+    """Remove the files of one part from the given date partitions."""
+    for group in [BATTLES_DIR, CONVERSATIONS_DIR]:
+        for date in dates:
+            filename = os.path.join(
+                root, group, f"date={date}", get_part_filename(part_name)
+            )
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def read_group(root, group, columns, start_date, end_date, part_names=None):
+    if not os.path.isdir(os.path.join(root, group)):
+        # no battles were written yet
+        return pd.DataFrame(columns=columns or [])
+    dataset = ds.dataset(
+        os.path.join(root, group),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+    )
+    # sort files so the two column groups stay row-aligned
+    fragments = sorted(
+        dataset.get_fragments(filter=get_date_filter(start_date, end_date)),
+        key=lambda x: x.path,
+    )
+    if part_names is not None:
+        part_filenames = set(get_part_filename(x) for x in part_names)
+        fragments = [x for x in fragments if os.path.basename(x.path) in part_filenames]
+    tables = []
+    for fragment in fragments:
+        # memory-mapped read of only the requested columns
+        file_columns = fragment.physical_schema.names
+        cols = (
+            file_columns
+            if columns is None
+            else [c for c in columns if c in file_columns]
+        )
+        tables.append(pq.read_table(fragment.path, columns=cols, memory_map=True))
+    if not tables:
+        return pd.DataFrame(columns=columns or [])
+    return pd.concat([from_arrow_table(t) for t in tables], ignore_index=True)
+
+
+def read_battles(
+    root,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    with_conversations=False,
+    part_names=None,
+):
+    """
+    Load battles from the store as a DataFrame sorted by tstamp.
+
+    columns: rating columns to load (None loads all of them)
+    start_date, end_date: inclusive "YYYY-MM-DD" bounds used to prune partitions
+    with_conversations: also load conversation_a / conversation_b
+    part_names: only load these parts (None loads all of them)
+    """
+    df = read_group(root, BATTLES_DIR, columns, start_date, end_date, part_names)
+    if with_conversations:
+        convs = read_group(
+            root,
+            CONVERSATIONS_DIR,
+            CONVERSATION_COLUMNS,
+            start_date,
+            end_date,
+            part_names,
+        )
+        assert len(convs) == len(df), "Battle store column groups are misaligned"
+        df = pd.concat([df, convs], axis=1)
+    if "tstamp" in df.columns:
+        df = df.sort_values(by=["tstamp"], kind="stable").reset_index(drop=True)
+    return df
+
+
+def load_battles(path, columns=None, with_conversations=True, **kwargs):
+    """Load cleaned battles from either a battle store directory or a JSON file."""
+    if is_battle_store(path):
+        return read_battles(
+            path, columns=columns, with_conversations=with_conversations, **kwargs
+        )
+    df = pd.read_json(path)
+    if columns is not None:
+        if with_conversations:
+            columns = columns + [c for c in CONVERSATION_COLUMNS if c not in columns]
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in", dest="in_file", type=str, required=True)
+    parser.add_argument("--out", type=str, required=True)
+    args = parser.parse_args()
+
+    battles = json.load(open(args.in_file))
+    dates = write_battle_store(battles, args.out)
+    print(f"Write {len(battles)} battles over {len(dates)} days to {args.out}")
@@ -1,4 +1,6 @@
 import argparse
+import asyncio
+import hashlib
 import json
 import pandas as pd
 import os
@@ -11,6 +13,7 @@ import threading
 import orjson
 
 from category import Category
+from fastchat.serve.monitor.battle_store import is_battle_store, read_battles
 
 
 LOCK = threading.RLock()
@@ -242,6 +245,281 @@ def get_answer(
             fout.write(json.dumps(question.to_dict()) + "\n")
 
 
+class LabelCache:
+    """Raw judge outputs on disk (json lines), keyed by a hash of the judge
+    config and the exact messages sent, so unchanged prompts are never re-labeled."""
+
+    def __init__(self, cache_file, judge_config):
+        self.cache_file = cache_file
+        self.judge_key = json.dumps(judge_config, sort_keys=True)
+        self.outputs = {}
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, "rb") as f:
+                for line in f:
+                    obj = orjson.loads(line)
+                    self.outputs[obj["key"]] = obj["output"]
+        self.fout = open(cache_file, "a") if cache_file else None
+
+    def get_key(self, messages, image_path=None):
+        payload = self.judge_key + json.dumps(
+            [messages, image_path], sort_keys=True, default=str
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.outputs.get(key)
+
+    def put(self, key, output):
+        self.outputs[key] = output
+        if self.fout is not None:
+            self.fout.write(json.dumps({"key": key, "output": output}) + "\n")
+            self.fout.flush()
+
+
+class EndpointLimiter:
+    """Concurrency limit of one endpoint. It is halved on every rate limit and grows
+    back by one after `limit` consecutive successes (AIMD), up to max_concurrency."""
+
+    def __init__(self, api_dict, api_type, max_concurrency):
+        self.api_dict = api_dict or {}
+        self.api_type = api_type
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.num_success = 0
+        self.cond = asyncio.Condition()
+
+        if api_type == "openai":
+            import openai
+
+            self.client = openai.AsyncOpenAI(
+                base_url=self.api_dict.get("api_base"),
+                api_key=self.api_dict.get("api_key"),
+            )
+        elif api_type == "anthropic":
+            import anthropic
+
+            self.client = anthropic.AsyncAnthropic(
+                api_key=self.api_dict.get("api_key") or os.environ["ANTHROPIC_API_KEY"]
+            )
+        else:
+            self.client = None
+
+    def free_slots(self):
+        return self.limit - self.in_flight
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, rate_limited):
+        async with self.cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1, self.limit // 2)
+                self.num_success = 0
+            else:
+                self.num_success += 1
+                if self.num_success >= self.limit:
+                    self.limit = min(self.max_concurrency, self.limit + 1)
+                    self.num_success = 0
+            self.cond.notify_all()
+
+
+async def async_chat_completion(
+    limiter, model, messages, temperature, max_tokens, image_path=None
+):
+    if limiter.api_type == "gemini":
+        # no async client, the sync call handles its own retries
+        await limiter.acquire()
+        try:
+            return await asyncio.to_thread(
+                chat_completion_gemini,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                api_dict=limiter.api_dict,
+                image_path=image_path,
+            )
+        finally:
+            await limiter.release(False)
+
+    if limiter.api_type == "openai":
+        import openai
+
+        rate_limit_errors = (openai.RateLimitError,)
+        retry_errors = (openai.APIConnectionError, openai.InternalServerError)
+    elif limiter.api_type == "anthropic":
+        import anthropic
+
+        rate_limit_errors = (anthropic.RateLimitError,)
+        retry_errors = (anthropic.APIError,)
+
+        sys_msg = ""
+        if messages[0]["role"] == "system":
+            sys_msg = messages[0]["content"]
+            messages = messages[1:]
+    else:
+        raise ValueError(f"api_type {limiter.api_type} not supported")
+
+    output = API_ERROR_OUTPUT
+    for attempt in range(API_MAX_RETRY):
+        rate_limited = False
+        retry = False
+        await limiter.acquire()
+        try:
+            if limiter.api_type == "openai":
+                completion = await limiter.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+                output = completion.choices[0].message.content
+            else:
+                response = await limiter.client.messages.create(
+                    model=model,
+                    messages=messages,
+                    stop_sequences=[anthropic.HUMAN_PROMPT],
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=sys_msg,
+                )
+                output = response.content[0].text
+        except rate_limit_errors as e:
+            print(type(e), e)
+            rate_limited = retry = True
+        except retry_errors as e:
+            print(type(e), e)
+            retry = True
+        except Exception as e:
+            print(type(e), e)
+        finally:
+            await limiter.release(rate_limited)
+
+        if not retry:
+            break
+        # exponential backoff with jitter
+        await asyncio.sleep(API_RETRY_SLEEP * (2**attempt) * random.uniform(0.5, 1.0))
+    return output
+
+
+class AsyncLabeler:
+    def __init__(self, config, categories, answer_file, testing):
+        self.config = config
+        self.categories = categories
+        self.testing = testing
+        self.limiters = [
+            EndpointLimiter(
+                api_dict,
+                config["api_type"],
+                config.get("parallel_per_endpoint", config["parallel"]),
+            )
+            for api_dict in (config["endpoints"] or [None])
+        ]
+        self.cache = LabelCache(
+            config.get("label_cache_file"),
+            {
+                "model_name": config["model_name"],
+                "api_type": config["api_type"],
+                "temperature": config["temperature"],
+                "max_token": config["max_token"],
+            },
+        )
+        # identical prompts in flight share one request
+        self.pending = {}
+        self.num_requests = 0
+        self.num_cache_hits = 0
+        self.fout = open(answer_file, "a")
+
+    def pick_limiter(self):
+        most_free = max(limiter.free_slots() for limiter in self.limiters)
+        return random.choice([x for x in self.limiters if x.free_slots() == most_free])
+
+    async def request(self, messages, image_path):
+        output = await async_chat_completion(
+            self.pick_limiter(),
+            self.config["model_name"],
+            messages,
+            self.config["temperature"],
+            self.config["max_token"],
+            image_path=image_path,
+        )
+        self.num_requests += 1
+        return output
+
+    async def get_output(self, messages, image_path):
+        key = self.cache.get_key(messages, image_path)
+        output = self.cache.get(key)
+        if output is not None:
+            self.num_cache_hits += 1
+            return output
+
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(
+                self.request(messages, image_path)
+            )
+        task = self.pending[key]
+        output = await task
+        self.pending.pop(key, None)
+        if output != API_ERROR_OUTPUT and self.cache.get(key) is None:
+            self.cache.put(key, output)
+        return output
+
+    async def label_row(self, question):
+        if "category_tag" in question:
+            category_tag = question["category_tag"]
+        else:
+            category_tag = {}
+
+        categories = [
+            category
+            for category in self.categories
+            if category.name_tag in question["required_tasks"]
+        ]
+        convs = [category.pre_process(question) for category in categories]
+        outputs = await asyncio.gather(
+            *[self.get_output(conv, question.get("image_path")) for conv in convs]
+        )
+
+        output_log = {}
+        for category, output in zip(categories, outputs):
+            category_tag[category.name_tag] = category.post_process(output)
+            if self.testing:
+                output_log[category.name_tag] = output
+
+        question["category_tag"] = category_tag
+        if self.testing:
+            question["output_log"] = output_log
+        question = question.drop(["prompt", "uid", "required_tasks"])
+        self.fout.write(json.dumps(question.to_dict()) + "\n")
+
+    async def run(self, not_labeled):
+        # bound the number of rows in flight so huge inputs do not spawn millions of tasks
+        max_rows_in_flight = 4 * sum(x.max_concurrency for x in self.limiters)
+        row_slots = asyncio.Semaphore(max_rows_in_flight)
+
+        async def run_row(row):
+            try:
+                await self.label_row(row)
+            finally:
+                row_slots.release()
+
+        tasks = []
+        pbar = tqdm.tqdm(total=len(not_labeled))
+        for _, row in not_labeled.iterrows():
+            await row_slots.acquire()
+            task = asyncio.ensure_future(run_row(row))
+            task.add_done_callback(lambda _: pbar.update(1))
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        pbar.close()
+        self.fout.close()
+        print(f"#requests: {self.num_requests}, #cache hits: {self.num_cache_hits}")
+
+
 def category_merge(row):
     id = row["uid"]
     input_category = row["category_tag"] if "category_tag" in row else {}
@@ -301,9 +579,12 @@ if __name__ == "__main__":
     )
 
     print("loading input data (might take min)")
-    with open(config["input_file"], "rb") as f:
-        data = orjson.loads(f.read())
-    input_data = pd.DataFrame(data)
+    if is_battle_store(config["input_file"]):
+        input_data = read_battles(config["input_file"], with_conversations=True)
+    else:
+        with open(config["input_file"], "rb") as f:
+            data = orjson.loads(f.read())
+        input_data = pd.DataFrame(data)
 
     # much faster than pd.apply
     input_data["uid"] = input_data.question_id.map(str) + input_data.tstamp.map(str)
@@ -380,32 +661,36 @@ if __name__ == "__main__":
         )
     not_labeled["prompt"] = not_labeled.prompt.map(lambda x: x[:12500])
 
-    with concurrent.futures.ThreadPoolExecutor(
-        max_workers=config["parallel"]
-    ) as executor:
-        futures = []
-        for index, row in tqdm.tqdm(not_labeled.iterrows()):
-            future = executor.submit(
-                get_answer,
-                row,
-                config["model_name"],
-                config["max_token"],
-                config["temperature"],
-                config["output_file"],
-                get_endpoint(config["endpoints"]),
-                [
-                    category
-                    for category in categories
-                    if category.name_tag in row["required_tasks"]
-                ],
-                args.testing,
-                config["api_type"],
-            )
-            futures.append(future)
-        for future in tqdm.tqdm(
-            concurrent.futures.as_completed(futures), total=len(futures)
-        ):
-            future.result()
+    if config.get("engine", "thread") == "async":
+        labeler = AsyncLabeler(config, categories, config["output_file"], args.testing)
+        asyncio.run(labeler.run(not_labeled))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=config["parallel"]
+        ) as executor:
+            futures = []
+            for index, row in tqdm.tqdm(not_labeled.iterrows()):
+                future = executor.submit(
+                    get_answer,
+                    row,
+                    config["model_name"],
+                    config["max_token"],
+                    config["temperature"],
+                    config["output_file"],
+                    get_endpoint(config["endpoints"]),
+                    [
+                        category
+                        for category in categories
+                        if category.name_tag in row["required_tasks"]
+                    ],
+                    args.testing,
+                    config["api_type"],
+                )
+                futures.append(future)
+            for future in tqdm.tqdm(
+                concurrent.futures.as_completed(futures), total=len(futures)
+            ):
+                future.result()
 
     if config["convert_to_json"]:
         # merge two data frames, but only take the fields from the cache data to overwrite the input data
@@ -3,9 +3,12 @@ Clean chatbot arena battle log.
 
 Usage:
 python3 clean_battle_data.py --mode conv_release
+python3 clean_battle_data.py --cache-dir battle_cache  # only clean new or changed log files
 """
 import argparse
 import datetime
+from functools import partial
+import hashlib
 import json
 import os
 from pytz import timezone
@@ -18,6 +21,11 @@ from collections import Counter
 import shortuuid
 
 from fastchat.serve.monitor.basic_stats import get_log_files, NUM_SERVERS
+from fastchat.serve.monitor.battle_store import (
+    delete_battle_parts,
+    read_battles,
+    write_battle_store,
+)
 from fastchat.utils import detect_language
 
 
@@ -66,6 +74,25 @@ ERROR_WORDS = [
     "**API REQUEST ERROR**",
 ]
 
+JUDGE_PREFIX = "arena_user_"
+# keys of a cleaned battle, in the order written by process_data
+BATTLE_KEYS = [
+    "question_id",
+    "model_a",
+    "model_b",
+    "winner",
+    "judge",
+    "conversation_a",
+    "conversation_b",
+    "turn",
+    "anony",
+    "language",
+    "tstamp",
+]
+
+CACHE_MANIFEST_FILE = "manifest.json"
+CACHE_VERSION = 1
+
 UNFINISHED_WORDS = [
     "▌",
     '<span class="cursor">',
@@ -302,7 +329,7 @@ def process_data(
                 model_a=models[0],
                 model_b=models[1],
                 winner=convert_type[row["type"]],
-                judge=f"arena_user_{user_id}",
+                judge=f"{JUDGE_PREFIX}{user_id}",
                 conversation_a=conversation_a,
                 conversation_b=conversation_b,
                 turn=len(conversation_a) // 2,
@@ -321,7 +348,18 @@ def clean_battle_data(
     sanitize_ip=False,
     anony_only=False,
     num_threads=16,
+    cache_dir=None,
 ):
+    if cache_dir is not None:
+        return clean_battle_data_cached(
+            log_files,
+            exclude_model_names,
+            ban_ip_list=ban_ip_list,
+            sanitize_ip=sanitize_ip,
+            num_threads=num_threads,
+            cache_dir=cache_dir,
+        )
+
     data = read_file_parallel(log_files, num_threads=16)
 
     battles = []
@@ -352,15 +390,21 @@ def clean_battle_data(
                 else:
                     all_ips[ip]["count"] += sub_all_ips[ip]["count"]
     battles.sort(key=lambda x: x["tstamp"])
-    last_updated_tstamp = battles[-1]["tstamp"]
 
-    last_updated_datetime = datetime.datetime.fromtimestamp(
-        last_updated_tstamp, tz=timezone("US/Pacific")
-    ).strftime("%Y-%m-%d %H:%M:%S %Z")
+    print_clean_stats(battles, len(data), count_dict, count_leak, all_ips, ban_ip_list)
+    return battles
+
+
+def print_clean_stats(battles, num_votes, count_dict, count_leak, all_ips, ban_ip_list):
+    last_updated_datetime = None
+    if battles:
+        last_updated_datetime = datetime.datetime.fromtimestamp(
+            battles[-1]["tstamp"], tz=timezone("US/Pacific")
+        ).strftime("%Y-%m-%d %H:%M:%S %Z")
 
-    print(f"#votes: {len(data)}")
+    print(f"#votes: {num_votes}")
     print(count_dict)
-    print(f"#battles: {len(battles)}, #anony: {count_dict['anony']}")
+    print(f"#battles: {len(battles)}, #anony: {count_dict.get('anony', 0)}")
     print(f"last-updated: {last_updated_datetime}")
     print(f"leaked_identity: {count_leak}")
 
@@ -370,6 +414,144 @@ def clean_battle_data(
                 del all_ips[ban_ip]
     print("Top 30 IPs:")
     print(sorted(all_ips.values(), key=lambda x: x["count"], reverse=True)[:30])
+
+
+def get_cache_part_name(filename):
+    return hashlib.md5(os.path.abspath(filename).encode()).hexdigest()
+
+
+def load_cache_manifest(cache_dir):
+    manifest_file = os.path.join(cache_dir, CACHE_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as fin:
+        manifest = json.load(fin)
+    if manifest.get("version") != CACHE_VERSION:
+        print(f"Ignoring battle cache with outdated version: {cache_dir}")
+        return {}
+    return manifest["files"]
+
+
+def save_cache_manifest(cache_dir, files):
+    manifest_file = os.path.join(cache_dir, CACHE_MANIFEST_FILE)
+    with open(manifest_file + ".tmp", "w") as fout:
+        json.dump({"version": CACHE_VERSION, "files": files}, fout)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def is_cache_entry_valid(entry, filename):
+    if entry is None:
+        return False
+    stat = os.stat(filename)
+    return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+
+def clean_file_to_cache(filename, cache_dir):
+    """Clean one log file without the global filters and store it as one cache part."""
+    # stat before reading so that a file appended during the read is redone next run
+    stat = os.stat(filename)
+    data = read_file(filename)
+    battles, count_dict, count_leak, _ = process_data(data, None, False, None)
+    part_name = get_cache_part_name(filename)
+    dates = write_battle_store(battles, cache_dir, part_name)
+    return filename, dict(
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        part_name=part_name,
+        dates=dates,
+        num_votes=len(data),
+        count_dict=count_dict,
+        count_leak=count_leak,
+    )
+
+
+def clean_battle_data_cached(
+    log_files,
+    exclude_model_names,
+    ban_ip_list=None,
+    sanitize_ip=False,
+    num_threads=16,
+    cache_dir="battle_cache",
+):
+    """
+    Same output as clean_battle_data, but each log file is cleaned once and kept
+    in a battle store under cache_dir, keyed by path, size and mtime.
+    Only new or changed files are processed; the global filters (excluded
+    models, banned IPs, IP sanitization) are applied when merging.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_cache_manifest(cache_dir)
+
+    stale_files = [f for f in log_files if not is_cache_entry_valid(manifest.get(f), f)]
+    for filename in stale_files:
+        if filename in manifest:
+            entry = manifest.pop(filename)
+            delete_battle_parts(cache_dir, entry["part_name"], entry["dates"])
+    print(
+        f"#cached files: {len(log_files) - len(stale_files)}, #new: {len(stale_files)}"
+    )
+
+    if stale_files:
+        with Pool(min(num_threads, len(stale_files))) as p:
+            clean_fn = partial(clean_file_to_cache, cache_dir=cache_dir)
+            for filename, entry in tqdm(
+                p.imap_unordered(clean_fn, stale_files), total=len(stale_files)
+            ):
+                manifest[filename] = entry
+        save_cache_manifest(cache_dir, manifest)
+
+    entries = [manifest[f] for f in log_files]
+    df = read_battles(
+        cache_dir,
+        with_conversations=True,
+        part_names=[entry["part_name"] for entry in entries],
+    )
+    return merge_cached_battles(
+        df, entries, exclude_model_names, ban_ip_list, sanitize_ip
+    )
+
+
+def merge_cached_battles(df, entries, exclude_model_names, ban_ip_list, sanitize_ip):
+    count_dict = Counter()
+    count_leak = Counter()
+    for entry in entries:
+        count_dict += Counter(entry["count_dict"])
+        count_leak += Counter(entry["count_leak"])
+    num_votes = sum(entry["num_votes"] for entry in entries)
+    if len(df) == 0:
+        print(f"#votes: {num_votes}")
+        print("#battles: 0")
+        return []
+
+    if exclude_model_names:
+        excluded = df["model_a"].isin(exclude_model_names) | df["model_b"].isin(
+            exclude_model_names
+        )
+        count_dict["exclude_model"] = int(excluded.sum())
+        df = df[~excluded]
+
+    ips = df["judge"].str[len(JUDGE_PREFIX) :]
+    all_ips = {
+        ip: {"ip": ip, "count": int(count), "sanitized_id": shortuuid.uuid()}
+        for ip, count in ips.value_counts().items()
+    }
+    if ban_ip_list is not None:
+        banned = ips.isin(ban_ip_list)
+        count_dict["banned"] = int(banned.sum())
+        df, ips = df[~banned], ips[~banned]
+    if sanitize_ip:
+        df = df.assign(
+            judge=JUDGE_PREFIX + ips.map(lambda ip: all_ips[ip]["sanitized_id"])
+        )
+
+    df = df.sort_values(by=["tstamp"], kind="stable")
+    battles = df[[c for c in BATTLE_KEYS if c in df.columns]].to_dict("records")
+
+    count_dict = {k: int(v) for k, v in (count_dict + Counter()).items()}
+    count_dict["anony"] = int(df["anony"].sum())
+    print_clean_stats(
+        battles, num_votes, count_dict, dict(count_leak), all_ips, ban_ip_list
+    )
     return battles
 
 
@@ -382,13 +564,29 @@ if __name__ == "__main__":
     parser.add_argument("--exclude-model-names", type=str, nargs="+")
     parser.add_argument("--ban-ip-file", type=str)
     parser.add_argument("--sanitize-ip", action="store_true", default=False)
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Keep cleaned battles per log file here and only process new or changed files",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["json", "parquet"],
+        default="json",
+        help="parquet writes a date-partitioned battle store directory (see battle_store.py)",
+    )
     args = parser.parse_args()
 
     log_files = get_log_files(args.max_num_files)
     ban_ip_list = json.load(open(args.ban_ip_file)) if args.ban_ip_file else None
 
     battles = clean_battle_data(
-        log_files, args.exclude_model_names or [], ban_ip_list, args.sanitize_ip
+        log_files,
+        args.exclude_model_names or [],
+        ban_ip_list,
+        args.sanitize_ip,
+        cache_dir=args.cache_dir,
     )
     last_updated_tstamp = battles[-1]["tstamp"]
     cutoff_date = datetime.datetime.fromtimestamp(
@@ -418,6 +616,10 @@ if __name__ == "__main__":
         battles = new_battles
         output = f"clean_battle_conv_{cutoff_date}.json"
 
-    with open(output, "w", encoding="utf-8", errors="replace") as fout:
-        json.dump(battles, fout, indent=2, ensure_ascii=False)
+    if args.output_format == "parquet":
+        output = output[: -len(".json")]
+        write_battle_store(battles, output)
+    else:
+        with open(output, "w", encoding="utf-8", errors="replace") as fout:
+            json.dump(battles, fout, indent=2, ensure_ascii=False)
     print(f"Write cleaned data to {output}")
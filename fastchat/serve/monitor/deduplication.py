@@ -13,18 +13,30 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 
+from fastchat.serve.monitor.battle_store import is_battle_store, read_battles
+from fastchat.serve.monitor.near_duplicate import find_near_duplicates
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--output_dir", type=str, default="output")
     parser.add_argument("--model", type=str, default=None)
     parser.add_argument("--input_file", type=str, required=True)
     parser.add_argument("--percentile", type=float, default=0.9999)
+    parser.add_argument(
+        "--near-dup-threshold",
+        type=float,
+        default=None,
+        help="Also group prompts whose MinHash Jaccard similarity is above this value",
+    )
     args = parser.parse_args()
     output_dir = args.output_dir
     input_file = args.input_file
 
-    with open(input_file) as f:
-        data = json.load(f)
+    if is_battle_store(input_file):
+        data = read_battles(input_file, with_conversations=True).to_dict("records")
+    else:
+        with open(input_file) as f:
+            data = json.load(f)
 
     os.makedirs(output_dir, exist_ok=True)
 
@@ -44,7 +56,16 @@ if __name__ == "__main__":
     df = pd.DataFrame(all_convs_new)
     print("Number of conversations: ", len(df))
 
-    prompt_counts = df["post_process_conv"].value_counts()
+    dedup_column = "post_process_conv"
+    if args.near_dup_threshold is not None:
+        # count near-duplicate prompts under the first prompt of their group
+        groups = find_near_duplicates(
+            df["post_process_conv"].tolist(), threshold=args.near_dup_threshold
+        )
+        df["near_dup_conv"] = df["post_process_conv"].values[groups]
+        dedup_column = "near_dup_conv"
+
+    prompt_counts = df[dedup_column].value_counts()
     # Select the top 20 most frequent prompts
     top_prompts = prompt_counts.head(20)
     print(top_prompts)
@@ -63,7 +84,7 @@ if __name__ == "__main__":
     dedup_tags = np.array(
         [{"high_freq": False, "sampled": True} for _ in range(len(df))]
     )
-    high_freq_groups = df.groupby("post_process_conv")
+    high_freq_groups = df.groupby(dedup_column)
     for prompt in tqdm(high_frequency_prompts):
         df_high_freq = high_freq_groups.get_group(prompt)
         sampled_indices = df_high_freq.sample(
@@ -75,7 +96,7 @@ if __name__ == "__main__":
     df["dedup_tag"] = dedup_tags
 
     # drop intermediate columns (post_process_conv)
-    df = df.drop(columns=["post_process_conv"])
+    df = df.drop(columns=["post_process_conv", "near_dup_conv"], errors="ignore")
 
     df.to_json(
         os.path.join(output_dir, "dedup.json"),
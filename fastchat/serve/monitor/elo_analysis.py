@@ -15,6 +15,7 @@ from tqdm import tqdm
 
 from fastchat.model.model_registry import get_model_info
 from fastchat.serve.monitor.basic_stats import get_log_files
+from fastchat.serve.monitor.battle_store import load_battles
 from fastchat.serve.monitor.clean_battle_data import clean_battle_data
 from fastchat.serve.monitor.rating_systems import (
     compute_elo,
@@ -23,7 +24,10 @@ from fastchat.serve.monitor.rating_systems import (
     compute_bootstrap_elo,
     compute_bootstrap_bt,
     compute_bootstrap_style_control,
+    compute_bt_from_counts,
+    compute_bootstrap_bt_from_counts,
 )
+from fastchat.serve.monitor.rating_state import RatingState
 
 pd.options.display.float_format = "{:.2f}".format
 
@@ -58,6 +62,14 @@ def compute_pairwise_win_fraction(battles, model_order, limit_show_number=None):
         battles, index="model_a", columns="model_b", aggfunc="size", fill_value=0
     )
 
+    return compute_pairwise_win_fraction_from_tables(
+        a_win_ptbl, b_win_ptbl, num_battles_ptbl, model_order, limit_show_number
+    )
+
+
+def compute_pairwise_win_fraction_from_tables(
+    a_win_ptbl, b_win_ptbl, num_battles_ptbl, model_order, limit_show_number=None
+):
     # Computing the proportion of wins for each model as A and as B
     # against all other models
     row_beats_col_freq = (a_win_ptbl + b_win_ptbl.T) / (
@@ -76,6 +88,21 @@ def compute_pairwise_win_fraction(battles, model_order, limit_show_number=None):
     return row_beats_col
 
 
+def get_battle_tables_from_counts(counts, models):
+    """Build the no-tie pivot tables of compute_pairwise_win_fraction from a
+    (model_a, model_b, outcome) count tensor, keeping only models that played."""
+    no_tie_counts = counts[:, :, [0, 2]]
+    played = no_tie_counts.sum(axis=(1, 2)) + no_tie_counts.sum(axis=(0, 2)) > 0
+    keep = np.flatnonzero(played)
+    names = [models[i] for i in keep]
+    counts = counts[np.ix_(keep, keep)]
+
+    a_win_ptbl = pd.DataFrame(counts[:, :, 2], index=names, columns=names)
+    b_win_ptbl = pd.DataFrame(counts[:, :, 0], index=names, columns=names)
+    num_battles_ptbl = a_win_ptbl + b_win_ptbl
+    return a_win_ptbl, b_win_ptbl, num_battles_ptbl
+
+
 def visualize_leaderboard_table(rating):
     models = list(rating.keys())
     models.sort(key=lambda k: -rating[k])
@@ -100,6 +127,10 @@ def visualize_leaderboard_table(rating):
 
 def visualize_pairwise_win_fraction(battles, model_order, scale=1):
     row_beats_col = compute_pairwise_win_fraction(battles, model_order)
+    return plot_pairwise_win_fraction(row_beats_col, scale=scale)
+
+
+def plot_pairwise_win_fraction(row_beats_col, scale=1):
     fig = px.imshow(
         row_beats_col,
         color_continuous_scale="RdBu",
@@ -125,7 +156,11 @@ def visualize_battle_count(battles, model_order, scale=1):
     ptbl = pd.pivot_table(
         battles, index="model_a", columns="model_b", aggfunc="size", fill_value=0
     )
-    battle_counts = ptbl + ptbl.T
+    return plot_battle_count(ptbl, model_order, scale=scale)
+
+
+def plot_battle_count(num_battles_ptbl, model_order, scale=1):
+    battle_counts = num_battles_ptbl + num_battles_ptbl.T
     fig = px.imshow(
         battle_counts.loc[model_order, model_order],
         text_auto=True,
@@ -149,6 +184,10 @@ def visualize_average_win_rate(battles, limit_show_number, scale=1):
     row_beats_col_freq = compute_pairwise_win_fraction(
         battles, None, limit_show_number=limit_show_number
     )
+    return plot_average_win_rate(row_beats_col_freq, scale=scale)
+
+
+def plot_average_win_rate(row_beats_col_freq, scale=1):
     fig = px.bar(
         row_beats_col_freq.mean(axis=1).sort_values(ascending=False),
         text_auto=".2f",
@@ -318,6 +357,35 @@ def filter_long_conv(row):
     return False
 
 
+def get_leaderboard_table_df(elo_rating_final, bootstrap_df, num_battles):
+    model_order = list(elo_rating_final.keys())
+
+    model_rating_q025 = bootstrap_df.quantile(0.025)
+    model_rating_q975 = bootstrap_df.quantile(0.975)
+
+    # compute ranking based on CI
+    ranking = {}
+    for i, model_a in enumerate(model_order):
+        ranking[model_a] = 1
+        for j, model_b in enumerate(model_order):
+            if i == j:
+                continue
+            if model_rating_q025[model_b] > model_rating_q975[model_a]:
+                ranking[model_a] += 1
+
+    # leaderboard_table_df: elo rating, variance, 95% interval, number of battles
+    return pd.DataFrame(
+        {
+            "rating": elo_rating_final,
+            "variance": bootstrap_df.var(),
+            "rating_q975": model_rating_q975,
+            "rating_q025": model_rating_q025,
+            "num_battles": num_battles,
+            "final_ranking": pd.Series(ranking),
+        }
+    )
+
+
 def report_elo_analysis_results(
     battles_json,
     rating_system="bt",
@@ -390,32 +458,12 @@ def report_elo_analysis_results(
         elo_rating_final = elo_rating_median
 
     model_order = list(elo_rating_final.keys())
-
-    model_rating_q025 = bootstrap_df.quantile(0.025)
-    model_rating_q975 = bootstrap_df.quantile(0.975)
-
-    # compute ranking based on CI
-    ranking = {}
-    for i, model_a in enumerate(model_order):
-        ranking[model_a] = 1
-        for j, model_b in enumerate(model_order):
-            if i == j:
-                continue
-            if model_rating_q025[model_b] > model_rating_q975[model_a]:
-                ranking[model_a] += 1
-
-    # leaderboard_table_df: elo rating, variance, 95% interval, number of battles
-    leaderboard_table_df = pd.DataFrame(
-        {
-            "rating": elo_rating_final,
-            "variance": bootstrap_df.var(),
-            "rating_q975": bootstrap_df.quantile(0.975),
-            "rating_q025": bootstrap_df.quantile(0.025),
-            "num_battles": battles["model_a"]
-            .value_counts()
-            .add(battles["model_b"].value_counts(), fill_value=0),
-            "final_ranking": pd.Series(ranking),
-        }
+    leaderboard_table_df = get_leaderboard_table_df(
+        elo_rating_final,
+        bootstrap_df,
+        battles["model_a"]
+        .value_counts()
+        .add(battles["model_b"].value_counts(), fill_value=0),
     )
 
     model_order.sort(key=lambda k: -elo_rating_final[k])
@@ -464,6 +512,98 @@ def report_elo_analysis_results(
     }
 
 
+def report_elo_analysis_results_from_state(
+    rating_state,
+    category="full",
+    num_bootstrap=100,
+    exclude_models=[],
+    exclude_tie=False,
+    scale=1,
+    num_cpu=None,
+):
+    """Same outputs as report_elo_analysis_results (BT only, no style control),
+    refit from the aggregated counts of a RatingState instead of raw battles."""
+    counts = rating_state.get_counts(category).copy()
+    models = rating_state.models
+
+    # remove excluded models
+    excluded_ids = [i for i, m in enumerate(models) if m in exclude_models]
+    counts[excluded_ids, :, :] = 0
+    counts[:, excluded_ids, :] = 0
+    no_tie_counts = counts.copy()
+    no_tie_counts[:, :, 1] = 0
+    if exclude_tie:
+        counts = no_tie_counts
+
+    print(f"Number of battles: {counts.sum()}")
+    bootstrap_df = compute_bootstrap_bt_from_counts(
+        counts, models, num_round=num_bootstrap, num_cpu=num_cpu
+    )
+    elo_rating_final = compute_bt_from_counts(counts, models)
+
+    model_order = list(elo_rating_final.keys())
+    num_battles = counts.sum(axis=(1, 2)) + counts.sum(axis=(0, 2))
+    leaderboard_table_df = get_leaderboard_table_df(
+        elo_rating_final,
+        bootstrap_df,
+        pd.Series(num_battles, index=models)[model_order],
+    )
+
+    model_order.sort(key=lambda k: -elo_rating_final[k])
+    limit_show_number = int(25 * scale)
+    model_order = model_order[:limit_show_number]
+
+    # Plots
+    a_win_ptbl, b_win_ptbl, num_battles_ptbl = get_battle_tables_from_counts(
+        no_tie_counts, models
+    )
+    model_order_no_ties = [m for m in model_order if m in num_battles_ptbl.index]
+    leaderboard_table = visualize_leaderboard_table(elo_rating_final)
+    win_fraction_heatmap = plot_pairwise_win_fraction(
+        compute_pairwise_win_fraction_from_tables(
+            a_win_ptbl, b_win_ptbl, num_battles_ptbl, model_order_no_ties
+        ),
+        scale=scale,
+    )
+    battle_count_heatmap = plot_battle_count(
+        num_battles_ptbl, model_order_no_ties, scale=scale
+    )
+    average_win_rate_bar = plot_average_win_rate(
+        compute_pairwise_win_fraction_from_tables(
+            a_win_ptbl,
+            b_win_ptbl,
+            num_battles_ptbl,
+            None,
+            limit_show_number=limit_show_number,
+        ),
+        scale=scale,
+    )
+    bootstrap_elo_rating = visualize_bootstrap_elo_rating(
+        bootstrap_df, elo_rating_final, limit_show_number, scale=scale
+    )
+
+    last_updated_tstamp = rating_state.last_updated_tstamp[category]
+    last_updated_datetime = datetime.datetime.fromtimestamp(
+        last_updated_tstamp, tz=timezone("US/Pacific")
+    ).strftime("%Y-%m-%d %H:%M:%S %Z")
+
+    return {
+        "rating_system": "bt",
+        "elo_rating_online": rating_state.elo_rating_online[category],
+        "elo_rating_final": elo_rating_final,
+        "leaderboard_table": leaderboard_table,
+        "win_fraction_heatmap": win_fraction_heatmap,
+        "battle_count_heatmap": battle_count_heatmap,
+        "average_win_rate_bar": average_win_rate_bar,
+        "bootstrap_elo_rating": bootstrap_elo_rating,
+        "last_updated_datetime": last_updated_datetime,
+        "last_updated_tstamp": last_updated_tstamp,
+        "bootstrap_df": bootstrap_df,
+        "leaderboard_table_df": leaderboard_table_df,
+        "style_coefficients": {},
+    }
+
+
 def pretty_print_elo_rating(rating):
     model_order = list(rating.keys())
     model_order.sort(key=lambda k: -rating[k])
@@ -490,13 +630,21 @@ if __name__ == "__main__":
     parser.add_argument("--scale", type=float, default=1)
     parser.add_argument("--style-control", action="store_true")
     parser.add_argument("--num-cpu", type=int, default=12)
+    parser.add_argument(
+        "--rating-state-file",
+        type=str,
+        help="Fold only new battles into this persisted state and refit from its counts",
+    )
     args = parser.parse_args()
 
     np.random.seed(42)
 
     if args.clean_battle_file:
-        # Read data from a cleaned battle files
-        battles = pd.read_json(args.clean_battle_file)
+        # Read data from a cleaned battle file or battle store.
+        # Conversation bodies are only needed by the "long" category.
+        battles = load_battles(
+            args.clean_battle_file, with_conversations="long" in args.category
+        )
     else:
         # Read data from all log files
         log_files = get_log_files(args.max_num_files)
@@ -513,7 +661,39 @@ if __name__ == "__main__":
     ), f"Invalid category: {args.category}"
 
     results = {}
+    if args.rating_state_file:
+        assert (
+            args.rating_system == "bt" and not args.style_control
+        ), "The rating state only supports BT without style control"
+        assert (
+            not args.langs
+            and not args.exclude_unknown_lang
+            and args.daily_vote_per_user is None
+            and not args.run_outlier_detect
+        ), "Row-level filters over the full history are not supported with the rating state"
+        rating_state = RatingState.load(args.rating_state_file)
+        num_new_battles = rating_state.fold(
+            battles,
+            {cat: filter_func_map[cat] for cat in args.category},
+            exclude_models=args.exclude_models,
+            exclude_tie=args.exclude_tie,
+        )
+        rating_state.save(args.rating_state_file)
+        print(f"Folded {num_new_battles} new battles into {args.rating_state_file}")
+        for cat in args.category:
+            results[cat] = report_elo_analysis_results_from_state(
+                rating_state,
+                category=cat,
+                num_bootstrap=args.num_bootstrap,
+                exclude_models=args.exclude_models,
+                exclude_tie=args.exclude_tie,
+                scale=args.scale,
+                num_cpu=args.num_cpu,
+            )
+
     for cat in args.category:
+        if cat in results:
+            continue
         filter_func = filter_func_map[cat]
         results[cat] = report_elo_analysis_results(
             battles,
@@ -0,0 +1,124 @@
+"""
+On-disk embedding cache shared by topic_clustering and deduplication.
+
+Embeddings are keyed by a hash of the prompt text and stored per model as an
+append-only float16 array that is memory-mapped on read, so reruns only embed
+prompts that were not seen before.
+
+Layout:
+    <cache_dir>/<model>/keys.bin        20-byte sha1 digests, one per row
+    <cache_dir>/<model>/embeddings.f16  float16 (num_rows, dim) row-major
+    <cache_dir>/<model>/meta.json       {"dim": ...}
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+KEY_SIZE = 20
+
+
+def hash_text(text):
+    return hashlib.sha1(text.encode("utf-8", errors="replace")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, model_name):
+        self.cache_dir = os.path.join(cache_dir, model_name.replace("/", "--"))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.keys_file = os.path.join(self.cache_dir, "keys.bin")
+        self.embeddings_file = os.path.join(self.cache_dir, "embeddings.f16")
+        self.meta_file = os.path.join(self.cache_dir, "meta.json")
+
+        self.dim = None
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as fin:
+                self.dim = json.load(fin)["dim"]
+        self.load_keys()
+
+    def load_keys(self):
+        if self.dim is None or not os.path.exists(self.keys_file):
+            self.keys = np.empty(0, dtype=f"S{KEY_SIZE}")
+        else:
+            self.keys = np.fromfile(self.keys_file, dtype=f"S{KEY_SIZE}")
+            # rows whose keys were written are complete; drop a torn tail
+            num_rows = min(
+                len(self.keys),
+                os.path.getsize(self.embeddings_file) // (2 * self.dim),
+            )
+            self.keys = self.keys[:num_rows]
+        self.sorted_order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.sorted_order]
+
+    def lookup(self, keys):
+        """Return the cache row of each key, or -1 if it is missing."""
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.sorted_keys) == 0:
+            return rows
+        pos = np.searchsorted(self.sorted_keys, keys)
+        pos = np.minimum(pos, len(self.sorted_keys) - 1)
+        found = self.sorted_keys[pos] == keys
+        rows[found] = self.sorted_order[pos[found]]
+        return rows
+
+    def append(self, keys, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float16)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self.meta_file, "w") as fout:
+                json.dump({"dim": self.dim}, fout)
+            # start clean in case files were left behind without meta.json
+            open(self.keys_file, "wb").close()
+            open(self.embeddings_file, "wb").close()
+        assert embeddings.shape[1] == self.dim, "Embedding dimension mismatch"
+
+        num_rows = len(self.keys)
+        # truncate a torn tail left by an interrupted append before writing
+        with open(self.embeddings_file, "r+b") as fout:
+            fout.truncate(num_rows * 2 * self.dim)
+            fout.seek(0, os.SEEK_END)
+            fout.write(embeddings.tobytes())
+        with open(self.keys_file, "r+b") as fout:
+            fout.truncate(num_rows * KEY_SIZE)
+            fout.seek(0, os.SEEK_END)
+            fout.write(np.asarray(keys, dtype=f"S{KEY_SIZE}").tobytes())
+        self.load_keys()
+
+    def read(self, rows):
+        embeddings = np.memmap(
+            self.embeddings_file,
+            dtype=np.float16,
+            mode="r",
+            shape=(len(self.keys), self.dim),
+        )
+        return np.asarray(embeddings[rows], dtype=np.float32)
+
+    def get_embeddings(self, texts, embed_fn, chunk_size=8192):
+        """
+        Return float32 (len(texts), dim) embeddings, calling embed_fn only on
+        texts that are not cached yet. Missing texts are embedded in chunks that
+        are appended as soon as they are done, so an interrupted run keeps its progress.
+
+        embed_fn: list of str -> array-like (n, dim)
+        """
+        keys = np.array([hash_text(text) for text in texts], dtype=f"S{KEY_SIZE}")
+        rows = self.lookup(keys)
+
+        missing = np.flatnonzero(rows < 0)
+        # embed each distinct missing prompt once
+        _, first_idx = np.unique(keys[missing], return_index=True)
+        missing = np.sort(missing[first_idx])
+        print(
+            f"#embedding cache hits: {len(texts) - len(missing)}, #new: {len(missing)}"
+        )
+
+        for i in tqdm(range(0, len(missing), chunk_size)):
+            chunk = missing[i : i + chunk_size]
+            embeddings = np.asarray(embed_fn([texts[j] for j in chunk]))
+            self.append(keys[chunk], embeddings)
+
+        if len(texts) == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return self.read(self.lookup(keys))
@@ -0,0 +1,219 @@
+"""
+Fast scanning of the *-conv.json conversation logs.
+
+Most lines of a log are "chat" records carrying whole conversation states,
+while the vote readers only need a few fields of the much rarer vote records.
+The loggers write "type" as one of the first keys of every record, so the type
+of a line is found with a byte-level search of the line head, and lines of
+other types are skipped without being decoded or even copied out of the file.
+The remaining lines are decoded with orjson when it is installed and passed
+through a projection, so only the fields a caller needs stay in memory.
+
+Files are read through mmap. scan_logs splits large files into line-aligned
+ranges and scans all ranges of all files with a pool of processes.
+
+Usage:
+from fastchat.serve.monitor.log_scanner import VOTE_TYPES, project_vote, scan_log
+votes = list(scan_log("2024-06-01-conv.json", VOTE_TYPES, project_vote))
+"""
+from collections import Counter
+import json
+import mmap
+from multiprocessing import Pool
+import os
+import re
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+VOTE_TYPES = ("leftvote", "rightvote", "tievote", "bothbad_vote")
+# bytes of the line head searched for the record type
+TYPE_SEARCH_BYTES = 256
+TYPE_RE = re.compile(rb'"type":\s*"([^"\\]*)"')
+# files larger than this are split into ranges scanned in parallel
+CHUNK_SIZE = 256 * 1024 * 1024
+
+
+def project_vote(record):
+    """
+    The fields of a vote record used by the vote statistics. The model names
+    are None without two states and "" if a state has no model name.
+    """
+    states = record.get("states") or []
+    if len(states) >= 2:
+        model_a = states[0].get("model_name", "")
+        model_b = states[1].get("model_name", "")
+    else:
+        model_a = model_b = None
+    return {
+        "type": record.get("type"),
+        "tstamp": record.get("tstamp"),
+        "models": record.get("models"),
+        "model_a": model_a,
+        "model_b": model_b,
+        "ip": record.get("ip"),
+    }
+
+
+def iter_lines(mm, start, end, wanted):
+    """
+    Yield (line_num, line_start, line_end, line_type) of the lines in
+    [start, end). Lines whose head type is not in wanted are skipped; line_type
+    is None if the type is not in the head.
+    """
+    pos = start
+    line_num = 0
+    while pos < end:
+        line_end = mm.find(b"\n", pos, end)
+        if line_end == -1:
+            line_end = end
+        line_num += 1
+        line_type = None
+        if wanted is not None:
+            m = TYPE_RE.search(mm, pos, min(pos + TYPE_SEARCH_BYTES, line_end))
+            if m is not None:
+                line_type = m.group(1)
+                if line_type not in wanted:
+                    pos = line_end + 1
+                    continue
+        yield line_num, pos, line_end, line_type
+        pos = line_end + 1
+
+
+def decode(line):
+    try:
+        return loads(line)
+    except ValueError:
+        return None
+
+
+def open_log(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def scan_log(path, types=None, project=None, start=0, end=None, line_numbers=False):
+    """
+    Yield the records of a log whose type is in types (all records if None),
+    passed through project. Records for which project returns None are
+    dropped, and so are lines that are not valid JSON.
+
+    line_numbers: yield (line_num, record) instead, with line_num counted
+    from start.
+    """
+    wanted = None if types is None else {t.encode() for t in types}
+    mm = open_log(path)
+    if mm is None:
+        return
+    with mm:
+        end = len(mm) if end is None else end
+        for line_num, line_start, line_end, _ in iter_lines(mm, start, end, wanted):
+            record = decode(mm[line_start:line_end])
+            if not isinstance(record, dict):
+                continue
+            if types is not None and record.get("type") not in types:
+                continue
+            if project is not None:
+                record = project(record)
+                if record is None:
+                    continue
+            yield (line_num, record) if line_numbers else record
+
+
+def count_types(path, types=VOTE_TYPES, start=0, end=None):
+    """
+    Count the records of each of types in a log. Lines are only decoded if
+    their type is not in the line head; a line is counted if it is a complete
+    JSON object.
+    """
+    wanted = {t.encode() for t in types}
+    counts = Counter({t: 0 for t in types})
+    mm = open_log(path)
+    if mm is None:
+        return counts
+    with mm:
+        end = len(mm) if end is None else end
+        for _, line_start, line_end, line_type in iter_lines(mm, start, end, wanted):
+            if line_type is not None:
+                if mm[line_start:line_end].rstrip().endswith(b"}"):
+                    counts[line_type.decode()] += 1
+                continue
+            record = decode(mm[line_start:line_end])
+            if isinstance(record, dict) and record.get("type") in types:
+                counts[record["type"]] += 1
+    return counts
+
+
+def get_complete_size(path):
+    """Size of the complete lines of a log, without a line still being written."""
+    mm = open_log(path)
+    if mm is None:
+        return 0
+    with mm:
+        return mm.rfind(b"\n") + 1
+
+
+def count_lines(path, start=0, end=None):
+    """Number of newlines in [start, end) of a file."""
+    count = 0
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = (os.fstat(f.fileno()).st_size if end is None else end) - start
+        while remaining > 0:
+            data = f.read(min(remaining, 16 * 1024 * 1024))
+            if not data:
+                break
+            count += data.count(b"\n")
+            remaining -= len(data)
+    return count
+
+
+def get_ranges(path, chunk_size=CHUNK_SIZE):
+    """Split a file into ranges of about chunk_size bytes ending at newlines."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def scan_range(args):
+    path, start, end, types, project = args
+    return list(scan_log(path, types, project, start, end))
+
+
+def scan_logs(paths, types=None, project=None, num_workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Same as scan_log over several logs, returning the records of all logs in
+    order. project must be picklable, e.g. a module-level function.
+    """
+    tasks = [
+        (path, start, end, types, project)
+        for path in paths
+        for start, end in get_ranges(path, chunk_size)
+    ]
+    num_workers = min(num_workers or os.cpu_count() or 1, len(tasks))
+    if num_workers <= 1:
+        parts = map(scan_range, tasks)
+    else:
+        with Pool(num_workers) as p:
+            parts = p.map(scan_range, tasks)
+
+    records = []
+    for part in parts:
+        records.extend(part)
+    return records
@@ -3,7 +3,7 @@ Live monitor of the website statistics and leaderboard.
 
 Dependency:
 sudo apt install pkg-config libicu-dev
-pip install pytz gradio gdown plotly polyglot pyicu pycld2 tabulate
+pip install pytz gradio gdown plotly polyglot pyicu pycld2 tabulate pyarrow
 """
 
 import argparse
@@ -21,7 +21,11 @@ import numpy as np
 from fastchat.constants import SURVEY_LINK
 from fastchat.serve.monitor.basic_stats import report_basic_stats, get_log_files
 from fastchat.serve.monitor.clean_battle_data import clean_battle_data
-from fastchat.serve.monitor.elo_analysis import report_elo_analysis_results
+from fastchat.serve.monitor.elo_analysis import (
+    report_elo_analysis_results,
+    report_elo_analysis_results_from_state,
+)
+from fastchat.serve.monitor.rating_state import RatingState
 from fastchat.utils import build_logger, get_window_url_params_js
 
 
@@ -80,7 +84,12 @@ We prompt GPT-4-Turbo as judge to compare the models' responses against a baseli
 
 
 def update_elo_components(
-    max_num_files, elo_results_file, ban_ip_file, exclude_model_names
+    max_num_files,
+    elo_results_file,
+    ban_ip_file,
+    exclude_model_names,
+    rating_state_file=None,
+    battle_cache_dir=None,
 ):
     log_files = get_log_files(max_num_files)
 
@@ -88,9 +97,21 @@ def update_elo_components(
     if elo_results_file is None:  # Do live update
         ban_ip_list = json.load(open(ban_ip_file)) if ban_ip_file else None
         battles = clean_battle_data(
-            log_files, exclude_model_names, ban_ip_list=ban_ip_list
+            log_files,
+            exclude_model_names,
+            ban_ip_list=ban_ip_list,
+            cache_dir=battle_cache_dir,
         )
-        elo_results = report_elo_analysis_results(battles, scale=2)
+        if rating_state_file:
+            # Only fold new battles and refit from the aggregated counts
+            rating_state = RatingState.load(rating_state_file)
+            rating_state.fold(battles, {"full": lambda x: True})
+            rating_state.save(rating_state_file)
+            elo_results = report_elo_analysis_results_from_state(
+                rating_state, "full", scale=2
+            )
+        else:
+            elo_results = report_elo_analysis_results(battles, scale=2)
 
         leader_component_values[0] = make_leaderboard_md_live(elo_results)
         leader_component_values[1] = elo_results["win_fraction_heatmap"]
@@ -123,12 +144,23 @@ def update_elo_components(
 
 
 def update_worker(
-    max_num_files, interval, elo_results_file, ban_ip_file, exclude_model_names
+    max_num_files,
+    interval,
+    elo_results_file,
+    ban_ip_file,
+    exclude_model_names,
+    rating_state_file=None,
+    battle_cache_dir=None,
 ):
     while True:
         tic = time.time()
         update_elo_components(
-            max_num_files, elo_results_file, ban_ip_file, exclude_model_names
+            max_num_files,
+            elo_results_file,
+            ban_ip_file,
+            exclude_model_names,
+            rating_state_file,
+            battle_cache_dir,
         )
         durtaion = time.time() - tic
         print(f"update duration: {durtaion:.2f} s")
@@ -1170,6 +1202,18 @@ if __name__ == "__main__":
     parser.add_argument("--exclude-model-names", type=str, nargs="+")
     parser.add_argument("--password", type=str, default=None, nargs="+")
     parser.add_argument("--arena-hard-leaderboard", type=str, default=None)
+    parser.add_argument(
+        "--rating-state-file",
+        type=str,
+        default=None,
+        help="Persist aggregated battle counts here and refit the live leaderboard incrementally",
+    )
+    parser.add_argument(
+        "--battle-cache-dir",
+        type=str,
+        default=None,
+        help="Cache cleaned battles per log file so each update only cleans new or changed files",
+    )
     args = parser.parse_args()
 
     logger = build_logger("monitor", "monitor.log")
@@ -1184,6 +1228,8 @@ if __name__ == "__main__":
                 args.elo_results_file,
                 args.ban_ip_file,
                 args.exclude_model_names,
+                args.rating_state_file,
+                args.battle_cache_dir,
             ),
         )
         update_thread.start()
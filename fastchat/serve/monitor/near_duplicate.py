@@ -0,0 +1,143 @@
+"""
+Approximate near-duplicate detection with MinHash + LSH banding.
+
+Runs on CPU with numpy only, so it scales to millions of prompts:
+signatures are computed in parallel per chunk of texts, candidate pairs come
+from vectorized band bucketing, and candidates are verified against the
+estimated Jaccard similarity before being merged with connected components.
+
+Usage:
+python3 near_duplicate.py --input-file clean_battle_conv.json --threshold 0.8
+"""
+import argparse
+from functools import partial
+from multiprocessing import Pool
+import os
+import re
+import zlib
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def get_shingles(text, ngram):
+    words = re.sub(r"\s+", " ", text.lower()).strip().split(" ")
+    if len(words) < ngram:
+        grams = [" ".join(words)]
+    else:
+        grams = [" ".join(words[i : i + ngram]) for i in range(len(words) - ngram + 1)]
+    return np.array([zlib.crc32(g.encode("utf-8")) for g in set(grams)], np.uint64)
+
+
+def get_permutations(num_perm, seed=42):
+    # a, b < 2^32 keep a * h + b below 2^64 for 32-bit shingle hashes
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def compute_minhash(texts, num_perm, ngram, seed=42):
+    a, b = get_permutations(num_perm, seed)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for i, text in enumerate(texts):
+        shingles = get_shingles(text, ngram)
+        hashes = (shingles[:, None] * a + b) % MERSENNE_PRIME & MAX_HASH
+        signatures[i] = hashes.min(axis=0)
+    return signatures
+
+
+def compute_minhash_parallel(texts, num_perm, ngram, num_proc=None, chunk_size=10000):
+    chunks = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    fn = partial(compute_minhash, num_perm=num_perm, ngram=ngram)
+    with Pool(num_proc or os.cpu_count()) as p:
+        results = list(tqdm(p.imap(fn, chunks), total=len(chunks)))
+    if not results:
+        return np.empty((0, num_perm), dtype=np.uint32)
+    return np.concatenate(results)
+
+
+def find_near_duplicates(
+    texts,
+    threshold=0.8,
+    num_perm=64,
+    num_bands=8,
+    ngram=3,
+    num_proc=None,
+):
+    """
+    Group texts whose estimated Jaccard similarity of word n-grams is at least threshold.
+    Returns an int array giving, for each text, the index of the first text in its group.
+
+    With num_perm=64 and num_bands=8 (8 rows per band), pairs around 0.77 similarity
+    have a 50% chance of becoming candidates; lower num_bands for higher thresholds.
+    """
+    assert num_perm % num_bands == 0, "num_perm must be divisible by num_bands"
+    num_texts = len(texts)
+    if num_texts == 0:
+        return np.empty(0, dtype=np.int64)
+    rows_per_band = num_perm // num_bands
+    signatures = compute_minhash_parallel(list(texts), num_perm, ngram, num_proc)
+
+    src, dst = [], []
+    for band in range(num_bands):
+        band_sig = np.ascontiguousarray(
+            signatures[:, band * rows_per_band : (band + 1) * rows_per_band]
+        ).view(f"V{4 * rows_per_band}")[:, 0]
+        _, bucket_ids = np.unique(band_sig, return_inverse=True)
+        order = np.argsort(bucket_ids, kind="stable")
+        sorted_buckets = bucket_ids[order]
+        # link every bucket member to the first member of its bucket
+        is_first = np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]]
+        first_member = order[np.flatnonzero(is_first)[np.cumsum(is_first) - 1]]
+        members = order[~is_first]
+        heads = first_member[~is_first]
+        if len(members) == 0:
+            continue
+        similarity = (signatures[members] == signatures[heads]).mean(axis=1)
+        verified = similarity >= threshold
+        src.append(heads[verified])
+        dst.append(members[verified])
+
+    if src:
+        src, dst = np.concatenate(src), np.concatenate(dst)
+    else:
+        src = dst = np.empty(0, dtype=np.int64)
+    graph = coo_matrix(
+        (np.ones(len(src), dtype=np.int8), (src, dst)), shape=(num_texts, num_texts)
+    )
+    _, labels = connected_components(graph, directed=False)
+
+    # represent each group by its first text
+    first_index = np.full(labels.max() + 1, num_texts)
+    np.minimum.at(first_index, labels, np.arange(num_texts))
+    return first_index[labels]
+
+
+if __name__ == "__main__":
+    import json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-file", type=str, required=True)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--num-perm", type=int, default=64)
+    parser.add_argument("--num-bands", type=int, default=8)
+    parser.add_argument("--ngram", type=int, default=3)
+    args = parser.parse_args()
+
+    texts = [
+        "\n".join(x["content"] for x in row["conversation_a"] if x["role"] == "user")
+        for row in json.load(open(args.input_file))
+    ]
+    groups = find_near_duplicates(
+        texts, args.threshold, args.num_perm, args.num_bands, args.ngram
+    )
+    group_ids, counts = np.unique(groups, return_counts=True)
+    print(f"#texts: {len(texts)}, #groups: {len(group_ids)}")
+    for i in np.argsort(counts)[::-1][:20]:
+        print(f"{counts[i]:6d} {texts[group_ids[i]][:100]!r}")
@@ -0,0 +1,179 @@
+"""
+Persisted rating state for incremental leaderboard updates.
+
+Instead of refitting from every raw battle on each refresh, the state keeps
+one (model_a, model_b, outcome) count tensor per category plus the timestamp
+of the last processed battle. New battles are folded in as count deltas, and
+BT / bootstrap are refit from the compact counts
+(see `report_elo_analysis_results_from_state` in elo_analysis.py).
+
+Usage:
+python3 -m fastchat.serve.monitor.elo_analysis --clean-battle-file clean_battle.json --rating-state-file rating_state.pkl
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from fastchat.serve.monitor.rating_systems import compute_elo
+
+# outcome ids used by preprocess_for_bt: model_a win -> 2, tie -> 1, model_b win -> 0
+OUTCOME_IDS = {"model_a": 2, "model_b": 0}
+TIE_OUTCOME_ID = 1
+RATING_STATE_VERSION = 2
+
+
+class RatingState:
+    def __init__(self):
+        self.version = RATING_STATE_VERSION
+        self.models = []
+        self.model_to_id = {}
+        # category -> int64 (num_models, num_models, 3) count tensor
+        self.counts = {}
+        # category -> {model: rating}, continued battle by battle
+        self.elo_rating_online = {}
+        # category -> (exclude_models, exclude_tie) of its online Elo ratings
+        self.online_filters = {}
+        # category -> tstamp of the last battle folded into that category
+        self.last_updated_tstamp = {}
+        # tstamp of the last battle seen, regardless of category
+        self.last_processed_tstamp = None
+
+    def get_counts(self, category):
+        if category not in self.counts:
+            raise KeyError(f"No battles folded for category: {category}")
+        return self.counts[category]
+
+    def get_model_ids(self, names):
+        for name in pd.unique(names):
+            if name not in self.model_to_id:
+                self.model_to_id[name] = len(self.models)
+                self.models.append(name)
+
+        num_models = len(self.models)
+        for category, counts in self.counts.items():
+            if counts.shape[0] < num_models:
+                grown = np.zeros((num_models, num_models, 3), dtype=np.int64)
+                grown[: counts.shape[0], : counts.shape[1]] = counts
+                self.counts[category] = grown
+        return names.map(self.model_to_id).to_numpy()
+
+    def fold(self, battles, filter_funcs, exclude_models=[], exclude_tie=False):
+        """
+        Fold battles newer than last_processed_tstamp into the counts.
+
+        battles: the full history of cleaned battles (list of dicts or DataFrame)
+            as produced by clean_battle_data
+        filter_funcs: {category: row filter}, same as the filter_func of report_elo_analysis_results
+        exclude_models, exclude_tie: filters of the online Elo update, same as
+            in report_elo_analysis_results. The counts keep every battle, these
+            filters are applied to them when refitting.
+        A category new to the state, or whose online Elo filters changed, is
+        folded from the full history.
+        Returns the number of new battles seen.
+        """
+        if not isinstance(battles, pd.DataFrame):
+            battles = pd.DataFrame(battles)
+        if len(battles) == 0:
+            return 0
+        online_filter = (tuple(sorted(exclude_models)), bool(exclude_tie))
+        # categories that need the full history
+        refold = [cat for cat in filter_funcs if cat not in self.counts]
+        refit_online = [
+            cat
+            for cat in filter_funcs
+            if cat in refold or self.online_filters.get(cat) != online_filter
+        ]
+        last_processed_tstamp = battles["tstamp"].max()
+        if self.last_processed_tstamp is not None:
+            if not refit_online and last_processed_tstamp <= self.last_processed_tstamp:
+                return 0
+            last_processed_tstamp = max(
+                last_processed_tstamp, self.last_processed_tstamp
+            )
+
+        battles = battles.sort_values(ascending=True, by=["tstamp"])
+        if not refit_online:
+            battles = battles[battles["tstamp"] > self.last_processed_tstamp]
+
+        # Only use anonymous votes
+        battles = battles[battles["anony"]].reset_index(drop=True)
+        is_new = np.ones(len(battles), dtype=bool)
+        if self.last_processed_tstamp is not None:
+            is_new = (battles["tstamp"] > self.last_processed_tstamp).to_numpy()
+        model_a_ids = self.get_model_ids(battles["model_a"])
+        model_b_ids = self.get_model_ids(battles["model_b"])
+        outcome_ids = (
+            battles["winner"].map(OUTCOME_IDS).fillna(TIE_OUTCOME_ID).to_numpy(int)
+        )
+        # same filters as the online update of report_elo_analysis_results
+        online = ~(
+            battles["model_a"].isin(exclude_models)
+            | battles["model_b"].isin(exclude_models)
+        ).to_numpy()
+        if exclude_tie:
+            online &= ~battles["winner"].str.contains("tie").to_numpy()
+
+        num_new_battles = int(is_new.sum())
+
+        num_models = len(self.models)
+        for category, filter_func in filter_funcs.items():
+            if category in refold:
+                self.counts[category] = np.zeros(
+                    (num_models, num_models, 3), dtype=np.int64
+                )
+            # the rows of the category, among the rows it needs
+            rows = (
+                np.ones(len(battles), dtype=bool)
+                if category in refit_online
+                else is_new
+            )
+            mask = np.zeros(len(battles), dtype=bool)
+            if rows.any():
+                mask[rows] = battles[rows].apply(filter_func, axis=1).to_numpy(bool)
+
+            count_mask = mask if category in refold else mask & is_new
+            np.add.at(
+                self.counts[category],
+                (
+                    model_a_ids[count_mask],
+                    model_b_ids[count_mask],
+                    outcome_ids[count_mask],
+                ),
+                1,
+            )
+            if category in refit_online:
+                self.elo_rating_online[category] = compute_elo(battles[mask & online])
+                self.online_filters[category] = online_filter
+            else:
+                self.elo_rating_online[category] = compute_elo(
+                    battles[mask & online],
+                    prev_ratings=self.elo_rating_online.get(category),
+                )
+            if mask.any():
+                self.last_updated_tstamp[category] = max(
+                    battles["tstamp"][mask].max(),
+                    self.last_updated_tstamp.get(category, 0),
+                )
+
+        self.last_processed_tstamp = last_processed_tstamp
+        return num_new_battles
+
+    def save(self, filename):
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as fout:
+            pickle.dump(self, fout)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved state, or start an empty one if the file does not exist."""
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename, "rb") as fin:
+            state = pickle.load(fin)
+        if getattr(state, "version", None) != RATING_STATE_VERSION:
+            print(f"Ignoring rating state with outdated version: {filename}")
+            return cls()
+        return state
@@ -62,6 +62,23 @@ def preprocess_for_bt(df):
     return matchups, outcomes, models, weights
 
 
+def preprocess_for_bt_from_counts(counts, models):
+    """
+    same outputs as preprocess_for_bt but built from an aggregated count tensor
+      counts: int (M,M,3) indexed by [model_a id, model_b id, outcome id]
+              using the outcome ids of preprocess_for_bt (model_a win -> 2, tie -> 1, model_b win -> 0)
+    models that never played are dropped so they do not enter the fit
+    """
+    played = counts.sum(axis=(1, 2)) + counts.sum(axis=(0, 2)) > 0
+    keep = np.flatnonzero(played)
+    counts = counts[np.ix_(keep, keep)]
+    model_a_ids, model_b_ids, outcome_ids = np.nonzero(counts)
+    matchups = np.column_stack([model_a_ids, model_b_ids]).astype(np.int32)
+    outcomes = outcome_ids.astype(np.float64) / 2.0
+    weights = counts[model_a_ids, model_b_ids, outcome_ids].astype(np.float64)
+    return matchups, outcomes, [models[i] for i in keep], weights
+
+
 def preprocess_for_style(
     df,
     apply_ratio=[1, 1, 1, 1],
@@ -136,10 +153,18 @@ def fit_vectorized_elo(
     return ratings + init_rating
 
 
-def compute_elo(df, k=4.0, base=10.0, init_rating=1000.0, scale=400.0):
+def compute_elo(
+    df, k=4.0, base=10.0, init_rating=1000.0, scale=400.0, prev_ratings=None
+):
+    """online Elo over df in row order, optionally continuing from prev_ratings ({model: rating})"""
+    prev_ratings = prev_ratings or {}
+    if len(df) == 0:
+        return dict(prev_ratings)
     matchups, outcomes, models = preprocess_for_elo(df)
     alpha = math.log(base) / scale
-    ratings = np.full(shape=(len(models),), fill_value=init_rating)
+    ratings = np.array(
+        [prev_ratings.get(model, init_rating) for model in models], dtype=np.float64
+    )
     for (model_a_idx, model_b_idx), outcome in zip(matchups, outcomes):
         prob = 1.0 / (
             1.0 + math.exp(alpha * (ratings[model_b_idx] - ratings[model_a_idx]))
@@ -147,7 +172,10 @@ def compute_elo(df, k=4.0, base=10.0, init_rating=1000.0, scale=400.0):
         update = k * (outcome - prob)
         ratings[model_a_idx] += update
         ratings[model_b_idx] -= update
-    return {model: ratings[idx] for idx, model in enumerate(models)}
+    return {
+        **prev_ratings,
+        **{model: ratings[idx] for idx, model in enumerate(models)},
+    }
 
 
 def compute_bootstrap_elo(
@@ -212,6 +240,30 @@ def scale_and_offset(
 
 def compute_bt(df, base=10.0, scale=400.0, init_rating=1000, tol=1e-6):
     matchups, outcomes, models, weights = preprocess_for_bt(df)
+    return fit_bt_ratings(
+        matchups, outcomes, models, weights, base, scale, init_rating, tol
+    )
+
+
+def compute_bt_from_counts(
+    counts, models, base=10.0, scale=400.0, init_rating=1000, tol=1e-6
+):
+    matchups, outcomes, models, weights = preprocess_for_bt_from_counts(counts, models)
+    return fit_bt_ratings(
+        matchups, outcomes, models, weights, base, scale, init_rating, tol
+    )
+
+
+def fit_bt_ratings(
+    matchups,
+    outcomes,
+    models,
+    weights,
+    base=10.0,
+    scale=400.0,
+    init_rating=1000,
+    tol=1e-6,
+):
     ratings = fit_bt(matchups, outcomes, weights, len(models), math.log(base), tol)
     scaled_ratings = scale_and_offset(ratings, models, scale, init_rating=init_rating)
     return pd.Series(scaled_ratings, index=models).sort_values(ascending=False)
@@ -227,13 +279,65 @@ def compute_bootstrap_bt(
     num_cpu=None,
 ):
     matchups, outcomes, models, weights = preprocess_for_bt(battles)
+    return fit_bootstrap_bt_ratings(
+        matchups,
+        outcomes,
+        models,
+        weights,
+        num_round,
+        base,
+        scale,
+        init_rating,
+        tol,
+        num_cpu,
+    )
+
+
+def compute_bootstrap_bt_from_counts(
+    counts,
+    models,
+    num_round,
+    base=10.0,
+    scale=400.0,
+    init_rating=1000.0,
+    tol=1e-6,
+    num_cpu=None,
+):
+    matchups, outcomes, models, weights = preprocess_for_bt_from_counts(counts, models)
+    return fit_bootstrap_bt_ratings(
+        matchups,
+        outcomes,
+        models,
+        weights,
+        num_round,
+        base,
+        scale,
+        init_rating,
+        tol,
+        num_cpu,
+    )
+
+
+def fit_bootstrap_bt_ratings(
+    matchups,
+    outcomes,
+    models,
+    weights,
+    num_round,
+    base=10.0,
+    scale=400.0,
+    init_rating=1000.0,
+    tol=1e-6,
+    num_cpu=None,
+):
+    num_battles = int(weights.sum())
     # bootstrap sample the unique outcomes and their counts directly using the multinomial distribution
     rng = np.random.default_rng(seed=0)
     idxs = rng.multinomial(
-        n=len(battles), pvals=weights / weights.sum(), size=(num_round)
+        n=num_battles, pvals=weights / weights.sum(), size=(num_round)
     )
     # only the distribution over their occurance counts changes between samples (and it can be 0)
-    boot_weights = idxs.astype(np.float64) / len(battles)
+    boot_weights = idxs.astype(np.float64) / num_battles
 
     # the only thing different across samples is the distribution of weights
     bt_fn = partial(
@@ -18,6 +18,8 @@ import torch
 from tqdm import tqdm
 from openai import OpenAI
 
+from fastchat.serve.monitor.battle_store import is_battle_store, read_battles
+from fastchat.serve.monitor.embedding_cache import EmbeddingCache
 from fastchat.utils import detect_language
 
 
@@ -34,7 +36,13 @@ def read_texts(input_file, min_length, max_length, english_only):
     visited = set()
     texts = []
 
-    lines = json.load(open(input_file, "r"))
+    if is_battle_store(input_file):
+        # only the conversation bodies are needed here
+        lines = read_battles(
+            input_file, columns=["question_id"], with_conversations=True
+        ).to_dict("records")
+    else:
+        lines = json.load(open(input_file, "r"))
 
     for l in tqdm(lines):
         if "text" in l:
@@ -79,26 +87,44 @@ def read_texts(input_file, min_length, max_length, english_only):
     return np.array(texts)
 
 
-def get_embeddings(texts, model_name, batch_size):
+def get_embedding_fn(model_name, batch_size):
     if model_name == "text-embedding-ada-002":
         client = OpenAI()
-        texts = texts.tolist()
-
-        embeddings = []
-        for i in tqdm(range(0, len(texts), batch_size)):
-            text = texts[i : i + batch_size]
-            responses = client.embeddings.create(input=text, model=model_name).data
-            embeddings.extend([data.embedding for data in responses])
-        embeddings = torch.tensor(embeddings)
+
+        def embed(texts):
+            texts = list(texts)
+            embeddings = []
+            for i in tqdm(range(0, len(texts), batch_size)):
+                text = texts[i : i + batch_size]
+                responses = client.embeddings.create(input=text, model=model_name).data
+                embeddings.extend([data.embedding for data in responses])
+            return torch.tensor(embeddings)
+
     else:
         model = SentenceTransformer(model_name)
-        embeddings = model.encode(
-            texts,
-            batch_size=batch_size,
-            show_progress_bar=True,
-            device="cuda",
-            convert_to_tensor=True,
+
+        def embed(texts):
+            return model.encode(
+                texts,
+                batch_size=batch_size,
+                show_progress_bar=True,
+                device="cuda",
+                convert_to_tensor=True,
+            )
+
+    return embed
+
+
+def get_embeddings(texts, model_name, batch_size, cache_dir=None):
+    embed = get_embedding_fn(model_name, batch_size)
+    if cache_dir is not None:
+        # only prompts missing from the cache are embedded
+        cache = EmbeddingCache(cache_dir, model_name)
+        embeddings = torch.from_numpy(
+            cache.get_embeddings(list(texts), lambda x: embed(x).cpu().numpy())
         )
+    else:
+        embeddings = embed(texts)
 
     embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
     return embeddings.cpu()
@@ -235,6 +261,12 @@ if __name__ == "__main__":
     parser.add_argument("--show-cut-off", type=int, default=512)
     parser.add_argument("--save-embeddings", action="store_true")
     parser.add_argument("--embeddings-file", type=str, default=None)
+    parser.add_argument(
+        "--embedding-cache-dir",
+        type=str,
+        default=None,
+        help="Reuse embeddings of previously seen prompts from this directory",
+    )
     args = parser.parse_args()
 
     num_clusters = args.num_clusters
@@ -247,7 +279,9 @@ if __name__ == "__main__":
     print(f"#text: {len(texts)}")
 
     if args.embeddings_file is None:
-        embeddings = get_embeddings(texts, args.model, args.batch_size)
+        embeddings = get_embeddings(
+            texts, args.model, args.batch_size, args.embedding_cache_dir
+        )
         if args.save_embeddings:
             # allow saving embedding to save time and money
             torch.save(embeddings, "embeddings.pt")
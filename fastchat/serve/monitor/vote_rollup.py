@@ -0,0 +1,344 @@
+"""
+Per-day rollups of the *-conv.json vote logs.
+
+A rollup summarizes one log: the chat count, the count of each vote type,
+the vote counts of every model pair, an hourly vote histogram and a
+HyperLogLog sketch of the voter IPs. Rollups merge by summing, so cumulative
+and date-range reports read one small file per day instead of every vote.
+
+Logs are append-only. A saved rollup records how many bytes of its log it
+covers and is brought up to date by scanning only the lines written since,
+so archived days are scanned once and the current day only by its tail.
+
+Online Elo depends on the order of the battles and does not merge by
+summing. A rollup also keeps the ratings after its day, continued from the
+ratings after the previous day, so a cumulative Elo only replays the new
+tail. If the ratings a day starts from change, the day is replayed from its
+log.
+
+Usage:
+from fastchat.serve.monitor.vote_rollup import load_rollups
+rollup = load_rollups(sorted(glob.glob("logs_archive/*-conv.json")), k_factor=32)
+"""
+import base64
+from datetime import datetime
+import hashlib
+import json
+import math
+import os
+
+from fastchat.serve.monitor.log_scanner import (
+    VOTE_TYPES,
+    count_types,
+    get_complete_size,
+    project_vote,
+    scan_log,
+)
+
+ROLLUP_VERSION = 1
+ROLLUP_DIR_NAME = "rollups"
+HLL_PRECISION = 12
+# bytes before the covered size that must not change between updates
+CHECK_BYTES = 256
+ELO_INIT_RATING = 1000
+
+
+class HyperLogLog:
+    """Distinct count sketch, about 1.6% standard error with 4096 registers."""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers or 1 << precision)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        h = int.from_bytes(digest, "big")
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # small range correction
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def to_str(self):
+        return base64.b64encode(bytes(self.registers)).decode()
+
+    @classmethod
+    def from_str(cls, s, precision=HLL_PRECISION):
+        return cls(precision, base64.b64decode(s))
+
+
+def get_winner(vote_type):
+    if vote_type == "leftvote":
+        return "model_a"
+    if vote_type == "rightvote":
+        return "model_b"
+    return "tie"
+
+
+def update_elo(ratings, votes, k_factor):
+    """
+    Continue online Elo over votes in timestamp order, the same update as
+    ELOCalculator of scripts_py/elo_analysis_simple.py.
+    """
+    ratings = dict(ratings)
+    votes = [v for v in votes if v["model_a"] is not None]
+    for vote in sorted(votes, key=lambda v: v["tstamp"] or 0):
+        model_a = vote["model_a"] or "Unknown"
+        model_b = vote["model_b"] or "Unknown"
+        rating_a = ratings.get(model_a, ELO_INIT_RATING)
+        rating_b = ratings.get(model_b, ELO_INIT_RATING)
+        score_a = {"model_a": 1.0, "model_b": 0.0, "tie": 0.5}[get_winner(vote["type"])]
+        expected_a = 1 / (1 + 10 ** ((rating_b - rating_a) / 400))
+        expected_b = 1 / (1 + 10 ** ((rating_a - rating_b) / 400))
+        ratings[model_a] = rating_a + k_factor * (score_a - expected_a)
+        ratings[model_b] = rating_b + k_factor * ((1 - score_a) - expected_b)
+    return ratings
+
+
+def get_elo_key(k_factor):
+    return str(float(k_factor))
+
+
+def get_ratings_digest(ratings):
+    return hashlib.sha1(json.dumps(ratings or {}, sort_keys=True).encode()).hexdigest()
+
+
+def get_check_digest(path, size):
+    with open(path, "rb") as f:
+        f.seek(max(size - CHECK_BYTES, 0))
+        return hashlib.sha1(f.read(size - f.tell())).hexdigest()
+
+
+class DailyRollup:
+    def __init__(self, source=None):
+        self.version = ROLLUP_VERSION
+        # name of the summarized log and the bytes of it covered so far
+        self.source = source
+        self.size = 0
+        self.check_digest = None
+        self.conversation_count = 0
+        self.vote_counts = {t: 0 for t in VOTE_TYPES}
+        # (model_a, model_b) -> vote count of each of VOTE_TYPES
+        self.pairs = {}
+        # "%Y-%m-%d %H:00" in local time -> vote count
+        self.hourly = {}
+        self.voters = HyperLogLog()
+        self.first_tstamp = None
+        self.last_tstamp = None
+        # get_elo_key(k_factor) -> {"start": digest of the starting ratings, "ratings": {model: rating}}
+        self.elo = {}
+
+    def fold(self, votes, conversation_count=0):
+        """Add projected votes (see log_scanner.project_vote) and a chat count."""
+        self.conversation_count += conversation_count
+        for vote in votes:
+            vote_type = vote["type"]
+            self.vote_counts[vote_type] += 1
+            tstamp = vote["tstamp"]
+            if tstamp is not None:
+                hour = datetime.fromtimestamp(tstamp).strftime("%Y-%m-%d %H:00")
+                self.hourly[hour] = self.hourly.get(hour, 0) + 1
+                if self.first_tstamp is None or tstamp < self.first_tstamp:
+                    self.first_tstamp = tstamp
+                if self.last_tstamp is None or tstamp > self.last_tstamp:
+                    self.last_tstamp = tstamp
+            if vote["ip"] is not None:
+                self.voters.add(vote["ip"])
+            if vote["model_a"] is not None:
+                # same default as the vote readers
+                pair = (vote["model_a"] or "Unknown", vote["model_b"] or "Unknown")
+                if pair not in self.pairs:
+                    self.pairs[pair] = [0] * len(VOTE_TYPES)
+                self.pairs[pair][VOTE_TYPES.index(vote_type)] += 1
+
+    def merge(self, other):
+        """Add the counts of another rollup. Elo ratings are not merged."""
+        self.conversation_count += other.conversation_count
+        for vote_type, count in other.vote_counts.items():
+            self.vote_counts[vote_type] += count
+        for pair, counts in other.pairs.items():
+            if pair not in self.pairs:
+                self.pairs[pair] = [0] * len(VOTE_TYPES)
+            self.pairs[pair] = [x + y for x, y in zip(self.pairs[pair], counts)]
+        for hour, count in other.hourly.items():
+            self.hourly[hour] = self.hourly.get(hour, 0) + count
+        self.voters.merge(other.voters)
+        tstamps = [t for t in [self.first_tstamp, other.first_tstamp] if t is not None]
+        self.first_tstamp = min(tstamps, default=None)
+        tstamps = [t for t in [self.last_tstamp, other.last_tstamp] if t is not None]
+        self.last_tstamp = max(tstamps, default=None)
+
+    def get_model_stats(self, bothbad_as_tie=True):
+        """
+        {model: {"wins", "losses", "ties", "total"}}. Every vote with two
+        models counts to the total of both; bothbad_vote counts as a tie if
+        bothbad_as_tie.
+        """
+        model_stats = {}
+        for (model_a, model_b), counts in self.pairs.items():
+            left, right, tie, bothbad = counts
+            if bothbad_as_tie:
+                tie += bothbad
+            for model, wins, losses in [
+                (model_a, left, right),
+                (model_b, right, left),
+            ]:
+                if model not in model_stats:
+                    model_stats[model] = {"wins": 0, "losses": 0, "ties": 0, "total": 0}
+                stats = model_stats[model]
+                stats["wins"] += wins
+                stats["losses"] += losses
+                stats["ties"] += tie
+                stats["total"] += sum(counts)
+        return model_stats
+
+    def get_elo_ratings(self, k_factor):
+        return self.elo[get_elo_key(k_factor)]["ratings"]
+
+    def update(self, log_file, k_factor=None, elo_start=None):
+        """
+        Bring the rollup up to date with the complete lines of log_file. With
+        k_factor, also keep the Elo ratings of the day continued from
+        elo_start. Returns whether the rollup changed.
+        """
+        end = get_complete_size(log_file)
+        if (
+            self.version != ROLLUP_VERSION
+            or self.source != os.path.basename(log_file)
+            or self.size > end
+            or (
+                self.size > 0
+                and get_check_digest(log_file, self.size) != self.check_digest
+            )
+        ):
+            # not the log this rollup was built from, start over
+            self.__init__(os.path.basename(log_file))
+        changed = False
+
+        if k_factor is not None:
+            digest = get_ratings_digest(elo_start)
+            elo = self.elo.get(get_elo_key(k_factor))
+            if elo is None or elo["start"] != digest:
+                votes = scan_log(log_file, VOTE_TYPES, project_vote, 0, self.size)
+                self.elo[get_elo_key(k_factor)] = {
+                    "start": digest,
+                    "ratings": update_elo(elo_start or {}, votes, k_factor),
+                }
+                changed = True
+
+        if end == self.size:
+            return changed
+
+        votes = list(scan_log(log_file, VOTE_TYPES, project_vote, self.size, end))
+        conversation_count = count_types(log_file, ["chat"], self.size, end)["chat"]
+        self.fold(votes, conversation_count)
+        for key, elo in self.elo.items():
+            elo["ratings"] = update_elo(elo["ratings"], votes, float(key))
+        self.size = end
+        self.check_digest = get_check_digest(log_file, end)
+        return True
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "source": self.source,
+            "size": self.size,
+            "check_digest": self.check_digest,
+            "conversation_count": self.conversation_count,
+            "vote_counts": self.vote_counts,
+            "pairs": [[*pair, *counts] for pair, counts in self.pairs.items()],
+            "hourly": self.hourly,
+            "voters": self.voters.to_str(),
+            "first_tstamp": self.first_tstamp,
+            "last_tstamp": self.last_tstamp,
+            "elo": self.elo,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rollup = cls(data["source"])
+        rollup.version = data["version"]
+        rollup.size = data["size"]
+        rollup.check_digest = data["check_digest"]
+        rollup.conversation_count = data["conversation_count"]
+        rollup.vote_counts.update(data["vote_counts"])
+        rollup.pairs = {(row[0], row[1]): row[2:] for row in data["pairs"]}
+        rollup.hourly = data["hourly"]
+        rollup.voters = HyperLogLog.from_str(data["voters"])
+        rollup.first_tstamp = data["first_tstamp"]
+        rollup.last_tstamp = data["last_tstamp"]
+        rollup.elo = data["elo"]
+        return rollup
+
+    def save(self, filename):
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as fout:
+            json.dump(self.to_dict(), fout)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved rollup, or start an empty one if it is missing or outdated."""
+        if not os.path.exists(filename):
+            return cls()
+        try:
+            with open(filename) as fin:
+                data = json.load(fin)
+            if data.get("version") != ROLLUP_VERSION:
+                return cls()
+            return cls.from_dict(data)
+        except (ValueError, KeyError, TypeError):
+            print(f"Ignoring unreadable rollup: {filename}")
+            return cls()
+
+
+def get_rollup_filename(log_file, rollup_dir=None):
+    """Rollups are kept in a rollups/ directory next to the logs by default."""
+    log_file = str(log_file)
+    if rollup_dir is None:
+        rollup_dir = os.path.join(os.path.dirname(log_file), ROLLUP_DIR_NAME)
+    return os.path.join(str(rollup_dir), os.path.basename(log_file) + ".rollup.json")
+
+
+def load_rollup(log_file, rollup_dir=None, k_factor=None, elo_start=None):
+    """The up to date rollup of one log, saved back if it changed."""
+    filename = get_rollup_filename(log_file, rollup_dir)
+    rollup = DailyRollup.load(filename)
+    if rollup.update(str(log_file), k_factor, elo_start):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        rollup.save(filename)
+    return rollup
+
+
+def load_rollups(log_files, rollup_dir=None, k_factor=None):
+    """
+    Merge the rollups of log_files, updating them as needed. Pass the logs in
+    time order: with k_factor, the Elo ratings of each day continue from the
+    day before, and the merged rollup gets the ratings after the last day.
+    """
+    merged = DailyRollup()
+    ratings = {}
+    for log_file in log_files:
+        rollup = load_rollup(log_file, rollup_dir, k_factor, ratings)
+        merged.merge(rollup)
+        if k_factor is not None:
+            ratings = rollup.get_elo_ratings(k_factor)
+    if k_factor is not None:
+        merged.elo[get_elo_key(k_factor)] = {
+            "start": get_ratings_digest({}),
+            "ratings": ratings,
+        }
+    return merged
@@ -0,0 +1,574 @@
+"""
+A model worker that serves many LoRA adapters on one shared base model.
+
+Every adapter is registered as its own model name, next to the base model.
+The weights of the base model are loaded once and the adapters are loaded
+into a fixed number of slots on their first request (LRU eviction, see
+fastchat/model/multi_lora.py). Requests run in a shared continuous batch:
+new requests join the running batch after their prefill, and every row
+applies the adapter it asked for, so mixed-adapter traffic is not serialized.
+
+Usage:
+python3 -m fastchat.serve.multi_lora_worker --model-path lmsys/vicuna-7b-v1.5 \
+    --lora-paths vicuna-sql=~/loras/sql,vicuna-med=~/loras/med --max-loras 8
+"""
+import argparse
+from collections import deque
+import json
+import os
+import queue
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+import uvicorn
+
+from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
+from fastchat.model.model_adapter import add_model_args, load_model
+from fastchat.model.multi_lora import LoraAdapterSlots
+from fastchat.serve.base_model_worker import BaseModelWorker, app
+from fastchat.serve.inference import prepare_logits_processor
+from fastchat.serve.model_worker import logger, worker_id
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
+from fastchat.utils import get_context_length, is_partial_stop, str_to_torch_dtype
+
+
+def cache_to_tensors(cache):
+    """[(key, value)] of every layer, each (batch, heads, seq_len, head_dim)."""
+    if isinstance(cache, (tuple, list)):
+        return [(k, v) for k, v in cache]
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def tensors_to_cache(kvs):
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(kvs))
+    return DynamicCache(kvs)
+
+
+def left_pad(kvs, mask, length):
+    pad = length - mask.shape[1]
+    if pad == 0:
+        return kvs, mask
+    kvs = [(F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))) for k, v in kvs]
+    return kvs, F.pad(mask, (pad, 0))
+
+
+class LoraRequest:
+    def __init__(self, params, adapter, input_ids):
+        self.params = params
+        self.adapter = adapter
+        self.input_ids = input_ids
+        self.output_ids = []
+        self.slot = None
+        self.temperature = float(params.get("temperature", 1.0))
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        self.top_k = int(params.get("top_k", -1))  # -1 means disable
+        self.max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.echo = bool(params.get("echo", True))
+        self.stop_str = params.get("stop", None)
+        self.stop_token_ids = params.get("stop_token_ids", None) or []
+        self.logits_processor = prepare_logits_processor(
+            self.temperature, self.repetition_penalty, self.top_p, self.top_k
+        )
+        # chunks for the client, the last one has a finish_reason
+        self.queue = queue.Queue()
+        # set when the client goes away, or by /worker_cancel
+        self.aborted = False
+        self.cancel_event = None
+        self.finished = False
+        self.text = ""
+
+    def is_cancelled(self):
+        return self.aborted or (
+            self.cancel_event is not None and self.cancel_event.is_set()
+        )
+
+    def fail(self, e):
+        self.finished = True
+        if isinstance(e, torch.cuda.OutOfMemoryError):
+            error_code = ErrorCode.CUDA_OUT_OF_MEMORY
+        else:
+            error_code = ErrorCode.INTERNAL_ERROR
+        self.queue.put(
+            {"text": f"{SERVER_ERROR_MSG}\n\n({e})", "error_code": error_code}
+        )
+
+    def cancel(self):
+        self.finished = True
+        self.queue.put(
+            {
+                "text": self.text,
+                "error_code": 0,
+                "usage": {
+                    "prompt_tokens": len(self.input_ids),
+                    "completion_tokens": len(self.output_ids),
+                    "total_tokens": len(self.input_ids) + len(self.output_ids),
+                },
+                "finish_reason": "abort",
+            }
+        )
+
+
+class LoraBatchEngine:
+    """Continuous batching over one model whose rows may use different adapters."""
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        slots: LoraAdapterSlots,
+        max_batch_size: int,
+        stream_interval: int,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.slots = slots
+        self.max_batch_size = max_batch_size
+        self.stream_interval = stream_interval
+        self.device = model.device
+        self.pad_token_id = (
+            tokenizer.pad_token_id
+            if tokenizer.pad_token_id is not None
+            else tokenizer.eos_token_id
+        )
+
+        self.pending = queue.Queue()
+        self.waiting = deque()
+        # admitted, not in the running batch until their prefill is done
+        self.prefilling = []
+        # state of the running batch, one row per request
+        self.rows = []
+        self.kvs = None
+        self.mask = None
+        self.positions = None
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: LoraRequest):
+        self.pending.put(request)
+
+    def loop(self):
+        while True:
+            # block only when there is nothing to run
+            if not self.rows and not self.waiting:
+                self.waiting.append(self.pending.get())
+            while not self.pending.empty():
+                self.waiting.append(self.pending.get())
+            try:
+                self.admit()
+                if self.rows:
+                    self.step()
+            except Exception as e:
+                # any error must reach the requests, or their streams wait forever
+                logger.error(f"LoRA batch failed: {e}")
+                # the whole batch shares the cache, so all of it fails
+                for req in self.rows + self.prefilling:
+                    req.fail(e)
+                    self.slots.release(req.slot)
+                self.rows, self.prefilling = [], []
+                self.kvs = self.mask = self.positions = None
+
+    @torch.inference_mode()
+    def admit(self):
+        """Prefill waiting requests and add them to the running batch."""
+        new_rows = self.prefilling
+        while self.waiting and len(self.rows) + len(new_rows) < self.max_batch_size:
+            req = self.waiting[0]
+            if req.is_cancelled():
+                self.waiting.popleft().cancel()
+                continue
+            try:
+                req.slot = self.slots.acquire(req.adapter)
+            except Exception as e:
+                # e.g. adapter files removed after startup, only this request fails
+                logger.error(f"Loading the LoRA adapter {req.adapter} failed: {e}")
+                self.waiting.popleft().fail(e)
+                continue
+            if req.slot is None:
+                # all adapter slots are held by running requests
+                break
+            new_rows.append(self.waiting.popleft())
+        if not new_rows:
+            return
+
+        length = max(len(req.input_ids) for req in new_rows)
+        input_ids = torch.full(
+            (len(new_rows), length), self.pad_token_id, dtype=torch.long
+        )
+        mask = torch.zeros((len(new_rows), length), dtype=torch.long)
+        for i, req in enumerate(new_rows):
+            input_ids[i, length - len(req.input_ids) :] = torch.as_tensor(req.input_ids)
+            mask[i, length - len(req.input_ids) :] = 1
+        input_ids, mask = input_ids.to(self.device), mask.to(self.device)
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        self.slots.set_batch([req.slot for req in new_rows])
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        kvs = cache_to_tensors(out.past_key_values)
+        positions = mask.sum(dim=1)
+        for i, req in enumerate(new_rows):
+            self.add_token(req, out.logits[i, -1])
+
+        if self.rows:
+            length = max(self.mask.shape[1], mask.shape[1])
+            self.kvs, self.mask = left_pad(self.kvs, self.mask, length)
+            kvs, mask = left_pad(kvs, mask, length)
+            self.kvs = [
+                (torch.cat([k0, k1]), torch.cat([v0, v1]))
+                for (k0, v0), (k1, v1) in zip(self.kvs, kvs)
+            ]
+            self.mask = torch.cat([self.mask, mask])
+            self.positions = torch.cat([self.positions, positions])
+        else:
+            self.kvs, self.mask, self.positions = kvs, mask, positions
+        self.rows += new_rows
+        self.prefilling = []
+        self.remove_finished()
+
+    @torch.inference_mode()
+    def step(self):
+        """Decode one token for every running request."""
+        input_ids = torch.as_tensor(
+            [[req.output_ids[-1]] for req in self.rows], device=self.device
+        )
+        self.mask = F.pad(self.mask, (0, 1), value=1)
+        self.slots.set_batch([req.slot for req in self.rows])
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=self.mask,
+            position_ids=self.positions.unsqueeze(1),
+            past_key_values=tensors_to_cache(self.kvs),
+            use_cache=True,
+        )
+        self.kvs = cache_to_tensors(out.past_key_values)
+        self.positions = self.positions + 1
+        for i, req in enumerate(self.rows):
+            self.add_token(req, out.logits[i, -1])
+        self.remove_finished()
+
+    def remove_finished(self):
+        keep = [i for i, req in enumerate(self.rows) if not req.finished]
+        if len(keep) == len(self.rows):
+            return
+        for req in self.rows:
+            if req.finished:
+                self.slots.release(req.slot)
+        self.rows = [self.rows[i] for i in keep]
+        if not self.rows:
+            self.kvs = self.mask = self.positions = None
+            return
+
+        index = torch.as_tensor(keep, device=self.device)
+        self.mask = self.mask[index]
+        # drop the padding columns that no remaining row needs
+        start = int(self.mask.any(dim=0).nonzero()[0])
+        self.mask = self.mask[:, start:]
+        self.kvs = [(k[index, :, start:], v[index, :, start:]) for k, v in self.kvs]
+        self.positions = self.positions[index]
+
+    def add_token(self, req: LoraRequest, logits):
+        """Sample the next token of req and stream its output."""
+        # checked at every decoding step
+        if req.is_cancelled():
+            req.cancel()
+            return
+
+        if req.logits_processor:
+            if req.repetition_penalty > 1.0:
+                tmp_output_ids = torch.as_tensor(
+                    [req.input_ids + req.output_ids], device=logits.device
+                )
+            else:
+                tmp_output_ids = None
+            last_token_logits = req.logits_processor(tmp_output_ids, logits[None])[0]
+        else:
+            last_token_logits = logits
+        if req.temperature < 1e-5 or req.top_p < 1e-8:  # greedy
+            token = int(torch.argmax(last_token_logits))
+        else:
+            probs = torch.softmax(last_token_logits.float(), dim=-1)
+            token = int(torch.multinomial(probs, num_samples=1))
+        req.output_ids.append(token)
+
+        i = len(req.output_ids) - 1
+        stopped = token in req.stop_token_ids
+        if not (
+            i % self.stream_interval == 0 or i == req.max_new_tokens - 1 or stopped
+        ):
+            return
+
+        if req.echo:
+            tmp_output_ids = req.input_ids + req.output_ids
+            rfind_start = len(req.params["prompt"])
+        else:
+            tmp_output_ids = req.output_ids
+            rfind_start = 0
+        output = self.tokenizer.decode(
+            tmp_output_ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=True,
+        )
+
+        partially_stopped = False
+        stop_str = req.stop_str
+        if stop_str:
+            if isinstance(stop_str, str):
+                stop_str = [stop_str]
+            elif not isinstance(stop_str, Iterable):
+                raise ValueError("Invalid stop field type.")
+            for each_stop in stop_str:
+                pos = output.rfind(each_stop, rfind_start)
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
+                    break
+                partially_stopped = is_partial_stop(output, each_stop)
+                if partially_stopped:
+                    break
+
+        finish_reason = None
+        if stopped:
+            finish_reason = "stop"
+        elif i == req.max_new_tokens - 1:
+            finish_reason = "length"
+        # Prevent yielding partial stop sequence
+        if partially_stopped and finish_reason is None:
+            return
+        req.text = output
+        req.queue.put(
+            {
+                "text": output,
+                "error_code": 0,
+                "usage": {
+                    "prompt_tokens": len(req.input_ids),
+                    "completion_tokens": i,
+                    "total_tokens": len(req.input_ids) + i,
+                },
+                "finish_reason": finish_reason,
+            }
+        )
+        req.finished = finish_reason is not None
+
+
+class MultiLoraWorker(BaseModelWorker):
+    def __init__(
+        self,
+        controller_addr: str,
+        worker_addr: str,
+        worker_id: str,
+        model_path: str,
+        model_names: List[str],
+        lora_paths: Dict[str, str],
+        limit_worker_concurrency: int,
+        no_register: bool,
+        device: str,
+        num_gpus: int,
+        max_gpu_memory: str,
+        max_loras: int,
+        revision: str = None,
+        dtype: Optional[torch.dtype] = None,
+        load_8bit: bool = False,
+        cpu_offloading: bool = False,
+        stream_interval: int = 2,
+        conv_template: Optional[str] = None,
+        debug: bool = False,
+    ):
+        super().__init__(
+            controller_addr,
+            worker_addr,
+            worker_id,
+            model_path,
+            model_names,
+            limit_worker_concurrency,
+            conv_template=conv_template,
+        )
+        # the base model keeps its own name
+        self.base_model_names = list(self.model_names)
+        self.model_names = self.base_model_names + list(lora_paths)
+
+        logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
+        self.model, self.tokenizer = load_model(
+            model_path,
+            revision=revision,
+            device=device,
+            num_gpus=num_gpus,
+            max_gpu_memory=max_gpu_memory,
+            dtype=dtype,
+            load_8bit=load_8bit,
+            cpu_offloading=cpu_offloading,
+            debug=debug,
+        )
+        if self.model.config.is_encoder_decoder:
+            raise ValueError("The multi-LoRA worker only supports decoder-only models")
+        if self.tokenizer.pad_token == None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.context_len = get_context_length(self.model.config)
+        self.device = device
+
+        self.slots = LoraAdapterSlots(self.model, lora_paths, max_loras)
+        # the executor runs one blocking stream per thread, so this bounds the batch
+        self.engine = LoraBatchEngine(
+            self.model,
+            self.tokenizer,
+            self.slots,
+            limit_worker_concurrency,
+            stream_interval,
+        )
+
+        if not no_register:
+            self.init_heart_beat()
+
+    def get_model_states(self):
+        loaded = list(self.slots.slot_of)
+        return {
+            name: "resident"
+            if name in self.base_model_names or name in loaded
+            else "unloaded"
+            for name in self.model_names
+        }
+
+    def generate_stream_gate(self, params):
+        self.call_ct += 1
+
+        model_name = params.get("model")
+        if model_name is not None and model_name not in self.model_names:
+            ret = {
+                "text": f"{SERVER_ERROR_MSG}\n\n(Unknown model: {model_name})",
+                "error_code": ErrorCode.INVALID_MODEL,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+            return
+        adapter = model_name if model_name in self.slots.lora_paths else None
+
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        input_ids = self.tokenizer(params["prompt"]).input_ids
+        input_ids = input_ids[-(self.context_len - max_new_tokens - 1) :]
+        stop_token_ids = list(params.get("stop_token_ids", None) or [])
+        if self.tokenizer.eos_token_id not in stop_token_ids:
+            stop_token_ids.append(self.tokenizer.eos_token_id)
+        request = LoraRequest(
+            {**params, "stop_token_ids": stop_token_ids}, adapter, input_ids
+        )
+
+        request.cancel_event = self.get_cancel_event(params)
+
+        encoder = StreamEncoder(params)
+        finished = False
+        self.engine.submit(request)
+        try:
+            while True:
+                ret = request.queue.get()
+                yield json.dumps(encoder.encode(ret)).encode() + b"\0"
+                if ret["error_code"] != 0 or ret["finish_reason"] is not None:
+                    finished = ret.get("finish_reason") != "abort"
+                    break
+        finally:
+            # the engine drops the request at its next step
+            request.aborted = True
+            if not finished:
+                self.record_cancellation(params, len(request.output_ids))
+
+    def generate_gate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
+        for x in self.generate_stream_gate(params):
+            pass
+        return json.loads(x[:-1].decode())
+
+
+def parse_lora_paths(s):
+    """name=path or path, comma separated, into a dict name -> path."""
+    lora_paths = {}
+    for item in s.split(","):
+        name, _, path = item.rpartition("=")
+        path = os.path.expanduser(path)
+        lora_paths[name or os.path.basename(path.rstrip("/"))] = path
+    return lora_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21002")
+    parser.add_argument(
+        "--controller-address", type=str, default="http://localhost:21001"
+    )
+    add_model_args(parser)
+    parser.add_argument(
+        "--model-names",
+        type=lambda s: s.split(","),
+        help="Optional display comma separated names of the base model",
+    )
+    parser.add_argument(
+        "--lora-paths",
+        type=parse_lora_paths,
+        required=True,
+        help="Comma separated LoRA adapters as name=path, served as model name. "
+        "All of them must be trained on the base model of --model-path.",
+    )
+    parser.add_argument(
+        "--max-loras",
+        type=int,
+        default=8,
+        help="Number of adapters loaded at the same time",
+    )
+    parser.add_argument(
+        "--conv-template", type=str, default=None, help="Conversation prompt template."
+    )
+    parser.add_argument(
+        "--limit-worker-concurrency",
+        type=int,
+        default=16,
+        help="Maximum number of requests in the running batch.",
+    )
+    parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument("--no-register", action="store_true")
+    parser.add_argument(
+        "--debug", type=bool, default=False, help="Print debugging messages"
+    )
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    if args.gpus:
+        if len(args.gpus.split(",")) < args.num_gpus:
+            raise ValueError(
+                f"Larger --num-gpus ({args.num_gpus}) than --gpus {args.gpus}!"
+            )
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+
+    worker = MultiLoraWorker(
+        args.controller_address,
+        args.worker_address,
+        worker_id,
+        args.model_path,
+        args.model_names,
+        args.lora_paths,
+        args.limit_worker_concurrency,
+        no_register=args.no_register,
+        device=args.device,
+        num_gpus=args.num_gpus,
+        max_gpu_memory=args.max_gpu_memory,
+        max_loras=args.max_loras,
+        revision=args.revision,
+        dtype=str_to_torch_dtype(args.dtype),
+        load_8bit=args.load_8bit,
+        cpu_offloading=args.cpu_offloading,
+        stream_interval=args.stream_interval,
+        conv_template=args.conv_template,
+        debug=args.debug,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -13,6 +13,7 @@ where all Peft models are trained on the exact same base model.
 """
 import argparse
 import asyncio
+from functools import partial
 import dataclasses
 import logging
 import json
@@ -56,8 +57,23 @@ from fastchat.model.model_codet5p import generate_stream_codet5p
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
+from fastchat.serve.base_model_worker import (
+    EmbeddingBatcher,
+    InferenceExecutor,
+    call_once,
+    create_queue_full_response,
+    iterate_in_executor,
+    release_on_exit,
+    run_until_disconnected,
+)
 from fastchat.serve.inference import generate_stream
-from fastchat.serve.model_worker import ModelWorker, worker_id, logger
+from fastchat.serve.model_pool import ModelPool
+from fastchat.serve.model_worker import (
+    ModelWorker,
+    add_embed_batch_args,
+    worker_id,
+    logger,
+)
 from fastchat.utils import build_logger, pretty_print_semaphore, get_context_length
 
 
@@ -83,9 +99,29 @@ def acquire_worker_semaphore():
     return workers[0].semaphore.acquire()
 
 
-def create_background_tasks():
+def get_inference_executor():
+    if workers[0].executor is None:
+        # Share the same executor for all workers for the same reason.
+        executor = InferenceExecutor(workers[0].limit_worker_concurrency)
+        for w in workers:
+            w.executor = executor
+    return workers[0].executor
+
+
+async def acquire_model(worker):
+    """Load the model of worker on demand and keep it resident while in use."""
+    if worker.model_pool is not None:
+        await worker.model_pool.acquire(worker, get_inference_executor())
+
+
+def release_model(worker):
+    if worker.model_pool is not None:
+        worker.model_pool.release(worker)
+
+
+def create_background_tasks(release=release_worker_semaphore):
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(release_worker_semaphore)
+    background_tasks.add_task(release)
     return background_tasks
 
 
@@ -97,31 +133,94 @@ def create_background_tasks():
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
-    generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
-    return StreamingResponse(generator, background=background_tasks)
+    if worker.is_queue_full():
+        return create_queue_full_response(stream=True)
+    await acquire_worker_semaphore()
+    try:
+        await acquire_model(worker)
+    except BaseException:
+        release_worker_semaphore()
+        raise
+    worker.start_generation(params)
+    release = call_once(
+        release_worker_semaphore,
+        partial(release_model, worker),
+        partial(worker.finish_generation, params),
+    )
+    generator = iterate_in_executor(
+        get_inference_executor(),
+        "generate_stream",
+        worker.generate_stream_gate(params),
+    )
+    background_tasks = create_background_tasks(release)
+    return StreamingResponse(
+        release_on_exit(generator, release), background=background_tasks
+    )
 
 
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
-    output = worker.generate_gate(params)
-    release_worker_semaphore()
+    if worker.is_queue_full():
+        return create_queue_full_response()
+    await acquire_worker_semaphore()
+    worker.start_generation(params)
+    try:
+        await acquire_model(worker)
+        try:
+            output = await run_until_disconnected(
+                request,
+                get_inference_executor().run("generate", worker.generate_gate, params),
+                partial(worker.cancel_generation, params["request_id"]),
+            )
+        finally:
+            release_model(worker)
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     return JSONResponse(output)
 
 
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
-    embedding = worker.get_embeddings(params)
-    background_tasks = create_background_tasks()
-    return JSONResponse(content=embedding, background=background_tasks)
+    if worker.is_queue_full():
+        return create_queue_full_response()
+    if worker.embedding_batcher is not None:
+        await acquire_model(worker)
+        try:
+            embedding = await worker.embedding_batcher.get_embeddings(
+                worker,
+                get_inference_executor(),
+                params,
+                acquire_worker_semaphore,
+                release_worker_semaphore,
+            )
+        finally:
+            release_model(worker)
+        return JSONResponse(content=embedding)
+    await acquire_worker_semaphore()
+    try:
+        await acquire_model(worker)
+        try:
+            embedding = await get_inference_executor().run(
+                "embeddings", worker.get_embeddings, params
+            )
+        finally:
+            release_model(worker)
+    finally:
+        release_worker_semaphore()
+    return JSONResponse(content=embedding)
+
+
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    cancelled = any(w.cancel_generation(params["request_id"]) for w in workers)
+    return {"cancelled": cancelled}
 
 
 @app.post("/worker_get_status")
@@ -130,6 +229,11 @@ async def api_get_status(request: Request):
         "model_names": [m for w in workers for m in w.model_names],
         "speed": 1,
         "queue_length": sum([w.get_queue_length() for w in workers]),
+        # the executor and the model pool are shared by all workers
+        "queue_depth": workers[0].get_queue_depth(),
+        "model_states": workers[0].get_model_states(),
+        "cancelled_requests": sum(w.num_cancelled_requests for w in workers),
+        "cancelled_tokens": sum(w.num_cancelled_tokens for w in workers),
     }
 
 
@@ -147,11 +251,23 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    worker = worker_map[params["model"]]
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
-    return {"context_length": worker.context_len}
+    return {
+        "context_length": worker.context_len,
+        "embed_in_truncate": getattr(worker, "embed_in_truncate", None),
+        "parallel_n": worker.supports_parallel_n(),
+        "render_prompt": True,
+    }
 
 
 def create_multi_model_worker():
@@ -189,6 +305,23 @@ def create_multi_model_worker():
     )
     parser.add_argument("--limit-worker-concurrency", type=int, default=5)
     parser.add_argument("--stream-interval", type=int, default=2)
+    add_embed_batch_args(parser)
+    parser.add_argument(
+        "--model-memory-budget",
+        type=float,
+        default=0,
+        help="GiB of model weights kept resident on the device. If set, models are "
+        "loaded on their first request and the least recently used ones are evicted. "
+        "0 loads all models at startup.",
+    )
+    parser.add_argument(
+        "--evict-to",
+        type=str,
+        choices=["cpu", "disk"],
+        default="cpu",
+        help="Where evicted models go: CPU RAM, or safetensors files in --evict-dir",
+    )
+    parser.add_argument("--evict-dir", type=str, default="evicted_models")
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument(
         "--ssl",
@@ -263,11 +396,26 @@ def create_multi_model_worker():
             xft_config=xft_config,
             stream_interval=args.stream_interval,
             conv_template=conv_template,
+            lazy_load=args.model_memory_budget > 0,
         )
         workers.append(w)
         for model_name in model_names:
             worker_map[model_name] = w
 
+    if args.model_memory_budget > 0:
+        model_pool = ModelPool(
+            int(args.model_memory_budget * 2**30), args.evict_to, args.evict_dir
+        )
+        for w in workers:
+            model_pool.add_worker(w)
+
+    if args.embed_batch_max_tokens > 0:
+        embedding_batcher = EmbeddingBatcher(
+            args.embed_batch_max_tokens, args.embed_batch_max_wait_ms / 1000
+        )
+        for w in workers:
+            w.embedding_batcher = embedding_batcher
+
     # Register all models
     url = args.controller_address + "/register_worker"
     data = {
@@ -277,6 +425,7 @@ def create_multi_model_worker():
             "model_names": [m for w in workers for m in w.model_names],
             "speed": 1,
             "queue_length": sum([w.get_queue_length() for w in workers]),
+            "model_states": workers[0].get_model_states(),
         },
     }
     r = requests.post(url, json=data)
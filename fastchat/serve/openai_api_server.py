@@ -11,7 +11,7 @@ import asyncio
 import argparse
 import json
 import os
-from typing import Generator, Optional, Union, Dict, List, Any
+from typing import Generator, Optional, Union, Dict, List, Any, Tuple
 
 import aiohttp
 import fastapi
@@ -61,11 +61,18 @@ from fastchat.protocol.api_protocol import (
     APITokenCheckResponse,
     APITokenCheckResponseItem,
 )
+from fastchat.serve.embedding_result_cache import EmbeddingResultCache, get_cache_key
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_DELTA, StreamDecoder
 from fastchat.utils import build_logger
 
 logger = build_logger("openai_api_server", "openai_api_server.log")
 
 conv_template_map = {}
+embed_truncation_map = {}
+model_details_map = {}
+embedding_cache = None
+# references to running cancellations, so they are not garbage collected
+cancel_tasks = set()
 
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
 
@@ -152,20 +159,15 @@ async def check_model(request) -> Optional[JSONResponse]:
     return ret
 
 
-async def check_length(request, prompt, max_tokens, worker_addr):
+def check_length(request, prompt_info, max_tokens):
+    """Check the prompt length with the token count returned by render_prompt."""
     if (
         not isinstance(max_tokens, int) or max_tokens <= 0
     ):  # model worker not support max_tokens=None
         max_tokens = 1024 * 1024
 
-    context_len = await fetch_remote(
-        worker_addr + "/model_details", {"model": request.model}, "context_length"
-    )
-    token_num = await fetch_remote(
-        worker_addr + "/count_token",
-        {"model": request.model, "prompt": prompt},
-        "count",
-    )
+    context_len = prompt_info["context_length"]
+    token_num = prompt_info["count"]
     length = min(max_tokens, context_len - token_num)
 
     if length <= 0:
@@ -279,7 +281,73 @@ async def get_gen_params(
     stop: Optional[Union[str, List[str]]],
     best_of: Optional[int] = None,
     use_beam_search: Optional[bool] = None,
+) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Return the generation parameters and the prompt info of render_prompt,
+    which carries the prompt token count. The parameters are None if the
+    prompt could not be rendered.
+    """
+    prompt_info = await render_prompt(model_name, worker_addr, messages)
+    if prompt_info["error_code"] != 0:
+        return None, prompt_info
+
+    gen_params = {
+        "model": model_name,
+        "prompt": prompt_info["prompt"],
+        "temperature": temperature,
+        "logprobs": logprobs,
+        "top_p": top_p,
+        "top_k": top_k,
+        "presence_penalty": presence_penalty,
+        "frequency_penalty": frequency_penalty,
+        "max_new_tokens": max_tokens,
+        "echo": echo,
+        "stop_token_ids": prompt_info["stop_token_ids"],
+    }
+
+    if len(prompt_info["images"]) > 0:
+        gen_params["images"] = prompt_info["images"]
+
+    if best_of is not None:
+        gen_params.update({"best_of": best_of})
+    if use_beam_search is not None:
+        gen_params.update({"use_beam_search": use_beam_search})
+
+    new_stop = set()
+    _add_to_set(stop, new_stop)
+    _add_to_set(prompt_info["stop_str"], new_stop)
+
+    gen_params["stop"] = list(new_stop)
+
+    logger.debug(f"==== request ====\n{gen_params}")
+    return gen_params, prompt_info
+
+
+async def render_prompt(
+    model_name: str,
+    worker_addr: str,
+    messages: Union[str, List[Dict[str, str]]],
 ) -> Dict[str, Any]:
+    """
+    Render the prompt of the messages with the worker's conversation template.
+    Return the prompt, images, stop_str, stop_token_ids, the prompt token
+    count ("count") and the context length of the model.
+
+    Workers with /worker_render_prompt render and count the prompt in one call.
+    For other workers the template is fetched and the prompt is rendered here,
+    then counted with /count_token.
+    """
+    details = await get_model_details(model_name, worker_addr)
+    if details.get("render_prompt", False):
+        ret = await fetch_remote(
+            worker_addr + "/worker_render_prompt",
+            {"model": model_name, "messages": messages},
+            "",
+        )
+        if isinstance(ret, str):
+            ret = json.loads(ret)
+        return ret
+
     conv = await get_conv(model_name, worker_addr)
     conv = Conversation(
         name=conv["name"],
@@ -299,70 +367,27 @@ async def get_gen_params(
         prompt = messages
         images = []
     else:
-        for message in messages:
-            msg_role = message["role"]
-            if msg_role == "system":
-                conv.set_system_message(message["content"])
-            elif msg_role == "user":
-                if type(message["content"]) == list:
-                    image_list = [
-                        item["image_url"]["url"]
-                        for item in message["content"]
-                        if item["type"] == "image_url"
-                    ]
-                    text_list = [
-                        item["text"]
-                        for item in message["content"]
-                        if item["type"] == "text"
-                    ]
-
-                    # TODO(chris): This only applies to LLaVA model. Implement an image_token string in the conv template.
-                    text = "<image>\n" * len(image_list)
-                    text += "\n".join(text_list)
-                    conv.append_message(conv.roles[0], (text, image_list))
-                else:
-                    conv.append_message(conv.roles[0], message["content"])
-            elif msg_role == "assistant":
-                conv.append_message(conv.roles[1], message["content"])
-            else:
-                raise ValueError(f"Unknown role: {msg_role}")
-
+        conv.append_openai_api_messages(messages)
         # Add a blank message for the assistant.
         conv.append_message(conv.roles[1], None)
         prompt = conv.get_prompt()
         images = conv.get_images()
 
-    gen_params = {
-        "model": model_name,
+    token_num = await fetch_remote(
+        worker_addr + "/count_token",
+        {"model": model_name, "prompt": prompt},
+        "count",
+    )
+    return {
         "prompt": prompt,
-        "temperature": temperature,
-        "logprobs": logprobs,
-        "top_p": top_p,
-        "top_k": top_k,
-        "presence_penalty": presence_penalty,
-        "frequency_penalty": frequency_penalty,
-        "max_new_tokens": max_tokens,
-        "echo": echo,
+        "images": images,
+        "stop_str": conv.stop_str,
         "stop_token_ids": conv.stop_token_ids,
+        "count": token_num,
+        "context_length": details["context_length"],
+        "error_code": 0,
     }
 
-    if len(images) > 0:
-        gen_params["images"] = images
-
-    if best_of is not None:
-        gen_params.update({"best_of": best_of})
-    if use_beam_search is not None:
-        gen_params.update({"use_beam_search": use_beam_search})
-
-    new_stop = set()
-    _add_to_set(stop, new_stop)
-    _add_to_set(conv.stop_str, new_stop)
-
-    gen_params["stop"] = list(new_stop)
-
-    logger.debug(f"==== request ====\n{gen_params}")
-    return gen_params
-
 
 async def get_worker_address(model_name: str) -> str:
     """
@@ -384,6 +409,22 @@ async def get_worker_address(model_name: str) -> str:
     return worker_addr
 
 
+async def get_worker_addresses(model_name: str) -> List[str]:
+    """
+    Get the addresses of all workers serving the requested model
+
+    Falls back to a single address from `get_worker_address` for controllers
+    without the `/get_worker_addresses` endpoint.
+    """
+    controller_address = app_settings.controller_address
+    ret = await fetch_remote(
+        controller_address + "/get_worker_addresses", {"model": model_name}, ""
+    )
+    if isinstance(ret, dict) and ret.get("addresses"):
+        return ret["addresses"]
+    return [await get_worker_address(model_name)]
+
+
 async def get_conv(model_name: str, worker_addr: str):
     conv_template = conv_template_map.get((worker_addr, model_name))
     if conv_template is None:
@@ -420,7 +461,7 @@ async def create_chat_completion(request: ChatCompletionRequest):
 
     worker_addr = await get_worker_address(request.model)
 
-    gen_params = await get_gen_params(
+    gen_params, prompt_info = await get_gen_params(
         request.model,
         worker_addr,
         request.messages,
@@ -433,12 +474,11 @@ async def create_chat_completion(request: ChatCompletionRequest):
         echo=False,
         stop=request.stop,
     )
+    if gen_params is None:
+        return create_error_response(prompt_info["error_code"], prompt_info["text"])
 
-    max_new_tokens, error_check_ret = await check_length(
-        request,
-        gen_params["prompt"],
-        gen_params["max_new_tokens"],
-        worker_addr,
+    max_new_tokens, error_check_ret = check_length(
+        request, prompt_info, gen_params["max_new_tokens"]
     )
 
     if error_check_ret is not None:
@@ -453,12 +493,8 @@ async def create_chat_completion(request: ChatCompletionRequest):
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
-        chat_completions.append(content)
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await generate_choices(gen_params, request.n, worker_addr)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
@@ -504,35 +540,30 @@ async def chat_completion_stream_generator(
         )
         yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
 
-        previous_text = ""
-        async for content in generate_completion_stream(gen_params, worker_addr):
-            if content["error_code"] != 0:
-                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-                return
-            decoded_unicode = content["text"].replace("\ufffd", "")
-            delta_text = decoded_unicode[len(previous_text) :]
-            previous_text = (
-                decoded_unicode
-                if len(decoded_unicode) > len(previous_text)
-                else previous_text
-            )
-
-            if len(delta_text) == 0:
-                delta_text = None
-            choice_data = ChatCompletionResponseStreamChoice(
-                index=i,
-                delta=DeltaMessage(content=delta_text),
-                finish_reason=content.get("finish_reason", None),
-            )
-            chunk = ChatCompletionStreamResponse(
-                id=id, choices=[choice_data], model=model_name
-            )
-            if delta_text is None:
-                if content.get("finish_reason", None) is not None:
-                    finish_stream_events.append(chunk)
-                continue
-            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+    decoders = [StreamDecoder(keep_text=False) for _ in range(n)]
+    async for i, content in generate_choice_streams(gen_params, n, worker_addr):
+        if content["error_code"] != 0:
+            yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        content, delta_text = decoders[i].decode(content)
+        delta_text = delta_text.replace("\ufffd", "")
+
+        if len(delta_text) == 0:
+            delta_text = None
+        choice_data = ChatCompletionResponseStreamChoice(
+            index=i,
+            delta=DeltaMessage(content=delta_text),
+            finish_reason=content.get("finish_reason", None),
+        )
+        chunk = ChatCompletionStreamResponse(
+            id=id, choices=[choice_data], model=model_name
+        )
+        if delta_text is None:
+            if content.get("finish_reason", None) is not None:
+                finish_stream_events.append(chunk)
+            continue
+        yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.model_dump_json(exclude_none=True)}\n\n"
@@ -551,48 +582,56 @@ async def create_completion(request: CompletionRequest):
     request.prompt = process_input(request.model, request.prompt)
 
     worker_addr = await get_worker_address(request.model)
+    all_gen_params = []
     for text in request.prompt:
-        max_tokens, error_check_ret = await check_length(
-            request, text, request.max_tokens, worker_addr
+        gen_params, prompt_info = await get_gen_params(
+            request.model,
+            worker_addr,
+            text,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=request.top_k,
+            frequency_penalty=request.frequency_penalty,
+            presence_penalty=request.presence_penalty,
+            max_tokens=request.max_tokens,
+            logprobs=request.logprobs,
+            echo=request.echo,
+            stop=request.stop,
+            # not supported when streaming
+            best_of=None if request.stream else request.best_of,
+            use_beam_search=None if request.stream else request.use_beam_search,
+        )
+        if gen_params is None:
+            return create_error_response(prompt_info["error_code"], prompt_info["text"])
+        max_tokens, error_check_ret = check_length(
+            request, prompt_info, request.max_tokens
         )
         if error_check_ret is not None:
             return error_check_ret
 
         if isinstance(max_tokens, int) and max_tokens < request.max_tokens:
             request.max_tokens = max_tokens
+        all_gen_params.append(gen_params)
+    for gen_params in all_gen_params:
+        gen_params["max_new_tokens"] = request.max_tokens
 
     if request.stream:
         generator = generate_completion_stream_generator(
-            request, request.n, worker_addr
+            request, all_gen_params, request.n, worker_addr
         )
         return StreamingResponse(generator, media_type="text/event-stream")
     else:
-        text_completions = []
-        for text in request.prompt:
-            gen_params = await get_gen_params(
-                request.model,
-                worker_addr,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.top_k,
-                frequency_penalty=request.frequency_penalty,
-                presence_penalty=request.presence_penalty,
-                max_tokens=request.max_tokens,
-                logprobs=request.logprobs,
-                echo=request.echo,
-                stop=request.stop,
-                best_of=request.best_of,
-                use_beam_search=request.use_beam_search,
-            )
-            for i in range(request.n):
-                content = asyncio.create_task(
-                    generate_completion(gen_params, worker_addr)
-                )
-                text_completions.append(content)
+        text_completions = [
+            generate_choices(gen_params, request.n, worker_addr)
+            for gen_params in all_gen_params
+        ]
 
         try:
-            all_tasks = await asyncio.gather(*text_completions)
+            all_tasks = [
+                content
+                for contents in await asyncio.gather(*text_completions)
+                for content in contents
+            ]
         except Exception as e:
             return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
 
@@ -619,90 +658,177 @@ async def create_completion(request: CompletionRequest):
 
 
 async def generate_completion_stream_generator(
-    request: CompletionRequest, n: int, worker_addr: str
+    request: CompletionRequest,
+    all_gen_params: List[Dict[str, Any]],
+    n: int,
+    worker_addr: str,
 ):
     model_name = request.model
     id = f"cmpl-{shortuuid.random()}"
     finish_stream_events = []
-    for text in request.prompt:
-        for i in range(n):
-            previous_text = ""
-            gen_params = await get_gen_params(
-                request.model,
-                worker_addr,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.top_k,
-                presence_penalty=request.presence_penalty,
-                frequency_penalty=request.frequency_penalty,
-                max_tokens=request.max_tokens,
-                logprobs=request.logprobs,
-                echo=request.echo,
-                stop=request.stop,
+    for prompt_index, gen_params in enumerate(all_gen_params):
+        decoders = [StreamDecoder(keep_text=False) for _ in range(n)]
+        async for i, content in generate_choice_streams(gen_params, n, worker_addr):
+            if content["error_code"] != 0:
+                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+            content, delta_text = decoders[i].decode(content)
+            delta_text = delta_text.replace("\ufffd", "")
+            # choices are numbered across prompts, as in non-streaming responses
+            choice_data = CompletionResponseStreamChoice(
+                index=prompt_index * n + i,
+                text=delta_text,
+                logprobs=create_openai_logprobs(content.get("logprobs", None)),
+                finish_reason=content.get("finish_reason", None),
             )
-            async for content in generate_completion_stream(gen_params, worker_addr):
-                if content["error_code"] != 0:
-                    yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                decoded_unicode = content["text"].replace("\ufffd", "")
-                delta_text = decoded_unicode[len(previous_text) :]
-                previous_text = (
-                    decoded_unicode
-                    if len(decoded_unicode) > len(previous_text)
-                    else previous_text
-                )
-                # todo: index is not apparent
-                choice_data = CompletionResponseStreamChoice(
-                    index=i,
-                    text=delta_text,
-                    logprobs=create_openai_logprobs(content.get("logprobs", None)),
-                    finish_reason=content.get("finish_reason", None),
-                )
-                chunk = CompletionStreamResponse(
-                    id=id,
-                    object="text_completion",
-                    choices=[choice_data],
-                    model=model_name,
-                )
-                if len(delta_text) == 0:
-                    if content.get("finish_reason", None) is not None:
-                        finish_stream_events.append(chunk)
-                    continue
-                yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+            chunk = CompletionStreamResponse(
+                id=id,
+                object="text_completion",
+                choices=[choice_data],
+                model=model_name,
+            )
+            if len(delta_text) == 0:
+                if content.get("finish_reason", None) is not None:
+                    finish_stream_events.append(chunk)
+                continue
+            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.model_dump_json(exclude_unset=True)}\n\n"
     yield "data: [DONE]\n\n"
 
 
+async def cancel_worker_generation(worker_addr: str, request_id: str):
+    try:
+        await fetch_remote(worker_addr + "/worker_cancel", {"request_id": request_id})
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.info(f"cancel failed: {worker_addr}, {request_id}, {e}")
+
+
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            # content = await response.aread()
-            buffer = b""
-            async for raw_chunk in response.aiter_raw():
-                buffer += raw_chunk
-                while (chunk_end := buffer.find(delimiter)) >= 0:
-                    chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
-                    if not chunk:
-                        continue
-                    yield json.loads(chunk.decode())
+    """Stream worker chunks; text comes as deltas, see fastchat.serve.stream_protocol."""
+    # lets the worker stop decoding if this stream is dropped half way
+    request_id = shortuuid.random()
+    completed = False
+    try:
+        async with httpx.AsyncClient() as client:
+            delimiter = b"\0"
+            async with client.stream(
+                "POST",
+                worker_addr + "/worker_generate_stream",
+                headers=headers,
+                json={
+                    **payload,
+                    "stream_protocol": STREAM_PROTOCOL_DELTA,
+                    "request_id": request_id,
+                },
+                timeout=WORKER_API_TIMEOUT,
+            ) as response:
+                buffer = b""
+                async for raw_chunk in response.aiter_raw():
+                    buffer += raw_chunk
+                    while (chunk_end := buffer.find(delimiter)) >= 0:
+                        chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+                        if not chunk:
+                            continue
+                        yield json.loads(chunk.decode())
+        completed = True
+    finally:
+        if not completed:
+            # the client went away or the choice was abandoned
+            task = asyncio.create_task(
+                cancel_worker_generation(worker_addr, request_id)
+            )
+            cancel_tasks.add(task)
+            task.add_done_callback(cancel_tasks.discard)
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
     return await fetch_remote(worker_addr + "/worker_generate", payload, "")
 
 
+async def get_model_details(model_name: str, worker_addr: str):
+    """The /model_details of a worker, cached per (worker, model)."""
+    key = (worker_addr, model_name)
+    details = model_details_map.get(key)
+    if details is None:
+        details = await fetch_remote(
+            worker_addr + "/model_details", {"model": model_name}, ""
+        )
+        if not isinstance(details, dict) or "error_code" in details:
+            # not cached, the worker is asked again next time
+            return {}
+        # parallel_n is None until a lazily loaded model is loaded
+        if details.get("parallel_n", False) is not None:
+            model_details_map[key] = details
+    return details
+
+
+async def get_parallel_n(model_name: str, worker_addr: str):
+    """Whether the worker samples n choices from one prefill in a single request."""
+    details = await get_model_details(model_name, worker_addr)
+    return bool(details.get("parallel_n", False))
+
+
+async def generate_choice_streams(payload: Dict[str, Any], n: int, worker_addr: str):
+    """
+    Stream the worker chunks of n choices of one prompt as (index, chunk),
+    interleaved in the order they arrive.
+    """
+    if n == 1:
+        async for content in generate_completion_stream(payload, worker_addr):
+            yield 0, content
+        return
+
+    if await get_parallel_n(payload["model"], worker_addr):
+        async for content in generate_completion_stream(
+            {**payload, "n": n}, worker_addr
+        ):
+            yield content.pop("index", 0), content
+        return
+
+    # one worker request per choice, all running at the same time
+    queue = asyncio.Queue()
+
+    async def stream_choice(i):
+        try:
+            async for content in generate_completion_stream(payload, worker_addr):
+                await queue.put((i, content))
+            await queue.put((i, None))
+        except Exception as e:
+            await queue.put((i, e))
+
+    tasks = [asyncio.create_task(stream_choice(i)) for i in range(n)]
+    try:
+        num_running = n
+        while num_running > 0:
+            i, content = await queue.get()
+            if content is None:
+                num_running -= 1
+            elif isinstance(content, Exception):
+                raise content
+            else:
+                yield i, content
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def generate_choices(payload: Dict[str, Any], n: int, worker_addr: str):
+    """Return the outputs of n choices of one prompt."""
+    if n > 1 and await get_parallel_n(payload["model"], worker_addr):
+        content = await generate_completion({**payload, "n": n}, worker_addr)
+        if isinstance(content, str):
+            content = json.loads(content)
+        if content["error_code"] != 0:
+            return [content]
+        return content["choices"]
+    return await asyncio.gather(
+        *[generate_completion(payload, worker_addr) for _ in range(n)]
+    )
+
+
 @app.post("/v1/embeddings", dependencies=[Depends(check_api_key)])
 @app.post("/v1/engines/{model_name}/embeddings", dependencies=[Depends(check_api_key)])
 async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
@@ -715,31 +841,69 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
 
     request.input = process_input(request.model, request.input)
 
-    data = []
     token_num = 0
+    results = [None] * len(request.input)
+    missing = list(range(len(request.input)))
+    truncation = None
+    if embedding_cache is not None:
+        truncation = await get_embed_truncation(request.model)
+    use_cache = truncation is not None
+    if use_cache:
+        cache_keys = [
+            get_cache_key(request.model, text, request.encoding_format, truncation)
+            for text in request.input
+        ]
+        missing = []
+        for i, key in enumerate(cache_keys):
+            hit = embedding_cache.get(key)
+            if hit is None:
+                missing.append(i)
+            else:
+                results[i] = hit[0]
+                token_num += hit[1]
+
     batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
     batches = [
-        request.input[i : min(i + batch_size, len(request.input))]
-        for i in range(0, len(request.input), batch_size)
+        missing[i : min(i + batch_size, len(missing))]
+        for i in range(0, len(missing), batch_size)
     ]
-    for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-            "encoding_format": request.encoding_format,
-        }
-        embedding = await get_embedding(payload)
+    # send all batches at once, spread over the workers serving the model
+    worker_addrs = await get_worker_addresses(request.model) if batches else []
+    embeddings = await asyncio.gather(
+        *[
+            get_embedding(
+                {
+                    "model": request.model,
+                    "input": [request.input[i] for i in batch],
+                    "encoding_format": request.encoding_format,
+                },
+                worker_addrs[num_batch % len(worker_addrs)],
+            )
+            for num_batch, batch in enumerate(batches)
+        ]
+    )
+    for batch, embedding in zip(batches, embeddings):
         if "error_code" in embedding and embedding["error_code"] != 0:
             return create_error_response(embedding["error_code"], embedding["text"])
-        data += [
-            {
-                "object": "embedding",
-                "embedding": emb,
-                "index": num_batch * batch_size + i,
-            }
-            for i, emb in enumerate(embedding["embedding"])
-        ]
+        for j, i in enumerate(batch):
+            results[i] = embedding["embedding"][j]
+            # only workers reporting per-input token counts can be cached
+            if use_cache and "token_nums" in embedding:
+                embedding_cache.put(
+                    cache_keys[i], results[i], embedding["token_nums"][j]
+                )
         token_num += embedding["token_num"]
+    if use_cache:
+        embedding_cache.flush()
+
+    data = [
+        {
+            "object": "embedding",
+            "embedding": emb,
+            "index": i,
+        }
+        for i, emb in enumerate(results)
+    ]
     return EmbeddingsResponse(
         data=data,
         model=request.model,
@@ -751,10 +915,25 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
     ).model_dump(exclude_none=True)
 
 
-async def get_embedding(payload: Dict[str, Any]):
+async def get_embed_truncation(model_name: str):
+    """
+    Whether the workers of the model truncate embedding inputs, part of the cache key.
+    None if the worker could not tell, then the cache is not used.
+    """
+    if model_name not in embed_truncation_map:
+        worker_addr = await get_worker_address(model_name)
+        details = await get_model_details(model_name, worker_addr)
+        if not details:
+            return None
+        embed_truncation_map[model_name] = bool(details.get("embed_in_truncate", False))
+    return embed_truncation_map[model_name]
+
+
+async def get_embedding(payload: Dict[str, Any], worker_addr: Optional[str] = None):
     controller_address = app_settings.controller_address
     model_name = payload["model"]
-    worker_addr = await get_worker_address(model_name)
+    if worker_addr is None:
+        worker_addr = await get_worker_address(model_name)
 
     embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
     return json.loads(embedding)
@@ -798,6 +977,17 @@ async def count_tokens(request: APITokenCheckRequest):
     return APITokenCheckResponse(prompts=checkedList)
 
 
+@app.get("/api/v1/embedding_cache_stats")
+async def show_embedding_cache_stats():
+    """
+    Hit/miss counters of the embedding result cache
+    This is not part of the OpenAI API spec.
+    """
+    if embedding_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **embedding_cache.get_stats()}
+
+
 @app.post("/api/v1/chat/completions")
 async def create_chat_completion(request: APIChatCompletionRequest):
     """Creates a completion for the chat message"""
@@ -810,7 +1000,7 @@ async def create_chat_completion(request: APIChatCompletionRequest):
 
     worker_addr = await get_worker_address(request.model)
 
-    gen_params = await get_gen_params(
+    gen_params, prompt_info = await get_gen_params(
         request.model,
         worker_addr,
         request.messages,
@@ -823,15 +1013,14 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         echo=False,
         stop=request.stop,
     )
+    if gen_params is None:
+        return create_error_response(prompt_info["error_code"], prompt_info["text"])
 
     if request.repetition_penalty is not None:
         gen_params["repetition_penalty"] = request.repetition_penalty
 
-    max_new_tokens, error_check_ret = await check_length(
-        request,
-        gen_params["prompt"],
-        gen_params["max_new_tokens"],
-        worker_addr,
+    max_new_tokens, error_check_ret = check_length(
+        request, prompt_info, gen_params["max_new_tokens"]
     )
 
     if error_check_ret is not None:
@@ -846,12 +1035,8 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
-        chat_completions.append(content)
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await generate_choices(gen_params, request.n, worker_addr)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
@@ -908,6 +1093,23 @@ def create_openai_api_server():
         default=False,
         help="Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.",
     )
+    parser.add_argument(
+        "--embedding-cache",
+        action="store_true",
+        help="Cache embedding results and serve repeated inputs without the workers",
+    )
+    parser.add_argument(
+        "--embedding-cache-size",
+        type=int,
+        default=100000,
+        help="Number of embeddings kept in the in-memory LRU tier",
+    )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        type=str,
+        default=None,
+        help="Directory of the on-disk tier of the embedding cache (implies --embedding-cache)",
+    )
     args = parser.parse_args()
 
     app.add_middleware(
@@ -920,6 +1122,12 @@ def create_openai_api_server():
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
 
+    global embedding_cache
+    if args.embedding_cache or args.embedding_cache_dir:
+        embedding_cache = EmbeddingResultCache(
+            args.embedding_cache_size, args.embedding_cache_dir
+        )
+
     logger.info(f"args: {args}")
     return args
 
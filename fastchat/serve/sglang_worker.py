@@ -20,7 +20,8 @@ from sglang.srt.utils import load_image, is_multimodal_model
 
 from fastchat.conversation import IMAGE_PLACEHOLDER_STR
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
-from fastchat.serve.base_model_worker import BaseModelWorker
+from fastchat.serve.base_model_worker import BaseModelWorker, create_cancelled_output
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
@@ -162,19 +163,45 @@ class SGLWorker(BaseModelWorker):
             yield ret
 
     async def generate_stream_gate(self, params):
+        encoder = StreamEncoder(params)
+        cancel_event = self.get_cancel_event(params)
+        # the generation is cancelled unless it runs to its end or fails
+        finished = False
+        last_ret = None
         try:
             async for ret in self.generate_stream(params):
-                yield json.dumps(ret).encode() + b"\0"
+                if cancel_event is not None and cancel_event.is_set():
+                    if last_ret is not None:
+                        ret = {**last_ret, "finish_reason": "abort"}
+                        yield json.dumps(encoder.encode(ret)).encode() + b"\0"
+                    break
+                last_ret = ret
+                yield json.dumps(encoder.encode(ret)).encode() + b"\0"
+            else:
+                finished = True
         except (ValueError, RuntimeError) as e:
+            finished = True
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
             yield json.dumps(ret).encode() + b"\0"
+        finally:
+            if not finished:
+                completion_tokens = 0
+                if last_ret is not None:
+                    completion_tokens = last_ret["usage"]["completion_tokens"]
+                self.record_cancellation(params, completion_tokens)
 
     async def generate_gate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
+        x = None
         async for x in self.generate_stream_gate(params):
             pass
+        if x is None:
+            # cancelled before the first chunk
+            return create_cancelled_output()
         return json.loads(x[:-1].decode())
 
 
@@ -188,9 +215,10 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
-def create_background_tasks():
+def create_background_tasks(params):
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_worker_semaphore)
+    background_tasks.add_task(worker.finish_generation, params)
     return background_tasks
 
 
@@ -198,8 +226,9 @@ def create_background_tasks():
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
+    worker.start_generation(params)
     generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
+    background_tasks = create_background_tasks(params)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -207,11 +236,21 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    output = await worker.generate_gate(params)
-    release_worker_semaphore()
+    worker.start_generation(params)
+    try:
+        output = await worker.generate_gate(params)
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     return JSONResponse(output)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    return {"cancelled": worker.cancel_generation(params["request_id"])}
+
+
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return worker.get_status()
@@ -228,9 +267,15 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "render_prompt": True}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,351 @@
+"""
+Speculative decoding for generate_stream.
+
+A drafter proposes the next k tokens and the target model scores all of them in
+one forward pass; the longest prefix of the draft the target model agrees with
+is kept, followed by one token sampled from the target model. A step therefore
+yields between 1 and k + 1 tokens for one forward pass of the target model.
+
+Two drafters are available:
+- prompt lookup: the draft is the continuation of the most recent earlier
+  occurrence of the last n-gram of the sequence. It needs no second model and
+  works well when the output copies from the prompt (code edits, RAG, summaries).
+- draft model: a small model with the same tokenizer drafts greedily, keeping
+  its own KV cache across the steps of a generation.
+
+Drafts are deterministic, so a draft token x is accepted with probability
+p(x) under the processed distribution p of the target model, and a rejected
+token is replaced by a sample from p with x removed. The outputs follow the
+same distribution as generate_stream; with greedy decoding they are the same
+tokens. Rejected draft tokens are dropped from the KV cache.
+
+Only decoder-only models with a standard KV cache (a transformers Cache or
+tuples of [batch, heads, seq, dim] tensors) are supported. Requests with n > 1,
+logprobs or judge_sent_end are served by generate_stream.
+"""
+from dataclasses import dataclass
+import gc
+import threading
+from typing import Dict, List, Optional
+
+import torch
+
+from fastchat.serve.inference import (
+    apply_stop_str,
+    generate_stream,
+    prepare_logits_processor,
+)
+
+SPECULATIVE_METHODS = ("prompt-lookup", "draft-model")
+
+
+@dataclass
+class SpeculativeConfig:
+    method: str = "prompt-lookup"
+    # the number of tokens proposed per step
+    num_draft_tokens: int = 5
+    # the longest n-gram matched by prompt lookup
+    max_ngram: int = 3
+    draft_model_path: Optional[str] = None
+
+
+class SpeculativeStats:
+    """Acceptance counters of a worker, shared by concurrent generations."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        # forward passes of the target model after the prefill
+        self.num_steps = 0
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_generated_tokens = 0
+
+    def update(self, num_steps, num_draft_tokens, num_accepted_tokens, num_generated):
+        with self.lock:
+            self.num_requests += 1
+            self.num_steps += num_steps
+            self.num_draft_tokens += num_draft_tokens
+            self.num_accepted_tokens += num_accepted_tokens
+            self.num_generated_tokens += num_generated
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "requests": self.num_requests,
+                "steps": self.num_steps,
+                "draft_tokens": self.num_draft_tokens,
+                "accepted_tokens": self.num_accepted_tokens,
+                "acceptance_rate": self.num_accepted_tokens
+                / max(self.num_draft_tokens, 1),
+                "tokens_per_step": self.num_generated_tokens / max(self.num_steps, 1),
+            }
+
+
+def crop_past_key_values(past_key_values, length: int):
+    """Keep the first length positions of a KV cache."""
+    if hasattr(past_key_values, "crop"):
+        # a negative argument is the number of positions to remove
+        num_removed = past_key_values.get_seq_length() - length
+        if num_removed > 0:
+            past_key_values.crop(-num_removed)
+        return past_key_values
+    return tuple(tuple(t[..., :length, :] for t in layer) for layer in past_key_values)
+
+
+class PromptLookupDrafter:
+    def __init__(self, max_ngram: int = 3):
+        self.max_ngram = max_ngram
+
+    def propose(self, output_ids: List[int], k: int) -> List[int]:
+        """The k tokens after the latest earlier occurrence of the last n-gram."""
+        for n in range(min(self.max_ngram, len(output_ids) - 1), 0, -1):
+            ngram = output_ids[-n:]
+            # search backwards, the most recent occurrence is the most relevant
+            for start in range(len(output_ids) - n - 1, -1, -1):
+                if output_ids[start : start + n] == ngram:
+                    return output_ids[start + n : start + n + k]
+        return []
+
+
+class DraftModelDrafter:
+    """Greedy drafts of a small model. One instance per generation."""
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+        self.past_key_values = None
+        # the tokens in the KV cache
+        self.cache_ids = []
+
+    def propose(self, output_ids: List[int], k: int) -> List[int]:
+        if k <= 0:
+            return []
+        # drop the cached tokens the target model rejected
+        num_common = 0
+        for a, b in zip(self.cache_ids, output_ids[:-1]):
+            if a != b:
+                break
+            num_common += 1
+        if num_common < len(self.cache_ids):
+            self.past_key_values = crop_past_key_values(
+                self.past_key_values, num_common
+            )
+            self.cache_ids = self.cache_ids[:num_common]
+
+        new_ids = output_ids[num_common:]
+        draft = []
+        for _ in range(k):
+            out = self.model(
+                input_ids=torch.as_tensor([new_ids], device=self.device),
+                use_cache=True,
+                past_key_values=self.past_key_values,
+            )
+            self.past_key_values = out.past_key_values
+            self.cache_ids.extend(new_ids)
+            token = int(torch.argmax(out.logits[0, -1, :]))
+            draft.append(token)
+            new_ids = [token]
+        return draft
+
+
+def process_logits(logits_processor, logits, output_ids, num_rows, use_ids):
+    """Apply the logits processor to the first num_rows positions of logits."""
+    if not logits_processor:
+        return logits[:num_rows]
+    if not use_ids:
+        # the processors work on each row alone
+        return logits_processor(None, logits[:num_rows])
+    # the repetition penalty of a position depends on the tokens before it
+    rows = []
+    for j in range(num_rows):
+        ids = torch.as_tensor([output_ids[: len(output_ids) - num_rows + 1 + j]])
+        rows.append(logits_processor(ids.to(logits.device), logits[j : j + 1])[0])
+    return torch.stack(rows)
+
+
+@torch.inference_mode()
+def generate_stream_speculative(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int = 2,
+    judge_sent_end: bool = False,
+    config: Optional[SpeculativeConfig] = None,
+    draft_model=None,
+    stats: Optional[SpeculativeStats] = None,
+):
+    if hasattr(model, "device"):
+        device = model.device
+
+    config = config or SpeculativeConfig()
+    if (
+        model.config.is_encoder_decoder
+        or int(params.get("n", 1)) > 1
+        or params.get("logprobs", None) is not None
+        or judge_sent_end
+    ):
+        yield from generate_stream(
+            model,
+            tokenizer,
+            params,
+            device,
+            context_len,
+            stream_interval,
+            judge_sent_end,
+        )
+        return
+
+    # Read parameters
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    temperature = float(params.get("temperature", 1.0))
+    repetition_penalty = float(params.get("repetition_penalty", 1.0))
+    top_p = float(params.get("top_p", 1.0))
+    top_k = int(params.get("top_k", -1))  # -1 means disable
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    echo = bool(params.get("echo", True))
+    stop_str = params.get("stop", None)
+    stop_token_ids = params.get("stop_token_ids", None) or []
+    if tokenizer.eos_token_id not in stop_token_ids:
+        stop_token_ids.append(tokenizer.eos_token_id)
+    greedy = temperature < 1e-5 or top_p < 1e-8
+
+    logits_processor = prepare_logits_processor(
+        temperature, repetition_penalty, top_p, top_k
+    )
+    input_ids = tokenizer(prompt).input_ids
+    max_src_len = context_len - max_new_tokens - 1
+    input_ids = input_ids[-max_src_len:]
+    output_ids = list(input_ids)
+    input_echo_len = len(input_ids)
+
+    if draft_model is not None:
+        drafter = DraftModelDrafter(draft_model, device)
+    else:
+        drafter = PromptLookupDrafter(config.max_ngram)
+
+    out = model(input_ids=torch.as_tensor([input_ids], device=device), use_cache=True)
+    past_key_values = out.past_key_values
+    logits = out.logits[0, -1:, :]
+    draft = []
+    num_steps = num_draft_tokens = num_accepted_tokens = 0
+    last_yield = -1
+    stopped = False
+    while True:
+        # pick the tokens of this step: the accepted draft and one more token
+        last_token_logits = process_logits(
+            logits_processor,
+            logits,
+            output_ids + draft,
+            len(draft) + 1,
+            repetition_penalty > 1.0,
+        )
+        if device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            last_token_logits = last_token_logits.float().to("cpu")
+
+        new_tokens = []
+        if greedy:
+            targets = torch.argmax(last_token_logits, dim=-1).tolist()
+            for j, target in enumerate(targets):
+                new_tokens.append(target)
+                if j == len(draft) or target != draft[j]:
+                    break
+        else:
+            probs = torch.softmax(last_token_logits.float(), dim=-1)
+            for j in range(len(draft) + 1):
+                if j < len(draft):
+                    x = draft[j]
+                    if torch.rand(()).item() < probs[j, x].item():
+                        new_tokens.append(x)
+                        continue
+                    probs[j, x] = 0
+                new_tokens.append(int(torch.multinomial(probs[j], num_samples=1)))
+                break
+        num_accepted_tokens += len(new_tokens) - 1
+
+        # stop at the first stop token, the tokens after it are dropped
+        for token in new_tokens:
+            output_ids.append(token)
+            if token in stop_token_ids:
+                stopped = True
+                break
+        i = len(output_ids) - input_echo_len - 1
+        done = stopped or i >= max_new_tokens - 1
+
+        # Yield the output tokens
+        if done or i - last_yield >= stream_interval:
+            last_yield = i
+            if echo:
+                tmp_output_ids = output_ids
+                rfind_start = len_prompt
+            else:
+                tmp_output_ids = output_ids[input_echo_len:]
+                rfind_start = 0
+            output = tokenizer.decode(
+                tmp_output_ids,
+                skip_special_tokens=True,
+                spaces_between_special_tokens=False,
+                clean_up_tokenization_spaces=True,
+            )
+            output, found_stop, partially_stopped = apply_stop_str(
+                output, stop_str, rfind_start
+            )
+            stopped = stopped or found_stop
+            done = done or found_stop
+
+            # Prevent yielding partial stop sequence
+            if not partially_stopped and not done:
+                yield {
+                    "text": output,
+                    "logprobs": None,
+                    "usage": {
+                        "prompt_tokens": input_echo_len,
+                        "completion_tokens": i,
+                        "total_tokens": input_echo_len + i,
+                    },
+                    "finish_reason": None,
+                }
+        if done:
+            break
+
+        # the last token is not in the KV cache yet
+        past_key_values = crop_past_key_values(past_key_values, len(output_ids) - 1)
+        k = min(config.num_draft_tokens, max_new_tokens - 2 - i)
+        draft = drafter.propose(output_ids, k)[:k]
+        out = model(
+            input_ids=torch.as_tensor([[output_ids[-1]] + draft], device=device),
+            use_cache=True,
+            past_key_values=past_key_values,
+        )
+        past_key_values = out.past_key_values
+        logits = out.logits[0]
+        num_steps += 1
+        num_draft_tokens += len(draft)
+
+    # Finish stream event, which contains finish reason
+    yield {
+        "text": output,
+        "logprobs": None,
+        "usage": {
+            "prompt_tokens": input_echo_len,
+            "completion_tokens": i,
+            "total_tokens": input_echo_len + i,
+        },
+        "finish_reason": "stop" if stopped else "length",
+    }
+    if stats is not None:
+        # the first token comes from the prefill
+        stats.update(num_steps, num_draft_tokens, num_accepted_tokens, i)
+
+    # Clean
+    del past_key_values, out, drafter
+    gc.collect()
+    torch.cuda.empty_cache()
+    if device == "xpu":
+        torch.xpu.empty_cache()
+    if device == "npu":
+        torch.npu.empty_cache()
@@ -0,0 +1,127 @@
+"""
+Stream protocol of /worker_generate_stream.
+
+Chunks are JSON objects terminated by b"\\0".
+
+Version 1 (cumulative, default): every chunk carries the full text generated
+so far in "text". Bytes on the wire and JSON work grow quadratically with the
+output length.
+
+Version 2 (delta): requested by sending "stream_protocol": 2 with the
+generation params. Every chunk only carries what was added since the previous one:
+    {"delta": "...", "offset": 123, "error_code": 0, "usage": {...}, "finish_reason": None}
+The full text is text[:offset] + delta, so the worker can still rewrite the
+tail when it has to. Logprobs are sent the same way: only the new entries in
+"logprobs", starting at entry "logprobs_offset". Error chunks are sent
+unchanged, with the message in "text".
+
+Workers that do not know version 2 ignore the param and keep sending
+cumulative chunks, and the controller relays chunks verbatim. StreamDecoder
+accepts both formats, so clients can always request version 2.
+"""
+import os
+
+STREAM_PROTOCOL_CUMULATIVE = 1
+STREAM_PROTOCOL_DELTA = 2
+
+
+def get_stream_protocol(params):
+    return int(params.get("stream_protocol", STREAM_PROTOCOL_CUMULATIVE))
+
+
+class StreamEncoder:
+    """Turn the cumulative chunks of a generate_stream into the protocol the client asked for."""
+
+    def __init__(self, params=None, protocol=None):
+        if protocol is None:
+            protocol = get_stream_protocol(params or {})
+        self.protocol = protocol
+        # what the client holds after the chunks sent so far
+        self.text = ""
+        self.num_logprobs = 0
+
+    def encode(self, ret):
+        if (
+            self.protocol != STREAM_PROTOCOL_DELTA
+            or ret.get("error_code", 0) != 0
+            or "text" not in ret
+        ):
+            return ret
+
+        text = ret["text"]
+        if ret.get("finish_reason") is None:
+            # hold back an incomplete utf-8 sequence until it is decoded
+            text = text.rstrip("\ufffd")
+        if text.startswith(self.text):
+            offset = len(self.text)
+        else:
+            offset = len(os.path.commonprefix([self.text, text]))
+        self.text = text
+
+        out = {k: v for k, v in ret.items() if k not in ("text", "logprobs")}
+        out["delta"] = text[offset:]
+        out["offset"] = offset
+
+        logprobs = ret.get("logprobs")
+        if logprobs is not None:
+            num_logprobs = len(logprobs["tokens"])
+            logprobs_offset = min(self.num_logprobs, num_logprobs)
+            out["logprobs"] = {
+                k: v[logprobs_offset:] if isinstance(v, list) else v
+                for k, v in logprobs.items()
+            }
+            out["logprobs_offset"] = logprobs_offset
+            self.num_logprobs = num_logprobs
+        return out
+
+
+class StreamDecoder:
+    """
+    Client side of the stream protocol, for chunks in either format.
+
+    decode(chunk) returns (chunk, new_text), where new_text is the text past the
+    longest text seen so far. With keep_text=True the returned chunk also has
+    the full text in "text", as in version 1; with keep_text=False only lengths
+    are tracked, for clients that forward deltas. Logprobs are always returned
+    cumulatively.
+    """
+
+    def __init__(self, keep_text=True):
+        self.keep_text = keep_text
+        # normalizes cumulative chunks from workers that only speak version 1
+        self.encoder = StreamEncoder(protocol=STREAM_PROTOCOL_DELTA)
+        self.text = ""
+        self.max_length = 0
+        self.logprobs = None
+
+    def decode(self, chunk):
+        if chunk.get("error_code", 0) != 0:
+            return chunk, ""
+        if "delta" not in chunk:
+            chunk = self.encoder.encode(chunk)
+
+        delta, offset = chunk.pop("delta"), chunk.pop("offset")
+        new_length = offset + len(delta)
+        new_text = delta[max(self.max_length - offset, 0) :]
+        self.max_length = max(self.max_length, new_length)
+
+        if self.keep_text:
+            if offset == len(self.text):
+                self.text += delta
+            else:
+                self.text = self.text[:offset] + delta
+            chunk["text"] = self.text
+
+        if chunk.get("logprobs") is not None:
+            logprobs_offset = chunk.pop("logprobs_offset", 0)
+            if self.logprobs is None:
+                self.logprobs = {}
+            for k, v in chunk["logprobs"].items():
+                if isinstance(v, list):
+                    values = self.logprobs.setdefault(k, [])
+                    del values[logprobs_offset:]
+                    values.extend(v)
+                else:
+                    self.logprobs[k] = v
+            chunk["logprobs"] = self.logprobs
+        return chunk, new_text
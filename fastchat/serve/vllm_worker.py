@@ -18,6 +18,7 @@ from vllm.sampling_params import SamplingParams
 from vllm.utils import random_uuid
 
 from fastchat.serve.base_model_worker import BaseModelWorker
+from fastchat.serve.stream_protocol import STREAM_PROTOCOL_CUMULATIVE, StreamEncoder
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
@@ -66,9 +67,11 @@ class VLLMWorker(BaseModelWorker):
 
     async def generate_stream(self, params):
         self.call_ct += 1
+        encoder = StreamEncoder(params)
+        cancel_event = self.get_cancel_event(params)
 
         context = params.pop("prompt")
-        request_id = params.pop("request_id")
+        request_id = params["request_id"]
         temperature = float(params.get("temperature", 1.0))
         top_p = float(params.get("top_p", 1.0))
         top_k = params.get("top_k", -1.0)
@@ -134,7 +137,9 @@ class VLLMWorker(BaseModelWorker):
                 continue
 
             aborted = False
-            if request and await request.is_disconnected():
+            if (request and await request.is_disconnected()) or (
+                cancel_event is not None and cancel_event.is_set()
+            ):
                 await engine.abort(request_id)
                 request_output.finished = True
                 aborted = True
@@ -145,6 +150,8 @@ class VLLMWorker(BaseModelWorker):
             completion_tokens = sum(
                 len(output.token_ids) for output in request_output.outputs
             )
+            if aborted:
+                self.record_cancellation(params, completion_tokens)
             ret = {
                 "text": text_outputs,
                 "error_code": 0,
@@ -163,13 +170,18 @@ class VLLMWorker(BaseModelWorker):
             # Emit twice here to ensure a 'finish_reason' with empty content in the OpenAI API response.
             # This aligns with the behavior of model_worker.
             if request_output.finished:
-                yield (json.dumps({**ret, **{"finish_reason": None}}) + "\0").encode()
-            yield (json.dumps(ret) + "\0").encode()
+                yield (
+                    json.dumps(encoder.encode({**ret, **{"finish_reason": None}}))
+                    + "\0"
+                ).encode()
+            yield (json.dumps(encoder.encode(ret)) + "\0").encode()
 
             if aborted:
                 break
 
     async def generate(self, params):
+        # the last chunk must hold the full output
+        params = {**params, "stream_protocol": STREAM_PROTOCOL_CUMULATIVE}
         async for x in self.generate_stream(params):
             pass
         return json.loads(x[:-1].decode())
@@ -185,13 +197,16 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
-def create_background_tasks(request_id):
+def create_background_tasks(params):
+    request_id = params["request_id"]
+
     async def abort_request() -> None:
         await engine.abort(request_id)
 
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_worker_semaphore)
     background_tasks.add_task(abort_request)
+    background_tasks.add_task(worker.finish_generation, params)
     return background_tasks
 
 
@@ -199,11 +214,12 @@ def create_background_tasks(request_id):
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    request_id = random_uuid()
-    params["request_id"] = request_id
+    # clients send unique request ids, so that they can cancel by id
+    params["request_id"] = params.get("request_id") or random_uuid()
+    worker.start_generation(params)
     params["request"] = request
+    background_tasks = create_background_tasks(params)
     generator = worker.generate_stream(params)
-    background_tasks = create_background_tasks(request_id)
     return StreamingResponse(generator, background=background_tasks)
 
 
@@ -211,15 +227,25 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    request_id = random_uuid()
+    request_id = params.get("request_id") or random_uuid()
     params["request_id"] = request_id
+    worker.start_generation(params)
     params["request"] = request
-    output = await worker.generate(params)
-    release_worker_semaphore()
+    try:
+        output = await worker.generate(params)
+    finally:
+        release_worker_semaphore()
+        worker.finish_generation(params)
     await engine.abort(request_id)
     return JSONResponse(output)
 
 
+@app.post("/worker_cancel")
+async def api_cancel(request: Request):
+    params = await request.json()
+    return {"cancelled": worker.cancel_generation(params["request_id"])}
+
+
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return worker.get_status()
@@ -236,9 +262,15 @@ async def api_get_conv(request: Request):
     return worker.get_conv_template()
 
 
+@app.post("/worker_render_prompt")
+async def api_render_prompt(request: Request):
+    params = await request.json()
+    return worker.render_prompt(params)
+
+
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    return {"context_length": worker.context_len, "render_prompt": True}
 
 
 if __name__ == "__main__":
@@ -174,7 +174,11 @@ def oai_moderation(text, custom_thresholds=None):
     return flagged
 
 
-def moderation_filter(text, model_list, do_moderation=False):
+def get_moderation_thresholds(model_list, do_moderation=False):
+    """
+    Return the category score thresholds to moderate the inputs of model_list
+    with, or None if they are not moderated.
+    """
     # Apply moderation for below models
     MODEL_KEYWORDS = [
         "claude",
@@ -201,8 +205,23 @@ def moderation_filter(text, model_list, do_moderation=False):
                 break
 
     if do_moderation:
-        return oai_moderation(text, custom_thresholds)
-    return False
+        return custom_thresholds
+    return None
+
+
+def moderation_filter(text, model_list, do_moderation=False):
+    """
+    Check whether text violates the OpenAI moderation API. text can also be a
+    list of texts, which are checked one by one and cached.
+    """
+    custom_thresholds = get_moderation_thresholds(model_list, do_moderation)
+    if custom_thresholds is None:
+        return False
+
+    from fastchat.serve.moderation import get_moderation_service
+
+    texts = [text] if isinstance(text, str) else text
+    return get_moderation_service().check(texts, custom_thresholds)
 
 
 def clean_flant5_ckpt(ckpt_path):
@@ -0,0 +1,126 @@
+"""
+Measure the time to first token of API provider calls with and without the
+shared client pool of fastchat.serve.api_client_pool.
+
+A stub OpenAI-compatible server is started in process and openai_api_stream_iter
+is called repeatedly. "fresh" drops all pooled clients before every call, which
+is what every call did before the pool existed; "pooled" keeps them. Point
+--api-base at a real HTTPS endpoint to include TLS handshakes, which widens
+the gap.
+
+Usage:
+python3 -m playground.benchmark.benchmark_api_client_pool --num-calls 200
+python3 -m playground.benchmark.benchmark_api_client_pool --api-base https://api.openai.com/v1 --model-name gpt-4o-mini --num-calls 20
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import numpy as np
+import uvicorn
+
+from fastchat.serve.api_client_pool import HTTP2_AVAILABLE, close_clients
+from fastchat.serve.api_provider import openai_api_stream_iter
+
+app = FastAPI()
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    params = await request.json()
+    num_tokens = params.get("max_tokens") or 16
+
+    def stream():
+        for i in range(num_tokens):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": params["model"],
+                "choices": [
+                    {"index": 0, "delta": {"content": f" t{i}"}, "finish_reason": None}
+                ],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def start_stub_server(port):
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def run_calls(num_calls, api_base, api_key, model_name, max_tokens, fresh):
+    ttfts = []
+    totals = []
+    messages = [{"role": "user", "content": "Hello!"}]
+    for _ in range(num_calls):
+        if fresh:
+            close_clients()
+        tic = time.perf_counter()
+        ttft = None
+        for _ in openai_api_stream_iter(
+            model_name,
+            messages,
+            temperature=0.7,
+            top_p=1.0,
+            max_new_tokens=max_tokens,
+            api_base=api_base,
+            api_key=api_key,
+        ):
+            if ttft is None:
+                ttft = time.perf_counter() - tic
+        ttfts.append(ttft)
+        totals.append(time.perf_counter() - tic)
+    return np.array(ttfts), np.array(totals)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-calls", type=int, default=200)
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--port", type=int, default=21099)
+    parser.add_argument("--api-base", type=str)
+    parser.add_argument("--api-key", type=str, default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--model-name", type=str, default="stub-model")
+    args = parser.parse_args()
+
+    if args.api_base is None:
+        start_stub_server(args.port)
+        args.api_base = f"http://127.0.0.1:{args.port}/v1"
+        args.api_key = args.api_key or "-"
+    print(f"api_base: {args.api_base}, http2: {HTTP2_AVAILABLE}")
+
+    # warm up imports and the server
+    run_calls(3, args.api_base, args.api_key, args.model_name, args.max_tokens, True)
+
+    results = {}
+    for name, fresh in [("fresh", True), ("pooled", False)]:
+        close_clients()
+        ttfts, totals = run_calls(
+            args.num_calls,
+            args.api_base,
+            args.api_key,
+            args.model_name,
+            args.max_tokens,
+            fresh,
+        )
+        results[name] = ttfts
+        print(
+            f"{name:>7}: ttft mean {ttfts.mean() * 1000:7.2f} ms, "
+            f"p50 {np.percentile(ttfts, 50) * 1000:7.2f} ms, "
+            f"p99 {np.percentile(ttfts, 99) * 1000:7.2f} ms, "
+            f"total mean {totals.mean() * 1000:7.2f} ms"
+        )
+    speedup = results["fresh"].mean() / results["pooled"].mean()
+    print(f"ttft speedup: {speedup:.2f}x")
@@ -0,0 +1,59 @@
+"""
+Measure Conversation.get_prompt over a growing conversation, the way the web
+server calls it several times per turn, with and without the segment cache.
+
+The uncached numbers clear the cache before every call, so every call renders
+all messages like the routine before the cache did.
+
+Usage:
+python3 -m playground.benchmark.benchmark_conversation_prompt --template vicuna_v1.1 --num-turns 50
+"""
+import argparse
+import time
+
+from fastchat.conversation import get_conv_template
+
+
+def run(template, num_turns, calls_per_turn, message_len, cached):
+    conv = get_conv_template(template)
+    message = "x" * message_len
+    tic = time.perf_counter()
+    for _ in range(num_turns):
+        conv.append_message(conv.roles[0], message)
+        conv.append_message(conv.roles[1], None)
+        for _ in range(calls_per_turn):
+            if not cached:
+                conv.__dict__.pop("_prompt_cache", None)
+            prompt = conv.get_prompt()
+        conv.update_last_message(message)
+    return time.perf_counter() - tic, prompt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", type=str, default="vicuna_v1.1")
+    parser.add_argument("--num-turns", type=int, default=50)
+    parser.add_argument("--calls-per-turn", type=int, default=4)
+    parser.add_argument("--message-len", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    results = {}
+    for cached in [False, True]:
+        elapsed = []
+        for _ in range(args.repeat):
+            t, prompt = run(
+                args.template,
+                args.num_turns,
+                args.calls_per_turn,
+                args.message_len,
+                cached,
+            )
+            elapsed.append(t)
+        results[cached] = (min(elapsed), prompt)
+        name = "cached" if cached else "uncached"
+        calls = args.num_turns * args.calls_per_turn
+        print(f"{name:>8}: {min(elapsed) * 1e6 / calls:8.1f} us per get_prompt")
+
+    assert results[False][1] == results[True][1]
+    print(f"speedup: {results[False][0] / results[True][0]:.1f}x")
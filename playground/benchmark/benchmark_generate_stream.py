@@ -0,0 +1,86 @@
+"""
+Measure the decoding speed of generate_stream and the time of each phase of
+a decoding step.
+
+Sampled tokens are copied to the host once per streamed chunk, so the speed
+is measured for each --stream-intervals value. A second pass with a StepTimer
+splits a step into the model forward, sampling and the output; the timer
+synchronizes the device after each phase, so that pass is slower and only
+its proportions are meaningful.
+
+Usage:
+python3 -m playground.benchmark.benchmark_generate_stream --model-path lmsys/vicuna-7b-v1.5
+python3 -m playground.benchmark.benchmark_generate_stream --model-path lmsys/vicuna-7b-v1.5 --temperature 0.7 --top-p 0.9 --repetition-penalty 1.1
+"""
+import argparse
+import time
+
+from fastchat.model.model_adapter import get_conversation_template, load_model
+from fastchat.serve.inference import StepTimer, generate_stream
+from fastchat.utils import get_context_length
+
+PROMPTS = [
+    "Write a short story about a robot learning to paint.",
+    "Explain how a hash table works and when it is slower than a search tree.",
+]
+
+
+def run(model, tokenizer, prompt, args, context_len, stream_interval, **kwargs):
+    params = {
+        "prompt": prompt,
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+        "repetition_penalty": args.repetition_penalty,
+        "max_new_tokens": args.max_new_tokens,
+        "echo": False,
+    }
+    tic = time.perf_counter()
+    for output in generate_stream(
+        model, tokenizer, params, args.device, context_len, stream_interval, **kwargs
+    ):
+        pass
+    return output["usage"]["completion_tokens"] + 1, time.perf_counter() - tic
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--stream-intervals", type=int, nargs="+", default=[1, 2, 8])
+    args = parser.parse_args()
+
+    model, tokenizer = load_model(args.model_path, device=args.device)
+    context_len = get_context_length(model.config)
+    prompts = []
+    for prompt in PROMPTS:
+        conv = get_conversation_template(args.model_path)
+        conv.append_message(conv.roles[0], prompt)
+        conv.append_message(conv.roles[1], None)
+        prompts.append(conv.get_prompt())
+
+    # warm up
+    run(model, tokenizer, prompts[0], args, context_len, 2)
+
+    for stream_interval in args.stream_intervals:
+        num_tokens, elapsed = 0, 0.0
+        for prompt in prompts:
+            n, t = run(model, tokenizer, prompt, args, context_len, stream_interval)
+            num_tokens += n
+            elapsed += t
+        print(
+            f"stream interval {stream_interval:3d}: {num_tokens / elapsed:8.1f} tokens/s"
+        )
+
+    step_timer = StepTimer()
+    for prompt in prompts:
+        run(model, tokenizer, prompt, args, context_len, 2, step_timer=step_timer)
+    for name, value in step_timer.get_stats().items():
+        print(
+            f"{name:>22}: {value:.3f}"
+            if isinstance(value, float)
+            else f"{name:>22}: {value}"
+        )
@@ -0,0 +1,103 @@
+"""
+Measure the import time and memory of the FastChat entry points with
+python -X importtime.
+
+Every module is imported in a fresh interpreter, in a temporary working
+directory (the servers create their log files under ./logs at import time).
+The table shows the cumulative import time of the module (the minimum over
+--repeat runs), the peak RSS of the process, whether torch and transformers
+were loaded, and the slowest direct imports of the module. The control-plane
+processes (controller, API server, web server) should not load torch.
+
+Usage:
+python3 -m playground.benchmark.benchmark_import_time
+python3 -m playground.benchmark.benchmark_import_time --modules fastchat.serve.controller --top 10
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ENTRY_POINTS = [
+    "fastchat.model.model_adapter",
+    "fastchat.serve.controller",
+    "fastchat.serve.openai_api_server",
+    "fastchat.serve.gradio_web_server",
+    "fastchat.serve.gradio_web_server_multi",
+    "fastchat.serve.model_worker",
+]
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+# written to fd 1 directly, the servers redirect sys.stdout to their loggers
+PROBE = (
+    "import os, resource, sys; "
+    "os.write(1, ('%d %s %s' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "
+    "'torch' in sys.modules, 'transformers' in sys.modules)).encode())"
+)
+
+
+def measure(module, work_dir):
+    """Return (cumulative us, peak rss KB, torch, transformers, children) or an error."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}; {PROBE}"],
+        cwd=work_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        return proc.stderr.strip().splitlines()[-1]
+
+    # -X importtime prints a module after its imports, indented by depth
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m:
+            entries.append(
+                (int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2, m.group(4))
+            )
+    # the last entry of the module is the outermost and includes its parent
+    # packages; its children are taken from the entry that ran the module body
+    indices = [i for i, e in enumerate(entries) if e[3] == module]
+    cumulative = entries[indices[-1]][1]
+    end = max(indices, key=lambda i: entries[i][0])
+    depth = entries[end][2]
+    children = []
+    for i in range(end - 1, -1, -1):
+        if entries[i][2] <= depth:
+            break
+        if entries[i][2] == depth + 1:
+            children.append((entries[i][1], entries[i][3]))
+    children.sort(reverse=True)
+
+    rss, torch, transformers = proc.stdout.split()
+    return cumulative, int(rss), torch == "True", transformers == "True", children
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.makedirs(os.path.join(work_dir, "logs"))
+        for module in args.modules:
+            results = [measure(module, work_dir) for _ in range(args.repeat)]
+            errors = [r for r in results if isinstance(r, str)]
+            if errors:
+                print(f"{module}: failed to import: {errors[0]}")
+                continue
+            cumulative, rss, torch, transformers, children = min(results)
+            print(
+                f"{module}: {cumulative / 1000:8.1f} ms, rss {rss / 1024:6.1f} MB, "
+                f"torch: {torch}, transformers: {transformers}"
+            )
+            for child_time, child in children[: args.top]:
+                print(f"    {child_time / 1000:8.1f} ms  {child}")
@@ -0,0 +1,202 @@
+"""
+Compare the shared log scanner of fastchat.serve.monitor.log_scanner with the
+line-by-line json.loads readers it replaced, on a synthetic *-conv.json log.
+
+The log mixes "chat" records and vote records with two conversation states,
+in about the proportions of a real arena log. Pass --log-file to reuse a log
+from an earlier run or to measure a real one.
+
+Usage:
+python3 -m playground.benchmark.benchmark_log_scanner --size-gb 2 --log-dir /tmp
+python3 -m playground.benchmark.benchmark_log_scanner --log-file ~/fastchat_logs/server0/2024-06-01-conv.json
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from fastchat.serve.monitor import log_scanner
+from fastchat.serve.monitor.log_scanner import (
+    VOTE_TYPES,
+    count_types,
+    project_vote,
+    scan_log,
+    scan_logs,
+)
+
+MODELS = ["vicuna-13b", "llama-3-70b", "qwen2-72b", "gpt-4o", "claude-3-5-sonnet"]
+
+
+def make_state(rng, model_name, num_turns):
+    words = ["the", "model", "answer", "question", "code", "中文", "token", "ok"]
+    messages = []
+    for _ in range(num_turns):
+        for role in ["USER", "ASSISTANT"]:
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(50, 600)))
+            messages.append([role, text])
+    return {
+        "template_name": "one_shot",
+        "system_message": "A chat between a curious human and an assistant.",
+        "roles": ["USER", "ASSISTANT"],
+        "messages": messages,
+        "offset": 0,
+        "conv_id": "%032x" % rng.getrandbits(128),
+        "model_name": model_name,
+    }
+
+
+def write_log(path, size_gb, chats_per_vote, seed=0):
+    rng = random.Random(seed)
+    # a pool of records reused with new timestamps, to keep generation fast
+    chats = []
+    votes = []
+    for _ in range(64):
+        model_a, model_b = rng.sample(MODELS, 2)
+        state_a = make_state(rng, model_a, rng.randint(1, 3))
+        state_b = make_state(rng, model_b, rng.randint(1, 3))
+        chats.append(
+            {
+                "type": "chat",
+                "model": model_a,
+                "gen_params": {
+                    "temperature": 0.7,
+                    "top_p": 1.0,
+                    "max_new_tokens": 1024,
+                },
+                "start": 0.0,
+                "finish": 0.0,
+                "state": state_a,
+                "ip": "127.0.0.1",
+            }
+        )
+        votes.append(
+            {
+                "type": rng.choice(VOTE_TYPES),
+                "models": ["", ""],
+                "states": [state_a, state_b],
+                "ip": "127.0.0.1",
+            }
+        )
+
+    target = int(size_gb * 1024**3)
+    tstamp = 1.7e9
+    with open(path, "w") as fout:
+        while fout.tell() < target:
+            tstamp += 1
+            if rng.random() < 1 / (chats_per_vote + 1):
+                record = rng.choice(votes)
+            else:
+                record = rng.choice(chats)
+            fout.write(json.dumps({"tstamp": round(tstamp, 4), **record}) + "\n")
+
+
+def load_votes_json(log_file):
+    """The reader before the shared scanner: every line is decoded."""
+    votes = []
+    with open(log_file, "r") as f:
+        for line in f:
+            try:
+                data = json.loads(line.strip())
+                if data.get("type") in VOTE_TYPES:
+                    votes.append(data)
+            except json.JSONDecodeError:
+                continue
+    return votes
+
+
+def count_votes_json(log_file):
+    counts = {t: 0 for t in VOTE_TYPES}
+    with open(log_file, "r") as f:
+        for line in f:
+            try:
+                vote_type = json.loads(line.strip()).get("type", "")
+                if vote_type in counts:
+                    counts[vote_type] += 1
+            except json.JSONDecodeError:
+                continue
+    return counts
+
+
+def scan_log_stdlib_json(log_file):
+    loads = log_scanner.loads
+    log_scanner.loads = json.loads
+    try:
+        return list(scan_log(log_file, VOTE_TYPES, project_vote))
+    finally:
+        log_scanner.loads = loads
+
+
+def timeit(name, func, size):
+    tic = time.perf_counter()
+    ret = func()
+    elapsed = time.perf_counter() - tic
+    print(f"{name:>28}: {elapsed:8.2f} s, {size / elapsed / 1024**2:8.1f} MB/s")
+    return ret, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-file", type=str)
+    parser.add_argument("--log-dir", type=str, default="/tmp")
+    parser.add_argument("--size-gb", type=float, default=2.0)
+    parser.add_argument("--chats-per-vote", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size-mb", type=int, default=256)
+    args = parser.parse_args()
+
+    log_file = args.log_file
+    if log_file is None:
+        log_file = os.path.join(args.log_dir, "benchmark-log-scanner-conv.json")
+        print(f"writing {args.size_gb} GB to {log_file}")
+        write_log(log_file, args.size_gb, args.chats_per_vote)
+    size = os.path.getsize(log_file)
+    print(
+        f"log size: {size / 1024**3:.2f} GB, orjson: {log_scanner.loads is not json.loads}"
+    )
+
+    # warm up the page cache
+    with open(log_file, "rb") as f:
+        while f.read(64 * 1024**2):
+            pass
+
+    baseline, t_baseline = timeit(
+        "json.loads every line", lambda: load_votes_json(log_file), size
+    )
+    _, t_stdlib = timeit("scan_log, json", lambda: scan_log_stdlib_json(log_file), size)
+    votes, t_scan = timeit(
+        "scan_log", lambda: list(scan_log(log_file, VOTE_TYPES, project_vote)), size
+    )
+    parallel, t_parallel = timeit(
+        f"scan_logs, {args.num_workers} workers",
+        lambda: scan_logs(
+            [log_file],
+            VOTE_TYPES,
+            project_vote,
+            num_workers=args.num_workers,
+            chunk_size=args.chunk_size_mb * 1024**2,
+        ),
+        size,
+    )
+    assert len(votes) == len(baseline) == len(parallel)
+    assert [v["tstamp"] for v in votes] == [v["tstamp"] for v in baseline]
+    assert [v["tstamp"] for v in parallel] == [v["tstamp"] for v in baseline]
+
+    counts_json, t_count_json = timeit(
+        "count, json.loads", lambda: count_votes_json(log_file), size
+    )
+    counts, t_count = timeit("count_types", lambda: count_types(log_file), size)
+    assert dict(counts) == counts_json
+
+    retained_baseline = sum(len(json.dumps(v)) for v in baseline)
+    retained_scan = sum(len(json.dumps(v)) for v in votes)
+    print(f"votes: {len(votes)}")
+    print(
+        f"retained vote data: {retained_baseline / 1024**2:.1f} MB -> "
+        f"{retained_scan / 1024**2:.1f} MB"
+    )
+    print(
+        f"speedup: scan_log {t_baseline / t_scan:.1f}x, "
+        f"scan_logs {t_baseline / t_parallel:.1f}x, "
+        f"count_types {t_count_json / t_count:.1f}x"
+    )
@@ -0,0 +1,108 @@
+"""
+Compare the decoding speed of generate_stream with speculative decoding.
+
+The prompts are generated with greedy decoding by default, so both runs must
+produce the same text; the acceptance counters show how many drafted tokens
+the model kept.
+
+Usage:
+python3 -m playground.benchmark.benchmark_speculative_decoding --model-path lmsys/vicuna-7b-v1.5 --device cpu
+python3 -m playground.benchmark.benchmark_speculative_decoding --model-path lmsys/vicuna-7b-v1.5 --method draft-model --draft-model-path double7/vicuna-68m
+"""
+import argparse
+import time
+
+from fastchat.model.model_adapter import get_conversation_template, load_model
+from fastchat.serve.inference import generate_stream
+from fastchat.serve.speculative_decoding import (
+    SPECULATIVE_METHODS,
+    SpeculativeConfig,
+    SpeculativeStats,
+    generate_stream_speculative,
+)
+from fastchat.utils import get_context_length
+
+PROMPTS = [
+    "Rewrite the following function with type annotations:\n\n"
+    "def mean(values):\n    total = 0\n    for value in values:\n"
+    "        total += value\n    return total / len(values)\n",
+    "Summarize in three sentences: The quick brown fox jumps over the lazy dog. "
+    "The dog does not react, so the fox jumps over the dog again and again.",
+    "Write a short story about a robot learning to paint.",
+]
+
+
+def run(generate, model, tokenizer, prompt, args, context_len, **kwargs):
+    params = {
+        "prompt": prompt,
+        "temperature": args.temperature,
+        "max_new_tokens": args.max_new_tokens,
+        "echo": False,
+    }
+    tic = time.perf_counter()
+    for output in generate(
+        model, tokenizer, params, args.device, context_len, **kwargs
+    ):
+        pass
+    return output, time.perf_counter() - tic
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument(
+        "--method", type=str, choices=SPECULATIVE_METHODS, default="prompt-lookup"
+    )
+    parser.add_argument("--draft-model-path", type=str, default=None)
+    parser.add_argument("--num-speculative-tokens", type=int, default=5)
+    parser.add_argument("--prompt-lookup-max-ngram", type=int, default=3)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    model, tokenizer = load_model(args.model_path, device=args.device)
+    context_len = get_context_length(model.config)
+    draft_model = None
+    if args.method == "draft-model":
+        draft_model, _ = load_model(args.draft_model_path, device=args.device)
+    config = SpeculativeConfig(
+        method=args.method,
+        num_draft_tokens=args.num_speculative_tokens,
+        max_ngram=args.prompt_lookup_max_ngram,
+        draft_model_path=args.draft_model_path,
+    )
+    stats = SpeculativeStats()
+
+    totals = {"baseline": [0, 0.0], "speculative": [0, 0.0]}
+    for prompt in PROMPTS:
+        conv = get_conversation_template(args.model_path)
+        conv.append_message(conv.roles[0], prompt)
+        conv.append_message(conv.roles[1], None)
+        prompt = conv.get_prompt()
+
+        base, t_base = run(generate_stream, model, tokenizer, prompt, args, context_len)
+        spec, t_spec = run(
+            generate_stream_speculative,
+            model,
+            tokenizer,
+            prompt,
+            args,
+            context_len,
+            config=config,
+            draft_model=draft_model,
+            stats=stats,
+        )
+        if args.temperature < 1e-5 and base["text"] != spec["text"]:
+            print("warning: the greedy outputs differ")
+        for name, output, elapsed in [
+            ("baseline", base, t_base),
+            ("speculative", spec, t_spec),
+        ]:
+            totals[name][0] += output["usage"]["completion_tokens"] + 1
+            totals[name][1] += elapsed
+
+    for name, (num_tokens, elapsed) in totals.items():
+        print(f"{name:>12}: {num_tokens / elapsed:8.1f} tokens/s")
+    print(f"speedup: {totals['baseline'][1] / totals['speculative'][1]:.2f}x")
+    print(stats.get_stats())
@@ -0,0 +1,246 @@
+"""
+Compare the vote database of scripts_py/database_manager.py with the
+routines it replaced: row-by-row inserts with the whole vote record stored in
+every row, a whole-file hash per sync, one statistics query per model and
+one SELECT and UPDATE per battle for the Elo ratings.
+
+The synthetic log only has small vote records, so the numbers show the
+database work rather than the log scanning measured by benchmark_log_scanner.
+
+Usage:
+python3 -m playground.benchmark.benchmark_vote_database --num-votes 1000000 --work-dir /tmp
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from fastchat.serve.monitor.log_scanner import VOTE_TYPES
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../scripts_py")
+)
+from database_manager import VoteDatabase
+
+MODELS = [f"model-{i}" for i in range(20)]
+
+
+def write_votes(path, num_votes, seed=0, tstamp=1.7e9, mode="w"):
+    rng = random.Random(seed)
+    with open(path, mode) as fout:
+        for _ in range(num_votes):
+            tstamp += rng.random()
+            model_a, model_b = rng.sample(MODELS, 2)
+            record = {
+                "tstamp": round(tstamp, 4),
+                "type": rng.choice(VOTE_TYPES),
+                "models": ["", ""],
+                "states": [
+                    {"model_name": model_a, "messages": [["USER", "hi"]]},
+                    {"model_name": model_b, "messages": [["USER", "hi"]]},
+                ],
+                "ip": f"10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)}",
+            }
+            fout.write(json.dumps(record) + "\n")
+    return tstamp
+
+
+class OldVoteDatabase(VoteDatabase):
+    """The routines before offset-based ingestion, on the same schema."""
+
+    def connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def load_votes_from_log(self, log_file_path):
+        with open(log_file_path, "rb") as f:
+            file_hash = hashlib.md5(f.read()).hexdigest()
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT file_hash FROM processed_logs WHERE file_path = ?",
+            (log_file_path,),
+        )
+        result = cursor.fetchone()
+        if result is not None and result[0] == file_hash:
+            conn.close()
+            return 0
+
+        new_records = 0
+        with open(log_file_path, "r") as f:
+            for line_num, line in enumerate(f, 1):
+                data = json.loads(line.strip())
+                if data.get("type") not in VOTE_TYPES:
+                    continue
+                states = data.get("states", [])
+                model_a = states[0].get("model_name", "")
+                model_b = states[1].get("model_name", "")
+                vote_id = hashlib.md5(
+                    f"{log_file_path}:{line_num}:{data.get('tstamp', '')}".encode()
+                ).hexdigest()
+                vote_type = data["type"]
+                winner = {
+                    "leftvote": model_a,
+                    "rightvote": model_b,
+                    "tievote": "tie",
+                    "bothbad_vote": "both_bad",
+                }[vote_type]
+                cursor.execute("SELECT id FROM votes WHERE vote_id = ?", (vote_id,))
+                if cursor.fetchone():
+                    continue
+                cursor.execute(
+                    """
+                    INSERT INTO votes
+                    (vote_id, timestamp, vote_type, model_a, model_b, winner, conversation_data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        vote_id,
+                        data.get("tstamp", ""),
+                        vote_type,
+                        model_a,
+                        model_b,
+                        winner,
+                        json.dumps(data),
+                    ),
+                )
+                new_records += 1
+
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO processed_logs (file_path, file_hash, record_count)
+            VALUES (?, ?, ?)
+            """,
+            (log_file_path, file_hash, new_records),
+        )
+        conn.commit()
+        conn.close()
+        return new_records
+
+    def update_model_stats(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DISTINCT model_a FROM votes UNION SELECT DISTINCT model_b FROM votes"
+        )
+        models = [row[0] for row in cursor.fetchall()]
+        for model in models:
+            cursor.execute(
+                """
+                SELECT
+                    COUNT(*),
+                    SUM(CASE WHEN winner = ? THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN winner != ? AND winner != 'tie' AND winner != 'both_bad' THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN winner = 'tie' THEN 1 ELSE 0 END)
+                FROM votes
+                WHERE (model_a = ? OR model_b = ?) AND vote_type IN ('leftvote', 'rightvote', 'tievote')
+                """,
+                (model, model, model, model),
+            )
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO model_stats
+                (model_name, total_battles, wins, losses, ties, last_updated)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                """,
+                (model, *cursor.fetchone()),
+            )
+        conn.commit()
+        conn.close()
+
+    def calculate_elo_ratings(self, k_factor=32):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE model_stats SET elo_rating = 1000.0")
+        cursor.execute(
+            """
+            SELECT model_a, model_b, winner FROM votes
+            WHERE vote_type IN ('leftvote', 'rightvote', 'tievote')
+            ORDER BY timestamp
+            """
+        )
+        for model_a, model_b, winner in cursor.fetchall():
+            cursor.execute(
+                "SELECT elo_rating FROM model_stats WHERE model_name = ?", (model_a,)
+            )
+            elo_a = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT elo_rating FROM model_stats WHERE model_name = ?", (model_b,)
+            )
+            elo_b = cursor.fetchone()[0]
+            expected_a = 1 / (1 + 10 ** ((elo_b - elo_a) / 400))
+            expected_b = 1 / (1 + 10 ** ((elo_a - elo_b) / 400))
+            if winner == model_a:
+                score_a, score_b = 1, 0
+            elif winner == model_b:
+                score_a, score_b = 0, 1
+            else:
+                score_a, score_b = 0.5, 0.5
+            cursor.execute(
+                "UPDATE model_stats SET elo_rating = ? WHERE model_name = ?",
+                (elo_a + k_factor * (score_a - expected_a), model_a),
+            )
+            cursor.execute(
+                "UPDATE model_stats SET elo_rating = ? WHERE model_name = ?",
+                (elo_b + k_factor * (score_b - expected_b), model_b),
+            )
+        conn.commit()
+        conn.close()
+
+
+def timeit(name, func):
+    tic = time.perf_counter()
+    ret = func()
+    elapsed = time.perf_counter() - tic
+    print(f"{name:>32}: {elapsed:8.2f} s")
+    return ret, elapsed
+
+
+def run(db, log_file, num_append, tstamp):
+    _, t_ingest = timeit("initial ingest", lambda: db.load_votes_from_log(log_file))
+    write_votes(log_file, num_append, seed=1, tstamp=tstamp, mode="a")
+    _, t_sync = timeit(
+        f"sync after {num_append} new votes", lambda: db.load_votes_from_log(log_file)
+    )
+
+    def stats():
+        db.update_model_stats()
+        db.calculate_elo_ratings()
+
+    _, t_stats = timeit("model stats + Elo", stats)
+    return t_ingest, t_sync, t_stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-votes", type=int, default=1000000)
+    parser.add_argument("--append-ratio", type=float, default=0.01)
+    parser.add_argument("--work-dir", type=str, default="/tmp")
+    args = parser.parse_args()
+
+    num_append = int(args.num_votes * args.append_ratio)
+    results = {}
+    rankings = {}
+    for name, cls in [("old", OldVoteDatabase), ("new", VoteDatabase)]:
+        log_file = os.path.join(args.work_dir, f"benchmark-vote-db-{name}-conv.json")
+        db_path = os.path.join(args.work_dir, f"benchmark-vote-db-{name}.db")
+        for path in [db_path, db_path + "-wal", db_path + "-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
+        tstamp = write_votes(log_file, args.num_votes)
+
+        print(f"{name}:")
+        db = cls(db_path)
+        results[name] = run(db, log_file, num_append, tstamp)
+        rankings[name] = [
+            (r["model"], r["total_battles"], r["wins"], r["elo_rating"])
+            for r in db.get_model_rankings()
+        ]
+        print(f"{'database size':>32}: {os.path.getsize(db_path) / 1024**2:8.1f} MB")
+
+    assert rankings["old"] == rankings["new"]
+    for i, step in enumerate(["initial ingest", "sync", "model stats + Elo"]):
+        print(f"speedup of {step}: {results['old'][i] / results['new'][i]:.1f}x")
@@ -0,0 +1,127 @@
+"""
+Compare the cumulative and delta worker stream protocols on long generations.
+
+Without --worker-address, a 4k-token generation is simulated in process and the
+full worker -> client path (JSON encode, wire bytes, JSON decode, delta
+recovery) is timed. With --worker-address, the same is measured against a
+running model worker.
+
+Usage:
+python3 -m playground.benchmark.benchmark_worker_stream --num-tokens 4096
+python3 -m playground.benchmark.benchmark_worker_stream --worker-address http://localhost:31000 --model-name vicuna-7b-v1.5
+"""
+import argparse
+import json
+import random
+import time
+
+import requests
+
+from fastchat.serve.stream_protocol import (
+    STREAM_PROTOCOL_CUMULATIVE,
+    STREAM_PROTOCOL_DELTA,
+    StreamDecoder,
+    StreamEncoder,
+)
+
+
+def simulate_worker_chunks(num_tokens, stream_interval=1, seed=0):
+    rng = random.Random(seed)
+    words = ["the", "model", "token", "stream", "protocol", "delta", "中文", "ok"]
+    text = ""
+    for i in range(num_tokens):
+        text += " " + rng.choice(words)
+        if (i + 1) % stream_interval == 0 or i == num_tokens - 1:
+            yield {
+                "text": text,
+                "error_code": 0,
+                "usage": {
+                    "prompt_tokens": 16,
+                    "completion_tokens": i + 1,
+                    "total_tokens": i + 17,
+                },
+                "finish_reason": "length" if i == num_tokens - 1 else None,
+            }
+
+
+def run_simulated(protocol, num_tokens, stream_interval):
+    encoder = StreamEncoder(protocol=protocol)
+    decoder = StreamDecoder(keep_text=False)
+    num_bytes = 0
+    output = []
+    tic = time.perf_counter()
+    for ret in simulate_worker_chunks(num_tokens, stream_interval):
+        # worker side
+        data = json.dumps(encoder.encode(ret)).encode() + b"\0"
+        num_bytes += len(data)
+        # client side
+        _, new_text = decoder.decode(json.loads(data[:-1].decode()))
+        output.append(new_text)
+    elapsed = time.perf_counter() - tic
+    return elapsed, num_bytes, "".join(output)
+
+
+def run_worker(protocol, worker_address, model_name, num_tokens):
+    gen_params = {
+        "model": model_name,
+        "prompt": "Write a very long story about a dragon.",
+        "temperature": 0.7,
+        "top_p": 1.0,
+        "max_new_tokens": num_tokens,
+        "echo": False,
+        "stream_protocol": protocol,
+    }
+    decoder = StreamDecoder(keep_text=False)
+    num_bytes = 0
+    output = []
+    tic = time.perf_counter()
+    response = requests.post(
+        worker_address + "/worker_generate_stream",
+        json=gen_params,
+        stream=True,
+        timeout=600,
+    )
+    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+        if chunk:
+            num_bytes += len(chunk) + 1
+            _, new_text = decoder.decode(json.loads(chunk.decode()))
+            output.append(new_text)
+    elapsed = time.perf_counter() - tic
+    return elapsed, num_bytes, "".join(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-tokens", type=int, default=4096)
+    parser.add_argument("--stream-interval", type=int, default=1)
+    parser.add_argument("--worker-address", type=str)
+    parser.add_argument("--model-name", type=str)
+    parser.add_argument("--num-trials", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    for name, protocol in [
+        ("cumulative", STREAM_PROTOCOL_CUMULATIVE),
+        ("delta", STREAM_PROTOCOL_DELTA),
+    ]:
+        best = None
+        for _ in range(args.num_trials):
+            if args.worker_address:
+                res = run_worker(
+                    protocol, args.worker_address, args.model_name, args.num_tokens
+                )
+            else:
+                res = run_simulated(protocol, args.num_tokens, args.stream_interval)
+            if best is None or res[0] < best[0]:
+                best = res
+        results[name] = best
+        elapsed, num_bytes, output = best
+        print(
+            f"{name:>10}: {elapsed * 1000:9.1f} ms, {num_bytes / 2**20:9.2f} MiB, "
+            f"{args.num_tokens / elapsed:10.0f} tokens/s"
+        )
+
+    if not args.worker_address:
+        assert results["cumulative"][2] == results["delta"][2], "Outputs differ"
+    speedup = results["cumulative"][0] / results["delta"][0]
+    print(f"speedup: {speedup:.1f}x")
@@ -4,12 +4,14 @@ FastChat 当天数据统计脚本
 专门用于统计当天的投票数据，生成简化的报告
 """
 
-import json
 import os
 from datetime import datetime
 from pathlib import Path
-from collections import defaultdict
 import argparse
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fastchat.serve.monitor.vote_rollup import load_rollup, load_rollups
 
 def get_today_log_file():
     """获取当天的日志文件"""
@@ -22,65 +24,20 @@ def get_today_log_file():
         print(f"❌ 未找到当天日志文件: {log_file}")
         return None
 
-def analyze_daily_data(log_file):
-    """分析当天的数据"""
-    if not log_file:
-        return None
-        
-    print(f"📊 分析当天数据: {log_file}")
-    
-    # 统计数据
-    vote_counts = defaultdict(int)
-    model_stats = defaultdict(lambda: {'wins': 0, 'losses': 0, 'ties': 0, 'total': 0})
-    conversation_count = 0
-    vote_count = 0
-    
-    try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line.strip())
-                    
-                    # 统计对话数量
-                    if data.get('type') == 'chat':
-                        conversation_count += 1
-                    
-                    # 统计投票数据
-                    elif data.get('type') in ['leftvote', 'rightvote', 'tievote', 'bothbad_vote']:
-                        vote_count += 1
-                        vote_type = data.get('type')
-                        vote_counts[vote_type] += 1
-                        
-                        # 获取模型信息
-                        states = data.get('states', [])
-                        if len(states) >= 2:
-                            model_a = states[0].get('model_name', 'Unknown')
-                            model_b = states[1].get('model_name', 'Unknown')
-                            
-                            # 统计胜负
-                            if vote_type == 'leftvote':
-                                model_stats[model_a]['wins'] += 1
-                                model_stats[model_b]['losses'] += 1
-                            elif vote_type == 'rightvote':
-                                model_stats[model_b]['wins'] += 1
-                                model_stats[model_a]['losses'] += 1
-                            elif vote_type == 'tievote':
-                                model_stats[model_a]['ties'] += 1
-                                model_stats[model_b]['ties'] += 1
-                            elif vote_type == 'bothbad_vote':
-                                # 双败不计入胜负，但计入总数
-                                pass
-                            
-                            # 更新总数
-                            model_stats[model_a]['total'] += 1
-                            model_stats[model_b]['total'] += 1
-                            
-                except json.JSONDecodeError:
-                    continue
-                    
-    except FileNotFoundError:
-        print(f"❌ 文件不存在: {log_file}")
-        return None
+def get_range_log_files(start_date, end_date):
+    """获取日期范围内（包含首尾）按日期排序的归档日志文件"""
+    log_dir = Path(os.path.dirname(os.path.abspath(__file__))) / 'logs_archive'
+    log_files = []
+    for log_file in sorted(log_dir.glob('*-conv.json')):
+        date = log_file.name[:-len('-conv.json')]
+        if start_date <= date <= end_date:
+            log_files.append(str(log_file))
+    return log_files
+
+def summarize_rollup(rollup, source):
+    """从投票汇总生成统计数据"""
+    # 双败不计入胜负，但计入总数
+    model_stats = rollup.get_model_stats(bothbad_as_tie=False)
     
     # 计算胜率
     for model in model_stats:
@@ -93,14 +50,39 @@ def analyze_daily_data(log_file):
             stats['win_rate'] = stats['tie_rate'] = stats['loss_rate'] = 0
     
     return {
-        'log_file': log_file,
-        'conversation_count': conversation_count,
-        'vote_count': vote_count,
-        'vote_counts': dict(vote_counts),
-        'model_stats': dict(model_stats),
+        'log_file': source,
+        'conversation_count': rollup.conversation_count,
+        'vote_count': sum(rollup.vote_counts.values()),
+        'vote_counts': {t: n for t, n in rollup.vote_counts.items() if n > 0},
+        'voter_count': rollup.voters.count(),
+        'model_stats': model_stats,
         'analysis_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
 
+def analyze_daily_data(log_file):
+    """分析当天的数据"""
+    if not log_file:
+        return None
+        
+    print(f"📊 分析当天数据: {log_file}")
+    
+    if not os.path.exists(log_file):
+        print(f"❌ 文件不存在: {log_file}")
+        return None
+    
+    # 汇总文件保存在日志目录的 rollups/ 下，再次分析时只扫描新增的日志
+    return summarize_rollup(load_rollup(log_file), log_file)
+
+def analyze_range_data(start_date, end_date):
+    """分析日期范围内的数据，合并每天的汇总"""
+    log_files = get_range_log_files(start_date, end_date)
+    if not log_files:
+        print(f"❌ 未找到 {start_date} 到 {end_date} 的日志文件")
+        return None
+    
+    print(f"📊 分析 {start_date} 到 {end_date} 的数据: {len(log_files)} 个日志文件")
+    return summarize_rollup(load_rollups(log_files), f"{start_date} ~ {end_date}")
+
 def generate_daily_report(data):
     """生成当天数据报告"""
     if not data:
@@ -116,6 +98,7 @@ def generate_daily_report(data):
     report.append("## 📊 基本统计")
     report.append(f"- **对话总数**: {data['conversation_count']}")
     report.append(f"- **投票总数**: {data['vote_count']}")
+    report.append(f"- **独立投票用户 (估计)**: {data['voter_count']}")
     report.append(f"- **参与模型数**: {len(data['model_stats'])}")
     report.append("")
     
@@ -197,6 +180,7 @@ def print_summary(data):
     print(f"🕐 分析时间: {data['analysis_time']}")
     print(f"💬 对话总数: {data['conversation_count']}")
     print(f"🗳️  投票总数: {data['vote_count']}")
+    print(f"👥 独立投票用户 (估计): {data['voter_count']}")
     print(f"🤖 参与模型: {len(data['model_stats'])}")
     
     if data['vote_count'] > 0:
@@ -225,18 +209,24 @@ def main():
     parser.add_argument("--log-file", help="指定日志文件路径（默认自动检测当天文件）")
     parser.add_argument("--output", help="输出报告文件路径")
     parser.add_argument("--no-save", action="store_true", help="不保存报告文件，仅显示统计")
+    parser.add_argument("--start-date", help="统计日期范围的开始日期 (YYYY-MM-DD)，合并范围内每天的汇总")
+    parser.add_argument("--end-date", help="统计日期范围的结束日期 (YYYY-MM-DD，默认: 今天)")
     
     args = parser.parse_args()
     
-    # 获取日志文件
-    log_file = args.log_file or get_today_log_file()
-    
-    if not log_file:
-        print("❌ 未找到可分析的日志文件")
-        return
-    
-    # 分析数据
-    data = analyze_daily_data(log_file)
+    if args.start_date:
+        end_date = args.end_date or datetime.now().strftime('%Y-%m-%d')
+        data = analyze_range_data(args.start_date, end_date)
+    else:
+        # 获取日志文件
+        log_file = args.log_file or get_today_log_file()
+        
+        if not log_file:
+            print("❌ 未找到可分析的日志文件")
+            return
+        
+        # 分析数据
+        data = analyze_daily_data(log_file)
     
     if not data:
         print("❌ 数据分析失败")
@@ -10,15 +10,35 @@ import os
 from datetime import datetime
 from pathlib import Path
 import hashlib
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fastchat.serve.monitor.log_scanner import VOTE_TYPES, count_lines, get_complete_size, scan_log
+
+# 日志行首之前用于校验的字节数，校验不一致说明文件被替换，需要从头导入
+CHECK_BYTES = 256
+VOTE_INSERT_BATCH_SIZE = 10000
 
 class VoteDatabase:
-    def __init__(self, db_path="votes.db"):
+    def __init__(self, db_path="votes.db", store_conversations=False):
+        """
+        store_conversations: 是否把完整的投票记录保存到 vote_conversations 表，
+        统计和排名只用到 votes 表，原始记录仍保留在日志中
+        """
         self.db_path = db_path
+        self.store_conversations = store_conversations
         self.init_database()
     
+    def connect(self):
+        """打开数据库连接，使用WAL模式，读取不会被写入阻塞"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
     def init_database(self):
         """初始化数据库表结构"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
         # 创建投票记录表
@@ -36,6 +56,14 @@ class VoteDatabase:
             )
         ''')
         
+        # 创建完整投票记录表（可选），与 votes 表分开存放，统计查询不读取这些大字段
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS vote_conversations (
+                vote_id TEXT PRIMARY KEY,
+                conversation_data TEXT NOT NULL
+            )
+        ''')
+        
         # 创建模型统计表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS model_stats (
@@ -50,15 +78,25 @@ class VoteDatabase:
         ''')
         
         # 创建日志文件处理记录表
+        # file_hash 为已处理部分最后 CHECK_BYTES 字节的哈希，byte_offset 和 line_count 为已处理的字节数和行数
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS processed_logs (
                 file_path TEXT PRIMARY KEY,
                 file_hash TEXT NOT NULL,
                 processed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                record_count INTEGER DEFAULT 0
+                record_count INTEGER DEFAULT 0,
+                byte_offset INTEGER,
+                line_count INTEGER DEFAULT 0
             )
         ''')
         
+        # 旧版本数据库补充新增的列，旧记录没有 byte_offset，会从头重新导入一次（投票ID不变，不会重复）
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(processed_logs)')]
+        if 'byte_offset' not in columns:
+            cursor.execute('ALTER TABLE processed_logs ADD COLUMN byte_offset INTEGER')
+        if 'line_count' not in columns:
+            cursor.execute('ALTER TABLE processed_logs ADD COLUMN line_count INTEGER DEFAULT 0')
+        
         # 创建索引
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_votes_timestamp ON votes(timestamp)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_votes_type ON votes(vote_type)')
@@ -67,161 +105,176 @@ class VoteDatabase:
         conn.commit()
         conn.close()
     
-    def get_file_hash(self, file_path):
-        """计算文件的MD5哈希值"""
-        hash_md5 = hashlib.md5()
+    def get_tail_hash(self, file_path, offset):
+        """计算文件 offset 之前最后 CHECK_BYTES 字节的MD5哈希值"""
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            f.seek(max(offset - CHECK_BYTES, 0))
+            return hashlib.md5(f.read(offset - f.tell())).hexdigest()
     
-    def is_file_processed(self, file_path):
-        """检查文件是否已经处理过"""
-        if not os.path.exists(file_path):
-            return False
-            
-        current_hash = self.get_file_hash(file_path)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT file_hash FROM processed_logs WHERE file_path = ?', (file_path,))
+    def get_processed_offset(self, cursor, file_path):
+        """获取文件已处理到的字节位置和行数，文件被替换或截断时返回 (0, 0)"""
+        cursor.execute('SELECT file_hash, byte_offset, line_count FROM processed_logs WHERE file_path = ?', (file_path,))
         result = cursor.fetchone()
-        
-        conn.close()
-        
-        if result is None:
-            return False
-        
-        return result[0] == current_hash
-    
-    def mark_file_processed(self, file_path, record_count):
-        """标记文件为已处理"""
-        file_hash = self.get_file_hash(file_path)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO processed_logs (file_path, file_hash, processed_at, record_count)
-            VALUES (?, ?, CURRENT_TIMESTAMP, ?)
-        ''', (file_path, file_hash, record_count))
-        
-        conn.commit()
-        conn.close()
+        if result is None or result[1] is None:
+            return 0, 0
+        
+        file_hash, offset, line_count = result
+        if offset > os.path.getsize(file_path) or self.get_tail_hash(file_path, offset) != file_hash:
+            print(f"⚠️ 文件内容已变化，从头重新处理: {file_path}")
+            return 0, 0
+        return offset, line_count
     
     def load_votes_from_log(self, log_file_path):
-        """从日志文件加载投票数据到数据库"""
-        if self.is_file_processed(log_file_path):
-            print(f"📋 文件已处理过，跳过: {log_file_path}")
-            return 0
-        
-        print(f"📥 正在处理新日志文件: {log_file_path}")
-        
-        conn = sqlite3.connect(self.db_path)
+        """从日志文件增量加载投票数据到数据库，只处理上次处理位置之后新增的完整行"""
+        conn = self.connect()
         cursor = conn.cursor()
         
         new_records = 0
         
         try:
-            with open(log_file_path, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    try:
-                        data = json.loads(line.strip())
-                        
-                        # 只处理投票类型的记录
-                        if data.get('type') not in ['leftvote', 'rightvote', 'tievote', 'bothbad_vote']:
-                            continue
-                        
-                        # 检查是否有足够的模型状态
-                        states = data.get('states', [])
-                        if len(states) < 2:
-                            continue
-                        
-                        # 提取模型名称
-                        model_a = states[0].get('model_name', '')
-                        model_b = states[1].get('model_name', '')
-                        
-                        if not model_a or not model_b:
-                            continue
-                        
-                        # 生成唯一的投票ID
-                        vote_id = hashlib.md5(f"{log_file_path}:{line_num}:{data.get('tstamp', '')}".encode()).hexdigest()
-                        
-                        # 确定获胜者
-                        vote_type = data.get('type')
-                        winner = None
-                        if vote_type == 'leftvote':
-                            winner = model_a
-                        elif vote_type == 'rightvote':
-                            winner = model_b
-                        elif vote_type == 'tievote':
-                            winner = 'tie'
-                        elif vote_type == 'bothbad_vote':
-                            winner = 'both_bad'
-                        
-                        # 插入投票记录
-                        cursor.execute('''
-                            INSERT OR IGNORE INTO votes 
-                            (vote_id, timestamp, vote_type, model_a, model_b, winner, conversation_data)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        ''', (vote_id, data.get('tstamp', ''), vote_type, model_a, model_b, winner, json.dumps(data)))
-                        
-                        if cursor.rowcount > 0:
-                            new_records += 1
-                            
-                    except json.JSONDecodeError:
+            offset, line_count = self.get_processed_offset(cursor, log_file_path)
+            end = get_complete_size(log_file_path)
+            if end == offset:
+                print(f"📋 文件没有新内容，跳过: {log_file_path}")
+                return 0
+            
+            print(f"📥 正在处理日志文件: {log_file_path} (从第 {offset} 字节开始)")
+            
+            vote_rows = []
+            conversation_rows = []
+            # 只解析投票类型的记录，对话记录按行首类型直接跳过
+            for line_num, data in scan_log(log_file_path, VOTE_TYPES, start=offset, end=end, line_numbers=True):
+                # 行号从文件开头计数，与之前导入的投票ID保持一致
+                line_num += line_count
+                try:
+                    # 检查是否有足够的模型状态
+                    states = data.get('states', [])
+                    if len(states) < 2:
                         continue
-                    except Exception as e:
-                        print(f"⚠️ 处理第{line_num}行时出错: {e}")
+                    
+                    # 提取模型名称
+                    model_a = states[0].get('model_name', '')
+                    model_b = states[1].get('model_name', '')
+                    
+                    if not model_a or not model_b:
                         continue
+                    
+                    # 生成唯一的投票ID
+                    vote_id = hashlib.md5(f"{log_file_path}:{line_num}:{data.get('tstamp', '')}".encode()).hexdigest()
+                    
+                    # 确定获胜者
+                    vote_type = data.get('type')
+                    winner = None
+                    if vote_type == 'leftvote':
+                        winner = model_a
+                    elif vote_type == 'rightvote':
+                        winner = model_b
+                    elif vote_type == 'tievote':
+                        winner = 'tie'
+                    elif vote_type == 'bothbad_vote':
+                        winner = 'both_bad'
+                    
+                    vote_rows.append((vote_id, data.get('tstamp', ''), vote_type, model_a, model_b, winner))
+                    if self.store_conversations:
+                        conversation_rows.append((vote_id, json.dumps(data)))
+                        
+                except Exception as e:
+                    print(f"⚠️ 处理第{line_num}行时出错: {e}")
+                    continue
+                
+                # 分批写入
+                if len(vote_rows) >= VOTE_INSERT_BATCH_SIZE:
+                    new_records += self.insert_votes(cursor, vote_rows, conversation_rows)
+            
+            new_records += self.insert_votes(cursor, vote_rows, conversation_rows)
+            
+            # 记录处理位置，与投票数据在同一个事务中提交
+            line_count += count_lines(log_file_path, offset, end)
+            cursor.execute('''
+                INSERT INTO processed_logs (file_path, file_hash, processed_at, record_count, byte_offset, line_count)
+                VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?)
+                ON CONFLICT(file_path) DO UPDATE SET
+                    file_hash = excluded.file_hash,
+                    processed_at = excluded.processed_at,
+                    record_count = CASE WHEN ? = 0 THEN excluded.record_count
+                                        ELSE processed_logs.record_count + excluded.record_count END,
+                    byte_offset = excluded.byte_offset,
+                    line_count = excluded.line_count
+            ''', (log_file_path, self.get_tail_hash(log_file_path, end), new_records, end, line_count, offset))
             
             conn.commit()
-            self.mark_file_processed(log_file_path, new_records)
             print(f"✅ 成功处理 {new_records} 条新记录")
             
         except Exception as e:
             print(f"❌ 处理日志文件失败: {e}")
             conn.rollback()
+            new_records = 0
         finally:
             conn.close()
         
         return new_records
     
+    def insert_votes(self, cursor, vote_rows, conversation_rows):
+        """批量写入投票记录，写入后清空列表，返回新写入的投票数"""
+        cursor.executemany('''
+            INSERT OR IGNORE INTO votes 
+            (vote_id, timestamp, vote_type, model_a, model_b, winner)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', vote_rows)
+        inserted = cursor.rowcount
+        if conversation_rows:
+            cursor.executemany('''
+                INSERT OR IGNORE INTO vote_conversations (vote_id, conversation_data)
+                VALUES (?, ?)
+            ''', conversation_rows)
+        vote_rows.clear()
+        conversation_rows.clear()
+        return inserted
+    
     def update_model_stats(self):
-        """更新模型统计数据"""
-        conn = sqlite3.connect(self.db_path)
+        """更新模型统计数据，一次聚合查询得到所有模型的统计"""
+        conn = self.connect()
         cursor = conn.cursor()
         
         try:
-            # 获取所有模型
-            cursor.execute('SELECT DISTINCT model_a FROM votes UNION SELECT DISTINCT model_b FROM votes')
-            models = [row[0] for row in cursor.fetchall()]
+            # 每场对战按两侧的模型各计一次，两侧是同一个模型时只计一次
+            # 只出现在 both_bad 投票中的模型也保留一行，对战次数为0
+            cursor.execute('''
+                WITH sides AS (
+                    SELECT model_a AS model, winner,
+                           vote_type IN ('leftvote', 'rightvote', 'tievote') AS valid
+                    FROM votes
+                    UNION ALL
+                    SELECT model_b AS model, winner,
+                           vote_type IN ('leftvote', 'rightvote', 'tievote') AS valid
+                    FROM votes
+                    WHERE model_b != model_a
+                )
+                SELECT 
+                    model,
+                    SUM(valid) as total_battles,
+                    SUM(CASE WHEN valid AND winner = model THEN 1 ELSE 0 END) as wins,
+                    SUM(CASE WHEN valid AND winner != model AND winner != 'tie' AND winner != 'both_bad' THEN 1 ELSE 0 END) as losses,
+                    SUM(CASE WHEN valid AND winner = 'tie' THEN 1 ELSE 0 END) as ties
+                FROM sides
+                GROUP BY model
+            ''')
+            stats = cursor.fetchall()
             
-            for model in models:
-                # 计算统计数据
-                cursor.execute('''
-                    SELECT 
-                        COUNT(*) as total_battles,
-                        SUM(CASE WHEN winner = ? THEN 1 ELSE 0 END) as wins,
-                        SUM(CASE WHEN winner != ? AND winner != 'tie' AND winner != 'both_bad' THEN 1 ELSE 0 END) as losses,
-                        SUM(CASE WHEN winner = 'tie' THEN 1 ELSE 0 END) as ties
-                    FROM votes 
-                    WHERE (model_a = ? OR model_b = ?) AND vote_type IN ('leftvote', 'rightvote', 'tievote')
-                ''', (model, model, model, model))
-                
-                result = cursor.fetchone()
-                total_battles, wins, losses, ties = result
-                
-                # 更新模型统计
-                cursor.execute('''
-                    INSERT OR REPLACE INTO model_stats 
-                    (model_name, total_battles, wins, losses, ties, last_updated)
-                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (model, total_battles, wins, losses, ties))
+            # 更新模型统计，保留已有的ELO评级
+            cursor.executemany('''
+                INSERT INTO model_stats (model_name, total_battles, wins, losses, ties, last_updated)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(model_name) DO UPDATE SET
+                    total_battles = excluded.total_battles,
+                    wins = excluded.wins,
+                    losses = excluded.losses,
+                    ties = excluded.ties,
+                    last_updated = excluded.last_updated
+            ''', stats)
             
             conn.commit()
-            print(f"✅ 已更新 {len(models)} 个模型的统计数据")
+            print(f"✅ 已更新 {len(stats)} 个模型的统计数据")
             
         except Exception as e:
             print(f"❌ 更新模型统计失败: {e}")
@@ -229,15 +282,30 @@ class VoteDatabase:
         finally:
             conn.close()
     
+    def get_pairwise_counts(self):
+        """获取每对模型各投票类型的次数 {(model_a, model_b): {vote_type: count}}"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT model_a, model_b, vote_type, COUNT(*)
+            FROM votes
+            GROUP BY model_a, model_b, vote_type
+        ''')
+        
+        result = {}
+        for model_a, model_b, vote_type, count in cursor.fetchall():
+            result.setdefault((model_a, model_b), {})[vote_type] = count
+        
+        conn.close()
+        return result
+    
     def calculate_elo_ratings(self, k_factor=32):
-        """计算ELO评级"""
-        conn = sqlite3.connect(self.db_path)
+        """计算ELO评级，一次读取所有对战，在内存中计算后批量写回"""
+        conn = self.connect()
         cursor = conn.cursor()
         
         try:
-            # 重置所有模型的ELO评级为1000
-            cursor.execute('UPDATE model_stats SET elo_rating = 1000.0')
-            
             # 按时间顺序获取所有有效对战
             cursor.execute('''
                 SELECT model_a, model_b, winner, timestamp 
@@ -248,13 +316,12 @@ class VoteDatabase:
             
             battles = cursor.fetchall()
             
+            # 所有模型的ELO评级从1000开始
+            ratings = {}
             for model_a, model_b, winner, timestamp in battles:
                 # 获取当前ELO评级
-                cursor.execute('SELECT elo_rating FROM model_stats WHERE model_name = ?', (model_a,))
-                elo_a = cursor.fetchone()[0]
-                
-                cursor.execute('SELECT elo_rating FROM model_stats WHERE model_name = ?', (model_b,))
-                elo_b = cursor.fetchone()[0]
+                elo_a = ratings.get(model_a, 1000.0)
+                elo_b = ratings.get(model_b, 1000.0)
                 
                 # 计算期望得分
                 expected_a = 1 / (1 + 10 ** ((elo_b - elo_a) / 400))
@@ -271,11 +338,12 @@ class VoteDatabase:
                     continue  # 跳过both_bad
                 
                 # 更新ELO评级
-                new_elo_a = elo_a + k_factor * (score_a - expected_a)
-                new_elo_b = elo_b + k_factor * (score_b - expected_b)
-                
-                cursor.execute('UPDATE model_stats SET elo_rating = ? WHERE model_name = ?', (new_elo_a, model_a))
-                cursor.execute('UPDATE model_stats SET elo_rating = ? WHERE model_name = ?', (new_elo_b, model_b))
+                ratings[model_a] = elo_a + k_factor * (score_a - expected_a)
+                ratings[model_b] = elo_b + k_factor * (score_b - expected_b)
+            
+            cursor.execute('UPDATE model_stats SET elo_rating = 1000.0')
+            cursor.executemany('UPDATE model_stats SET elo_rating = ? WHERE model_name = ?',
+                               [(rating, model) for model, rating in ratings.items()])
             
             conn.commit()
             print(f"✅ 已计算 {len(battles)} 场对战的ELO评级")
@@ -288,7 +356,7 @@ class VoteDatabase:
     
     def get_vote_distribution(self):
         """获取投票分布统计"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -306,7 +374,7 @@ class VoteDatabase:
     
     def get_model_rankings(self):
         """获取模型排名"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -361,7 +429,7 @@ class VoteDatabase:
     
     def get_database_stats(self):
         """获取数据库统计信息"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connect()
         cursor = conn.cursor()
         
         cursor.execute('SELECT COUNT(*) FROM votes')
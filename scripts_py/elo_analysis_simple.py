@@ -4,14 +4,18 @@ FastChat ELO评分分析工具
 基于投票数据计算模型的ELO评分和排名
 """
 
-import json
 import pandas as pd
 import numpy as np
 from collections import defaultdict
 import argparse
 import os
+import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fastchat.serve.monitor.log_scanner import VOTE_TYPES, project_vote, scan_log
+from fastchat.serve.monitor.vote_rollup import load_rollups
+
 class ELOCalculator:
     def __init__(self, k_factor=32, initial_rating=1000):
         self.k_factor = k_factor
@@ -56,31 +60,22 @@ class ELOCalculator:
 def load_battle_data(log_file):
     """加载对战数据"""
     battles = []
-    with open(log_file, 'r') as f:
-        for line in f:
-            try:
-                data = json.loads(line.strip())
-                if data.get('type') in ['leftvote', 'rightvote', 'tievote', 'bothbad_vote']:
-                    if 'states' in data and len(data['states']) >= 2:
-                        model_a = data['states'][0].get('model_name', 'Unknown')
-                        model_b = data['states'][1].get('model_name', 'Unknown')
-                        
-                        # 确定获胜者
-                        if data['type'] == 'leftvote':
-                            winner = 'model_a'
-                        elif data['type'] == 'rightvote':
-                            winner = 'model_b'
-                        else:  # tievote or bothbad_vote
-                            winner = 'tie'
-                        
-                        battles.append({
-                            'model_a': model_a,
-                            'model_b': model_b,
-                            'winner': winner,
-                            'timestamp': data.get('tstamp', 0)
-                        })
-            except json.JSONDecodeError:
-                continue
+    for vote in scan_log(log_file, VOTE_TYPES, project_vote):
+        if vote['model_a'] is not None:
+            # 确定获胜者
+            if vote['type'] == 'leftvote':
+                winner = 'model_a'
+            elif vote['type'] == 'rightvote':
+                winner = 'model_b'
+            else:  # tievote or bothbad_vote
+                winner = 'tie'
+            
+            battles.append({
+                'model_a': vote['model_a'] or 'Unknown',
+                'model_b': vote['model_b'] or 'Unknown',
+                'winner': winner,
+                'timestamp': vote['tstamp'] or 0
+            })
     return battles
 
 def analyze_elo_rankings(battles, k_factor=32):
@@ -147,6 +142,38 @@ def analyze_elo_rankings(battles, k_factor=32):
     
     return results
 
+def analyze_elo_rollup(rollup, k_factor=32):
+    """根据合并后的每天汇总生成ELO排名，评分由汇总按天接续计算"""
+    model_stats = rollup.get_model_stats(bothbad_as_tie=True)
+    if not model_stats:
+        print("没有找到对战数据")
+        return None
+    
+    print(f"正在汇总 {sum(sum(counts) for counts in rollup.pairs.values())} 场对战...")
+    
+    ratings = rollup.get_elo_ratings(k_factor)
+    rankings = sorted(ratings.items(), key=lambda x: x[1], reverse=True)
+    
+    # 生成结果
+    results = []
+    for rank, (model, elo_rating) in enumerate(rankings, 1):
+        stats = model_stats.get(model, {'wins': 0, 'losses': 0, 'ties': 0, 'total': 0})
+        total_battles = stats['total']
+        win_rate = (stats['wins'] / total_battles * 100) if total_battles > 0 else 0
+        
+        results.append({
+            'rank': rank,
+            'model': model,
+            'elo_rating': round(elo_rating, 1),
+            'total_battles': total_battles,
+            'wins': stats['wins'],
+            'losses': stats['losses'],
+            'ties': stats['ties'],
+            'win_rate': round(win_rate, 1)
+        })
+    
+    return results
+
 def print_results(results):
     """打印结果"""
     if not results:
@@ -172,6 +199,10 @@ def main():
     parser = argparse.ArgumentParser(description='FastChat ELO评分分析工具')
     parser.add_argument('--log-file', type=str, default='logs/chat.log',
                        help='投票日志文件路径')
+    parser.add_argument('--log-files', type=str, nargs='+',
+                       help='按时间顺序的多个日志文件，通过每天的汇总文件累积分析')
+    parser.add_argument('--rollup-dir', type=str, default=None,
+                       help='汇总文件目录 (默认: 日志所在目录下的 rollups/)')
     parser.add_argument('--output', type=str, default='elo_rankings.csv',
                        help='输出CSV文件路径')
     parser.add_argument('--k-factor', type=float, default=32,
@@ -181,17 +212,24 @@ def main():
     
     args = parser.parse_args()
     
-    # 检查日志文件
-    if not os.path.exists(args.log_file):
-        print(f"错误: 找不到日志文件 {args.log_file}")
-        return
-    
-    print(f"正在分析ELO评分: {args.log_file}")
-    print(f"K因子: {args.k_factor}")
-    
-    # 加载数据
-    battles = load_battle_data(args.log_file)
-    results = analyze_elo_rankings(battles, args.k_factor)
+    if args.log_files:
+        # 累积分析：历史日志只读取汇总，当天日志只扫描新增部分
+        print(f"正在分析ELO评分: {len(args.log_files)} 个日志文件")
+        print(f"K因子: {args.k_factor}")
+        rollup = load_rollups(args.log_files, args.rollup_dir, k_factor=args.k_factor)
+        results = analyze_elo_rollup(rollup, args.k_factor)
+    else:
+        # 检查日志文件
+        if not os.path.exists(args.log_file):
+            print(f"错误: 找不到日志文件 {args.log_file}")
+            return
+        
+        print(f"正在分析ELO评分: {args.log_file}")
+        print(f"K因子: {args.k_factor}")
+        
+        # 加载数据
+        battles = load_battle_data(args.log_file)
+        results = analyze_elo_rankings(battles, args.k_factor)
     
     if results:
         print_results(results)
@@ -12,7 +12,9 @@ import time
 import shutil
 import argparse
 import subprocess
+import shlex
 import glob
+import hashlib
 import locale
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -22,6 +24,12 @@ import base64
 from io import BytesIO
 import numpy as np
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fastchat.serve.monitor.log_scanner import VOTE_TYPES, count_types
+
+# 报告数据文件 report_data.json 的格式版本，格式不兼容地改变时加1
+REPORT_DATA_VERSION = 1
+
 # 语言本地化配置
 def get_system_language():
     """获取系统语言设置"""
@@ -264,16 +272,9 @@ def count_vote_entries(log_file):
     vote_types = {'leftvote': 0, 'rightvote': 0, 'tievote': 0, 'bothbad_vote': 0, 'total': 0}
     
     try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line.strip())
-                    vote_type = data.get('type', '')
-                    if vote_type in ['leftvote', 'rightvote', 'tievote', 'bothbad_vote']:
-                        vote_types[vote_type] += 1
-                        vote_types['total'] += 1
-                except json.JSONDecodeError:
-                    continue
+        # 只按行首的类型计数，不解析对话记录
+        vote_types.update(count_types(log_file, VOTE_TYPES))
+        vote_types['total'] = sum(vote_types[t] for t in VOTE_TYPES)
     except Exception:
         pass
     
@@ -333,75 +334,55 @@ def analyze_cumulative_vote_data():
     for log_file in all_log_files:
         print(f"  - {log_file.name} ({log_file.parent.name if log_file.parent.name != main_dir.name else 'root'})")
     
-    # 创建临时合并文件
-    temp_merged_file = main_dir / 'temp_merged_logs.json'
+    # 每个日志对应 logs_archive/rollups/ 下的一个每日汇总文件，已归档的日期只读取汇总，
+    # 当天的日志只扫描上次汇总之后新增的部分，累积分析的开销取决于天数而不是投票数
+    log_files_arg = ' '.join(shlex.quote(str(log_file)) for log_file in all_log_files)
+    
+    # 运行投票分析
+    cmd = f"python {main_dir}/vote_analysis.py --log-files {log_files_arg} --export"
+    output = run_command(cmd, t('cumulative_vote_analysis'))
+    
+    # 运行ELO分析
+    cmd = f"python {main_dir}/elo_analysis_simple.py --log-files {log_files_arg} --export"
+    output = run_command(cmd, t('cumulative_elo_analysis'))
     
+    # 读取生成的数据文件
     try:
-        # 合并所有日志文件
-        with open(temp_merged_file, 'w', encoding='utf-8') as merged_file:
-            for log_file in all_log_files:
-                print(f"Processing {log_file.name}...")
-                try:
-                    with open(log_file, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            merged_file.write(line)
-                except Exception as e:
-                    print(f"⚠️  Error processing {log_file.name}: {e}")
-                    continue
-        
-        print(f"Merged {len(all_log_files)} files into {temp_merged_file}")
-        
-        # 运行投票分析
-        cmd = f"python {main_dir}/vote_analysis.py --log-file {temp_merged_file} --export"
-        output = run_command(cmd, t('cumulative_vote_analysis'))
+        # 读取投票分析数据 - 从 static/reports 目录读取
+        reports_dir = Path(__file__).parent.parent / 'static' / 'reports'
         
-        # 运行ELO分析
-        cmd = f"python {main_dir}/elo_analysis_simple.py --log-file {temp_merged_file} --export"
-        output = run_command(cmd, t('cumulative_elo_analysis'))
+        # 读取投票分析数据
+        vote_file = reports_dir / 'vote_analysis.csv'
+        with open(vote_file, 'r', encoding='utf-8') as f:
+            vote_data = f.read()
         
-        # 读取生成的数据文件
-        try:
-            # 读取投票分析数据 - 从 static/reports 目录读取
-            reports_dir = Path(__file__).parent.parent / 'static' / 'reports'
-            
-            # 读取投票分析数据
-            vote_file = reports_dir / 'vote_analysis.csv'
-            with open(vote_file, 'r', encoding='utf-8') as f:
-                vote_data = f.read()
-            
-            # 读取ELO排名数据
-            elo_file = reports_dir / 'elo_rankings.csv'
-            with open(elo_file, 'r', encoding='utf-8') as f:
-                elo_data = f.read()
-                
-            # 读取投票分布数据
-            distribution_file = reports_dir / 'vote_distribution.json'
-            with open(distribution_file, 'r', encoding='utf-8') as f:
-                distribution_data = json.load(f)
-                
-            # 解析CSV数据
-            vote_lines = vote_data.strip().split('\n')
-            vote_headers = vote_lines[0].split(',')
-            vote_rows = [dict(zip(vote_headers, line.split(','))) for line in vote_lines[1:]]
-            
-            elo_lines = elo_data.strip().split('\n')
-            elo_headers = elo_lines[0].split(',')
-            elo_rows = [dict(zip(elo_headers, line.split(','))) for line in elo_lines[1:]]
+        # 读取ELO排名数据
+        elo_file = reports_dir / 'elo_rankings.csv'
+        with open(elo_file, 'r', encoding='utf-8') as f:
+            elo_data = f.read()
             
-            return vote_rows, elo_rows, distribution_data
+        # 读取投票分布数据
+        distribution_file = reports_dir / 'vote_distribution.json'
+        with open(distribution_file, 'r', encoding='utf-8') as f:
+            distribution_data = json.load(f)
             
-        except FileNotFoundError as e:
-            print(t('data_file_missing').format(e))
-            return [], [], {}
-        except Exception as e:
-            print(t('data_read_failed').format(e))
-            return [], [], {}
-    
-    finally:
-        # 清理临时文件
-        if temp_merged_file.exists():
-            temp_merged_file.unlink()
-            print(f"Cleaned up temporary file: {temp_merged_file}")
+        # 解析CSV数据
+        vote_lines = vote_data.strip().split('\n')
+        vote_headers = vote_lines[0].split(',')
+        vote_rows = [dict(zip(vote_headers, line.split(','))) for line in vote_lines[1:]]
+        
+        elo_lines = elo_data.strip().split('\n')
+        elo_headers = elo_lines[0].split(',')
+        elo_rows = [dict(zip(elo_headers, line.split(','))) for line in elo_lines[1:]]
+        
+        return vote_rows, elo_rows, distribution_data
+        
+    except FileNotFoundError as e:
+        print(t('data_file_missing').format(e))
+        return [], [], {}
+    except Exception as e:
+        print(t('data_read_failed').format(e))
+        return [], [], {}
 
 def analyze_vote_data(log_file):
     """分析投票数据"""
@@ -1236,6 +1217,49 @@ def create_report_html(data_source, vote_rows, elo_rows, distribution_data):
     print(t('report_generated').format(html_file_path))
     return 'report.html'
 
+def parse_number(value):
+    """把CSV中读出的字符串转换为数字，无法转换时原样返回"""
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+def create_report_data(data_source, vote_rows, elo_rows, distribution_data, report_html='report.html'):
+    """
+    保存报告数据 report_data.json，与 report.html 放在同一目录
+    Web界面直接读取这份数据，不再从HTML中用正则表达式解析
+    data_version 是数据内容的哈希值，数据不变时保持不变，供界面缓存使用
+    """
+    data = {
+        'data_source': str(data_source),
+        'vote_distribution': distribution_data,
+        'models': [{key: parse_number(value) for key, value in row.items()} for row in vote_rows],
+        'elo_rankings': [{key: parse_number(value) for key, value in row.items()} for row in elo_rows],
+    }
+    data_version = hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+    report_data = {
+        'version': REPORT_DATA_VERSION,
+        'data_version': data_version,
+        'generated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'report_html': report_html,
+        **data,
+    }
+    
+    reports_dir = Path(__file__).parent.parent / 'static' / 'reports'
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    
+    # 先写临时文件再替换，读取方不会读到写了一半的文件
+    data_file_path = reports_dir / 'report_data.json'
+    tmp_file_path = reports_dir / 'report_data.json.tmp'
+    with open(tmp_file_path, 'w', encoding='utf-8') as f:
+        json.dump(report_data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file_path, data_file_path)
+    
+    print(t('report_generated').format(data_file_path))
+    return 'report_data.json'
+
 def create_summary_report():
  
     print(t('summary_report'))
@@ -1596,6 +1620,7 @@ def main():
 - 每个日志文件名如 2025-06-26-conv.json，表示当天的投票数据。
 - 日志文件为JSON格式，记录了每一场对战的详细信息。
 - 日志文件不会被覆盖，便于追溯和复查。
+- rollups/ 目录保存每天日志的投票汇总，由分析脚本自动生成和更新，删除后会重新生成。
 
 建议：如需长期归档，可定期备份本目录。
 ''')
@@ -1624,6 +1649,10 @@ def main():
         html_report = create_report_html(log_file if not args.cumulative else "累积历史数据", vote_rows, elo_rows, distribution_data)
         if html_report:
             reports_generated.append('report.html')
+            # 数据文件在HTML之后写入，界面看到新数据时HTML已经就绪
+            report_data = create_report_data(log_file if not args.cumulative else "累积历史数据", vote_rows, elo_rows, distribution_data, html_report)
+            if report_data:
+                reports_generated.append(report_data)
     if not args.html_only:
         summary_report = create_summary_report()
         if summary_report:
@@ -6,67 +6,44 @@ FastChat 投票统计工具
 
 import json
 import pandas as pd
-from collections import defaultdict, Counter
 from datetime import datetime
 import argparse
 import os
+import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fastchat.serve.monitor.log_scanner import VOTE_TYPES, project_vote, scan_log
+from fastchat.serve.monitor.vote_rollup import DailyRollup, load_rollups
+
 def load_vote_data(log_file):
-    """加载投票数据"""
-    votes = []
-    with open(log_file, 'r') as f:
-        for line in f:
-            try:
-                data = json.loads(line.strip())
-                if data.get('type') in ['leftvote', 'rightvote', 'tievote', 'bothbad_vote']:
-                    votes.append(data)
-            except json.JSONDecodeError:
-                continue
-    return votes
+    """加载投票数据，只保留统计所需的字段"""
+    return list(scan_log(log_file, VOTE_TYPES, project_vote))
 
 def analyze_votes(votes):
     """分析投票数据"""
-    if not votes:
+    rollup = DailyRollup()
+    rollup.fold(votes)
+    return analyze_rollup(rollup)
+
+def analyze_rollup(rollup):
+    """分析投票汇总数据，多天的汇总合并后同样适用"""
+    # 统计基本信息
+    total_votes = sum(rollup.vote_counts.values())
+    if total_votes == 0:
         print("没有找到投票数据")
         return
     
-    # 统计基本信息
-    total_votes = len(votes)
-    vote_types = Counter(vote['type'] for vote in votes)
-    
     print(f"=== 投票统计概览 ===")
     print(f"总投票数: {total_votes}")
     print(f"投票类型分布:")
-    for vote_type, count in vote_types.items():
-        percentage = (count / total_votes) * 100
-        print(f"  {vote_type}: {count} ({percentage:.1f}%)")
-    
-    # 分析模型对战结果
-    model_stats = defaultdict(lambda: {'wins': 0, 'losses': 0, 'ties': 0, 'total': 0})
+    for vote_type, count in rollup.vote_counts.items():
+        if count > 0:
+            percentage = (count / total_votes) * 100
+            print(f"  {vote_type}: {count} ({percentage:.1f}%)")
     
-    for vote in votes:
-        if 'states' in vote and len(vote['states']) >= 2:
-            model_a = vote['states'][0].get('model_name', 'Unknown')
-            model_b = vote['states'][1].get('model_name', 'Unknown')
-            vote_type = vote['type']
-            
-            # 统计每个模型的胜负
-            if vote_type == 'leftvote':
-                model_stats[model_a]['wins'] += 1
-                model_stats[model_b]['losses'] += 1
-            elif vote_type == 'rightvote':
-                model_stats[model_b]['wins'] += 1
-                model_stats[model_a]['losses'] += 1
-            elif vote_type == 'tievote':
-                model_stats[model_a]['ties'] += 1
-                model_stats[model_b]['ties'] += 1
-            elif vote_type == 'bothbad_vote':
-                model_stats[model_a]['ties'] += 1
-                model_stats[model_b]['ties'] += 1
-            
-            model_stats[model_a]['total'] += 1
-            model_stats[model_b]['total'] += 1
+    # 分析模型对战结果，平局和双败都计为平局
+    model_stats = rollup.get_model_stats(bothbad_as_tie=True)
     
     # 计算胜率
     print(f"\n=== 模型表现统计 ===")
@@ -98,20 +75,15 @@ def analyze_votes(votes):
     
     # 时间分析
     print(f"\n=== 时间分析 ===")
-    timestamps = [vote['tstamp'] for vote in votes]
-    if timestamps:
-        start_time = datetime.fromtimestamp(min(timestamps))
-        end_time = datetime.fromtimestamp(max(timestamps))
+    if rollup.first_tstamp is not None:
+        start_time = datetime.fromtimestamp(rollup.first_tstamp)
+        end_time = datetime.fromtimestamp(rollup.last_tstamp)
         print(f"投票时间范围: {start_time} 到 {end_time}")
+        print(f"独立投票用户 (估计): {rollup.voters.count()}")
         
         # 按小时统计
-        hourly_votes = defaultdict(int)
-        for ts in timestamps:
-            hour = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:00')
-            hourly_votes[hour] += 1
-        
         print(f"\n每小时投票数 (前10个最活跃时段):")
-        sorted_hours = sorted(hourly_votes.items(), key=lambda x: x[1], reverse=True)
+        sorted_hours = sorted(rollup.hourly.items(), key=lambda x: x[1], reverse=True)
         for hour, count in sorted_hours[:10]:
             print(f"  {hour}: {count} 票")
     
@@ -128,6 +100,10 @@ def main():
     parser = argparse.ArgumentParser(description='FastChat 投票统计工具')
     parser.add_argument('--log-file', type=str, default='logs/chat.log', 
                        help='投票日志文件路径')
+    parser.add_argument('--log-files', type=str, nargs='+',
+                       help='按时间顺序的多个日志文件，通过每天的汇总文件累积分析')
+    parser.add_argument('--rollup-dir', type=str, default=None,
+                       help='汇总文件目录 (默认: 日志所在目录下的 rollups/)')
     parser.add_argument('--output', type=str, default='vote_analysis.csv',
                        help='输出CSV文件路径')
     parser.add_argument('--export', action='store_true',
@@ -135,15 +111,21 @@ def main():
     
     args = parser.parse_args()
     
-    # 检查日志文件是否存在
-    if not os.path.exists(args.log_file):
-        print(f"错误: 找不到日志文件 {args.log_file}")
-        print("请确保FastChat正在运行并生成日志文件")
-        return
-    
-    print(f"正在分析投票数据: {args.log_file}")
-    votes = load_vote_data(args.log_file)
-    model_performance = analyze_votes(votes)
+    if args.log_files:
+        # 累积分析：历史日志只读取汇总，当天日志只扫描新增部分
+        print(f"正在分析 {len(args.log_files)} 个日志文件的投票数据")
+        rollup = load_rollups(args.log_files, args.rollup_dir)
+    else:
+        # 检查日志文件是否存在
+        if not os.path.exists(args.log_file):
+            print(f"错误: 找不到日志文件 {args.log_file}")
+            print("请确保FastChat正在运行并生成日志文件")
+            return
+        
+        print(f"正在分析投票数据: {args.log_file}")
+        rollup = DailyRollup()
+        rollup.fold(load_vote_data(args.log_file))
+    model_performance = analyze_rollup(rollup)
     
     if args.export and model_performance:
         # 创建 static/reports 目录
@@ -155,7 +137,7 @@ def main():
         export_to_csv(model_performance, output_path)
         
         # 生成投票类型分布数据
-        vote_types = Counter(vote['type'] for vote in votes)
+        vote_types = rollup.vote_counts
         vote_distribution = {
             'leftvote': vote_types.get('leftvote', 0),
             'rightvote': vote_types.get('rightvote', 0),